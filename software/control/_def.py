@@ -1,4 +1,5 @@
 import os
+import sys
 import glob
 import numpy as np
 from pathlib import Path
@@ -108,6 +109,68 @@ class CAMERA:
 class VOLUMETRIC_IMAGING:
     NUM_PLANES_PER_VOLUME = 20
 
+class SPECTRUM_ROI:
+    FAST_MODE_MARGIN_PIXELS = 16 # rows kept above and below the spectrum band when the sensor ROI is reduced to it
+    FAST_MODE_FRAMERATE = None # frame rate requested in fast spectrum mode, None keeps the camera's
+    # curvature (smile) of the band, fitted from a reference frame, see fit_curved_band() in control/spectrum.py
+    CURVATURE_DEGREE = 2 # of the polynomial of the center row along the columns
+    WIDTH_DEGREE = 1 # of the polynomial of the band width along the columns
+    CURVATURE_COLUMN_STEP = 8 # every this many columns are fitted
+    CURVATURE_WIDTH_FWHM_FACTOR = 2.0 # extraction width in units of the FWHM of the band
+    CURVATURE_MIN_SIGNAL = 20 # columns whose peak is less than this above the background are not fitted
+    BACKGROUND_GAP_PIXELS = 3 # between the fitted band and its background bands
+    BACKGROUND_WIDTH_PIXELS = 0 # of the background band on either side of the fitted band, 0: no background subtraction
+    CURVED_BAND_FILE = str(Path.home()) + '/spectrometer_curved_band.json' # the fitted band, as a track for Load Tracks
+    # straight band of Auto ROI, see detect_band() in control/spectrum.py
+    AUTO_ROI_COLUMN_BIN = 16 # columns summed into one point of the centerline
+    AUTO_ROI_MIN_SIGNAL = 20 # binned columns whose peak is less than this above the background are not fitted
+    AUTO_ROI_WIDTH_FWHM_FACTOR = 2.0 # extraction width in units of the FWHM of the band
+    AUTO_ROI_FOLLOW_INTERVAL_MS = 500 # of the re-detection when the ROI follows the band
+    AUTO_ROI_FOLLOW_TOLERANCE_PIXELS = 1 # drift of the band that moves the ROI
+
+class SPECTRUM_DATACUBE:
+    ENABLED = True # multipoint scans assemble the spectrum of every FOV into datacube_<configuration>.npy in the folder of the time point
+    TRACK = 0 # of the SpectrumExtractor whose spectrum goes into the datacube
+    BANDS = None # (start, end) ranges in units of the spectrum axis shown as red, green and blue; None: the thirds of the axis
+    FLUSH_INTERVAL_FOVS = 10 # the datacube file is written every this many FOVs
+
+class SPECTRUM_RECORDING:
+    CAPACITY_SPECTRA = 100000 # preallocated in the recording file (4 bytes per point of each spectrum), recording stops when full
+    INDEX_FLUSH_INTERVAL_SPECTRA = 1000 # the number of recorded spectra is written every this many spectra
+    QUEUE_SIZE_FRAMES = 10 # frames waiting for extraction; frames arriving while it is full are dropped and counted
+
+class SPECTRUM_WAVELENGTH:
+    REFERENCE_LINES_NM = [404.66,435.83,546.07,576.96,579.07,696.54,706.72,738.40,750.39,763.51,811.53] # of the reference lamp (Hg-Ar)
+    DISPERSION_DEGREE = 2 # of the polynomial of the wavelength along the columns
+    PEAK_MIN_PROMINENCE = 20 # of the peaks of the lamp spectrum
+    MATCH_TOLERANCE_NM = 3 # peaks are matched to the lines within this, through the previous calibration
+    AXIS = 'pixel' # of the spectra: 'pixel', 'nm', 'nm resampled' or 'wavenumber resampled' (uniform grids)
+    GRID_POINTS = None # of the resampled spectra, None: the number of columns
+    CALIBRATION_FILE = str(Path.home()) + '/spectrometer_wavelength_calibration.json'
+
+class SPECTRUM_PEAKS:
+    SMOOTHING_WINDOW = 11 # of the Savitzky-Golay filter, in points of the spectrum; 1: no smoothing
+    SMOOTHING_ORDER = 2
+    MIN_PROMINENCE = 20
+    MAX_PEAKS = 5 # peaks tracked at once
+    MAX_SHIFT = 5 # largest move of a peak from one spectrum to the next, in units of the spectrum axis
+    MAX_MISSED_SPECTRA = 10 # a peak not found in this many spectra in a row is no longer tracked
+    HISTORY_SPECTRA = 10000 # spectra kept in the time series
+
+class SPECTRUM_ACCUMULATION:
+    MODE = 'frames' # what multipoint saves for the Ns spectrum frames of a FOV: 'frames' (Ns images), 'spectrum' or 'band' (mean and std, see control/spectrum.py)
+    KEEP_RAW_FRAMES = False # also save the Ns images when accumulating
+
+class SPECTRUM_CORRECTION:
+    N_CALIBRATION_FRAMES = 32 # frames averaged into a master dark or flat
+    OUTPUT_DTYPE = 'float32' # of the corrected frames: 'float32' or 'uint16'
+    FLAT_MIN_FRACTION = 0.05 # pixels of the flat below this fraction of its maximum are not flat corrected
+    CACHE_DIRECTORY = str(Path.home()) + '/spectrometer_calibration' # master frames by camera SN, exposure time, gain, pixel format and ROI
+
+class INSTRUMENTATION:
+    ENABLED = False # can be toggled at runtime, see control/instrumentation.py
+    EVENTS_PER_THREAD = 65536 # size of the ring buffer of timing events of each thread
+
 class CMD_EXECUTION_STATUS:
     COMPLETED_WITHOUT_ERRORS = 0
     IN_PROGRESS = 1
@@ -221,6 +284,10 @@ class PLATE_READER:
     OFFSET_COLUMN_1_MM = 20
     OFFSET_ROW_A_MM = 20
 
+# well plate geometries used by the plate scheduler; A1 is given relative to A1 of the 96 well plate (PLATE_READER.OFFSET_COLUMN_1_MM, PLATE_READER.OFFSET_ROW_A_MM)
+WELLPLATE_FORMATS = {'96':{'rows':8, 'columns':12, 'well_spacing_mm':9, 'A1_offset_relative_to_96_mm':0, 'well_size_mm':6.4},
+                     '384':{'rows':16, 'columns':24, 'well_spacing_mm':4.5, 'A1_offset_relative_to_96_mm':-2.25, 'well_size_mm':3.3}}
+
 DEFAULT_DISPLAY_CROP = 50 # value ranges from 1 to 100 - image display crop size 
 
 CAMERA_PIXEL_SIZE_UM = {'IMX290':2.9,'IMX178':2.4,'IMX226':1.85,'IMX250':3.45,'IMX252':3.45,'IMX273':3.45,'IMX264':3.45,'IMX265':3.45,'IMX571':3.76,'PYTHON300':4.8}
@@ -259,6 +326,8 @@ SHOW_DAC_CONTROL = False
 
 DAC_SETTLING_TIME_S = 0.05
 
+CONFIGURATION_SAVE_DELAY_S = 0.5 # configuration changes (e.g. from dragging a slider) are written to the xml file once they stop for this long
+
 class SLIDE_POSITION:
     LOADING_X_MM = 30
     LOADING_Y_MM = 55
@@ -283,16 +352,37 @@ MULTIPOINT_BF_SAVING_OPTION = 'Raw'
 ##########################################################
 #### start of loading machine specific configurations ####
 ##########################################################
-config_files = glob.glob('.' + '/' + 'configuration*.txt')
-if config_files:
-    if len(config_files) > 1:
-        print('multiple machine configuration files found, the program will exit')
-        exit()
-    print('load machine-specific configuration')
-    exec(open(config_files[0]).read())
+# configuration*.toml / .json / .yaml (typed, see control/machine_configuration.py) are used before configuration*.txt
+import control.machine_configuration as _machine_configuration
+_config_files = sorted(f for extension in ('toml','json','yaml','yml') for f in glob.glob('.' + '/' + 'configuration*.' + extension))
+if _config_files:
+    if len(_config_files) > 1:
+        print('multiple machine configuration files found (' + ', '.join(_config_files) + '), the program will exit')
+        sys.exit(1)
+    print('load machine-specific configuration ' + _config_files[0])
+    try:
+        MACHINE_CONFIGURATION = _machine_configuration.load(_config_files[0],_machine_configuration.get_settings(globals()))
+    except _machine_configuration.MachineConfigurationError as e:
+        print('invalid machine configuration ' + str(e))
+        sys.exit(1)
+    _machine_configuration.apply(MACHINE_CONFIGURATION,globals())
+    print('machine-specific configuration loaded')
 else:
-    print('machine-specifc configuration not present, the program will exit')
-    exit()
+    _config_files = glob.glob('.' + '/' + 'configuration*.txt')
+    if _config_files:
+        if len(_config_files) > 1:
+            print('multiple machine configuration files found, the program will exit')
+            sys.exit(1)
+        print('load machine-specific configuration')
+        exec(open(_config_files[0]).read())
+        _errors = _machine_configuration.validate(globals())
+        if _errors:
+            print('invalid machine configuration ' + _config_files[0] + ':\n' + '\n'.join('  ' + error for error in _errors))
+            sys.exit(1)
+        MACHINE_CONFIGURATION = _machine_configuration.from_namespace(globals())
+    else:
+        print('machine-specifc configuration not present, the program will exit')
+        sys.exit(1)
 ##########################################################
 ##### end of loading machine specific configurations #####
 ##########################################################
\ No newline at end of file
@@ -1,6 +1,7 @@
 import argparse
 import cv2
 import time
+import re
 import numpy as np
 try:
     import control.gxipy as gx
@@ -8,8 +9,21 @@ except:
     print('gxipy import error')
 
 from control._def import *
+from control.camera_base import CameraBase
+from control.camera_simulation import SimulatedCamera
 
-class Camera(object):
+# opencv names bayer patterns after the second row, e.g. an RGGB sensor is COLOR_BayerBG2RGB
+BAYER_TO_RGB = {'GR':cv2.COLOR_BayerGB2RGB, 'RG':cv2.COLOR_BayerBG2RGB, 'GB':cv2.COLOR_BayerGR2RGB, 'BG':cv2.COLOR_BayerRG2RGB}
+
+# upper limit of the memory used by preallocated frame buffers
+FRAME_BUFFER_POOL_SIZE_MB = 256
+
+try:
+    _PIXEL_FORMAT_NAMES = dict((getattr(gx.GxPixelFormatEntry,name),name) for name in dir(gx.GxPixelFormatEntry) if not name.startswith('__'))
+except:
+    _PIXEL_FORMAT_NAMES = {}
+
+class Camera(CameraBase):
 
     def __init__(self,sn=None,rotate_image_angle=None,flip_image=None):
 
@@ -29,6 +43,7 @@ class Camera(object):
 
         self.exposure_time = 0
         self.analog_gain = 0
+        self.pixel_format = None
         self.frame_ID = -1
         self.frame_ID_software = -1
         self.frame_ID_offset_hardware_trigger = 0
@@ -56,6 +71,16 @@ class Camera(object):
         self.rotate_image_angle = rotate_image_angle
         self.flip_image = flip_image
 
+        # preallocated buffers - current_frame comes from a ring of buffers and is overwritten after num_frame_buffers further
+        # frames (copy it to keep it); read_frame() returns an array of the caller, see CameraBase
+        self.num_frame_buffers = 4
+        self._raw_buffers = None
+        self._raw_buffer_index = 0
+        self._frame_buffers = None
+        self._frame_buffers_key = None
+        self._frame_buffer_index = 0
+        self._rgb16_buffer = None
+
     def open(self,index=0):
         (device_num, self.device_info_list) = self.device_manager.update_device_list()
         if device_num == 0:
@@ -83,7 +108,8 @@ class Camera(object):
 
     def enable_callback(self):
         user_param = None
-        self.camera.register_capture_callback(user_param,self._on_frame_callback)
+        # the callback gets a view of the driver buffer and converts/copies it into a preallocated buffer
+        self.camera.register_capture_callback(user_param,self._on_frame_callback,copy=False)
         self.callback_is_enabled = True
 
     def disable_callback(self):
@@ -156,6 +182,10 @@ class Camera(object):
     def start_streaming(self):
         self.camera.stream_on()
         self.is_streaming = True
+        # the payload size is known once streaming is on
+        payload_size = self.camera.data_stream[self.device_index].payload_size
+        if self._raw_buffers is None or self._raw_buffers[0].nbytes != payload_size:
+            self._raw_buffers = [np.empty(payload_size,dtype=np.uint8) for i in range(self._get_num_frame_buffers(payload_size))]
 
     def stop_streaming(self):
         self.camera.stream_off()
@@ -181,6 +211,7 @@ class Camera(object):
                 self.camera.PixelFormat.set(gx.GxPixelFormatEntry.BAYER_RG8)
             if format == 'BAYER_RG12':
                 self.camera.PixelFormat.set(gx.GxPixelFormatEntry.BAYER_RG12)
+            self.pixel_format = format
         else:
             print("pixel format is not implemented or not writable")
 
@@ -206,16 +237,69 @@ class Camera(object):
         else:
         	print('trigger not sent - camera is not streaming')
 
-    def read_frame(self):
-        raw_image = self.camera.data_stream[self.device_index].get_image()
+    def read_frame(self,out=None):
+        # the image is acquired directly into a preallocated buffer and converted into out, or into a new array
+        if self._raw_buffers is None:
+            raw_image = self.camera.data_stream[self.device_index].get_image()
+        else:
+            self._raw_buffer_index = (self._raw_buffer_index + 1) % len(self._raw_buffers)
+            raw_image = self.camera.data_stream[self.device_index].get_image(buffer=self._raw_buffers[self._raw_buffer_index])
+        if raw_image is None:
+            return None
         if self.is_color:
-            rgb_image = raw_image.convert("RGB")
-            numpy_image = rgb_image.get_numpy_array()
+            if out is None:
+                raw = raw_image.get_numpy_array()
+                out = np.empty((raw.shape[0],raw.shape[1],3),dtype=np.uint8)
+            numpy_image = self._convert(raw_image,out)
+        elif out is not None:
+            np.copyto(out,raw_image.get_numpy_array())
+            numpy_image = out
         else:
-            numpy_image = raw_image.get_numpy_array()
+            # the raw buffer is reused by the next read
+            numpy_image = np.copy(raw_image.get_numpy_array())
         # self.current_frame = numpy_image
         return numpy_image
 
+    def _get_num_frame_buffers(self,frame_size_bytes):
+        return int(max(2,min(self.num_frame_buffers,FRAME_BUFFER_POOL_SIZE_MB*1024*1024//max(frame_size_bytes,1))))
+
+    def _get_frame_buffer(self,height,width,pixel_format):
+        # next buffer of the ring, (re)allocated only when the frame size or pixel format changes
+        key = (height,width,pixel_format)
+        if self._frame_buffers_key != key:
+            is_16bit = (pixel_format & gx.PIXEL_BIT_MASK) == gx.GX_PIXEL_16BIT
+            shape = (height,width,3) if self.is_color else (height,width)
+            dtype = np.uint8 if (self.is_color or is_16bit == False) else np.uint16
+            n = self._get_num_frame_buffers(int(np.prod(shape))*np.dtype(dtype).itemsize)
+            self._frame_buffers = [np.empty(shape,dtype=dtype) for i in range(n)]
+            self._frame_buffers_key = key
+        self._frame_buffer_index = (self._frame_buffer_index + 1) % len(self._frame_buffers)
+        return self._frame_buffers[self._frame_buffer_index]
+
+    def _convert(self,raw_image,out=None):
+        # bayer to rgb into a reusable buffer - replaces raw_image.convert("RGB"), which allocates new images
+        raw = raw_image.get_numpy_array()
+        if raw is None:
+            return None
+        pixel_format = raw_image.get_pixel_format()
+        if out is None:
+            out = self._get_frame_buffer(raw.shape[0],raw.shape[1],pixel_format)
+        pattern = re.search(r'BAYER_(GR|RG|GB|BG)',_PIXEL_FORMAT_NAMES.get(pixel_format,''))
+        if pattern is None:
+            print('pixel format ' + hex(pixel_format) + ' is not a bayer format')
+            return None
+        if raw.dtype == np.uint8:
+            cv2.cvtColor(raw,BAYER_TO_RGB[pattern.group(1)],dst=out)
+        else:
+            # 10/12 bit: convert at full depth, then keep the 8 most significant valid bits (as convert() does)
+            # the intermediate is kept apart from the output ring, read_frame() converts into the caller's array
+            if self._rgb16_buffer is None or self._rgb16_buffer.shape != out.shape:
+                self._rgb16_buffer = np.empty(out.shape,dtype=np.uint16)
+            cv2.cvtColor(raw,BAYER_TO_RGB[pattern.group(1)],dst=self._rgb16_buffer)
+            valid_bits = int(re.search(r'(\d+)$',_PIXEL_FORMAT_NAMES[pixel_format]).group(1))
+            np.right_shift(self._rgb16_buffer,valid_bits-8,out=out,casting='unsafe')
+        return out
+
     def _on_frame_callback(self, user_param, raw_image):
         if raw_image is None:
             print("Getting image failed.")
@@ -226,11 +310,15 @@ class Camera(object):
         if self.image_locked:
             print('last image is still being processed, a frame is dropped')
             return
+        # raw_image wraps the driver buffer, which is only valid during this callback
         if self.is_color:
-            rgb_image = raw_image.convert("RGB")
-            numpy_image = rgb_image.get_numpy_array()
+            numpy_image = self._convert(raw_image)
         else:
-            numpy_image = raw_image.get_numpy_array()
+            raw = raw_image.get_numpy_array()
+            if raw is None:
+                return
+            numpy_image = self._get_frame_buffer(raw.shape[0],raw.shape[1],raw_image.get_pixel_format())
+            np.copyto(numpy_image,raw)
         if numpy_image is None:
             return
         self.current_frame = numpy_image
@@ -335,117 +423,16 @@ class Camera(object):
         self.camera.LineMode.set(gx.GxLineModeEntry.OUTPUT)
         self.camera.LineSource.set(gx.GxLineSourceEntry.EXPOSURE_ACTIVE)
 
-class Camera_Simulation(object):
-    
-    def __init__(self,sn=None,rotate_image_angle=None,flip_image=None):
-        # many to be purged
-        self.sn = sn
-        self.device_info_list = None
-        self.device_index = 0
-        self.camera = None
-        self.is_color = None
-        self.gamma_lut = None
-        self.contrast_lut = None
-        self.color_correction_param = None
+class Camera_Simulation(SimulatedCamera):
+    # Daheng-like preset: 2000x2000 mono sensor looking at a (synthetic) brightfield mosaic
 
+    def __init__(self,sn=None,rotate_image_angle=None,flip_image=None,scene=None):
+        SimulatedCamera.__init__(self,sn=sn,width=2000,height=2000,scene=scene,max_fps=30,bit_depth=8,gain_dB_per_unit=1)
         self.rotate_image_angle = rotate_image_angle
         self.flip_image = flip_image
 
-        self.exposure_time = 0
-        self.analog_gain = 0
-        self.frame_ID = 0
-        self.frame_ID_software = -1
-        self.frame_ID_offset_hardware_trigger = 0
-        self.timestamp = 0
-
-        self.image_locked = False
-        self.current_frame = None
-
-        self.callback_is_enabled = False
-        self.callback_was_enabled_before_autofocus = False
-        self.callback_was_enabled_before_multipoint = False
-
         self.GAIN_MAX = 24
         self.GAIN_MIN = 0
         self.GAIN_STEP = 1
         self.EXPOSURE_TIME_MS_MIN = 0.01
         self.EXPOSURE_TIME_MS_MAX = 4000
-
-    def open(self,index=0):
-        pass
-
-    def set_callback(self,function):
-        self.new_image_callback_external = function
-
-    def enable_callback(self):
-        self.callback_is_enabled = True
-
-    def disable_callback(self):
-        self.callback_is_enabled = False
-
-    def open_by_sn(self,sn):
-        pass
-
-    def close(self):
-        pass
-
-    def set_exposure_time(self,exposure_time):
-        pass
-
-    def set_analog_gain(self,analog_gain):
-        pass
-
-    def get_awb_ratios(self):
-        pass
-
-    def set_wb_ratios(self, wb_r=None, wb_g=None, wb_b=None):
-        pass
-
-    def start_streaming(self):
-        self.frame_ID_software = 0
-
-    def stop_streaming(self):
-        pass
-
-    def set_pixel_format(self,format):
-        print(format)
-
-    def set_continuous_acquisition(self):
-        pass
-
-    def set_software_triggered_acquisition(self):
-        pass
-
-    def set_hardware_triggered_acquisition(self):
-        pass
-
-    def send_trigger(self):
-        self.frame_ID = self.frame_ID + 1
-        self.timestamp = time.time()
-        if self.frame_ID == 1:
-            self.current_frame = np.random.randint(255,size=(2000,2000),dtype=np.uint8)
-            self.current_frame[901:1100,901:1100] = 200
-        else:
-            self.current_frame = np.roll(self.current_frame,10,axis=0)
-            pass 
-            # self.current_frame = np.random.randint(255,size=(768,1024),dtype=np.uint8)
-        if self.new_image_callback_external is not None and self.callback_is_enabled:
-            self.new_image_callback_external(self)
-
-    def read_frame(self):
-        return self.current_frame
-
-    def _on_frame_callback(self, user_param, raw_image):
-        pass
-
-    def set_ROI(self,offset_x=None,offset_y=None,width=None,height=None):
-        pass
-
-    def reset_camera_acquisition_counter(self):
-        pass
-
-    def set_line3_to_strobe(self):
-        pass
-
-    def set_line3_to_exposure_active(self):
-        pass
\ No newline at end of file
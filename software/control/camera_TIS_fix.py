@@ -3,10 +3,14 @@ from collections import namedtuple
 from time import sleep
 import sys
 import time #@@@
+import threading
 import numpy as np
 from scipy import misc
 import cv2
 
+from control.camera_base import CameraBase
+from control.camera_simulation import SimulatedCamera, SpectrumScene
+
 try:
     import gi
     gi.require_version("Gst", "1.0")
@@ -18,10 +22,16 @@ except ImportError:
 DeviceInfo = namedtuple("DeviceInfo", "status name identifier connection_type")
 CameraProperty = namedtuple("CameraProperty", "status value min max default step type flags category group")
 
-class Camera(object):
+# upper bound for the memory held by the ring of frame buffers
+FRAME_BUFFER_POOL_SIZE_MB = 256
+
+class Camera(CameraBase):
 
-    def __init__(self,sn=None,width=1920,height=1080,framerate=30,color=False):
+    def __init__(self,sn=None,width=1920,height=1080,framerate=30,color=False,rotate_image_angle=None,flip_image=None):
         Gst.init(sys.argv)
+        self.rotate_image_angle = rotate_image_angle
+        self.flip_image = flip_image
+        self.sn = sn
         self.height = height
         self.width = width
         self.sample = None
@@ -33,6 +43,8 @@ class Camera(object):
         self.image_locked = False
         self.is_streaming = False
         self.is_color = color
+        self.exposure_time = 0
+        self.analog_gain = 0
 
         self.GAIN_MAX = 480
         self.GAIN_MIN = 0
@@ -44,22 +56,40 @@ class Camera(object):
         self.callback_was_enabled_before_autofocus = False
         self.callback_was_enabled_before_multipoint = False
 
+        # frames are copied once from the mapped gst buffer into a ring of preallocated buffers;
+        # a frame returned by read_frame() stays valid until num_frame_buffers further frames arrive
+        self.num_frame_buffers = 4
+        self._frame_buffers = None
+        self._frame_buffers_key = None
+        self._frame_buffer_index = 0
+        self._frame_lock = threading.Lock()
+        self._new_sample_handler_id = None
+        self.current_frame = None
+        self.reset_statistics()
+
         format = "BGRx"
         if(color == False):
             format="GRAY8"
-
-        if(framerate == 2500000):    
-            p = 'tcambin serial="%s" name=source ! video/x-raw,format=%s,width=%d,height=%d,framerate=%d/10593' % (sn,format,width,height,framerate,)
-        else:
-            p = 'tcambin serial="%s" name=source ! video/x-raw,format=%s,width=%d,height=%d,framerate=%d/1' % (sn,format,width,height,framerate,)
-
+        self.format = format
+        self.pixel_format = format
+        self.framerate = framerate
+
+        # sensor ROI, see set_ROI()
+        self.sensor_width = width
+        self.sensor_height = height
+        self.ROI_offset_x = 0
+        self.ROI_offset_y = 0
+        self.ROI_width = width
+        self.ROI_height = height
+
+        p = 'tcambin serial="%s" name=source ! capsfilter name=caps caps=%s' % (sn,self._get_caps_string())
         p += ' ! videoconvert ! appsink name=sink'
 
         print(p)
         try:
             self.pipeline = Gst.parse_launch(p)
         except GLib.Error as error:
-            print("Error creating pipeline: {0}".format(err))
+            print("Error creating pipeline: {0}".format(error))
             raise
 
         self.pipeline.set_state(Gst.State.READY)
@@ -67,6 +97,8 @@ class Camera(object):
         # Query a pointer to our source, so we can set properties.
         self.source = self.pipeline.get_by_name("source")
 
+        self.capsfilter = self.pipeline.get_by_name("caps")
+
         # Query a pointer to the appsink, so we can assign the callback function.
         self.appsink = self.pipeline.get_by_name("sink")
         self.appsink.set_property("max-buffers",5)
@@ -80,7 +112,9 @@ class Camera(object):
         self.new_image_callback_external = function
 
     def enable_callback(self):
-        self.appsink.connect('new-sample', self._on_new_buffer)
+        # connect once; callback_is_enabled is left to the caller as before (the multipoint restart logic relies on it)
+        if self._new_sample_handler_id is None:
+            self._new_sample_handler_id = self.appsink.connect('new-sample', self._on_new_buffer)
 
     def disable_callback(self):
         pass
@@ -92,10 +126,12 @@ class Camera(object):
         self.stop_streaming()
 
     def set_exposure_time(self,exposure_time):
+        self.exposure_time = exposure_time
         self._set_property('Exposure Auto',False)
         self._set_property('Exposure Time (us)',int(exposure_time*1000))
 
     def set_analog_gain(self,analog_gain):
+        self.analog_gain = analog_gain
         self._set_property('Gain Auto',False)
         self._set_property('Gain',int(analog_gain))
 
@@ -111,9 +147,10 @@ class Camera(object):
             self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
             self.is_streaming = True
         except GLib.Error as error:
-            print("Error starting pipeline: {0}".format(err))#error?
+            print("Error starting pipeline: {0}".format(error))
             raise
         self.frame_ID = 0
+        self.reset_statistics()
 
     def stop_streaming(self):
         self.pipeline.set_state(Gst.State.NULL)
@@ -141,40 +178,80 @@ class Camera(object):
         # self._set_property('Software Trigger',1)
 
     def read_frame(self):
-        return self.current_frame
+        # the ring slot is reused after num_frame_buffers frames, the caller gets its own copy
+        with self._frame_lock:
+            return None if self.current_frame is None else self.current_frame.copy()
+
+    def get_statistics(self):
+        statistics = dict(self._statistics)
+        elapsed = time.time() - statistics.pop('t_start')
+        statistics['fps'] = statistics['frames_received']/elapsed if elapsed > 0 else 0
+        n = max(statistics['frames_received'] - statistics['frames_dropped'],1)
+        statistics['latency_ms_mean'] = statistics.pop('latency_ms_sum')/n
+        statistics['processing_time_ms_mean'] = statistics.pop('processing_time_ms_sum')/n
+        statistics['max_buffers'] = self.appsink.get_property('max-buffers')
+        return statistics
+
+    def reset_statistics(self):
+        self._statistics = {'t_start':time.time(),'frames_received':0,'frames_dropped':0,'frames_dropped_upstream':0,
+                            'latency_ms':0,'latency_ms_max':0,'latency_ms_sum':0,'processing_time_ms_sum':0}
+        self._last_buffer_offset = None
+
+    def _get_frame_buffer(self,shape):
+        if self._frame_buffers_key != shape:
+            frame_size_bytes = int(numpy.prod(shape))
+            n = int(max(2,min(self.num_frame_buffers,FRAME_BUFFER_POOL_SIZE_MB*1024*1024//max(frame_size_bytes,1))))
+            self._frame_buffers = [numpy.empty(shape,dtype=numpy.uint8) for i in range(n)]
+            self._frame_buffer_index = 0
+            self._frame_buffers_key = shape
+        self._frame_buffer_index = (self._frame_buffer_index + 1) % len(self._frame_buffers)
+        return self._frame_buffers[self._frame_buffer_index]
+
+    def _pull_sample(self):
+        # one new-sample signal per sample: every sample that reaches the appsink is pulled and counted
+        sample = self.appsink.emit('pull-sample')
+        if sample is not None:
+            self._statistics['frames_received'] = self._statistics['frames_received'] + 1
+        return sample
 
     def _on_new_buffer(self, appsink):
-        # Function that is called when a new sample from camera is available
+        # called from the gstreamer streaming thread when a new sample is available
+        t0 = time.time()
         self.newsample = True
-        # print('new buffer received: ' + str(time.time())) #@@@
+        sample = self._pull_sample()
+        if sample is None:
+            return Gst.FlowReturn.OK
+        # a frame still being processed costs this frame only, it is counted in frames_dropped and reported by get_statistics()
         if self.image_locked:
-            print('last image is still being processed, a frame is dropped')
-            return
-        if self.samplelocked is False:
-            self.samplelocked = True
-            try:
-                self.sample = self.appsink.get_property('last-sample')
-                self._gstbuffer_to_opencv()
-                # print('new buffer read into RAM: ' + str(time.time())) #@@@
-                self.samplelocked = False
-                self.newsample = False
-                # gotimage reflects if a new image was triggered
-                self.gotimage = True
-                self.frame_ID = self.frame_ID + 1 # @@@ read frame ID from the camera
-                self.timestamp = time.time()
-                if self.new_image_callback_external is not None:
-                    self.new_image_callback_external(self)
-            except GLib.Error as error:
-                print("Error on_new_buffer pipeline: {0}".format(err)) #error
-                self.img_mat = None
+            self._statistics['frames_dropped'] = self._statistics['frames_dropped'] + 1
+            return Gst.FlowReturn.OK
+        # the frame is written into the next ring slot, which is not current_frame: read_frame() may be copying current_frame meanwhile,
+        # and the slot it copies cannot come round again before the swap below, which waits for the copy to finish
+        try:
+            frame = self._gstbuffer_to_opencv(sample)
+        except GLib.Error as error:
+            print("Error on_new_buffer pipeline: {0}".format(error))
+            return Gst.FlowReturn.OK
+        if frame is None:
+            return Gst.FlowReturn.OK
+        with self._frame_lock:
+            self.current_frame = frame
+        self.newsample = False
+        # gotimage reflects if a new image was triggered
+        self.gotimage = True
+        self.frame_ID = self.frame_ID + 1 # @@@ read frame ID from the camera
+        self.timestamp = time.time()
         self.image_received = True
+        if self.new_image_callback_external is not None:
+            self.new_image_callback_external(self)
+        self._statistics['processing_time_ms_sum'] = self._statistics['processing_time_ms_sum'] + (time.time()-t0)*1000
         return Gst.FlowReturn.OK
 
     def _get_property(self, PropertyName):
         try:
             return CameraProperty(*self.source.get_tcam_property(PropertyName))
         except GLib.Error as error:
-            print("Error get Property {0}: {1}",PropertyName, format(err))
+            print("Error get Property {0}: {1}".format(PropertyName,error))
             raise
 
     def _set_property(self, PropertyName, value):
@@ -182,129 +259,99 @@ class Camera(object):
             print('setting ' + PropertyName + 'to ' + str(value))
             self.source.set_tcam_property(PropertyName,GObject.Value(type(value),value))
         except GLib.Error as error:
-            print("Error set Property {0}: {1}",PropertyName, format(err))
+            print("Error set Property {0}: {1}".format(PropertyName,error))
             raise
 
-    def _gstbuffer_to_opencv(self):
-        # Sample code from https://gist.github.com/cbenhagen/76b24573fa63e7492fb6#file-gst-appsink-opencv-py-L34
-        buf = self.sample.get_buffer()
-        caps = self.sample.get_caps()
-        bpp = 4;
-        if caps.get_structure(0).get_value('format') == "BGRx":
-            bpp = 4;
-
-        if caps.get_structure(0).get_value('format') == "GRAY8":
-            bpp = 1;
-
-        self.current_frame = numpy.ndarray(
-            (caps.get_structure(0).get_value('height'),
-             caps.get_structure(0).get_value('width'),
-             bpp),
-            buffer=buf.extract_dup(0, buf.get_size()),
-            dtype=numpy.uint8)
-    
+    def _gstbuffer_to_opencv(self,sample):
+        buf = sample.get_buffer()
+        structure = sample.get_caps().get_structure(0)
+        bpp = 4
+        if structure.get_value('format') == "GRAY8":
+            bpp = 1
+        height = structure.get_value('height')
+        width = structure.get_value('width')
+
+        # frames lost before the appsink show up as gaps in the buffer offset (the frame count for tcam sources)
+        if buf.offset != Gst.BUFFER_OFFSET_NONE:
+            if self._last_buffer_offset is not None and buf.offset > self._last_buffer_offset + 1:
+                self._statistics['frames_dropped_upstream'] = self._statistics['frames_dropped_upstream'] + buf.offset - self._last_buffer_offset - 1
+            self._last_buffer_offset = buf.offset
+        # latency: pipeline running time now vs the capture time stamp of the buffer
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            clock = self.pipeline.get_clock()
+            if clock is not None:
+                latency_ms = (clock.get_time() - self.pipeline.get_base_time() - buf.pts)/1e6
+                self._statistics['latency_ms'] = latency_ms
+                self._statistics['latency_ms_max'] = max(self._statistics['latency_ms_max'],latency_ms)
+                self._statistics['latency_ms_sum'] = self._statistics['latency_ms_sum'] + latency_ms
+
+        success, map_info = buf.map(Gst.MapFlags.READ)
+        if not success:
+            print('failed to map the gst buffer')
+            return None
+        try:
+            # rows may be padded to a 4-byte stride by videoconvert
+            stride = map_info.size//height
+            view = numpy.frombuffer(map_info.data,dtype=numpy.uint8,count=stride*height).reshape(height,stride)
+            frame = self._get_frame_buffer((height,width,bpp))
+            numpy.copyto(frame.reshape(height,width*bpp),view[:,:width*bpp])
+        finally:
+            buf.unmap(map_info)
+        return frame
+
     def set_pixel_format(self,format):
         pass
 
-class Camera_Simulation(object):
-
-    def __init__(self,sn=None,width=640,height=480,framerate=30,color=False):
-        self.height = height
-        self.width = width
-        self.sample = None
-        self.samplelocked = False
-        self.newsample = False
-        self.gotimage = False
-        self.img_mat = None
-        self.new_image_callback_external = None
-        self.image_locked = False
-        self.is_streaming = False
+    def _get_caps_string(self):
+        if(self.framerate == 2500000):
+            return 'video/x-raw,format=%s,width=%d,height=%d,framerate=%d/10593' % (self.format,self.ROI_width,self.ROI_height,self.framerate)
+        return 'video/x-raw,format=%s,width=%d,height=%d,framerate=%d/1' % (self.format,self.ROI_width,self.ROI_height,self.framerate)
+
+    def set_ROI(self,offset_x=None,offset_y=None,width=None,height=None,framerate=None):
+        # the frame size is set through the caps, the position on the sensor through the offset properties;
+        # both can only change while the pipeline is stopped. The sensors take sizes in steps of 4 (width: 16) pixels
+        if offset_x is not None:
+            self.ROI_offset_x = int(offset_x)//4*4
+        if offset_y is not None:
+            self.ROI_offset_y = int(offset_y)//4*4
+        if width is not None:
+            self.ROI_width = max(16,int(width)//16*16)
+        if height is not None:
+            self.ROI_height = max(4,int(height)//4*4)
+        if framerate is not None:
+            self.framerate = framerate
+        self.ROI_width = min(self.ROI_width,self.sensor_width - self.ROI_offset_x)
+        self.ROI_height = min(self.ROI_height,self.sensor_height - self.ROI_offset_y)
+        was_streaming = self.is_streaming
+        if was_streaming:
+            self.stop_streaming()
+        self.capsfilter.set_property('caps',Gst.Caps.from_string(self._get_caps_string()))
+        try:
+            # the device is only open from READY on, in NULL the offset properties may not be writable
+            self.pipeline.set_state(Gst.State.READY)
+            self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
+            try:
+                self._set_property('Offset Auto Center',False)
+            except GLib.Error:
+                pass # not every model has it, the offsets below still apply
+            self._set_property('Offset X',self.ROI_offset_x)
+            self._set_property('Offset Y',self.ROI_offset_y)
+        finally:
+            if was_streaming:
+                self.start_streaming()
+
+class Camera_Simulation(SimulatedCamera):
+    # spectrometer preset: 1920x1080 GRAY8 sensor imaging tilted line spectra
+
+    def __init__(self,sn=None,width=1920,height=1080,framerate=30,color=False,scene=None,rotate_image_angle=None,flip_image=None):
+        SimulatedCamera.__init__(self,sn=sn,width=width,height=height,scene=scene if scene is not None else SpectrumScene(),
+                                 max_fps=framerate,bit_depth=8,gain_dB_per_unit=0.1)
         self.is_color = color
+        self.rotate_image_angle = rotate_image_angle
+        self.flip_image = flip_image
 
         self.GAIN_MAX = 480
         self.GAIN_MIN = 0
         self.GAIN_STEP = 10
         self.EXPOSURE_TIME_MS_MIN = 0.02
         self.EXPOSURE_TIME_MS_MAX = 4000
-
-        self.callback_is_enabled = False
-        self.callback_was_enabled_before_autofocus = False
-        self.callback_was_enabled_before_multipoint = False
-
-    def open(self,index=0):
-        pass
-
-    def set_callback(self,function):
-        self.new_image_callback_external = function
-
-    def enable_callback(self):
-        pass
-
-    def disable_callback(self):
-        pass
-
-    def open_by_sn(self,sn):
-        pass
-
-    def close(self):
-        pass
-
-    def set_exposure_time(self,exposure_time):
-        pass
-
-    def set_analog_gain(self,analog_gain):
-        pass
-
-    def get_awb_ratios(self):
-        pass
-
-    def set_wb_ratios(self, wb_r=None, wb_g=None, wb_b=None):
-        pass
-
-    def start_streaming(self):
-        print('start_streaming')
-        self.frame_ID = 0
-
-    def stop_streaming(self):
-        pass
-
-    def set_continuous_acquisition(self):
-        pass
-
-    def set_software_triggered_acquisition(self):
-        pass
-
-    def set_hardware_triggered_acquisition(self):
-        pass
-
-    def send_trigger(self):
-        self.image_received = False
-        self.frame_ID = self.frame_ID + 1
-        self.timestamp = time.time()
-        if self.frame_ID == 1:
-            self.current_frame = np.random.randint(255,size=(1080,1920),dtype=np.uint8)
-            self.current_frame[501:580,951:970] = 200
-        else:
-            self.current_frame = np.roll(self.current_frame,10,axis=0)
-            # self.current_frame = np.random.randint(255,size=(768,1024),dtype=np.uint8)
-        self.image_received = True
-        if self.new_image_callback_external is not None:
-            self.new_image_callback_external(self)
-
-    def read_frame(self):
-        return self.current_frame
-
-    def _on_new_buffer(self, appsink):
-        pass
-
-    def _get_property(self, PropertyName):
-        pass
-
-    def _set_property(self, PropertyName, value):
-        pass
-
-    def _gstbuffer_to_opencv(self):
-        pass
-
-    def set_pixel_format(self,format):
-        pass
@@ -0,0 +1,84 @@
+class CameraBase(object):
+    # the interface the controllers in core*.py expect from a camera
+    # attributes the controllers read: current_frame, frame_ID, frame_ID_software, frame_ID_offset_hardware_trigger,
+    # timestamp, is_color, image_locked, callback_is_enabled, callback_was_enabled_before_autofocus,
+    # callback_was_enabled_before_multipoint, GAIN_MIN/MAX/STEP, EXPOSURE_TIME_MS_MIN/MAX
+    # features a camera does not have are no-ops, as in the existing drivers
+    # buffer lifetime: read_frame() returns an array that belongs to the caller. current_frame, set before the callback, may be a
+    # buffer of a ring the camera reuses (num_frame_buffers frames later): it can be read during the callback, but has to be
+    # copied before it is kept, queued or emitted through a queued signal
+
+    def open(self,index=0):
+        pass
+
+    def open_by_sn(self,sn):
+        pass
+
+    def close(self):
+        pass
+
+    def set_callback(self,function):
+        self.new_image_callback_external = function
+
+    def enable_callback(self):
+        self.callback_is_enabled = True
+
+    def disable_callback(self):
+        self.callback_is_enabled = False
+
+    def set_exposure_time(self,exposure_time):
+        pass
+
+    def set_analog_gain(self,analog_gain):
+        pass
+
+    def get_awb_ratios(self):
+        pass
+
+    def set_wb_ratios(self, wb_r=None, wb_g=None, wb_b=None):
+        pass
+
+    def set_reverse_x(self,value):
+        pass
+
+    def set_reverse_y(self,value):
+        pass
+
+    def set_pixel_format(self,format):
+        pass
+
+    def start_streaming(self):
+        pass
+
+    def stop_streaming(self):
+        pass
+
+    def set_continuous_acquisition(self):
+        pass
+
+    def set_software_triggered_acquisition(self):
+        pass
+
+    def set_hardware_triggered_acquisition(self):
+        pass
+
+    def send_trigger(self):
+        pass
+
+    def read_frame(self):
+        return None if self.current_frame is None else self.current_frame.copy()
+
+    def set_ROI(self,offset_x=None,offset_y=None,width=None,height=None):
+        pass
+
+    def reset_camera_acquisition_counter(self):
+        pass
+
+    def set_line3_to_strobe(self):
+        pass
+
+    def set_line3_to_exposure_active(self):
+        pass
+
+    def get_statistics(self):
+        return {}
@@ -0,0 +1,381 @@
+import time
+import queue
+import threading
+import numpy as np
+import cv2
+
+from control._def import TriggerMode
+from control.camera_base import CameraBase
+
+def _defocus(image,sigma_px):
+    # gaussian approximation of the defocus point spread function
+    if sigma_px < 0.5:
+        return image
+    return cv2.GaussianBlur(image,(0,0),min(sigma_px,30))
+
+class SpectrumScene(object):
+    # tilted line spectra on a weak continuum, one gaussian track per fiber/slit
+    # lines: (x position as a fraction of the sensor width, amplitude, width in pixels)
+    # tracks: (y position as a fraction of the sensor height, sigma in pixels)
+
+    def __init__(self,lines=None,tracks=None,tilt_deg=0.5,continuum=0.05,focus_z_mm=0,defocus_px_per_um=0.2):
+        if lines is None:
+            lines = [(0.18,0.5,4),(0.31,1.0,3),(0.44,0.35,6),(0.58,0.8,3),(0.66,0.25,2),(0.81,0.6,5)]
+        if tracks is None:
+            tracks = [(0.5,6)]
+        self.lines = lines
+        self.tracks = tracks
+        self.tilt_deg = tilt_deg
+        self.continuum = continuum
+        self.focus_z_mm = focus_z_mm
+        self.defocus_px_per_um = defocus_px_per_um
+        self._cache_key = None
+        self._cache = None
+
+    def render(self,width,height,offset_x,offset_y,sensor_width,sensor_height,x_mm=0,y_mm=0,z_mm=0):
+        # the spectrum does not depend on the stage position, only the defocus does
+        sigma_blur = round(abs(z_mm - self.focus_z_mm)*1000*self.defocus_px_per_um,1)
+        key = (width,height,offset_x,offset_y,sensor_width,sensor_height,sigma_blur)
+        if key == self._cache_key:
+            return self._cache
+        x = np.arange(offset_x,offset_x+width,dtype=np.float32)
+        y = np.arange(offset_y,offset_y+height,dtype=np.float32)
+        spectrum = np.full(width,self.continuum,dtype=np.float32)
+        for x_fraction, amplitude, line_width in self.lines:
+            sigma = np.sqrt(line_width**2 + sigma_blur**2)
+            spectrum += amplitude*(line_width/sigma)*np.exp(-0.5*np.square((x - x_fraction*sensor_width)/sigma))
+        image = np.zeros((height,width),dtype=np.float32)
+        slope = np.tan(np.radians(self.tilt_deg))
+        for y_fraction, track_sigma in self.tracks:
+            sigma = np.sqrt(track_sigma**2 + sigma_blur**2)
+            center = y_fraction*sensor_height + slope*(x - sensor_width/2)
+            image += (track_sigma/sigma)*np.exp(-0.5*np.square((y[:,None] - center[None,:])/sigma))
+        image *= spectrum[None,:]
+        self._cache_key = key
+        self._cache = image
+        return image
+
+class MosaicScene(object):
+    # brightfield/fluorescence tiles cut from a stored mosaic (ndarray or image file) at the stage position
+    # without a mosaic a synthetic sample of cells is generated; the mosaic wraps around at its edges
+
+    def __init__(self,mosaic=None,pixel_size_um=0.5,mode='brightfield',focus_z_mm=0,defocus_px_per_um=2,size=4096,seed=0):
+        if isinstance(mosaic,str):
+            mosaic = cv2.imread(mosaic,cv2.IMREAD_GRAYSCALE)
+        if mosaic is None:
+            mosaic = self.generate_mosaic(size,mode,seed)
+        mosaic = mosaic.astype(np.float32)
+        if mosaic.max() > 1:
+            mosaic /= np.iinfo(np.uint16).max if mosaic.max() > 255 else 255
+        self.mosaic = mosaic
+        self.pixel_size_um = pixel_size_um
+        self.focus_z_mm = focus_z_mm
+        self.defocus_px_per_um = defocus_px_per_um
+
+    @staticmethod
+    def generate_mosaic(size,mode='brightfield',seed=0):
+        rng = np.random.default_rng(seed)
+        cells = np.zeros((size,size),dtype=np.float32)
+        n_cells = size*size//(1500 if mode == 'brightfield' else 6000)
+        for x, y, r, intensity in zip(rng.integers(0,size,n_cells),rng.integers(0,size,n_cells),rng.integers(3,10,n_cells),rng.uniform(0.3,1,n_cells)):
+            cv2.circle(cells,(int(x),int(y)),int(r),float(intensity),-1)
+        cells = cv2.GaussianBlur(cells,(0,0),1.5)
+        if mode == 'brightfield':
+            return 0.8 - 0.5*cells
+        return 0.02 + 0.9*cells
+
+    def render(self,width,height,offset_x,offset_y,sensor_width,sensor_height,x_mm=0,y_mm=0,z_mm=0):
+        mosaic_height, mosaic_width = self.mosaic.shape
+        # the sensor center looks at the stage position
+        col = int(round(x_mm*1000/self.pixel_size_um)) + offset_x - sensor_width//2
+        row = int(round(y_mm*1000/self.pixel_size_um)) + offset_y - sensor_height//2
+        col = col % mosaic_width
+        row = row % mosaic_height
+        if col + width <= mosaic_width and row + height <= mosaic_height:
+            image = self.mosaic[row:row+height,col:col+width]
+        else:
+            image = self.mosaic[np.ix_(np.arange(row,row+height) % mosaic_height,np.arange(col,col+width) % mosaic_width)]
+        return _defocus(image,abs(z_mm - self.focus_z_mm)*1000*self.defocus_px_per_um)
+
+class SimulatedCamera(CameraBase):
+    # renders a scene through a simple sensor model (shot noise, read noise, full well, bit depth, gain)
+    # and honors exposure time, frame rate/readout time and software, hardware and continuous triggering
+    # frames are produced by an acquisition thread and delivered through the callback, like the real drivers;
+    # read_frame() after send_trigger() blocks until the triggered frame is ready, like the Daheng driver, and returns None on a timeout
+
+    def __init__(self,sn=None,width=2000,height=2000,scene=None,max_fps=30,bit_depth=8,full_well_e=10000,read_noise_e=3,
+                 photons_per_ms=500,dark_current_e_per_ms=0,gain_dB_per_unit=1,noise=True,seed=None):
+        self.sn = sn
+        self.sensor_width = width
+        self.sensor_height = height
+        self.scene = scene if scene is not None else MosaicScene()
+        self.max_fps = max_fps
+        self.bit_depth = bit_depth
+        self.pixel_format = 'MONO' + str(bit_depth)
+        self.full_well_e = full_well_e
+        self.read_noise_e = read_noise_e
+        self.photons_per_ms = photons_per_ms
+        self.dark_current_e_per_ms = dark_current_e_per_ms
+        self.gain_dB_per_unit = gain_dB_per_unit
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.is_color = False
+        self.exposure_time = 10
+        self.analog_gain = 0
+        self.frame_ID = 0
+        self.frame_ID_software = -1
+        self.frame_ID_offset_hardware_trigger = 0
+        self.timestamp = 0
+        self.image_received = False
+
+        self.image_locked = False
+        self.current_frame = None
+        self.new_image_callback_external = None
+
+        self.callback_is_enabled = False
+        self.callback_was_enabled_before_autofocus = False
+        self.callback_was_enabled_before_multipoint = False
+        self.is_streaming = False
+
+        self.GAIN_MAX = 24
+        self.GAIN_MIN = 0
+        self.GAIN_STEP = 1
+        self.EXPOSURE_TIME_MS_MIN = 0.01
+        self.EXPOSURE_TIME_MS_MAX = 4000
+
+        self.ROI_offset_x = 0
+        self.ROI_offset_y = 0
+        self.ROI_width = width
+        self.ROI_height = height
+
+        self.trigger_mode = TriggerMode.SOFTWARE
+        # frame rate in continuous acquisition, as set through set_ROI() like the TIS driver; exposure and readout can make it slower
+        self.framerate = max_fps
+        # in hardware trigger mode, triggers come from hardware_trigger() or, to stand in for an external trigger line, from an internal generator
+        self.hardware_trigger_fps = None
+
+        self.position_source = None
+
+        self.num_frame_buffers = 4
+        self._frame_buffers = None
+        self._frame_buffers_key = None
+        self._frame_buffer_index = 0
+        self._work_buffer = None
+        self._noise = None
+
+        self._trigger_queue = queue.Queue(maxsize=1)
+        self._frame_ready = threading.Event()
+        self._frame_ready.set()
+        self._t_ready = 0
+        self._thread = None
+        self._stop_requested = False
+        self.reset_statistics()
+
+    def set_position_source(self,function):
+        # function() returns the stage position (x_mm, y_mm, z_mm), e.g. from a NavigationController
+        self.position_source = function
+
+    def set_scene(self,scene):
+        self.scene = scene
+
+    def set_exposure_time(self,exposure_time):
+        self.exposure_time = exposure_time
+
+    def set_analog_gain(self,analog_gain):
+        self.analog_gain = analog_gain
+
+    def set_pixel_format(self,format):
+        if format.startswith('MONO') and format[4:].isdigit():
+            self.bit_depth = int(format[4:])
+            self.pixel_format = format
+        else:
+            print('pixel format ' + str(format) + ' is not supported by the simulated camera')
+
+    def set_ROI(self,offset_x=None,offset_y=None,width=None,height=None,framerate=None):
+        if offset_x is not None:
+            self.ROI_offset_x = int(offset_x)
+        if offset_y is not None:
+            self.ROI_offset_y = int(offset_y)
+        if width is not None:
+            self.ROI_width = int(width)
+        if height is not None:
+            self.ROI_height = int(height)
+        if framerate is not None:
+            self.framerate = framerate
+        self.ROI_width = max(1,min(self.ROI_width,self.sensor_width - self.ROI_offset_x))
+        self.ROI_height = max(1,min(self.ROI_height,self.sensor_height - self.ROI_offset_y))
+
+    def get_readout_time(self):
+        # rolling readout: the row time is set by the full frame rate, so a smaller ROI height reads out faster
+        return self.ROI_height/(self.max_fps*self.sensor_height)
+
+    def get_frame_period(self):
+        period = max(self.exposure_time/1000,self.get_readout_time())
+        if self.trigger_mode == TriggerMode.CONTINUOUS and self.framerate:
+            period = max(period,1/self.framerate)
+        return period
+
+    def start_streaming(self):
+        if self.is_streaming:
+            return
+        self.frame_ID_software = 0
+        self._stop_requested = False
+        self._t_ready = 0
+        self.is_streaming = True
+        self._thread = threading.Thread(target=self._acquisition_loop,daemon=True)
+        self._thread.start()
+
+    def stop_streaming(self):
+        if not self.is_streaming:
+            return
+        self._stop_requested = True
+        self._thread.join()
+        self.is_streaming = False
+        self._frame_ready.set()
+
+    def close(self):
+        self.stop_streaming()
+
+    def set_continuous_acquisition(self):
+        self.trigger_mode = TriggerMode.CONTINUOUS
+
+    def set_software_triggered_acquisition(self):
+        self.trigger_mode = TriggerMode.SOFTWARE
+
+    def set_hardware_triggered_acquisition(self):
+        self.trigger_mode = TriggerMode.HARDWARE
+        self.frame_ID_offset_hardware_trigger = self.frame_ID
+
+    def set_hardware_trigger_fps(self,fps):
+        self.hardware_trigger_fps = fps
+
+    def send_trigger(self):
+        self.image_received = False
+        if not self.is_streaming:
+            # no acquisition thread - produce the frame right away, as the earlier simulated cameras did
+            self._deliver(self._render())
+            return
+        if self.trigger_mode == TriggerMode.SOFTWARE:
+            self._accept_trigger()
+
+    def hardware_trigger(self):
+        # a pulse on the trigger input
+        if self.is_streaming and self.trigger_mode == TriggerMode.HARDWARE:
+            self._accept_trigger()
+
+    def _accept_trigger(self):
+        self._statistics['triggers_received'] = self._statistics['triggers_received'] + 1
+        # triggers that arrive while the sensor is still busy are ignored
+        if time.time() < self._t_ready or self._trigger_queue.full():
+            self._statistics['triggers_dropped'] = self._statistics['triggers_dropped'] + 1
+            return
+        self._frame_ready.clear()
+        self._t_ready = time.time() + self.exposure_time/1000 + self.get_readout_time()
+        self._trigger_queue.put_nowait(time.time())
+
+    def read_frame(self):
+        # None rather than the previous frame on a timeout, as the Daheng driver does; the frame itself is a copy of the ring slot
+        if not self._frame_ready.wait(timeout=self.exposure_time/1000 + self.get_readout_time() + 1):
+            print('simulated camera: timeout waiting for the triggered frame')
+            return None
+        frame = self.current_frame
+        return None if frame is None else frame.copy()
+
+    def reset_camera_acquisition_counter(self):
+        self.frame_ID = 0
+
+    def get_statistics(self):
+        statistics = dict(self._statistics)
+        elapsed = time.time() - statistics.pop('t_start')
+        statistics['fps'] = statistics['frames_generated']/elapsed if elapsed > 0 else 0
+        statistics['render_time_ms_mean'] = statistics.pop('render_time_ms_sum')/max(statistics['frames_generated'],1)
+        return statistics
+
+    def reset_statistics(self):
+        self._statistics = {'t_start':time.time(),'frames_generated':0,'frames_dropped':0,'triggers_received':0,'triggers_dropped':0,'render_time_ms_sum':0}
+
+    def _acquisition_loop(self):
+        t_next_frame = time.time()
+        t_next_hardware_trigger = time.time()
+        while not self._stop_requested:
+            if self.trigger_mode == TriggerMode.CONTINUOUS:
+                # the frame started at t_next_frame is read out at the end of the exposure
+                # exposures overlap the readout of the previous frame; restart the schedule if it has fallen behind
+                t_start = t_next_frame if t_next_frame > time.time() - self.get_frame_period() else time.time()
+                t_next_frame = t_start + self.get_frame_period()
+                frame = self._render()
+                self._sleep_until(t_start + self.exposure_time/1000 + self.get_readout_time())
+                self._deliver(frame)
+                continue
+            if self.trigger_mode == TriggerMode.HARDWARE and self.hardware_trigger_fps:
+                if time.time() >= t_next_hardware_trigger:
+                    self.hardware_trigger()
+                    t_next_hardware_trigger = max(t_next_hardware_trigger + 1/self.hardware_trigger_fps,time.time() - 1/self.hardware_trigger_fps)
+            try:
+                t_trigger = self._trigger_queue.get(timeout=0.001 if self.hardware_trigger_fps else 0.05)
+            except queue.Empty:
+                continue
+            frame = self._render()
+            self._sleep_until(t_trigger + self.exposure_time/1000 + self.get_readout_time())
+            self._deliver(frame)
+
+    def _sleep_until(self,t):
+        while not self._stop_requested:
+            remaining = t - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining,0.05))
+
+    def _get_frame_buffer(self,height,width,dtype):
+        key = (height,width,dtype)
+        if self._frame_buffers_key != key:
+            self._frame_buffers = [np.empty((height,width),dtype=dtype) for i in range(self.num_frame_buffers)]
+            self._work_buffer = np.empty((height,width),dtype=np.float32)
+            self._frame_buffer_index = 0
+            self._frame_buffers_key = key
+        self._frame_buffer_index = (self._frame_buffer_index + 1) % len(self._frame_buffers)
+        return self._frame_buffers[self._frame_buffer_index]
+
+    def _get_noise(self,n):
+        # unit normal noise, drawn once and read at a random offset for every frame
+        if self._noise is None or self._noise.size < n + 65536:
+            self._noise = self.rng.standard_normal(n + 65536,dtype=np.float32)
+        start = int(self.rng.integers(0,self._noise.size - n))
+        return self._noise[start:start+n]
+
+    def _render(self):
+        t0 = time.time()
+        width, height = self.ROI_width, self.ROI_height
+        x_mm, y_mm, z_mm = self.position_source() if self.position_source is not None else (0,0,0)
+        scene = self.scene.render(width,height,self.ROI_offset_x,self.ROI_offset_y,self.sensor_width,self.sensor_height,x_mm,y_mm,z_mm)
+        max_value = 2**self.bit_depth - 1
+        frame = self._get_frame_buffer(height,width,np.uint8 if self.bit_depth <= 8 else np.uint16)
+        electrons = self._work_buffer
+        np.multiply(scene,self.photons_per_ms*self.exposure_time,out=electrons)
+        electrons += self.dark_current_e_per_ms*self.exposure_time
+        if self.noise:
+            # shot noise and read noise, gaussian approximation
+            noise_std = np.sqrt(electrons + self.read_noise_e**2)
+            noise_std *= self._get_noise(width*height).reshape(height,width)
+            electrons += noise_std
+        np.minimum(electrons,self.full_well_e,out=electrons)
+        electrons *= (max_value/self.full_well_e)*10**(self.analog_gain*self.gain_dB_per_unit/20)
+        np.clip(electrons,0,max_value,out=electrons)
+        np.copyto(frame,electrons,casting='unsafe')
+        self._statistics['render_time_ms_sum'] = self._statistics['render_time_ms_sum'] + (time.time()-t0)*1000
+        return frame
+
+    def _deliver(self,frame):
+        self.current_frame = frame
+        self.frame_ID = self.frame_ID + 1
+        self.frame_ID_software = self.frame_ID_software + 1
+        self.timestamp = time.time()
+        self.image_received = True
+        self._statistics['frames_generated'] = self._statistics['frames_generated'] + 1
+        self._frame_ready.set()
+        if self.new_image_callback_external is not None and self.callback_is_enabled:
+            if self.image_locked:
+                self._statistics['frames_dropped'] = self._statistics['frames_dropped'] + 1
+                return
+            self.new_image_callback_external(self)
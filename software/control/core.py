@@ -14,9 +14,14 @@ from qtpy.QtGui import *
 import control.utils as utils
 from control._def import *
 import control.tracking as tracking
-
-from queue import Queue
-from threading import Thread, Lock
+import control.instrumentation as instrumentation
+import control.microscope as microscope
+from control.microscope import Configuration # Qt-free, shared with the headless acquisition core
+from control.spectrum import SpectrumAccumulator, SpectrumProjection, WavelengthCalibration, PeakTracker, save_accumulated_spectrum, load_tracks, fit_curved_band, detect_band, SpectrumDatacube, SpectrumRecording
+
+from queue import Queue, Full, Empty
+from threading import Thread, Lock, Event, current_thread
+import atexit
 import time
 import numpy as np
 import pyqtgraph as pg
@@ -36,9 +41,11 @@ class StreamHandler(QObject):
     image_to_display = Signal(np.ndarray)
 
     image_to_spectrum_extraction = Signal(np.ndarray)
+    packet_image_to_spectrum_recording = Signal(np.ndarray, int, float) # the frames in between, while spectra are recorded
     packet_image_to_write = Signal(np.ndarray, int, float)
     packet_image_for_tracking = Signal(np.ndarray, int, float)
     signal_new_frame_received = Signal()
+    signal_calibration_frame_captured = Signal(str)
 
     def __init__(self,crop_width=Acquisition.CROP_WIDTH,crop_height=Acquisition.CROP_HEIGHT,display_resolution_scaling=1):
 
@@ -55,6 +62,7 @@ class StreamHandler(QObject):
         self.display_resolution_scaling = display_resolution_scaling
 
         self.save_image_flag = False
+        self.save_spectrum_flag = False
         self.track_flag = False
         self.handler_busy = False
 
@@ -68,12 +76,24 @@ class StreamHandler(QObject):
         self.x2 = None
         self.y2 = None
 
+        self.frameCorrector = None # dark and flat correction of the frames for spectrum extraction
+
+    def set_frame_corrector(self,frameCorrector):
+        self.frameCorrector = frameCorrector
+
     def start_recording(self):
         self.save_image_flag = True
 
     def stop_recording(self):
         self.save_image_flag = False
 
+    def start_spectrum_recording(self):
+        # every frame goes to the SpectrumRecorder
+        self.save_spectrum_flag = True
+
+    def stop_spectrum_recording(self):
+        self.save_spectrum_flag = False
+
     def start_tracking(self):
         self.tracking_flag = True
 
@@ -104,6 +124,8 @@ class StreamHandler(QObject):
 
         camera.image_locked = True
         self.handler_busy = True
+        t_start = time.perf_counter()
+        instrumentation.count('stream_handler.frames')
         self.signal_new_frame_received.emit() # self.liveController.turn_off_illumination()
 
         # measure real fps
@@ -114,13 +136,17 @@ class StreamHandler(QObject):
             self.timestamp_last = timestamp_now
             self.fps_real = self.counter
             self.counter = 0
-            print('real camera fps is ' + str(self.fps_real))
 
         # rotate and flip
         camera.current_frame = utils.rotate_and_flip_image(camera.current_frame,rotate_image_angle=camera.rotate_image_angle,flip_image=camera.flip_image)
+
+        # frames for a master dark or flat
+        if self.frameCorrector is not None and self.frameCorrector.capture_kind is not None:
+            kind = self.frameCorrector.add_capture_frame(camera.current_frame,camera)
+            if kind is not None:
+                self.signal_calibration_frame_captured.emit(kind)
         
         image_with_ROIbox = np.copy(camera.current_frame)
-        print('size of current frame is ' + str(camera.current_frame.shape))
         image_with_ROIbox = np.squeeze(image_with_ROIbox)
 
         # crop image
@@ -128,7 +154,6 @@ class StreamHandler(QObject):
         image_cropped = np.squeeze(image_cropped)
 
         if self.x1 is not None:
-            print('adding box')
             rect_width = 5
             color = (255,255,255)
             #cv2.line(image_with_ROIbox, (self.x1, self.y1), (self.x2, self.y2), 255, 5)
@@ -143,23 +168,35 @@ class StreamHandler(QObject):
             # self.image_to_display.emit(cv2.resize(image_cropped,(round(self.crop_width*self.display_resolution_scaling), round(self.crop_height*self.display_resolution_scaling)),cv2.INTER_LINEAR))
             self.image_to_display.emit(image_with_ROIbox)
             # self.image_to_display.emit(image_cropped)
-            self.image_to_spectrum_extraction.emit(np.squeeze(camera.current_frame))
+            frame_for_spectrum = np.squeeze(camera.current_frame)
+            if self.frameCorrector is not None:
+                with instrumentation.span('stream_handler.correct'):
+                    frame_for_spectrum = self.frameCorrector.correct_frame(frame_for_spectrum,camera)
+            # copies: the camera and the frame corrector reuse their buffers, and the signal is queued
+            self.image_to_spectrum_extraction.emit(np.copy(frame_for_spectrum))
             self.timestamp_last_display = time_now
+        elif self.save_spectrum_flag:
+            frame_for_spectrum = np.squeeze(camera.current_frame)
+            if self.frameCorrector is not None:
+                with instrumentation.span('stream_handler.correct'):
+                    frame_for_spectrum = self.frameCorrector.correct_frame(frame_for_spectrum,camera)
+            self.packet_image_to_spectrum_recording.emit(np.copy(frame_for_spectrum),camera.frame_ID,camera.timestamp)
 
         # send image to write
         if self.save_image_flag and time_now-self.timestamp_last_save >= 1/self.fps_save:
             if camera.is_color:
                 image_cropped = cv2.cvtColor(image_cropped,cv2.COLOR_RGB2BGR)
-            self.packet_image_to_write.emit(image_cropped,camera.frame_ID,camera.timestamp)
+            self.packet_image_to_write.emit(np.copy(image_cropped),camera.frame_ID,camera.timestamp)
             self.timestamp_last_save = time_now
 
         # send image to track
         if self.track_flag and time_now-self.timestamp_last_track >= 1/self.fps_track:
             # track is a blocking operation - it needs to be
             # @@@ will cropping before emitting the signal lead to speedup?
-            self.packet_image_for_tracking.emit(image_cropped,camera.frame_ID,camera.timestamp)
+            self.packet_image_for_tracking.emit(np.copy(image_cropped),camera.frame_ID,camera.timestamp)
             self.timestamp_last_track = time_now
 
+        instrumentation.record('stream_handler.on_new_frame',time.perf_counter() - t_start,t_start)
         self.handler_busy = False
         camera.image_locked = False
 
@@ -217,7 +254,8 @@ class ImageSaver(QObject):
                 return
             # process the queue
             try:
-                [image,frame_ID,timestamp] = self.queue.get(timeout=0.1)
+                [image,frame_ID,timestamp,t_enqueued] = self.queue.get(timeout=0.1)
+                instrumentation.record('image_saver.queue_wait',time.perf_counter() - t_enqueued,t_enqueued)
                 self.image_lock.acquire(True)
                 folder_ID = int(self.counter/self.max_num_image_per_folder)
                 file_ID = int(self.counter%self.max_num_image_per_folder)
@@ -226,7 +264,8 @@ class ImageSaver(QObject):
                     os.mkdir(os.path.join(self.base_path,self.experiment_ID,str(folder_ID)))
                 saving_path = os.path.join(self.base_path,self.experiment_ID,str(folder_ID),str(file_ID) + '_' + str(frame_ID) + '.' + self.image_format)
                 
-                cv2.imwrite(saving_path,image)
+                with instrumentation.span('image_saver.encode'):
+                    cv2.imwrite(saving_path,image)
                 self.counter = self.counter + 1
                 self.queue.task_done()
                 self.image_lock.release()
@@ -235,11 +274,12 @@ class ImageSaver(QObject):
                             
     def enqueue(self,image,frame_ID,timestamp):
         try:
-            self.queue.put_nowait([image,frame_ID,timestamp])
+            self.queue.put_nowait([image,frame_ID,timestamp,time.perf_counter()])
             if ( self.recording_time_limit>0 ) and ( time.time()-self.recording_start_time >= self.recording_time_limit ):
                 self.stop_recording.emit()
             # when using self.queue.put(str_), program can be slowed down despite multithreading because of the block and the GIL
         except:
+            instrumentation.count('image_saver.frames_discarded')
             print('imageSaver queue is full, image discarded')
 
     def set_base_path(self,path):
@@ -271,6 +311,7 @@ class SpectrumROIManager(QObject):
     autoROI_finished = Signal()
     ROI_coordinates = Signal(np.ndarray)
     calculated_y_values = Signal(int, int)
+    calculated_width = Signal(int)
 
     def __init__(self,camera,liveController,spectrumExtractor):
         QObject.__init__(self)
@@ -279,53 +320,56 @@ class SpectrumROIManager(QObject):
         self.spectrumExtractor = spectrumExtractor
         self.liveController_was_live_before_autoROI = None
         self.camera_callback_was_enabled_before_autoROI = None
-        self.image_shape = (1080,1920)
+        self.image_shape = (1080,1920) # full frame
         self.x1 = 0
         self.x2 = 1919
         self.w = 10
+        # fast spectrum mode: the sensor only reads out the rows of the spectrum band, the extraction mask is cropped to them
+        self.fast_spectrum_mode = False
+        self.sensor_ROI_offset_y = 0
+        self.framerate_full_frame = None # set while fast spectrum mode runs at SPECTRUM_ROI.FAST_MODE_FRAMERATE
+        self.mask = None # extraction mask in full frame coordinates
+        self.tracks = None # several tracks instead of the mask, see load_tracks()
+        # continuous auto ROI: the band is re-detected every SPECTRUM_ROI.AUTO_ROI_FOLLOW_INTERVAL_MS to follow drift
+        self.timer_follow = QTimer()
+        self.timer_follow.setInterval(SPECTRUM_ROI.AUTO_ROI_FOLLOW_INTERVAL_MS)
+        self.timer_follow.timeout.connect(self.follow_band)
+        self.band = None # the last detected band, see detect_band()
+
+    def detect_band(self):
+        # the band in the current frame in full frame coordinates, or None if there is no band
+        if self.camera.current_frame is None:
+            return None
+        return detect_band(self.camera.current_frame,SPECTRUM_ROI.AUTO_ROI_COLUMN_BIN,SPECTRUM_ROI.AUTO_ROI_MIN_SIGNAL,
+            SPECTRUM_ROI.AUTO_ROI_WIDTH_FWHM_FACTOR,row_offset=self.sensor_ROI_offset_y)
     
     def find_coordinates(self):
-
-        raw_image = np.squeeze(np.copy(self.camera.current_frame))
-        image_shape = raw_image.shape
-        # find left coordinate
-        max_values = np.amax(raw_image, 1)
-        print(max_values)
-        x1_indices = np.where(max_values > 75)
-       
-        x1 = np.min(x1_indices)
-        y1 = np.argmax((raw_image[:, x1]))
-        print('point1: ' + str((x1, y1)))
-
-        # find right coordinate
-        x2_indices = np.where(max_values > 75)
-        x2 = np.max(x2_indices)
-        y2 = np.argmax((raw_image[:, x2]))
-        print('point2: ' + str((x2, y2)))
-        
+        # the ends of the band (in frame coordinates) and the shape of the frame
+        image_shape = np.squeeze(self.camera.current_frame).shape
+        band = self.detect_band()
+        if band is None:
+            raise ValueError('no spectrum band found in the current frame')
+        x1 = int(round(band['x1']))
+        y1 = int(round(band['y1'])) - self.sensor_ROI_offset_y
+        x2 = int(round(band['x2']))
+        y2 = int(round(band['y2'])) - self.sensor_ROI_offset_y
+        print('point1: ' + str((x1, y1)) + ', point2: ' + str((x2, y2)) + ', width ' + str(round(band['w'],1)))
         self.ROI_coordinates.emit(np.array([x1, y1, x2, y2]))
         return x1, y1, x2, y2, image_shape
 
     def updated_x_coordinates(self):
-
-        raw_image = np.copy(self.camera.current_frame)
-        image_shape = raw_image.shape
-        # find left x-coordinate
-        max_values = np.amax(raw_image, 1)
-        x1_indices = np.where(max_values > 75)
-        x1 = np.min(x1_indices)
-
-        # find right y-coordinate
-        x2_indices = np.where(max_values > 75)
-        x2 = np.max(x2_indices)
-       
-        return x1, x2, image_shape
+        image_shape = np.squeeze(self.camera.current_frame).shape
+        band = self.detect_band()
+        if band is None:
+            raise ValueError('no spectrum band found in the current frame')
+        return int(round(band['x1'])), int(round(band['x2'])), image_shape
     
     def manual_updatedROI(self, y0_input, y1_input, w):
         
+        self.w = w
         mask = self.create_mask(self.x1, y0_input, self.x2, y1_input, self.image_shape)
-        self.ROI_coordinates.emit(np.array([self.x1, y0_input, self.x2, y1_input]))
-        self.spectrumExtractor.update_ROI(mask)
+        self.ROI_coordinates.emit(np.array([self.x1, y0_input - self.sensor_ROI_offset_y, self.x2, y1_input - self.sensor_ROI_offset_y]))
+        self.set_mask(mask)
 
     def create_mask(self, x1, y1, x2, y2, image_shape):
         
@@ -354,14 +398,142 @@ class SpectrumROIManager(QObject):
         b = (y1 - m * x1)
         y0 = b
         y1 = m*(width-1) + b 
-        self.calculated_y_values.emit(y0, y1)
+        self.calculated_y_values.emit(int(round(y0)), int(round(y1)))
 
     def auto_ROI(self):
-        x1, y1, x2, y2, image_shape = self.find_coordinates()
-        mask = self.create_mask(x1, y1, x2, y2, image_shape)
-        self.spectrumExtractor.update_ROI(mask)
+        band = self.detect_band()
+        if band is None:
+            raise ValueError('no spectrum band found in the current frame')
+        self.apply_band(band)
+        print('spectrum band: (' + str(round(band['x1'])) + ', ' + str(round(band['y1'],1)) + ') to (' + str(round(band['x2'])) + ', ' + str(round(band['y2'],1)) + '), width ' + str(round(band['w'],1)))
+
+    def apply_band(self, band):
+        # extracts along the band (in full frame coordinates) with its width
+        self.band = band
+        self.w = max(1,int(round(band['w'])))
+        # the mask spans the frame, as for the manual entries: the line through the band at the first and last column
+        x1, x2 = self.x1, self.x2
+        m = (band['y2'] - band['y1'])/max(band['x2'] - band['x1'],1)
+        y1 = int(round(band['y1'] + m*(x1 - band['x1'])))
+        y2 = int(round(band['y1'] + m*(x2 - band['x1'])))
+        mask = self.create_mask(x1, y1, x2, y2, self.image_shape)
+        self.set_mask(mask)
+        self.ROI_coordinates.emit(np.array([x1, y1 - self.sensor_ROI_offset_y, x2, y2 - self.sensor_ROI_offset_y]))
         self.update_y_values_to_ROIwidget(x1, y1, x2, y2)
-        # self.spectrumExtractor.mask = mask
+        self.calculated_width.emit(self.w)
+
+    def follow_band(self):
+        # re-detects the band and moves the ROI when it drifted by more than SPECTRUM_ROI.AUTO_ROI_FOLLOW_TOLERANCE_PIXELS;
+        # tracks are left alone
+        if self.tracks is not None:
+            return
+        band = self.detect_band()
+        if band is None:
+            return
+        if self.band is not None:
+            drift = max(abs(band['y1'] - self.band['y1']),abs(band['y2'] - self.band['y2']),abs(band['w'] - self.band['w'])/2)
+            if drift <= SPECTRUM_ROI.AUTO_ROI_FOLLOW_TOLERANCE_PIXELS:
+                return
+        self.apply_band(band)
+
+    def set_continuous_auto_ROI(self, enabled):
+        if enabled:
+            self.timer_follow.start()
+        else:
+            self.timer_follow.stop()
+
+    def set_mask(self, mask):
+        self.mask = mask
+        self.tracks = None
+        if self.fast_spectrum_mode:
+            self.apply_sensor_ROI()
+        else:
+            self.spectrumExtractor.update_ROI(mask)
+
+    def get_sensor_ROI_rows(self):
+        # the rows of the band of the mask with a margin, aligned for the sensor; None if there is no band yet
+        if self.mask is None:
+            return None
+        rows = np.flatnonzero(self.mask.any(axis=1))
+        if len(rows) == 0:
+            return None
+        height = self.image_shape[0]
+        y0 = max(0,rows[0] - SPECTRUM_ROI.FAST_MODE_MARGIN_PIXELS)//4*4
+        y1 = min(height,-(-(rows[-1] + 1 + SPECTRUM_ROI.FAST_MODE_MARGIN_PIXELS)//4)*4)
+        return y0, y1
+
+    def apply_sensor_ROI(self):
+        rows = self.get_sensor_ROI_rows()
+        if rows is None:
+            return
+        y0, y1 = rows
+        if (y0, y1 - y0) != (self.sensor_ROI_offset_y, getattr(self.camera,'ROI_height',None)):
+            if SPECTRUM_ROI.FAST_MODE_FRAMERATE is not None:
+                if self.framerate_full_frame is None:
+                    self.framerate_full_frame = self.camera.framerate
+                self.camera.set_ROI(offset_y=y0,height=y1-y0,framerate=SPECTRUM_ROI.FAST_MODE_FRAMERATE)
+            else:
+                self.camera.set_ROI(offset_y=y0,height=y1-y0)
+            y0 = getattr(self.camera,'ROI_offset_y',y0) # the camera may round
+            y1 = y0 + getattr(self.camera,'ROI_height',y1 - y0)
+        self.sensor_ROI_offset_y = y0
+        if self.tracks is None:
+            self.spectrumExtractor.update_ROI(self.mask[y0:y1])
+        else:
+            self.spectrumExtractor.set_row_offset(y0,y1-y0)
+        print('sensor ROI: rows ' + str(y0) + ' to ' + str(y1))
+
+    def set_fast_spectrum_mode(self, enabled):
+        # returns whether fast spectrum mode is on
+        if enabled:
+            if self.get_sensor_ROI_rows() is None:
+                print('no spectrum ROI yet, run auto ROI first')
+                return False
+            self.fast_spectrum_mode = True
+            self.apply_sensor_ROI()
+        elif self.fast_spectrum_mode:
+            self.restore_full_frame()
+        return self.fast_spectrum_mode
+
+    def restore_full_frame(self):
+        self.fast_spectrum_mode = False
+        if self.framerate_full_frame is not None:
+            self.camera.set_ROI(offset_y=0,height=self.image_shape[0],framerate=self.framerate_full_frame)
+            self.framerate_full_frame = None
+        else:
+            self.camera.set_ROI(offset_y=0,height=self.image_shape[0])
+        self.sensor_ROI_offset_y = 0
+        if self.tracks is not None:
+            self.spectrumExtractor.set_row_offset(0,self.image_shape[0])
+        elif self.mask is not None:
+            self.spectrumExtractor.update_ROI(self.mask)
+
+    def set_tracks(self, tracks):
+        self.spectrumExtractor.set_tracks(tracks,self.image_shape)
+        self.tracks = tracks
+        # the sensor ROI of fast spectrum mode covers every track and background
+        self.mask = self.spectrumExtractor.projection.get_footprint()
+        if self.fast_spectrum_mode:
+            self.apply_sensor_ROI()
+        print(str(len(tracks)) + ' spectrum tracks')
+
+    def load_tracks(self, filename):
+        self.set_tracks(load_tracks(filename))
+
+    def fit_curvature(self):
+        # extracts along the curvature of the band in the current frame instead of a straight line; the fitted band is saved
+        # as a track file that Load Tracks can restore
+        raw_image = np.squeeze(np.copy(self.camera.current_frame))
+        track = fit_curved_band(raw_image,SPECTRUM_ROI.CURVATURE_DEGREE,SPECTRUM_ROI.WIDTH_DEGREE,SPECTRUM_ROI.CURVATURE_COLUMN_STEP,
+            SPECTRUM_ROI.CURVATURE_WIDTH_FWHM_FACTOR,SPECTRUM_ROI.CURVATURE_MIN_SIGNAL,row_offset=self.sensor_ROI_offset_y)
+        if SPECTRUM_ROI.BACKGROUND_WIDTH_PIXELS > 0:
+            track['background_gap'] = SPECTRUM_ROI.BACKGROUND_GAP_PIXELS
+            track['background_width'] = SPECTRUM_ROI.BACKGROUND_WIDTH_PIXELS
+        print('curved band: center ' + str(np.round(track['centre'],6)) + ', width ' + str(np.round(track['width'],6)) + ', rms residual ' + str(round(track['residual_rms'],2)) + ' pixels')
+        with open(SPECTRUM_ROI.CURVED_BAND_FILE,'w') as f:
+            json.dump([track],f,indent=4)
+        self.set_tracks([track])
+        return track
 
     #def manual_ROI(self): 
         
@@ -414,6 +586,7 @@ class SpectrumROIManager(QObject):
 class SpectrumExtractor(QObject):
 
     packet_spectrum = Signal(np.ndarray,np.ndarray)
+    packet_spectra = Signal(np.ndarray,np.ndarray) # x and the spectra of all the tracks (number of tracks x width)
 
 
 
@@ -424,23 +597,280 @@ class SpectrumExtractor(QObject):
         # self.w = 100
         self.mask = np.ones((1080, 1920), np.uint8)
         # cv2.line(self.mask, (0, 10), (100, 50), 1, self.w)
+        # x axis of the spectra, see set_wavelength_calibration()
+        self.wavelength_calibration = None
+        self.axis = SPECTRUM_WAVELENGTH.AXIS
+        self.grid_points = SPECTRUM_WAVELENGTH.GRID_POINTS
+        self.x = None
+        # the mask, or the tracks of set_tracks(), compiled into one sparse projection
+        self.projection = SpectrumProjection(self.mask.shape,[{'weights':self.mask}])
+        self.tracks = None
+        self.row_offset = 0 # first sensor row of the frames (fast spectrum mode), for the tracks
+        self.update_axis()
 
     def update_ROI(self, mask):
         self.mask = np.copy(mask)
+        self.projection = SpectrumProjection(self.mask.shape,[{'weights':self.mask}])
+        self.tracks = None
+        self.row_offset = 0
+        self.update_axis()
+
+    def set_tracks(self, tracks, shape):
+        # several spectra per frame, e.g. of multi-fiber inputs; tracks are dicts in full frame coordinates, see control/spectrum.py
+        self.projection = SpectrumProjection(shape,tracks)
+        self.tracks = tracks
+        self.set_row_offset(0,shape[0])
+        self.update_axis()
+
+    def set_wavelength_calibration(self, calibration, axis=None):
+        self.wavelength_calibration = calibration
+        if axis is not None:
+            self.axis = axis
+        self.update_axis()
+
+    def set_axis(self, axis, grid_points=None):
+        # 'pixel', 'nm', 'nm resampled' or 'wavenumber resampled'; the resampling is folded into the projection
+        self.axis = axis
+        self.grid_points = grid_points
+        self.update_axis()
+
+    def update_axis(self):
+        width = self.projection.shape[1]
+        calibration = self.wavelength_calibration
+        resampling = None
+        if calibration is not None and calibration.width != width:
+            print('the wavelength calibration is for ' + str(calibration.width) + ' columns, the frames have ' + str(width))
+            calibration = None
+        if calibration is None or self.axis == 'pixel':
+            self.x = numpy.linspace(0, width - 1, num=width)
+        elif self.axis == 'nm':
+            self.x = calibration.get_wavelengths()
+        else:
+            unit = 'wavenumber' if self.axis.startswith('wavenumber') else 'nm'
+            self.x = calibration.get_grid(unit,self.grid_points)
+            resampling = calibration.get_resampling_matrix(self.x,unit)
+        self.projection.set_resampling(resampling)
+
+    def extract_pixel_spectra(self, raw_image):
+        # the spectra on the column axis, e.g. for a wavelength calibration
+        return self.projection.extract(raw_image,self.row_offset,resample=False)
+
+    def calibrate_wavelength(self, raw_image, lines_nm=SPECTRUM_WAVELENGTH.REFERENCE_LINES_NM, use_previous_calibration=True):
+        # fits the dispersion to the peaks of the (first) spectrum of a frame of the reference lamp and saves it
+        spectrum = self.extract_pixel_spectra(np.squeeze(np.copy(raw_image)))[0]
+        previous = self.wavelength_calibration if use_previous_calibration else None
+        if previous is not None and previous.width != len(spectrum):
+            previous = None
+        calibration = WavelengthCalibration.from_spectrum(spectrum,lines_nm,SPECTRUM_WAVELENGTH.DISPERSION_DEGREE,
+            SPECTRUM_WAVELENGTH.PEAK_MIN_PROMINENCE,previous,SPECTRUM_WAVELENGTH.MATCH_TOLERANCE_NM)
+        print('wavelength calibration: ' + str(len(calibration.pixels)) + ' lines, rms residual ' + str(round(calibration.residual_rms_nm,4)) + ' nm')
+        calibration.save(SPECTRUM_WAVELENGTH.CALIBRATION_FILE)
+        self.set_wavelength_calibration(calibration)
+        return calibration
+
+    def load_wavelength_calibration(self, filename=SPECTRUM_WAVELENGTH.CALIBRATION_FILE):
+        if os.path.exists(filename):
+            self.set_wavelength_calibration(WavelengthCalibration.load(filename))
+
+    def set_row_offset(self, row_offset, height):
+        self.row_offset = row_offset
+        if self.tracks is not None:
+            self.mask = self.projection.get_footprint()[row_offset:row_offset+height]
+
+    def extract_spectra(self, raw_image):
+        # the spectra of all the tracks on the current axis, None for a frame from before a change of the sensor ROI
+        height, width = raw_image.shape[:2]
+        if width != self.projection.shape[1] or self.row_offset + height > self.projection.shape[0] or (self.tracks is None and self.mask.shape != (height, width)):
+            return None
+        return self.projection.extract(raw_image,self.row_offset)
 
     def extract_and_display_the_spectrum(self,raw_image):
         # print('>>> entering <extract_and_display_the_spectrum>')
-        dimensions = raw_image.shape
-        width = dimensions[1]
-        height = dimensions[0]
-        final_matrix = (self.mask * raw_image)
-        spectrum = numpy.sum(final_matrix, axis=0)
-        x = numpy.linspace(0, width - 1, num=width)
-        self.packet_spectrum.emit(x, spectrum)
+        spectra = self.extract_spectra(raw_image)
+        if spectra is None:
+            return
+        self.packet_spectra.emit(self.x, spectra)
+        self.packet_spectrum.emit(self.x, spectra[0])
         # print('>>>    sum(spectrum): ' + str(sum(spectrum)))
         # print('>>> leaving <extract_and_display_the_spectrum>')
 
 
+class SpectrumRecorder(QObject):
+
+    # extracts the spectra of the frames of packet_image_to_spectrum_recording in its own thread and records them, with the camera
+    # frame ID and time stamp, to <base path>/<experiment ID>/spectra.npy, see SpectrumRecording. Frames arriving while the queue
+    # is full are dropped and counted (frames_dropped, also in the recording metadata). stop_recording is emitted when the file
+    # is full or the time limit is reached
+    stop_recording = Signal()
+
+    def __init__(self,spectrumExtractor=None):
+        QObject.__init__(self)
+        self.spectrumExtractor = spectrumExtractor
+        self.base_path = './'
+        self.experiment_ID = ''
+        self.recording = None
+        self.is_recording = False
+        self.recording_start_time = 0
+        self.recording_time_limit = -1
+        self.capacity = SPECTRUM_RECORDING.CAPACITY_SPECTRA
+        self.frames_dropped = 0
+        self.lock = Lock()
+        self.queue = Queue(SPECTRUM_RECORDING.QUEUE_SIZE_FRAMES)
+        self.stop_signal_received = False
+        self.thread = Thread(target=self.process_queue)
+        self.thread.start()
+
+    def set_spectrum_extractor(self,spectrumExtractor):
+        self.spectrumExtractor = spectrumExtractor
+
+    def set_base_path(self,path):
+        self.base_path = path
+
+    def set_recording_time_limit(self,time_limit):
+        self.recording_time_limit = time_limit
+
+    def start_new_experiment(self,experiment_ID):
+        self.stop()
+        self.experiment_ID = experiment_ID + '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%-S.%f')
+        os.mkdir(os.path.join(self.base_path,self.experiment_ID))
+        self.recording_start_time = time.time()
+        self.frames_dropped = 0
+        self.is_recording = True # the file is created with the first spectrum, which gives its length
+
+    def enqueue(self,image,frame_ID,timestamp):
+        # called from the camera thread (direct connection), so that the recording does not depend on the gui event loop
+        if not self.is_recording:
+            return
+        try:
+            self.queue.put_nowait([image,frame_ID,timestamp,time.perf_counter()])
+        except Full:
+            self.frames_dropped = self.frames_dropped + 1
+            instrumentation.count('spectrum_recorder.frames_dropped')
+
+    def process_queue(self):
+        while not self.stop_signal_received:
+            try:
+                [image,frame_ID,timestamp,t_enqueued] = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            instrumentation.record('spectrum_recorder.queue_wait',time.perf_counter() - t_enqueued,t_enqueued)
+            try:
+                if self.is_recording and self.spectrumExtractor is not None:
+                    with instrumentation.span('spectrum_recorder.extract'):
+                        spectra = self.spectrumExtractor.extract_spectra(image)
+                    if spectra is not None:
+                        self.record(self.spectrumExtractor.x,spectra[0],timestamp,frame_ID)
+            finally:
+                self.queue.task_done()
+
+    def record(self,x,spectrum,timestamp=None,frame_ID=-1):
+        # timestamp: of the frame, time.time() when not given
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if not self.is_recording:
+                return
+            if self.recording is None:
+                self.recording = SpectrumRecording(os.path.join(self.base_path,self.experiment_ID,'spectra.npy'),x,self.capacity,
+                    SPECTRUM_RECORDING.INDEX_FLUSH_INTERVAL_SPECTRA,self.recording_start_time)
+            self.recording.frames_dropped = self.frames_dropped
+            if not self.recording.append(timestamp,spectrum,frame_ID):
+                instrumentation.count('spectrum_recorder.spectra_discarded')
+            finished = self.recording.is_full() or (self.recording_time_limit > 0 and timestamp - self.recording_start_time >= self.recording_time_limit)
+            if finished:
+                self._close_recording()
+        if finished:
+            self.stop_recording.emit()
+
+    def stop(self):
+        # the frames already queued are recorded first, unless stop() is called from the recording thread
+        if current_thread() is not self.thread and self.is_recording:
+            self.queue.join()
+        with self.lock:
+            self._close_recording()
+
+    def _close_recording(self):
+        self.is_recording = False
+        if self.recording is not None:
+            self.recording.frames_dropped = self.frames_dropped
+            self.recording.close()
+            print(str(self.recording.count) + ' spectra recorded, ' + str(self.frames_dropped) + ' frames dropped')
+            self.recording = None
+
+    def close(self):
+        self.stop()
+        self.stop_signal_received = True
+        self.thread.join()
+
+
+class SpectrumPeakTracker(QObject):
+
+    # time, and the ids, positions (in units of the spectrum axis) and heights of the peaks found in a spectrum
+    packet_peaks = Signal(float,np.ndarray,np.ndarray,np.ndarray)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.tracker = PeakTracker(SPECTRUM_PEAKS.SMOOTHING_WINDOW,SPECTRUM_PEAKS.SMOOTHING_ORDER,SPECTRUM_PEAKS.MIN_PROMINENCE,SPECTRUM_PEAKS.MAX_PEAKS,
+            SPECTRUM_PEAKS.MAX_SHIFT,SPECTRUM_PEAKS.MAX_MISSED_SPECTRA,SPECTRUM_PEAKS.HISTORY_SPECTRA)
+        self.enabled = False
+        self.track_index = 0 # of the spectrum (track of the SpectrumExtractor) that is analysed
+        self.timestamp_start = time.time()
+        self.log_file = None
+        self.lock = Lock()
+
+    def set_enabled(self,enabled):
+        self.enabled = enabled
+
+    def set_smoothing_window(self,window):
+        with self.lock:
+            self.tracker.set_smoothing(window,SPECTRUM_PEAKS.SMOOTHING_ORDER)
+
+    def set_min_prominence(self,value):
+        self.tracker.min_prominence = value
+
+    def set_max_peaks(self,N):
+        with self.lock:
+            self.tracker.max_peaks = N
+            self.tracker.reset()
+
+    def set_max_shift(self,value):
+        self.tracker.max_shift = value
+
+    def reset(self):
+        with self.lock:
+            self.tracker.reset()
+            self.timestamp_start = time.time()
+
+    def start_logging(self,filename):
+        # one line per peak and spectrum: time (s), peak, position, height
+        self.stop_logging()
+        self.log_file = open(filename,'w')
+        self.log_file.write('time (s),peak,position,height\n')
+
+    def stop_logging(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def track(self,x,spectra):
+        if not self.enabled:
+            return
+        spectrum = spectra[min(self.track_index,spectra.shape[0] - 1)] if spectra.ndim == 2 else spectra
+        t = time.time() - self.timestamp_start
+        with self.lock, instrumentation.span('peak_tracker.update'):
+            ids, positions, heights = self.tracker.update(x,spectrum,t)
+        if self.log_file is not None and len(ids) > 0:
+            self.log_file.write(''.join('%.4f,%d,%.6g,%.6g\n' % record for record in zip([t]*len(ids),ids,positions,heights)))
+        self.packet_peaks.emit(t,ids,positions,heights)
+
+    def get_time_series(self):
+        with self.lock:
+            return self.tracker.get_time_series()
+
+    def close(self):
+        self.stop_logging()
+
+
 class ImageSaver_Tracking(QObject):
     def __init__(self,base_path,image_format='bmp'):
         QObject.__init__(self)
@@ -486,9 +916,50 @@ class ImageSaver_Tracking(QObject):
         self.thread.join()
 
 
-'''
 class ImageSaver_MultiPointAcquisition(QObject):
-'''
+
+    # saves images to given paths in a background thread so that encoding and disk io overlap with stage moves
+
+    def __init__(self,max_queue_size=32):
+        QObject.__init__(self)
+        self.queue = Queue(max_queue_size)
+        self.stop_signal_received = False
+        self.thread = Thread(target=self.process_queue)
+        self.thread.start()
+        self.counter = 0
+
+    def process_queue(self):
+        while True:
+            # stop the thread if stop signal is received
+            if self.stop_signal_received:
+                return
+            # process the queue
+            try:
+                [image,saving_path,is_color,t_enqueued] = self.queue.get(timeout=0.1)
+            except:
+                continue
+            instrumentation.record('image_saver.queue_wait',time.perf_counter() - t_enqueued,t_enqueued)
+            try:
+                if is_color:
+                    image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+                with instrumentation.span('image_saver.encode'):
+                    cv2.imwrite(saving_path,image)
+                self.counter = self.counter + 1
+            except Exception as e:
+                print('error saving ' + saving_path + ': ' + str(e))
+            self.queue.task_done()
+
+    def enqueue(self,image,saving_path,is_color=False):
+        # unlike ImageSaver this blocks when the queue is full - no image should be discarded during an acquisition
+        self.queue.put([image,saving_path,is_color,time.perf_counter()])
+
+    def wait_till_all_images_are_saved(self):
+        self.queue.join()
+
+    def close(self):
+        self.queue.join()
+        self.stop_signal_received = True
+        self.thread.join()
 
 class ImageDisplay(QObject):
 
@@ -535,20 +1006,6 @@ class ImageDisplay(QObject):
         self.stop_signal_received = True
         self.thread.join()
 
-class Configuration:
-    def __init__(self,mode_id=None,name=None,camera_sn=None,exposure_time=None,analog_gain=None,illumination_source=None,illumination_intensity=None,channel=None,dac_led=None,dac_laser=None):
-        self.id = mode_id
-        self.name = name
-        self.exposure_time = exposure_time
-        self.analog_gain = analog_gain
-        self.illumination_source = illumination_source
-        self.illumination_intensity = illumination_intensity
-        self.camera_sn = camera_sn
-        self.channel = channel
-        self.dac_led = dac_led
-        self.dac_laser = dac_laser
-
-
 class LiveController(QObject):
 
     def __init__(self,camera,microcontroller,microcontroller2,configurationManager,control_illumination=True):
@@ -590,10 +1047,22 @@ class LiveController(QObject):
         self.illumination_on = False
 
     def set_illumination(self,illumination_source,intensity):
-        if illumination_source < 10: # LED matrix
-            self.microcontroller.set_illumination_led_matrix(illumination_source,r=(intensity/100)*LED_MATRIX_R_FACTOR,g=(intensity/100)*LED_MATRIX_G_FACTOR,b=(intensity/100)*LED_MATRIX_B_FACTOR)
-        else:
-            self.microcontroller.set_illumination(illumination_source,intensity)
+        microscope.get_device_state(self.microcontroller).write('illumination',(illumination_source,intensity),lambda value: microscope.set_illumination(self.microcontroller,*value),settle=True)
+
+    def set_DAC(self,DAC,value):
+        # value in %
+        microscope.get_device_state(self.microcontroller2).write(('DAC',DAC),int(value*65535/100),lambda value: self.microcontroller2.analog_write_DAC8050x(DAC,value),settle=True)
+
+    def get_settling_time_remaining(self):
+        # > 0 only if illumination or a DAC changed less than DAC_SETTLING_TIME_S ago
+        settling_time_s = microscope.get_device_state(self.microcontroller).get_settling_time_remaining(DAC_SETTLING_TIME_S)
+        if self.microcontroller2 is not None:
+            settling_time_s = max(settling_time_s,microscope.get_device_state(self.microcontroller2).get_settling_time_remaining(DAC_SETTLING_TIME_S))
+        return settling_time_s
+
+    def invalidate_device_state(self,key=None):
+        # call when the camera was set outside of set_microscope_mode
+        microscope.get_device_state(self.camera).invalidate(key)
 
     def start_live(self):
         self.is_live = True
@@ -667,6 +1136,11 @@ class LiveController(QObject):
     def set_microscope_mode(self,configuration):
 
         self.currentConfiguration = configuration
+
+        # only what differs from the last written camera, illumination and DAC state is sent
+        changes = microscope.get_configuration_changes(configuration,self.camera,self.microcontroller,self.microcontroller2,self.control_illumination)
+        if len(changes) == 0:
+            return
         print("setting microscope mode to " + self.currentConfiguration.name)
         
         # temporarily stop live while changing mode
@@ -675,13 +1149,8 @@ class LiveController(QObject):
             if self.control_illumination:
                 self.turn_off_illumination()
 
-        # set camera exposure time and analog gain
-        self.camera.set_exposure_time(self.currentConfiguration.exposure_time)
-        self.camera.set_analog_gain(self.currentConfiguration.analog_gain)
-
-        # set illumination
-        if self.control_illumination:
-            self.set_illumination(self.currentConfiguration.illumination_source,self.currentConfiguration.illumination_intensity)
+        # set camera exposure time and analog gain, illumination and DACs
+        microscope.apply_configuration_changes(changes)
 
         # restart live 
         if self.is_live is True:
@@ -1042,16 +1511,15 @@ class AutofocusWorker(QObject):
             steps_moved = steps_moved + 1
             self.liveController.turn_on_illumination()
             self.wait_till_operation_is_completed()
-            self.camera.send_trigger()
-            image = self.camera.read_frame()
+            with instrumentation.span('autofocus.capture'):
+                self.camera.send_trigger()
+                image = self.camera.read_frame()
             self.liveController.turn_off_illumination()
             image = utils.crop_image(image,self.crop_width,self.crop_height)
             self.image_to_display.emit(image)
             QApplication.processEvents()
-            timestamp_0 = time.time()
-            focus_measure = utils.calculate_focus_measure(image)
-            timestamp_1 = time.time()
-            print('             calculating focus measure took ' + str(timestamp_1-timestamp_0) + ' second')
+            with instrumentation.span('autofocus.focus_measure'):
+                focus_measure = utils.calculate_focus_measure(image)
             focus_measure_vs_z[i] = focus_measure
             print(i,focus_measure)
             focus_measure_max = max(focus_measure, focus_measure_max)
@@ -1189,6 +1657,7 @@ class MultiPointWorker(QObject):
     signal_current_configuration_spectrum = Signal(Configuration)
     signal_current_configuration_widefield = Signal(Configuration)
     signal_current_channel = Signal(str)
+    datacube_updated = Signal(str,int,int,int) # configuration, and the row, column and plane of the FOV
 
     def __init__(self,multiPointController):
         QObject.__init__(self)
@@ -1205,6 +1674,12 @@ class MultiPointWorker(QObject):
         self.NZ = self.multiPointController.NZ
         self.Nt = self.multiPointController.Nt
         self.N_spectrum = self.multiPointController.N_spectrum
+        self.spectrum_accumulation_mode = self.multiPointController.spectrum_accumulation_mode
+        self.keep_raw_spectrum_frames = self.multiPointController.keep_raw_spectrum_frames
+        self.spectrumExtractor = self.multiPointController.spectrumExtractor
+        self.frameCorrector = self.multiPointController.frameCorrector
+        self.datacube_enabled = self.multiPointController.datacube_enabled
+        self.datacubes = {} # of the current time point, by spectrum configuration
         self.deltaX = self.multiPointController.deltaX
         self.deltaX_usteps = self.multiPointController.deltaX_usteps
         self.deltaY = self.multiPointController.deltaY
@@ -1253,6 +1728,21 @@ class MultiPointWorker(QObject):
         while self.microcontroller.is_busy():
             time.sleep(SLEEP_TIME_S)
 
+    def create_datacubes(self,current_path):
+        # one datacube per spectrum configuration, filled with the spectrum of every FOV as it is captured
+        self.datacubes = {}
+        if not self.datacube_enabled or self.spectrumExtractor is None:
+            return
+        for config in self.selected_configurations:
+            if config.channel == 'Spectrum':
+                self.datacubes[config.name] = SpectrumDatacube(os.path.join(current_path,'datacube_' + str(config.name) + '.npy'),
+                    self.NY,self.NX,self.NZ,self.spectrumExtractor.x,SPECTRUM_DATACUBE.BANDS)
+        self.multiPointController.datacubes = self.datacubes
+
+    def close_datacubes(self):
+        for datacube in self.datacubes.values():
+            datacube.close()
+
     def run_single_time_point(self):
 
         # disable joystick button action
@@ -1267,6 +1757,7 @@ class MultiPointWorker(QObject):
 
         # create a dataframe to save coordinates
         coordinates_pd = pd.DataFrame(columns = ['i', 'j', 'k', 'x (mm)', 'y (mm)', 'z (um)'])
+        self.create_datacubes(current_path)
 
         x_scan_direction = 1
         dx_usteps = 0
@@ -1281,13 +1772,17 @@ class MultiPointWorker(QObject):
             # along x
             for j in range(self.NX):
 
+                t_fov_start = time.perf_counter()
+
                 if (self.NZ > 1):
                     # maneuver for achiving uniform step size and repeatability when using open-loop control
-                    self.navigationController.move_z_usteps(-160)
-                    self.wait_till_operation_is_completed()
-                    self.navigationController.move_z_usteps(160)
-                    self.wait_till_operation_is_completed()
-                    time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+                    with instrumentation.span('multipoint.move_z'):
+                        self.navigationController.move_z_usteps(-160)
+                        self.wait_till_operation_is_completed()
+                        self.navigationController.move_z_usteps(160)
+                        self.wait_till_operation_is_completed()
+                    with instrumentation.span('multipoint.settle'):
+                        time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
 
                 # z-stack
                 for k in range(self.NZ):
@@ -1297,10 +1792,11 @@ class MultiPointWorker(QObject):
                     # temporary: replace the above line with the line below to AF every FOV
                     # if (self.NZ == 1) and (self.do_autofocus):
                         configuration_name_AF = 'View Sample'
-                        config_AF = next((config for config in self.configurationManagers['Widefield'].configurations if config.name == configuration_name_AF))
+                        config_AF = self.configurationManagers['Widefield'].get_configuration_by_name(configuration_name_AF)
                         self.signal_current_configuration_widefield.emit(config_AF)
-                        self.autofocusController.autofocus()
-                        self.autofocusController.wait_till_autofocus_has_completed()
+                        with instrumentation.span('multipoint.autofocus'):
+                            self.autofocusController.autofocus()
+                            self.autofocusController.wait_till_autofocus_has_completed()
 
                     '''
                     # moved to before each z-stack on 12/29/2021
@@ -1318,19 +1814,25 @@ class MultiPointWorker(QObject):
                     # iterate through selected modes
                     for config in self.selected_configurations:
                         channel = config.channel
-                        if config.channel == 'Widefield':
-                            self.signal_current_configuration_widefield.emit(config)
-                        elif config.channel == 'Spectrum':
-                            self.signal_current_configuration_spectrum.emit(config)
-                        self.signal_current_channel.emit(channel)
-                        self.wait_till_operation_is_completed()
+                        with instrumentation.span('multipoint.set_configuration'):
+                            if config.channel == 'Widefield':
+                                self.signal_current_configuration_widefield.emit(config)
+                            elif config.channel == 'Spectrum':
+                                self.signal_current_configuration_spectrum.emit(config)
+                            self.signal_current_channel.emit(channel)
+                            self.wait_till_operation_is_completed()
                         # self.liveControllers[channel].turn_on_illumination() #illumination controled by DAC, done through the configuration manager
                         # self.wait_till_operation_is_completed()
-                        time.sleep(DAC_SETTLING_TIME_S)
+                        with instrumentation.span('multipoint.settle'):
+                            time.sleep(self.liveControllers[channel].get_settling_time_remaining())
                         
                         if channel == 'Widefield':
-                            self.cameras[channel].send_trigger() 
-                            image = self.cameras[channel].read_frame()
+                            with instrumentation.span('multipoint.capture'):
+                                self.cameras[channel].send_trigger() 
+                                image = self.cameras[channel].read_frame()
+                            if image is None:
+                                print('no frame from the ' + channel + ' camera, ' + file_ID + str(config.name) + ' is not saved')
+                                continue
                             # self.liveController.turn_off_illumination() #illumination controled by DAC, done through the configuration manager
                             # rotate and flip
                             image = utils.rotate_and_flip_image(image,rotate_image_angle=self.cameras[channel].rotate_image_angle,flip_image=self.cameras[channel].flip_image)
@@ -1344,21 +1846,82 @@ class MultiPointWorker(QObject):
                             saving_path = os.path.join(current_path, file_ID + str(config.name) + '.' + Acquisition.IMAGE_FORMAT)
                             if self.cameras[channel].is_color:
                                 image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
-                            cv2.imwrite(saving_path,image)
+                            with instrumentation.span('multipoint.save'):
+                                cv2.imwrite(saving_path,image)
                             QApplication.processEvents()
                         else:
+                            accumulator = None
+                            if self.spectrum_accumulation_mode != 'frames':
+                                mask = self.spectrumExtractor.mask if self.spectrumExtractor is not None else None
+                                accumulator = SpectrumAccumulator(self.spectrum_accumulation_mode,mask)
+                            corrected = False
+                            datacube = self.datacubes.get(config.name)
+                            spectrum_sum = None
+                            N_extracted = 0
                             for l in range(self.N_spectrum):
-                                self.cameras[channel].send_trigger() 
-                                while self.cameras[channel].image_received == False:
-                                    time.sleep(0.005)
-                                image = self.cameras[channel].read_frame()
+                                with instrumentation.span('multipoint.capture'):
+                                    self.cameras[channel].send_trigger() 
+                                    while self.cameras[channel].image_received == False:
+                                        time.sleep(0.005)
+                                    image = self.cameras[channel].read_frame()
+                                if image is None:
+                                    print('no frame from the ' + channel + ' camera, spectrum frame ' + str(l) + ' is skipped')
+                                    continue
                                 # self.liveController.turn_off_illumination() #illumination controled by DAC, done through the configuration manager
                                 # image = utils.crop_image(image,self.crop_width,self.crop_height)
-                                saving_path = os.path.join(current_path, file_ID + str(config.name) + '_' + str(l) + '.' + Acquisition.IMAGE_FORMAT)
-                                if self.cameras[channel].is_color:
-                                    image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
-                                cv2.imwrite(saving_path,image)
+                                if accumulator is not None or datacube is not None:
+                                    if self.frameCorrector is not None:
+                                        with instrumentation.span('multipoint.correct'):
+                                            image_corrected = self.frameCorrector.correct_frame(image,self.cameras[channel])
+                                    else:
+                                        image_corrected = image
+                                    corrected = image_corrected is not image
+                                # in 'spectrum' mode the accumulated spectra are those of the extractor (tracks, wavelength axis), as in the datacube
+                                extract = datacube is not None or (accumulator is not None and self.spectrum_accumulation_mode == 'spectrum' and self.spectrumExtractor is not None)
+                                spectra = None
+                                if extract:
+                                    with instrumentation.span('multipoint.extract'):
+                                        spectra = self.spectrumExtractor.extract_spectra(np.squeeze(image_corrected))
+                                    if spectra is None:
+                                        print('spectrum frame ' + str(l) + ' does not match the extraction (sensor ROI changed), it is not extracted')
+                                if accumulator is not None:
+                                    with instrumentation.span('multipoint.accumulate'):
+                                        if self.spectrum_accumulation_mode != 'spectrum' or self.spectrumExtractor is None:
+                                            accumulator.add(image_corrected,image)
+                                        elif spectra is not None:
+                                            accumulator.add_spectrum(spectra,image)
+                                if datacube is not None:
+                                    if spectra is not None:
+                                        spectrum = spectra[min(SPECTRUM_DATACUBE.TRACK,spectra.shape[0] - 1)]
+                                        spectrum_sum = spectrum.astype(np.float64) if spectrum_sum is None else spectrum_sum + spectrum
+                                        N_extracted = N_extracted + 1
+                                if accumulator is None or self.keep_raw_spectrum_frames:
+                                    saving_path = os.path.join(current_path, file_ID + str(config.name) + '_' + str(l) + '.' + Acquisition.IMAGE_FORMAT)
+                                    if self.cameras[channel].is_color:
+                                        image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+                                    with instrumentation.span('multipoint.save'):
+                                        cv2.imwrite(saving_path,image)
                                 QApplication.processEvents()
+                            if accumulator is not None:
+                                result = accumulator.get_result()
+                                if result['saturated_pixels'] > 0:
+                                    print(file_ID + str(config.name) + ': ' + str(result['saturated_pixels']) + ' saturated pixels in ' + str(result['N']) + ' frames')
+                                with instrumentation.span('multipoint.save'):
+                                    metadata = {'sensor_ROI_offset_y':getattr(self.cameras[channel],'ROI_offset_y',0),'corrected':corrected}
+                                    if self.spectrum_accumulation_mode == 'spectrum' and self.spectrumExtractor is not None:
+                                        # one row per track, on the axis of the extractor
+                                        metadata['x'] = self.spectrumExtractor.x
+                                        metadata['axis'] = self.spectrumExtractor.axis
+                                    save_accumulated_spectrum(os.path.join(current_path, file_ID + str(config.name) + '_' + self.spectrum_accumulation_mode + '.npz'),result,**metadata)
+                            if datacube is not None and N_extracted > 0:
+                                # the scan goes back and forth along x
+                                column = j if x_scan_direction == 1 else self.NX - 1 - j
+                                position = (self.navigationController.x_pos_mm,self.navigationController.y_pos_mm,self.navigationController.z_pos_mm*1000)
+                                with instrumentation.span('multipoint.datacube'):
+                                    datacube.add(i,column,k,spectrum_sum/N_extracted,position)
+                                    if np.count_nonzero(datacube.filled) % SPECTRUM_DATACUBE.FLUSH_INTERVAL_FOVS == 0:
+                                        datacube.flush()
+                                self.datacube_updated.emit(config.name,i,column,k)
 
                     # add the coordinate of the current location
                     coordinates_pd = coordinates_pd.append({'i':i,'j':j,'k':k,
@@ -1377,32 +1940,39 @@ class MultiPointWorker(QObject):
                         self.navigationController.move_z_usteps(-dz_usteps)
                         self.wait_till_operation_is_completed()
                         coordinates_pd.to_csv(os.path.join(current_path,'coordinates.csv'),index=False,header=True)
+                        self.close_datacubes()
                         self.navigationController.enable_joystick_button_action = True
                         return
 
                     if self.NZ > 1:
                         # move z
                         if k < self.NZ - 1:
-                            self.navigationController.move_z_usteps(self.deltaZ_usteps)
-                            self.wait_till_operation_is_completed()
-                            time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+                            with instrumentation.span('multipoint.move_z'):
+                                self.navigationController.move_z_usteps(self.deltaZ_usteps)
+                                self.wait_till_operation_is_completed()
+                            with instrumentation.span('multipoint.settle'):
+                                time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
                             dz_usteps = dz_usteps + self.deltaZ_usteps
                 
                 if self.NZ > 1:
                     # move z back
-                    self.navigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
-                    self.wait_till_operation_is_completed()
+                    with instrumentation.span('multipoint.move_z'):
+                        self.navigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
+                        self.wait_till_operation_is_completed()
                     dz_usteps = dz_usteps - self.deltaZ_usteps*(self.NZ-1)
 
                 # update FOV counter
                 self.FOV_counter = self.FOV_counter + 1
+                instrumentation.record('multipoint.fov',time.perf_counter() - t_fov_start,t_fov_start)
 
                 if self.NX > 1:
                     # move x
                     if j < self.NX - 1:
-                        self.navigationController.move_x_usteps(x_scan_direction*self.deltaX_usteps)
-                        self.wait_till_operation_is_completed()
-                        time.sleep(SCAN_STABILIZATION_TIME_MS_X/1000)
+                        with instrumentation.span('multipoint.move_x'):
+                            self.navigationController.move_x_usteps(x_scan_direction*self.deltaX_usteps)
+                            self.wait_till_operation_is_completed()
+                        with instrumentation.span('multipoint.settle'):
+                            time.sleep(SCAN_STABILIZATION_TIME_MS_X/1000)
                         dx_usteps = dx_usteps + x_scan_direction*self.deltaX_usteps
 
             '''
@@ -1418,9 +1988,11 @@ class MultiPointWorker(QObject):
             if self.NY > 1:
                 # move y
                 if i < self.NY - 1:
-                    self.navigationController.move_y_usteps(self.deltaY_usteps)
-                    self.wait_till_operation_is_completed()
-                    time.sleep(SCAN_STABILIZATION_TIME_MS_Y/1000)
+                    with instrumentation.span('multipoint.move_y'):
+                        self.navigationController.move_y_usteps(self.deltaY_usteps)
+                        self.wait_till_operation_is_completed()
+                    with instrumentation.span('multipoint.settle'):
+                        time.sleep(SCAN_STABILIZATION_TIME_MS_Y/1000)
                     dy_usteps = dy_usteps + self.deltaY_usteps
 
         if self.NY > 1:
@@ -1437,6 +2009,7 @@ class MultiPointWorker(QObject):
             time.sleep(SCAN_STABILIZATION_TIME_MS_X/1000)
 
         coordinates_pd.to_csv(os.path.join(current_path,'coordinates.csv'),index=False,header=True)
+        self.close_datacubes()
         self.navigationController.enable_joystick_button_action = True
 
 class MultiPointController(QObject):
@@ -1447,6 +2020,7 @@ class MultiPointController(QObject):
     signal_current_configuration_spectrum = Signal(Configuration)
     signal_current_configuration_widefield = Signal(Configuration)
     signal_current_channel = Signal(str)
+    datacube_updated = Signal(str,int,int,int)
 
     def __init__(self,cameras,navigationController,liveControllers,autofocusController,configurationManagers):
         QObject.__init__(self)
@@ -1462,6 +2036,12 @@ class MultiPointController(QObject):
         self.NZ = 1
         self.Nt = 1
         self.N_spectrum = 1
+        self.spectrum_accumulation_mode = SPECTRUM_ACCUMULATION.MODE
+        self.keep_raw_spectrum_frames = SPECTRUM_ACCUMULATION.KEEP_RAW_FRAMES
+        self.spectrumExtractor = None # for the extraction mask when accumulating spectra
+        self.frameCorrector = None # dark and flat correction of the accumulated spectra
+        self.datacube_enabled = SPECTRUM_DATACUBE.ENABLED
+        self.datacubes = {} # of the running or last time point, by spectrum configuration, see SpectrumDatacube
         mm_per_ustep_X = SCREW_PITCH_X_MM/(self.navigationController.x_microstepping*FULLSTEPS_PER_REV_X)
         mm_per_ustep_Y = SCREW_PITCH_Y_MM/(self.navigationController.y_microstepping*FULLSTEPS_PER_REV_Y)
         mm_per_ustep_Z = SCREW_PITCH_Z_MM/(self.navigationController.z_microstepping*FULLSTEPS_PER_REV_Z)
@@ -1507,6 +2087,16 @@ class MultiPointController(QObject):
         self.do_autofocus = flag
     def set_N_spectrum(self,N):
         self.N_spectrum = N
+    def set_spectrum_accumulation_mode(self,mode):
+        self.spectrum_accumulation_mode = mode
+    def set_keep_raw_spectrum_frames(self,flag):
+        self.keep_raw_spectrum_frames = flag
+    def set_spectrum_extractor(self,spectrumExtractor):
+        self.spectrumExtractor = spectrumExtractor
+    def set_frame_corrector(self,frameCorrector):
+        self.frameCorrector = frameCorrector
+    def set_datacube_enabled(self,flag):
+        self.datacube_enabled = flag
 
     def set_crop(self,crop_width,height):
         self.crop_width = crop_width
@@ -1523,19 +2113,20 @@ class MultiPointController(QObject):
         os.mkdir(os.path.join(self.base_path,self.experiment_ID))
         for channel in self.configurationManagers.keys():
             self.configurationManagers[channel].write_configuration(os.path.join(self.base_path,self.experiment_ID)+"/configurations_" + channel + ".xml") # save the configuration for the experiment
-        acquisition_parameters = {'dx(mm)':self.deltaX, 'Nx':self.NX, 'dy(mm)':self.deltaY, 'Ny':self.NY, 'dz(um)':self.deltaZ*1000,'Nz':self.NZ,'dt(s)':self.deltat,'Nt':self.Nt,'with AF':self.do_autofocus}
+        acquisition_parameters = {'dx(mm)':self.deltaX, 'Nx':self.NX, 'dy(mm)':self.deltaY, 'Ny':self.NY, 'dz(um)':self.deltaZ*1000,'Nz':self.NZ,'dt(s)':self.deltat,'Nt':self.Nt,'with AF':self.do_autofocus,'Ns':self.N_spectrum,'Ns mode':self.spectrum_accumulation_mode}
         f = open(os.path.join(self.base_path,self.experiment_ID)+"/acquisition parameters.json","w")
         f.write(json.dumps(acquisition_parameters))
         f.close()
+        if self.spectrumExtractor is not None and self.spectrumExtractor.wavelength_calibration is not None:
+            self.spectrumExtractor.wavelength_calibration.save(os.path.join(self.base_path,self.experiment_ID)+"/wavelength calibration.json")
 
     def set_selected_configurations(self, selected_configurations_name):
         self.selected_configurations = []
         for configuration_name in selected_configurations_name:
             for channel in self.configurationManagers.keys(): 
-                try:
-                    self.selected_configurations.append(next((config for config in self.configurationManagers[channel].configurations if config.name == configuration_name)))
-                except:
-                    pass
+                configuration = self.configurationManagers[channel].get_configuration_by_name(configuration_name)
+                if configuration is not None:
+                    self.selected_configurations.append(configuration)
 
     def run_acquisition(self): # @@@ to do: change name to run_experiment
         print('start multipoint')
@@ -1574,6 +2165,7 @@ class MultiPointController(QObject):
         self.multiPointWorker.finished.connect(self.multiPointWorker.deleteLater)
         self.multiPointWorker.finished.connect(self.thread.quit)
         self.multiPointWorker.image_to_display.connect(self.slot_image_to_display)
+        self.multiPointWorker.datacube_updated.connect(self.datacube_updated.emit)
         self.multiPointWorker.signal_current_configuration_spectrum.connect(self.slot_current_configuration_spectrum,type=Qt.BlockingQueuedConnection)
         self.multiPointWorker.signal_current_configuration_widefield.connect(self.slot_current_configuration_widefield,type=Qt.BlockingQueuedConnection)
         self.multiPointWorker.signal_current_channel.connect(self.slot_current_channel,type=Qt.BlockingQueuedConnection)
@@ -1757,7 +2349,7 @@ class TrackingController(QObject):
     def set_selected_configurations(self, selected_configurations_name):
         self.selected_configurations = []
         for configuration_name in selected_configurations_name:
-            self.selected_configurations.append(next((config for config in self.configurationManager.configurations if config.name == configuration_name)))
+            self.selected_configurations.append(self.configurationManager.get_configuration_by_name(configuration_name))
 
     def toggle_stage_tracking(self,state):
         self.flag_stage_tracking_enabled = state > 0
@@ -2276,19 +2868,75 @@ class ImageArrayDisplayWindow(QMainWindow):
         elif illumination_source == 13:
             self.graphics_widget_4.img.setImage(image,autoLevels=False)
 
+class XMLFileWriter(object):
+    # writes an xml tree to its file from a background thread: save() returns immediately and the write happens once
+    # there were no new save() for delay_s, so a burst of changes (e.g. dragging a slider) ends up in one write
+    # the file is replaced atomically (write to a temporary file, then rename), so it is never left half written
+    # the tree must only be modified while holding self.lock
+
+    def __init__(self,tree,filename,delay_s=CONFIGURATION_SAVE_DELAY_S):
+        self.tree = tree
+        self.filename = filename
+        self.delay_s = delay_s
+        self.lock = Lock()
+        self.write_lock = Lock()
+        self.save_requested = Event()
+        self.timestamp_last_save_request = 0
+        self.thread = Thread(target=self.run,daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def save(self):
+        self.timestamp_last_save_request = time.time()
+        self.save_requested.set()
+
+    def run(self):
+        while True:
+            self.save_requested.wait()
+            while True:
+                remaining_s = self.timestamp_last_save_request + self.delay_s - time.time()
+                if remaining_s <= 0:
+                    break
+                time.sleep(remaining_s)
+            self.flush()
+
+    def flush(self):
+        # writes now if a save is pending
+        with self.write_lock:
+            if not self.save_requested.is_set():
+                return
+            self.save_requested.clear()
+            self.write(self.filename)
+
+    def write(self,filename):
+        with self.lock:
+            data = ET.tostring(self.tree,encoding="utf-8",xml_declaration=True,pretty_print=True)
+        filename_temporary = filename + '.tmp'
+        with open(filename_temporary,'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename_temporary,filename)
+        instrumentation.count('configuration_manager.writes')
+
 class ConfigurationManager(QObject):
     def __init__(self,filename=str(Path.home()) + "/configurations_default.xml",channel=None):
         QObject.__init__(self)
         self.config_filename = filename
         self.configurations = []
+        self.configurations_by_id = {}
+        self.configurations_by_name = {}
+        self.modes_by_id = {} # the xml elements
         self.channel = channel
         self.read_configurations()
+        self.writer = XMLFileWriter(self.config_xml_tree,self.config_filename)
         
     def save_configurations(self):
-        self.write_configuration(self.config_filename)
+        # asynchronous, see XMLFileWriter
+        self.writer.save()
 
     def write_configuration(self,filename):
-        self.config_xml_tree.write(filename, encoding="utf-8", xml_declaration=True, pretty_print=True)
+        self.writer.write(filename)
 
     def read_configurations(self):
         if(os.path.isfile(self.config_filename)==False):
@@ -2298,27 +2946,37 @@ class ConfigurationManager(QObject):
         self.num_configurations = 0
         for mode in self.config_xml_tree_root.iter('mode'):
             self.num_configurations = self.num_configurations + 1
-            self.configurations.append(
-                Configuration(
-                    mode_id = mode.get('ID'),
-                    name = mode.get('Name'),
-                    exposure_time = float(mode.get('ExposureTime')),
-                    analog_gain = float(mode.get('AnalogGain')),
-                    illumination_source = int(mode.get('IlluminationSource')),
-                    illumination_intensity = float(mode.get('IlluminationIntensity')),
-                    camera_sn = mode.get('CameraSN'),
-                    channel = mode.get('Channel'),
-                    dac_led = float(mode.get('DAC_LED')),
-                    dac_laser = float(mode.get('DAC_Laser'))
-                )
+            configuration = Configuration(
+                mode_id = mode.get('ID'),
+                name = mode.get('Name'),
+                exposure_time = float(mode.get('ExposureTime')),
+                analog_gain = float(mode.get('AnalogGain')),
+                illumination_source = int(mode.get('IlluminationSource')),
+                illumination_intensity = float(mode.get('IlluminationIntensity')),
+                camera_sn = mode.get('CameraSN'),
+                channel = mode.get('Channel'),
+                dac_led = float(mode.get('DAC_LED')),
+                dac_laser = float(mode.get('DAC_Laser'))
             )
+            self.configurations.append(configuration)
+            self.configurations_by_id[configuration.id] = configuration
+            self.configurations_by_name.setdefault(configuration.name,configuration)
+            self.modes_by_id[configuration.id] = mode
+
+    def get_configuration(self,configuration_id):
+        return self.configurations_by_id.get(str(configuration_id))
+
+    def get_configuration_by_name(self,name):
+        return self.configurations_by_name.get(name)
 
     def update_configuration(self,configuration_id,attribute_name,new_value):
-        list = self.config_xml_tree_root.xpath("//mode[contains(@ID," + "'" + str(configuration_id) + "')]")
-        mode_to_update = list[0]
-        mode_to_update.set(attribute_name,str(new_value))
+        with self.writer.lock:
+            self.modes_by_id[str(configuration_id)].set(attribute_name,str(new_value))
         self.save_configurations()
 
+    def close(self):
+        self.writer.flush()
+
 class PlateReaderNavigationController(QObject):
 
     signal_homing_complete = Signal()
@@ -2341,11 +2999,19 @@ class PlateReaderNavigationController(QObject):
 
         self.is_homing = False
         self.is_scanning = False
+        # set after homing completes; cleared by invalidate_position() if steps may have been lost
+        self.position_is_trusted = False
+
+    def invalidate_position(self):
+        self.position_is_trusted = False
 
+    # relative x/y moves are manual jogs (plate reading moves to absolute well positions): home before the next pipelined run
     def move_x_usteps(self,usteps):
+        self.position_is_trusted = False
         self.microcontroller.move_x_usteps(usteps)
 
     def move_y_usteps(self,usteps):
+        self.position_is_trusted = False
         self.microcontroller.move_y_usteps(usteps)
 
     def move_z_usteps(self,usteps):
@@ -2403,7 +3069,13 @@ class PlateReaderNavigationController(QObject):
         else:
             self.z_pos_mm = z_pos*STAGE_POS_SIGN_Z*(SCREW_PITCH_Z_MM/(self.z_microstepping*FULLSTEPS_PER_REV_Z))
         # check homing status
-        if self.is_homing and self.microcontroller.mcu_cmd_execution_in_progress == False:
+        if self.is_homing and self.microcontroller._cmd_execution_status in (CMD_EXECUTION_STATUS.CMD_INVALID,CMD_EXECUTION_STATUS.CMD_EXECUTION_ERROR):
+            self.is_homing = False
+            self.position_is_trusted = False
+            print('homing failed')
+        elif self.is_homing and self.microcontroller.mcu_cmd_execution_in_progress == False:
+            self.is_homing = False
+            self.position_is_trusted = True
             self.signal_homing_complete.emit()
         # for debugging
         # print('X: ' + str(self.x_pos_mm) + ' Y: ' + str(self.y_pos_mm))
@@ -2423,8 +3095,9 @@ class PlateReaderNavigationController(QObject):
             self.signal_current_well.emit(row+column)
 
     def home(self):
-        self.is_homing = True
+        self.position_is_trusted = False
         self.microcontroller.home_xy()
+        self.is_homing = True
 
     def home_x(self):
         self.microcontroller.home_x()
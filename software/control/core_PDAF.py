@@ -16,6 +16,7 @@ import control.tracking as tracking
 from queue import Queue
 from threading import Thread, Lock
 import time
+import json
 import numpy as np
 import pyqtgraph as pg
 import cv2
@@ -33,6 +34,8 @@ class PDAFController(QObject):
     def __init__(self,internal_states):
         QObject.__init__(self)
         self.coefficient_shift2defocus = 1
+        self.shift_offset = 0
+        self.shift_axis = 0
         self.registration_upsample_factor = 5
         self.image1_received = False
         self.image2_received = False
@@ -67,7 +70,7 @@ class PDAFController(QObject):
         self.image1 = self.image1[(self.y-int(self.h/2)):(self.y+int(self.h/2)),(self.x-int(self.w/2)):(self.x+int(self.w/2))]
         self.image2 = self.image2[(self.y-int(self.h/2)):(self.y+int(self.h/2)),(self.x-int(self.w/2)):(self.x+int(self.w/2))] # additional offsets may need to be added
         shift = self._compute_shift_from_image_pair()
-        self.defocus = shift*self.coefficient_shift2defocus
+        self.defocus = (shift-self.shift_offset)*self.coefficient_shift2defocus
         self.image1_received = False
         self.image2_received = False
         self.locked = False
@@ -86,7 +89,16 @@ class PDAFController(QObject):
         # method 2: use skimage.registration.phase_cross_correlation
         shifts,error,phasediff = skimage.registration.phase_cross_correlation(self.image1,self.image2,upsample_factor=self.registration_upsample_factor,space='real')
         print(shifts) # for debugging
-        return shifts[0] # can be shifts[1] - depending on camera orientation
+        return shifts[self.shift_axis] # can be shifts[1] - depending on camera orientation
+
+    def load_calibration(self,filename):
+        # calibration file generated by tools/calibrate_PDAF.py
+        with open(filename) as f:
+            calibration = json.load(f)
+        self.coefficient_shift2defocus = calibration['coefficient_shift2defocus']
+        self.shift_offset = calibration.get('shift_offset',0)
+        self.shift_axis = calibration.get('shift_axis',0)
+        print('loaded PDAF calibration: ' + str(self.coefficient_shift2defocus) + ' um/pixel')
 
     def close(self):
         pass
@@ -0,0 +1,181 @@
+# set QT_API environment variable
+import os
+os.environ["QT_API"] = "pyqt5"
+import qtpy
+
+# qt libraries
+from qtpy.QtCore import *
+from qtpy.QtWidgets import *
+from qtpy.QtGui import *
+
+import numpy as np
+
+from control._def import *
+from control.microscope import Microscope, AcquisitionPlan, Configuration
+
+class MicroscopeController(QObject):
+
+    # thin Qt layer over control.microscope.Microscope: the acquisition runs in the microscope's worker thread,
+    # its events are re-emitted as signals (queued to the gui thread), nothing in the acquisition waits for the gui
+    # it has the interface of MultiPointController that MultiPointWidget uses, and replaces it in the single camera guis
+
+    acquisitionStarted = Signal()
+    acquisitionFinished = Signal()
+    image_to_display = Signal(np.ndarray)
+    image_to_display_multi = Signal(np.ndarray,int)
+    signal_current_configuration = Signal(Configuration)
+    signal_fov = Signal(int,int,int,int) # t, i, j, k
+    signal_result = Signal(object) # the dict returned by Microscope.acquire()
+
+    def __init__(self,microscope,navigationController=None,liveControllers=None,configurationManager=None):
+        QObject.__init__(self)
+        self.microscope = microscope
+        self.navigationController = navigationController # MultiPointWidget reads the microstepping from it
+        self.liveControllers = liveControllers if liveControllers is not None else {}
+        self.configurationManager = configurationManager
+        self.acquisition_in_progress = False
+        self.acquisitions_pending = 0 # plans submitted and not finished; live and the callbacks are restored after the last one
+        self.display_configuration_names = None # None: display every image
+        self.microscope.add_listener(self._on_microscope_event)
+
+        # the plan run by run_acquisition() without a plan, set by MultiPointWidget
+        self.NX = 1
+        self.NY = 1
+        self.NZ = 1
+        self.Nt = 1
+        self.deltaX = Acquisition.DX
+        self.deltaY = Acquisition.DY
+        self.deltaZ = Acquisition.DZ/1000
+        self.deltat = 0
+        self.do_autofocus = False
+        self.N_spectrum = 1
+        self.spectrum_accumulation_mode = SPECTRUM_ACCUMULATION.MODE
+        self.keep_raw_spectrum_frames = SPECTRUM_ACCUMULATION.KEEP_RAW_FRAMES
+        self.experiment_ID = None
+        self.base_path = None
+        self.selected_configurations = []
+
+    def set_NX(self,N):
+        self.NX = N
+    def set_NY(self,N):
+        self.NY = N
+    def set_NZ(self,N):
+        self.NZ = N
+    def set_Nt(self,N):
+        self.Nt = N
+    def set_deltaX(self,delta):
+        self.deltaX = delta
+    def set_deltaY(self,delta):
+        self.deltaY = delta
+    def set_deltaZ(self,delta_um):
+        self.deltaZ = delta_um/1000
+    def set_deltat(self,delta):
+        self.deltat = delta
+    def set_af_flag(self,flag):
+        self.do_autofocus = flag
+    def set_N_spectrum(self,N):
+        self.N_spectrum = N
+    def set_spectrum_accumulation_mode(self,mode):
+        self.spectrum_accumulation_mode = mode
+    def set_keep_raw_spectrum_frames(self,flag):
+        self.keep_raw_spectrum_frames = flag
+
+    def set_base_path(self,path):
+        self.base_path = path
+
+    def start_new_experiment(self,experiment_ID):
+        # the folder is created by Microscope.acquire(), with the time stamp of the start of the acquisition
+        self.experiment_ID = experiment_ID
+
+    def set_selected_configurations(self,selected_configurations_name):
+        self.selected_configurations = []
+        for configuration_name in selected_configurations_name:
+            if self.configurationManager is not None:
+                configuration = self.configurationManager.get_configuration_by_name(configuration_name)
+                if configuration is not None:
+                    self.selected_configurations.append(configuration)
+            else:
+                self.selected_configurations.append(configuration_name)
+
+    def get_plan(self):
+        return AcquisitionPlan(NX=self.NX,NY=self.NY,NZ=self.NZ,Nt=self.Nt,deltaX_mm=self.deltaX,deltaY_mm=self.deltaY,deltaZ_um=self.deltaZ*1000,
+                               deltat_s=self.deltat,configurations=list(self.selected_configurations),N_spectrum=self.N_spectrum,
+                               do_autofocus=self.do_autofocus,base_path=self.base_path,experiment_ID=self.experiment_ID if self.experiment_ID is not None else 'acquisition',
+                               spectrum_accumulation=self.spectrum_accumulation_mode,keep_raw_spectrum_frames=self.keep_raw_spectrum_frames)
+
+    def run_acquisition(self,plan=None):
+        # plan: AcquisitionPlan, None: the plan set through the MultiPointController interface
+        if plan is None:
+            plan = self.get_plan()
+        if self.acquisition_in_progress:
+            print('acquisition in progress, the plan is queued')
+        else:
+            # live is stopped for the duration of the acquisition and restored afterwards
+            for liveController in self.liveControllers.values():
+                liveController.was_live_before_multipoint = liveController.is_live
+                if liveController.is_live:
+                    liveController.stop_live()
+            # frames are read with read_frame() during the acquisition, the callbacks are restored afterwards
+            for camera in self.microscope.cameras.values():
+                camera.callback_was_enabled_before_multipoint = getattr(camera,'callback_is_enabled',False)
+                if camera.callback_was_enabled_before_multipoint:
+                    camera.stop_streaming()
+                    camera.disable_callback()
+                    camera.start_streaming()
+        self.acquisition_in_progress = True
+        self.acquisitions_pending = self.acquisitions_pending + 1
+        self.acquisitionStarted.emit()
+        future = self.microscope.submit(plan)
+        # also when acquire() raised before the acquisition started, e.g. for a plan without base_path
+        future.add_done_callback(self._on_plan_done)
+        return future
+
+    def request_abort_aquisition(self):
+        self.microscope.abort()
+
+    def _on_microscope_event(self,event,*data):
+        # called from the acquisition thread
+        if event == 'configuration':
+            self.signal_current_configuration.emit(data[0])
+        elif event == 'image':
+            image, configuration, index = data
+            if self.display_configuration_names is None or configuration.name in self.display_configuration_names:
+                self.image_to_display.emit(image)
+                self.image_to_display_multi.emit(image,int(configuration.id) if configuration.id is not None else -1)
+        elif event == 'fov':
+            self.signal_fov.emit(*data[0])
+        elif event == 'finished':
+            result = data[0]
+            if self.configurationManager is not None and result['experiment_path'] is not None:
+                # save the configuration for the experiment
+                self.configurationManager.write_configuration(os.path.join(result['experiment_path'],'configurations.xml'))
+            self.signal_result.emit(result)
+
+    def _on_plan_done(self,future):
+        # called from the acquisition thread
+        if future.exception() is not None:
+            print('acquisition error: ' + repr(future.exception()))
+        QMetaObject.invokeMethod(self,'_on_acquisition_completed',Qt.QueuedConnection)
+
+    @Slot()
+    def _on_acquisition_completed(self):
+        self.acquisitions_pending = self.acquisitions_pending - 1
+        if self.acquisitions_pending > 0:
+            return
+        self.acquisition_in_progress = False
+        for camera in self.microscope.cameras.values():
+            if getattr(camera,'callback_was_enabled_before_multipoint',False):
+                camera.stop_streaming()
+                camera.enable_callback()
+                camera.start_streaming()
+                camera.callback_was_enabled_before_multipoint = False
+        for liveController in self.liveControllers.values():
+            if liveController.was_live_before_multipoint:
+                liveController.start_live()
+        self.acquisitionFinished.emit()
+
+    def set_display_configurations(self,configuration_names):
+        self.display_configuration_names = configuration_names
+
+    def close(self):
+        self.microscope.remove_listener(self._on_microscope_event)
@@ -26,6 +26,262 @@ from pathlib import Path
 import control.utils_config as utils_config
 
 import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+class PlateScheduler(object):
+
+    # well coordinate table in microsteps + visiting order that minimizes the estimated travel time
+
+    def __init__(self,plate_format='96',x_microstepping=MICROSTEPPING_DEFAULT_X,y_microstepping=MICROSTEPPING_DEFAULT_Y):
+        self.x_microstepping = x_microstepping
+        self.y_microstepping = y_microstepping
+        self.calibration_offset_x_mm = 0
+        self.calibration_offset_y_mm = 0
+        self.wells = []
+        self.set_plate_format(plate_format)
+
+    def set_plate_format(self,plate_format):
+        self.plate_format = plate_format
+        self.number_of_rows = WELLPLATE_FORMATS[plate_format]['rows']
+        self.number_of_columns = WELLPLATE_FORMATS[plate_format]['columns']
+        # the row and column spacings of the plate reader (calibrated for 96 well plates), scaled to the format
+        scale = WELLPLATE_FORMATS[plate_format]['well_spacing_mm']/WELLPLATE_FORMATS['96']['well_spacing_mm']
+        self.row_spacing_mm = PLATE_READER.ROW_SPACING_MM*scale
+        self.column_spacing_mm = PLATE_READER.COLUMN_SPACING_MM*scale
+        self.wells = [well for well in self.wells if well[0] < self.number_of_rows and well[1] < self.number_of_columns]
+        self._update_coordinates()
+
+    def set_calibration_offset(self,offset_x_mm,offset_y_mm):
+        # measured position of A1 minus its nominal position, for the plate currently loaded
+        self.calibration_offset_x_mm = offset_x_mm
+        self.calibration_offset_y_mm = offset_y_mm
+        self._update_coordinates()
+
+    def _update_coordinates(self):
+        # stage coordinates of every well of the plate, in microsteps, indexed [row,column]
+        mm_per_ustep_X = SCREW_PITCH_X_MM/(self.x_microstepping*FULLSTEPS_PER_REV_X)
+        mm_per_ustep_Y = SCREW_PITCH_Y_MM/(self.y_microstepping*FULLSTEPS_PER_REV_Y)
+        offset = WELLPLATE_FORMATS[self.plate_format]['A1_offset_relative_to_96_mm']
+        self.x_mm = PLATE_READER.OFFSET_COLUMN_1_MM + offset + self.calibration_offset_x_mm + np.arange(self.number_of_columns)*self.column_spacing_mm
+        self.y_mm = PLATE_READER.OFFSET_ROW_A_MM + offset + self.calibration_offset_y_mm + np.arange(self.number_of_rows)*self.row_spacing_mm
+        self.x_usteps = np.round(self.x_mm/mm_per_ustep_X).astype(int)
+        self.y_usteps = np.round(self.y_mm/mm_per_ustep_Y).astype(int)
+
+    def well_name(self,row,column):
+        return chr(ord('A')+row) + str(column+1)
+
+    def parse_wells(self,wells_str):
+        # e.g. 'A1-B12, C3, H' (rectangular ranges, single wells, whole rows or columns)
+        wells = []
+        for token in wells_str.upper().replace(' ','').split(','):
+            if token == '':
+                continue
+            corners = []
+            for part in token.split('-'):
+                match = re.fullmatch(r'([A-Z]?)(\d*)',part)
+                if match is None or part == '':
+                    raise ValueError('invalid well: ' + part)
+                corners.append(match.groups())
+            if len(corners) == 1:
+                corners = corners*2
+            rows = [ord(c[0])-ord('A') if c[0] else None for c in corners]
+            columns = [int(c[1])-1 if c[1] else None for c in corners]
+            if None not in columns and min(columns) < 0:
+                raise ValueError('invalid well: ' + token + ' (columns start at 1)')
+            row_range = range(min(rows),max(rows)+1) if None not in rows else range(self.number_of_rows)
+            column_range = range(min(columns),max(columns)+1) if None not in columns else range(self.number_of_columns)
+            for row in row_range:
+                for column in column_range:
+                    if row >= self.number_of_rows or column >= self.number_of_columns:
+                        raise ValueError('well ' + self.well_name(row,column) + ' is not on a ' + self.plate_format + ' well plate')
+                    if (row,column) not in wells:
+                        wells.append((row,column))
+        return wells
+
+    def set_wells(self,wells):
+        # wells: list of (row, column), starting from 0
+        self.wells = list(wells)
+
+    def set_columns(self,columns):
+        # columns: starting from 1, as in PlateReadingController.set_selected_columns
+        self.wells = [(row,column-1) for column in columns for row in range(self.number_of_rows)]
+
+    def get_well_coordinates_usteps(self,wells):
+        wells = np.array(wells,dtype=int).reshape(-1,2)
+        return np.stack((self.x_usteps[wells[:,1]],self.y_usteps[wells[:,0]]),axis=1)
+
+    def move_time(self,dx_mm,dy_mm):
+        # x and y are moved simultaneously, each with a trapezoidal velocity profile
+        return np.maximum(self._axis_move_time(np.abs(dx_mm),MAX_VELOCITY_X_mm,MAX_ACCELERATION_X_mm),self._axis_move_time(np.abs(dy_mm),MAX_VELOCITY_Y_mm,MAX_ACCELERATION_Y_mm))
+
+    def _axis_move_time(self,distance,v_max,a_max):
+        # triangular profile when the distance is too short to reach v_max
+        return np.where(distance < v_max**2/a_max,2*np.sqrt(distance/a_max),distance/v_max + v_max/a_max)
+
+    def _path_time(self,order,start_mm,positions_mm):
+        path = np.concatenate(([start_mm],positions_mm[order]))
+        return float(np.sum(self.move_time(np.diff(path[:,0]),np.diff(path[:,1]))))
+
+    def get_visiting_order(self,start_mm=(0,0)):
+        # returns the wells in the order they should be visited
+        # candidates: serpentine by column (the original order), serpentine by row and nearest neighbour refined with 2-opt; the fastest is used
+        if len(self.wells) < 2:
+            return list(self.wells)
+        wells = np.array(self.wells,dtype=int)
+        positions_mm = np.stack((self.x_mm[wells[:,1]],self.y_mm[wells[:,0]]),axis=1)
+        start_mm = np.array(start_mm,dtype=float)
+        candidates = [self._serpentine_order(wells,0),self._serpentine_order(wells,1),self._two_opt(self._nearest_neighbour_order(start_mm,positions_mm),start_mm,positions_mm)]
+        times = [self._path_time(order,start_mm,positions_mm) for order in candidates]
+        order = candidates[int(np.argmin(times))]
+        return [tuple(well) for well in wells[order].tolist()]
+
+    def _serpentine_order(self,wells,major_axis):
+        # major_axis 0: column by column (rows in alternating direction), 1: row by row
+        major = wells[:,1-major_axis]
+        minor = wells[:,major_axis]
+        rank = np.searchsorted(np.unique(major),major)
+        minor = np.where(rank%2 == 0,minor,-minor)
+        return np.lexsort((minor,major))
+
+    def _nearest_neighbour_order(self,start_mm,positions_mm):
+        n = len(positions_mm)
+        visited = np.zeros(n,dtype=bool)
+        order = []
+        current = start_mm
+        for i in range(n):
+            t = self.move_time(positions_mm[:,0]-current[0],positions_mm[:,1]-current[1])
+            t[visited] = np.inf
+            j = int(np.argmin(t))
+            order.append(j)
+            visited[j] = True
+            current = positions_mm[j]
+        return np.array(order)
+
+    def _two_opt(self,order,start_mm,positions_mm,max_passes=20):
+        # open path with a fixed start - reversing path[i:j+1] replaces edges (i-1,i) and (j,j+1) with (i-1,j) and (i,j+1)
+        points = np.concatenate(([start_mm],positions_mm))
+        T = self.move_time(points[:,0][:,None]-points[:,0][None,:],points[:,1][:,None]-points[:,1][None,:])
+        path = np.concatenate(([0],order+1))
+        n = len(path)
+        for p in range(max_passes):
+            improved = False
+            for i in range(1,n-1):
+                j = np.arange(i+1,n)
+                after = np.append(path[j[:-1]+1],-1)
+                old = T[path[i-1],path[i]] + np.where(after >= 0,T[path[j],after],0)
+                new = T[path[i-1],path[j]] + np.where(after >= 0,T[path[i],after],0)
+                gain = old - new
+                k = int(np.argmax(gain))
+                if gain[k] > 1e-9:
+                    path[i:j[k]+1] = path[i:j[k]+1][::-1].copy()
+                    improved = True
+            if improved == False:
+                break
+        return path[1:]-1
+
+    def estimate_time(self,wells,configurations,NZ=1,start_mm=(0,0),homing=False,overhead_per_image_s=0.05):
+        # dry-run estimate in seconds: travel + settling + exposures
+        # homing: the stage goes from start_mm to the origin first, and from there to the wells
+        wells = np.array(wells,dtype=int).reshape(-1,2)
+        if len(wells) == 0:
+            return 0
+        positions_mm = np.stack((self.x_mm[wells[:,1]],self.y_mm[wells[:,0]]),axis=1)
+        if homing:
+            travel_time = float(self.move_time(start_mm[0],start_mm[1])) + self._path_time(np.arange(len(wells)),np.zeros(2),positions_mm)
+        else:
+            travel_time = self._path_time(np.arange(len(wells)),np.array(start_mm,dtype=float),positions_mm)
+        settling_time = len(wells)*SCAN_STABILIZATION_TIME_MS_Y/1000
+        if NZ > 1:
+            settling_time = settling_time + len(wells)*NZ*SCAN_STABILIZATION_TIME_MS_Z/1000
+        exposure_time = len(wells)*NZ*sum([config.exposure_time/1000 + overhead_per_image_s for config in configurations])
+        return travel_time + settling_time + exposure_time
+
+class WellStatisticsCalculator(object):
+
+    # per-well reduction of plate reader images, computed on a thread pool while the stage moves
+    # well mask: centered circle; background: pixels outside a larger centered circle
+
+    def __init__(self,max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.mask_diameter_fraction = 0.8 # relative to the shorter side of the image
+        self.background_diameter_fraction = 1.0
+        self.spectrum_mask = None
+        self.futures = []
+        self.spectra = []
+        self._masks = {}
+
+    def set_mask_diameter(self,mask_diameter_fraction,background_diameter_fraction=None):
+        self.mask_diameter_fraction = mask_diameter_fraction
+        if background_diameter_fraction is not None:
+            self.background_diameter_fraction = background_diameter_fraction
+
+    def set_spectrum_mask(self,mask):
+        # weights for spectrum extraction (summed along rows, as in SpectrumExtractor), None to disable
+        self.spectrum_mask = None if mask is None else np.asarray(mask,dtype=np.float32)
+
+    def _get_masks(self,shape,mask_diameter_fraction,background_diameter_fraction):
+        key = (shape,mask_diameter_fraction,background_diameter_fraction)
+        masks = self._masks.get(key)
+        if masks is None:
+            height, width = shape
+            y, x = np.ogrid[:height,:width]
+            r2 = (y - (height-1)/2)**2 + (x - (width-1)/2)**2
+            d = min(height,width)
+            well_mask = r2 <= (mask_diameter_fraction*d/2)**2
+            background_mask = r2 > (background_diameter_fraction*d/2)**2
+            masks = (well_mask,background_mask)
+            self._masks[key] = masks
+        return masks
+
+    def submit(self,image,well,configuration_name,z_index=0):
+        # the image is copied (camera frames may come from a ring of reused buffers) and the masks are the ones set when it is submitted
+        self.futures.append(self.executor.submit(self._compute,np.copy(image),well,configuration_name,z_index,
+            self.mask_diameter_fraction,self.background_diameter_fraction,self.spectrum_mask))
+
+    def _compute(self,image,well,configuration_name,z_index,mask_diameter_fraction,background_diameter_fraction,spectrum_mask):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image,cv2.COLOR_RGB2GRAY)
+        well_mask, background_mask = self._get_masks(image.shape,mask_diameter_fraction,background_diameter_fraction)
+        pixels = image[well_mask]
+        background = float(np.median(image[background_mask])) if background_mask.any() else 0.0
+        total = float(np.sum(pixels,dtype=np.float64))
+        result = {'well':well,'configuration':configuration_name,'z':z_index,
+                  'mean':total/pixels.size,'median':float(np.median(pixels)),'background':background,
+                  'total':total,'total_background_subtracted':total - background*pixels.size,'n_pixels':int(pixels.size)}
+        spectrum = None
+        if spectrum_mask is not None and spectrum_mask.shape == image.shape:
+            spectrum = np.sum(spectrum_mask*(image - np.float32(background)),axis=0)
+        return result, spectrum
+
+    def write_table(self,path,table_format='csv'):
+        # waits for the pending computations and writes one table (plus spectra.npy if enabled) per plate
+        results = []
+        spectra = []
+        for future in self.futures:
+            result, spectrum = future.result()
+            if spectrum is not None:
+                result['spectrum_index'] = len(spectra)
+                spectra.append(spectrum)
+            results.append(result)
+        self.futures = []
+        df = pd.DataFrame(results)
+        saved = False
+        if table_format == 'parquet':
+            try:
+                df.to_parquet(os.path.join(path,'well_statistics.parquet'),index=False)
+                saved = True
+            except ImportError:
+                print('parquet support (pyarrow) not available, saving as csv')
+        if saved == False:
+            df.to_csv(os.path.join(path,'well_statistics.csv'),index=False)
+        if len(spectra) > 0:
+            np.save(os.path.join(path,'spectra.npy'),np.stack(spectra))
+        return df
+
+    def close(self):
+        self.executor.shutdown(wait=True)
 
 class PlateReadingWorker(QObject):
 
@@ -67,6 +323,14 @@ class PlateReadingWorker(QObject):
         self.abort_acquisition_requested = False
         self.selected_configurations = self.plateReadingController.selected_configurations
         self.selected_columns = self.plateReadingController.selected_columns
+        self.plateScheduler = self.plateReadingController.plateScheduler
+        self.pipelined = self.plateReadingController.pipelined
+        self.imageSaver = self.plateReadingController.imageSaver
+        self.wellStatisticsCalculator = self.plateReadingController.wellStatisticsCalculator
+        self.do_well_statistics = self.plateReadingController.do_well_statistics
+        self.save_raw_images = self.plateReadingController.save_raw_images
+        self.table_format = self.plateReadingController.table_format
+        self.current_configuration = None
 
     def run(self):
         self.abort_acquisition_requested = False
@@ -74,11 +338,11 @@ class PlateReadingWorker(QObject):
         while self.time_point < self.Nt and self.abort_acquisition_requested == False:
             # continous acquisition
             if self.dt == 0:
-                self.run_single_time_point()
+                self._run_single_time_point()
                 self.time_point = self.time_point + 1
             # timed acquisition
             else:
-                self.run_single_time_point()
+                self._run_single_time_point()
                 self.time_point = self.time_point + 1
                 # check if the aquisition has taken longer than dt or integer multiples of dt, if so skip the next time point(s)
                 while time.time() > self.timestamp_acquisition_started + self.time_point*self.dt:
@@ -90,118 +354,246 @@ class PlateReadingWorker(QObject):
                 while time.time() < self.timestamp_acquisition_started + self.time_point*self.dt:
                     time.sleep(0.05)
         self.plateReaderNavigationController.is_scanning = False
+        if self.pipelined:
+            self.imageSaver.wait_till_all_images_are_saved()
         self.finished.emit()
 
     def wait_till_operation_is_completed(self):
         while self.microcontroller.is_busy():
             time.sleep(SLEEP_TIME_S)
 
-    def run_single_time_point(self):
+    def _run_single_time_point(self):
+        if self.pipelined:
+            self.run_single_time_point_pipelined()
+        else:
+            self.run_single_time_point()
+        if self.do_well_statistics:
+            self.wellStatisticsCalculator.write_table(os.path.join(self.base_path,self.experiment_ID,str(self.time_point)),self.table_format)
+
+    def get_wells(self):
+        # (row, column) in visiting order, both starting from 0
+        if self.plateReaderNavigationController.position_is_trusted and self.pipelined:
+            start_mm = (self.plateReaderNavigationController.x_pos_mm,self.plateReaderNavigationController.y_pos_mm)
+        else:
+            start_mm = (0,0) # home
+        return self.plateScheduler.get_visiting_order(start_mm)
+
+    def move_to_well(self,well,previous_well=None):
+        # move x and y simultaneously, using the precomputed coordinate table
+        x_usteps, y_usteps = self.plateScheduler.get_well_coordinates_usteps([well])[0]
+        if previous_well is None or previous_well[1] != well[1]:
+            self.plateReaderNavigationController.move_x_to_usteps(int(x_usteps))
+        if previous_well is None or previous_well[0] != well[0]:
+            self.plateReaderNavigationController.move_y_to_usteps(int(y_usteps))
+
+    def set_configuration(self,config):
+        # configurations are only re-applied when they change
+        if config is not self.current_configuration:
+            self.signal_current_configuration.emit(config)
+            self.wait_till_operation_is_completed()
+            self.current_configuration = config
+
+    def run_single_time_point_pipelined(self):
+        # differences from run_single_time_point():
+        # - homing only when the stage position is not trusted
+        # - the move to the next well is issued as soon as the last exposure at the current well ends, image cropping, display and saving overlap with the move
+        # - saving (encoding + disk io) runs in a background thread
+        # - the configuration order is reversed at every other well, so the last configuration of a well is reused at the next one
+        # - illumination stays on between consecutive captures that use the same source and intensity
         self.FOV_counter = 0
-        column_counter = 0
-        print('multipoint acquisition - time point ' + str(self.time_point+1))
-        
+        self.current_configuration = None
+        print('plate reading (pipelined) - time point ' + str(self.time_point+1))
+
         # for each time point, create a new folder
         current_path = os.path.join(self.base_path,self.experiment_ID,str(self.time_point))
         os.mkdir(current_path)
 
         # run homing
-        self.plateReaderNavigationController.home()
-        self.wait_till_operation_is_completed()
+        if self.plateReaderNavigationController.position_is_trusted == False:
+            self.plateReaderNavigationController.home()
+            self.wait_till_operation_is_completed()
+            # is_homing is cleared with the next position packet, as completed or failed
+            while self.plateReaderNavigationController.is_homing:
+                time.sleep(SLEEP_TIME_S)
+            if self.plateReaderNavigationController.position_is_trusted == False:
+                print('homing did not complete, plate reading aborted')
+                return
 
-        # row scan direction
-        row_scan_direction = 1 # 1: A -> H, 0: H -> A
+        wells = self.get_wells()
+        if len(wells) == 0:
+            return
 
-        # go through columns
-        for column in self.selected_columns:
-            
-            # increament counter
-            column_counter = column_counter + 1
+        # move to the first well
+        self.move_to_well(wells[0])
+
+        for i,(row,column) in enumerate(wells):
             
-            # move to the current column
-            self.plateReaderNavigationController.moveto_column(column-1)
+            file_ID = self.plateScheduler.well_name(row,column)
+
+            # wait for the move to complete
             self.wait_till_operation_is_completed()
-            
-            '''
-            # row homing
-            if column_counter > 1:
-                self.plateReaderNavigationController.home_y()
-                self.wait_till_operation_is_completed()
-            '''
-            
-            # go through rows
-            for row in range(PLATE_READER.NUMBER_OF_ROWS):
+            time.sleep(SCAN_STABILIZATION_TIME_MS_Y/1000)
 
-                if row_scan_direction == 0: # reverse scan:
-                    row = PLATE_READER.NUMBER_OF_ROWS - 1 -row
+            # AF
+            if (self.NZ == 1) and (self.do_autofocus) and (self.FOV_counter%Acquisition.NUMBER_OF_FOVS_PER_AF==0):
+                configuration_name_AF = 'BF LED matrix full'
+                config_AF = self.configurationManager.get_configuration_by_name(configuration_name_AF)
+                self.set_configuration(config_AF)
+                self.autofocusController.autofocus()
+                self.autofocusController.wait_till_autofocus_has_completed()
 
-                row_str = chr(ord('A')+row)
-                file_ID = row_str + str(column)
+            # configuration order
+            configurations = self.selected_configurations if i%2 == 0 else self.selected_configurations[::-1]
 
-                # move to the selected row
-                self.plateReaderNavigationController.moveto_row(row)
-                self.wait_till_operation_is_completed()
-                time.sleep(SCAN_STABILIZATION_TIME_MS_Y/1000)
-                
-                # AF
-                if (self.NZ == 1) and (self.do_autofocus) and (self.FOV_counter%Acquisition.NUMBER_OF_FOVS_PER_AF==0):
-                    configuration_name_AF = 'BF LED matrix full'
-                    config_AF = next((config for config in self.configurationManager.configurations if config.name == configuration_name_AF))
-                    self.signal_current_configuration.emit(config_AF)
-                    self.autofocusController.autofocus()
-                    self.autofocusController.wait_till_autofocus_has_completed()
-
-                # z stack
-                for k in range(self.NZ):
-
-                    if(self.NZ > 1):
-                        # update file ID
-                        file_ID = file_ID + '_' + str(k)
-                        # maneuver for achiving uniform step size and repeatability when using open-loop control
-                        self.plateReaderNavigationController.move_z_usteps(80)
-                        self.wait_till_operation_is_completed()
-                        self.plateReaderNavigationController.move_z_usteps(-80)
-                        self.wait_till_operation_is_completed()
-                        time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+            captured_images = []
+            for k in range(self.NZ):
 
-                    # iterate through selected modes
-                    for config in self.selected_configurations:
-                        self.signal_current_configuration.emit(config)
-                        self.wait_till_operation_is_completed()
+                if self.NZ > 1:
+                    # maneuver for achiving uniform step size and repeatability when using open-loop control
+                    self.plateReaderNavigationController.move_z_usteps(80)
+                    self.wait_till_operation_is_completed()
+                    self.plateReaderNavigationController.move_z_usteps(-80)
+                    self.wait_till_operation_is_completed()
+                    time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+
+                for j,config in enumerate(configurations):
+                    self.set_configuration(config)
+                    if self.liveController.illumination_on == False:
                         self.liveController.turn_on_illumination()
                         self.wait_till_operation_is_completed()
-                        self.camera.send_trigger() 
-                        image = self.camera.read_frame()
+                    self.camera.send_trigger()
+                    # read_frame() returns an array of the caller (kept until the well is done), or None on a timeout
+                    image = self.camera.read_frame()
+                    next_config = configurations[j+1] if j+1 < len(configurations) else None
+                    if next_config is None or (next_config.illumination_source,next_config.illumination_intensity) != (config.illumination_source,config.illumination_intensity):
                         self.liveController.turn_off_illumination()
-                        image = utils.crop_image(image,self.crop_width,self.crop_height)
-                        saving_path = os.path.join(current_path, file_ID + '_' + str(config.name) + '.' + Acquisition.IMAGE_FORMAT)
-                        # self.image_to_display.emit(cv2.resize(image,(round(self.crop_width*self.display_resolution_scaling), round(self.crop_height*self.display_resolution_scaling)),cv2.INTER_LINEAR))
-                        # image_to_display = utils.crop_image(image,round(self.crop_width*self.liveController.display_resolution_scaling), round(self.crop_height*self.liveController.display_resolution_scaling))
-                        image_to_display = utils.crop_image(image,round(self.crop_width), round(self.crop_height))
-                        self.image_to_display.emit(image_to_display)
-                        self.image_to_display_multi.emit(image_to_display,config.illumination_source)
+                    if image is None:
+                        print('no frame from the camera, ' + file_ID + ' ' + str(config.name) + ' is skipped')
+                        continue
+                    captured_images.append((image,file_ID + ('_' + str(k) if self.NZ > 1 else '') + '_' + str(config.name),config,k))
+
+                if self.NZ > 1:
+                    if k < self.NZ - 1:
+                        self.plateReaderNavigationController.move_z_usteps(self.deltaZ_usteps)
+                        self.wait_till_operation_is_completed()
+                        time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+                    else:
+                        # move z back
+                        self.plateReaderNavigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
+                        self.wait_till_operation_is_completed()
+
+            # all exposures at this well are done - start moving to the next well
+            if i + 1 < len(wells) and self.abort_acquisition_requested == False:
+                self.move_to_well(wells[i+1],wells[i])
+
+            # process the images while the stage is moving
+            for image, image_name, config, k in captured_images:
+                image = utils.crop_image(image,self.crop_width,self.crop_height)
+                self.image_to_display.emit(image)
+                self.image_to_display_multi.emit(image,config.illumination_source)
+                if self.do_well_statistics:
+                    self.wellStatisticsCalculator.submit(image,file_ID,config.name,k)
+                if self.save_raw_images:
+                    saving_path = os.path.join(current_path, image_name + '.' + Acquisition.IMAGE_FORMAT)
+                    self.imageSaver.enqueue(image,saving_path,self.camera.is_color)
+
+            self.FOV_counter = self.FOV_counter + 1
+
+            if self.abort_acquisition_requested:
+                self.wait_till_operation_is_completed()
+                # the stage may have been stopped or moved by hand meanwhile, the next run homes again
+                self.plateReaderNavigationController.invalidate_position()
+                return
+
+    def run_single_time_point(self):
+        self.FOV_counter = 0
+        print('multipoint acquisition - time point ' + str(self.time_point+1))
+        
+        # for each time point, create a new folder
+        current_path = os.path.join(self.base_path,self.experiment_ID,str(self.time_point))
+        os.mkdir(current_path)
+
+        # run homing
+        self.plateReaderNavigationController.home()
+        self.wait_till_operation_is_completed()
+
+        # go through wells (by default: columns in ascending order, rows in alternating direction)
+        previous_well = None
+        for well in self.get_wells():
+
+            row, column = well
+            file_ID = self.plateScheduler.well_name(row,column)
+
+            # move to the selected well
+            self.move_to_well(well,previous_well)
+            self.wait_till_operation_is_completed()
+            time.sleep(SCAN_STABILIZATION_TIME_MS_Y/1000)
+            previous_well = well
+            
+            # AF
+            if (self.NZ == 1) and (self.do_autofocus) and (self.FOV_counter%Acquisition.NUMBER_OF_FOVS_PER_AF==0):
+                configuration_name_AF = 'BF LED matrix full'
+                config_AF = self.configurationManager.get_configuration_by_name(configuration_name_AF)
+                self.signal_current_configuration.emit(config_AF)
+                self.autofocusController.autofocus()
+                self.autofocusController.wait_till_autofocus_has_completed()
+
+            # z stack
+            for k in range(self.NZ):
+
+                if(self.NZ > 1):
+                    # update file ID
+                    file_ID = file_ID + '_' + str(k)
+                    # maneuver for achiving uniform step size and repeatability when using open-loop control
+                    self.plateReaderNavigationController.move_z_usteps(80)
+                    self.wait_till_operation_is_completed()
+                    self.plateReaderNavigationController.move_z_usteps(-80)
+                    self.wait_till_operation_is_completed()
+                    time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+
+                # iterate through selected modes
+                for config in self.selected_configurations:
+                    self.signal_current_configuration.emit(config)
+                    self.wait_till_operation_is_completed()
+                    self.liveController.turn_on_illumination()
+                    self.wait_till_operation_is_completed()
+                    self.camera.send_trigger() 
+                    # read_frame() returns an array of the caller, or None on a timeout
+                    image = self.camera.read_frame()
+                    self.liveController.turn_off_illumination()
+                    if image is None:
+                        print('no frame from the camera, ' + file_ID + '_' + str(config.name) + ' is skipped')
+                        continue
+                    image = utils.crop_image(image,self.crop_width,self.crop_height)
+                    saving_path = os.path.join(current_path, file_ID + '_' + str(config.name) + '.' + Acquisition.IMAGE_FORMAT)
+                    # self.image_to_display.emit(cv2.resize(image,(round(self.crop_width*self.display_resolution_scaling), round(self.crop_height*self.display_resolution_scaling)),cv2.INTER_LINEAR))
+                    # image_to_display = utils.crop_image(image,round(self.crop_width*self.liveController.display_resolution_scaling), round(self.crop_height*self.liveController.display_resolution_scaling))
+                    image_to_display = utils.crop_image(image,round(self.crop_width), round(self.crop_height))
+                    self.image_to_display.emit(image_to_display)
+                    self.image_to_display_multi.emit(image_to_display,config.illumination_source)
+                    if self.do_well_statistics:
+                        self.wellStatisticsCalculator.submit(image,self.plateScheduler.well_name(row,column),config.name,k)
+                    if self.save_raw_images:
                         if self.camera.is_color:
                             image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
                         cv2.imwrite(saving_path,image)
-                        QApplication.processEvents()
-
-                    if(self.NZ > 1):
-                        # move z
-                        if k < self.NZ - 1:
-                            self.plateReaderNavigationController.move_z_usteps(self.deltaZ_usteps)
-                            self.wait_till_operation_is_completed()
-                            time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
+                    QApplication.processEvents()
 
-                if self.NZ > 1:
-                    # move z back
-                    self.plateReaderNavigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
-                    self.wait_till_operation_is_completed()
+                if(self.NZ > 1):
+                    # move z
+                    if k < self.NZ - 1:
+                        self.plateReaderNavigationController.move_z_usteps(self.deltaZ_usteps)
+                        self.wait_till_operation_is_completed()
+                        time.sleep(SCAN_STABILIZATION_TIME_MS_Z/1000)
 
-                if self.abort_acquisition_requested:
-                    return
+            if self.NZ > 1:
+                # move z back
+                self.plateReaderNavigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
+                self.wait_till_operation_is_completed()
 
-            # update row scan direction
-            row_scan_direction = 1 - row_scan_direction
+            if self.abort_acquisition_requested:
+                self.plateReaderNavigationController.invalidate_position()
+                return
 
 class PlateReadingController(QObject):
 
@@ -242,6 +634,13 @@ class PlateReadingController(QObject):
         self.base_path = None
         self.selected_configurations = []
         self.selected_columns = []
+        self.pipelined = False
+        self.imageSaver = ImageSaver_MultiPointAcquisition()
+        self.plateScheduler = PlateScheduler('96',self.plateReaderNavigationController.x_microstepping,self.plateReaderNavigationController.y_microstepping)
+        self.wellStatisticsCalculator = WellStatisticsCalculator()
+        self.do_well_statistics = False
+        self.save_raw_images = True
+        self.table_format = 'csv'
 
     def set_NZ(self,N):
         self.NZ = N
@@ -260,6 +659,29 @@ class PlateReadingController(QObject):
     def set_af_flag(self,flag):
         self.do_autofocus = flag
 
+    def set_pipelined_acquisition(self,flag):
+        self.pipelined = flag
+
+    def set_well_statistics_flag(self,flag):
+        self.do_well_statistics = flag
+
+    def set_save_raw_images_flag(self,flag):
+        self.save_raw_images = flag
+
+    def set_table_format(self,table_format):
+        # 'csv' or 'parquet'
+        self.table_format = table_format
+
+    def set_well_mask_diameter(self,mask_diameter_fraction,background_diameter_fraction=None):
+        self.wellStatisticsCalculator.set_mask_diameter(mask_diameter_fraction,background_diameter_fraction)
+
+    def set_spectrum_mask(self,mask):
+        self.wellStatisticsCalculator.set_spectrum_mask(mask)
+
+    def load_spectrum_mask(self,filename):
+        # .npy array of the weights of the spectrum extraction, of the shape of the cropped images; None to disable
+        self.set_spectrum_mask(None if filename is None else np.load(filename))
+
     def set_crop(self,crop_width,height):
         self.crop_width = crop_width
         self.crop_height = crop_height
@@ -281,11 +703,32 @@ class PlateReadingController(QObject):
     def set_selected_configurations(self, selected_configurations_name):
         self.selected_configurations = []
         for configuration_name in selected_configurations_name:
-            self.selected_configurations.append(next((config for config in self.configurationManager.configurations if config.name == configuration_name)))
+            self.selected_configurations.append(self.configurationManager.get_configuration_by_name(configuration_name))
     
     def set_selected_columns(self,selected_columns):
         selected_columns.sort()
         self.selected_columns = selected_columns
+        self.plateScheduler.set_columns(selected_columns)
+
+    def set_selected_wells(self,selected_wells):
+        # selected_wells: list of (row, column) starting from 0, or a string such as 'A1-B12, C3'
+        if isinstance(selected_wells,str):
+            selected_wells = self.plateScheduler.parse_wells(selected_wells)
+        self.plateScheduler.set_wells(selected_wells)
+        self.selected_columns = sorted(set([column+1 for row,column in self.plateScheduler.wells]))
+
+    def set_plate_format(self,plate_format):
+        self.plateScheduler.set_plate_format(plate_format)
+
+    def set_plate_calibration_offset(self,offset_x_mm,offset_y_mm):
+        self.plateScheduler.set_calibration_offset(offset_x_mm,offset_y_mm)
+
+    def get_estimated_acquisition_time(self):
+        # dry run: time for one time point, in seconds
+        homing = (self.pipelined == False) or (self.plateReaderNavigationController.position_is_trusted == False)
+        start_mm = (self.plateReaderNavigationController.x_pos_mm,self.plateReaderNavigationController.y_pos_mm)
+        wells = self.plateScheduler.get_visiting_order((0,0) if homing else start_mm)
+        return self.plateScheduler.estimate_time(wells,self.selected_configurations,self.NZ,start_mm,homing=homing)
 
     def run_acquisition(self): # @@@ to do: change name to run_experiment
         print('start plate reading')
@@ -348,6 +791,10 @@ class PlateReadingController(QObject):
         self.acquisitionFinished.emit()
         QApplication.processEvents()
 
+    def close(self):
+        self.imageSaver.close()
+        self.wellStatisticsCalculator.close()
+
     def slot_image_to_display(self,image):
         self.image_to_display.emit(image)
 
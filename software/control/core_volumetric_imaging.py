@@ -11,6 +11,7 @@ from qtpy.QtGui import *
 import control.utils as utils
 from control._def import *
 import control.tracking as tracking
+import control.instrumentation as instrumentation
 
 from queue import Queue
 from threading import Thread, Lock
@@ -31,7 +32,10 @@ class StreamHandler(QObject):
     packet_image_to_write = Signal(np.ndarray, int, float)
     packet_image_for_tracking = Signal(np.ndarray, int, float)
     packet_image_for_array_display = Signal(np.ndarray, int)
+    packet_image_for_volume_assembly = Signal(np.ndarray, int, float)
     signal_new_frame_received = Signal()
+    signal_recording_state_changed = Signal(bool)
+    signal_frame_index_restarted = Signal() # the frame index starts again from 0 (hardware trigger mode set, or the camera counter reset)
 
     def __init__(self,crop_width=Acquisition.CROP_WIDTH,crop_height=Acquisition.CROP_HEIGHT,display_resolution_scaling=0.5):
         QObject.__init__(self)
@@ -55,11 +59,17 @@ class StreamHandler(QObject):
         self.counter = 0
         self.fps_real = 0
 
+        # for detecting restarts of the frame index
+        self.last_frame_ID = None
+        self.last_frame_ID_offset = None
+
     def start_recording(self):
         self.save_image_flag = True
+        self.signal_recording_state_changed.emit(True)
 
     def stop_recording(self):
         self.save_image_flag = False
+        self.signal_recording_state_changed.emit(False)
 
     def start_tracking(self):
         self.tracking_flag = True
@@ -85,6 +95,8 @@ class StreamHandler(QObject):
 
         camera.image_locked = True
         self.handler_busy = True
+        t_start = time.perf_counter()
+        instrumentation.count('stream_handler.frames')
         self.signal_new_frame_received.emit() # self.liveController.turn_off_illumination()
 
         # measure real fps
@@ -95,11 +107,9 @@ class StreamHandler(QObject):
             self.timestamp_last = timestamp_now
             self.fps_real = self.counter
             self.counter = 0
-            print('real camera fps is ' + str(self.fps_real))
 
-        # crop image
-        image_cropped = utils.crop_image(camera.current_frame,self.crop_width,self.crop_height)
-        image_cropped = np.squeeze(image_cropped)
+        # crop image - a copy, current_frame is reused by the camera and the frame goes through queued signals
+        image_cropped = np.squeeze(np.copy(utils.crop_image(camera.current_frame,self.crop_width,self.crop_height)))
 
         # send image to display
         time_now = time.time()
@@ -108,9 +118,18 @@ class StreamHandler(QObject):
             self.image_to_display.emit(utils.crop_image(image_cropped,round(self.crop_width*self.display_resolution_scaling), round(self.crop_height*self.display_resolution_scaling)))
             self.timestamp_last_display = time_now
 
+        # set_hardware_triggered_acquisition() moves the offset to the current frame ID, and the camera counter restarts with the stream
+        if (self.last_frame_ID is not None and camera.frame_ID < self.last_frame_ID) or (self.last_frame_ID_offset is not None and camera.frame_ID_offset_hardware_trigger != self.last_frame_ID_offset):
+            self.signal_frame_index_restarted.emit()
+        self.last_frame_ID = camera.frame_ID
+        self.last_frame_ID_offset = camera.frame_ID_offset_hardware_trigger
+
         # send image to array display
         self.packet_image_for_array_display.emit(image_cropped,(camera.frame_ID - camera.frame_ID_offset_hardware_trigger - 1) % VOLUMETRIC_IMAGING.NUM_PLANES_PER_VOLUME)
 
+        # send image to volume assembly - frame index starts from 0
+        self.packet_image_for_volume_assembly.emit(image_cropped,camera.frame_ID - camera.frame_ID_offset_hardware_trigger - 1,camera.timestamp)
+
         # send image to write
         if self.save_image_flag and time_now-self.timestamp_last_save >= 1/self.fps_save:
             if camera.is_color:
@@ -125,10 +144,235 @@ class StreamHandler(QObject):
             self.packet_image_for_tracking.emit(image_cropped,camera.frame_ID,camera.timestamp)
             self.timestamp_last_track = time_now
 
+        instrumentation.record('stream_handler.on_new_frame',time.perf_counter() - t_start,t_start)
         self.handler_busy = False
         camera.image_locked = False
 
 
+class VolumeAssembler(QObject):
+
+    # writes incoming planes into a preallocated ring of (planes, H, W) volumes
+    # frame index -> volume ID = frame index // planes, plane = frame index % planes
+    # a volume is delivered once all its planes are in; volumes that are still incomplete when a frame two volumes later arrives are reported and discarded
+
+    packet_volume_to_display = Signal(np.ndarray, int)
+    packet_volume_to_write = Signal(np.ndarray, int, float)
+    mip_to_display = Signal(np.ndarray)
+    orthogonal_slices_to_display = Signal(np.ndarray, np.ndarray)
+    signal_incomplete_volume = Signal(int, int) # volume ID, number of missing planes
+
+    def __init__(self,num_planes=VOLUMETRIC_IMAGING.NUM_PLANES_PER_VOLUME,num_volumes_in_ring=4):
+        QObject.__init__(self)
+        self.num_planes = num_planes
+        self.num_volumes_in_ring = num_volumes_in_ring
+        self.fps_display = 10
+        self.timestamp_last_display = 0
+        self.save_flag = False
+        self.ring = None
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.last_frame_index = -1
+        self.frames_dropped = 0
+        self.frames_out_of_order = 0
+        self.frames_late = 0
+        self.volumes_completed = 0
+        self.volumes_incomplete = 0
+        self.frames_overrun = 0
+
+    def set_num_planes(self,num_planes):
+        self.num_planes = num_planes
+        self.ring = None
+
+    def restart(self):
+        # the frame index starts again from 0: forget the volumes being assembled and the closed volume IDs, otherwise every new
+        # frame would be taken as late; slots still reserved by the saver stay reserved until it releases them
+        if self.ring is not None:
+            self.volume_ID[:] = -1
+            self.last_closed_volume_ID[:] = -1
+            self.plane_received[:] = False
+        self.reset_statistics()
+
+    def set_display_fps(self,fps):
+        self.fps_display = fps
+
+    def set_save_flag(self,flag):
+        # delivered volumes stay reserved in the ring until release_volume() is called by the saver
+        self.save_flag = flag
+
+    def _allocate(self,image):
+        n, p = self.num_volumes_in_ring, self.num_planes
+        height, width = image.shape[0], image.shape[1]
+        self.ring = np.zeros((n,p) + image.shape,dtype=image.dtype)
+        self.plane_received = np.zeros((n,p),dtype=bool)
+        self.volume_ID = np.full(n,-1,dtype=np.int64)
+        self.volume_timestamp = np.zeros(n)
+        self.volume_reserved = np.zeros(n,dtype=bool)
+        self.last_closed_volume_ID = np.full(n,-1,dtype=np.int64)
+        # previews: max intensity projection along z, xz slice through the center row, yz slice through the center column
+        self.mip = np.zeros((n,) + image.shape,dtype=image.dtype)
+        self.slice_xz = np.zeros((n,p,width) + image.shape[2:],dtype=image.dtype)
+        self.slice_yz = np.zeros((n,p,height) + image.shape[2:],dtype=image.dtype)
+        self.reset_statistics()
+
+    def on_new_image(self,image,frame_index,timestamp):
+        if self.ring is None or self.ring.shape[2:] != image.shape or self.ring.dtype != image.dtype:
+            self._allocate(image)
+
+        # a jump back by more than a volume is a restart of the index that was not signalled, not a late frame
+        if frame_index < self.last_frame_index - self.num_planes:
+            self.restart()
+
+        # drop / out-of-order detection
+        if frame_index > self.last_frame_index + 1:
+            self.frames_dropped = self.frames_dropped + (frame_index - self.last_frame_index - 1)
+        elif frame_index <= self.last_frame_index:
+            self.frames_out_of_order = self.frames_out_of_order + 1
+            # the frame was counted as dropped when the gap was seen
+            self.frames_dropped = max(self.frames_dropped - 1,0)
+        self.last_frame_index = max(frame_index,self.last_frame_index)
+
+        volume_ID = frame_index // self.num_planes
+        plane = frame_index % self.num_planes
+
+        # flush volumes that can no longer be completed
+        for slot in np.nonzero((self.volume_ID >= 0) & (self.volume_ID < volume_ID - 1))[0]:
+            self._discard_incomplete(slot)
+
+        slot = volume_ID % self.num_volumes_in_ring
+        if self.volume_ID[slot] != volume_ID:
+            if self.volume_ID[slot] > volume_ID or self.last_closed_volume_ID[slot] >= volume_ID:
+                # plane of a volume that has already been delivered or discarded
+                self.frames_late = self.frames_late + 1
+                return
+            if self.volume_reserved[slot]:
+                # the saver has not released this slot yet
+                self.frames_overrun = self.frames_overrun + 1
+                return
+            self.volume_ID[slot] = volume_ID
+            self.volume_timestamp[slot] = timestamp
+            self.plane_received[slot] = False
+        elif self.plane_received[slot,plane]:
+            return
+
+        # write the plane and update the previews
+        volume = self.ring[slot]
+        volume[plane] = image
+        if self.plane_received[slot].any():
+            np.maximum(self.mip[slot],image,out=self.mip[slot])
+        else:
+            self.mip[slot] = image
+        self.slice_xz[slot,plane] = image[image.shape[0]//2]
+        self.slice_yz[slot,plane] = image[:,image.shape[1]//2]
+        self.plane_received[slot,plane] = True
+
+        time_now = time.time()
+        if time_now - self.timestamp_last_display >= 1/self.fps_display:
+            self.mip_to_display.emit(self.mip[slot])
+            self.orthogonal_slices_to_display.emit(self.slice_xz[slot],self.slice_yz[slot])
+            self.timestamp_last_display = time_now
+
+        if self.plane_received[slot].all():
+            self._deliver(slot)
+
+    def _deliver(self,slot):
+        volume_ID = int(self.volume_ID[slot])
+        self.volumes_completed = self.volumes_completed + 1
+        self.volume_ID[slot] = -1
+        self.last_closed_volume_ID[slot] = volume_ID
+        self.packet_volume_to_display.emit(self.ring[slot],volume_ID)
+        if self.save_flag:
+            self.volume_reserved[slot] = True
+            self.packet_volume_to_write.emit(self.ring[slot],volume_ID,self.volume_timestamp[slot])
+
+    def _discard_incomplete(self,slot):
+        volume_ID = int(self.volume_ID[slot])
+        n_missing = int(self.num_planes - np.sum(self.plane_received[slot]))
+        self.volumes_incomplete = self.volumes_incomplete + 1
+        self.volume_ID[slot] = -1
+        self.last_closed_volume_ID[slot] = volume_ID
+        self.plane_received[slot] = False
+        print('volume ' + str(volume_ID) + ' incomplete, ' + str(n_missing) + ' plane(s) missing')
+        self.signal_incomplete_volume.emit(volume_ID,n_missing)
+
+    def release_volume(self,volume_ID):
+        self.volume_reserved[volume_ID % self.num_volumes_in_ring] = False
+
+    def get_statistics(self):
+        return {'frames_dropped':self.frames_dropped,'frames_out_of_order':self.frames_out_of_order,'frames_late':self.frames_late,
+                'volumes_completed':self.volumes_completed,'volumes_incomplete':self.volumes_incomplete,'frames_overrun':self.frames_overrun}
+
+
+class VolumeSaver(QObject):
+
+    # saves complete volumes as .npy files, one file per volume
+
+    stop_recording = Signal()
+    volume_saved = Signal(int)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.base_path = './'
+        self.experiment_ID = ''
+        self.queue = Queue(4)
+        self.stop_signal_received = False
+        self.thread = Thread(target=self.process_queue)
+        self.thread.start()
+        self.counter = 0
+        self.recording_start_time = 0
+        self.recording_time_limit = -1
+
+    def process_queue(self):
+        while True:
+            # stop the thread if stop signal is received
+            if self.stop_signal_received:
+                return
+            # process the queue
+            try:
+                [volume,volume_ID,timestamp] = self.queue.get(timeout=0.1)
+            except:
+                continue
+            try:
+                saving_path = os.path.join(self.base_path,self.experiment_ID,'volume_' + str(volume_ID) + '.npy')
+                np.save(saving_path,volume)
+                self.counter = self.counter + 1
+            except Exception as e:
+                print('error saving volume ' + str(volume_ID) + ': ' + str(e))
+            self.volume_saved.emit(volume_ID)
+            self.queue.task_done()
+
+    def enqueue(self,volume,volume_ID,timestamp):
+        try:
+            self.queue.put_nowait([volume,volume_ID,timestamp])
+            if ( self.recording_time_limit>0 ) and ( time.time()-self.recording_start_time >= self.recording_time_limit ):
+                self.stop_recording.emit()
+        except:
+            print('volumeSaver queue is full, volume discarded')
+            self.volume_saved.emit(volume_ID)
+
+    def set_base_path(self,path):
+        self.base_path = path
+
+    def set_recording_time_limit(self,time_limit):
+        self.recording_time_limit = time_limit
+
+    def start_new_experiment(self,experiment_ID):
+        # generate unique experiment ID
+        self.experiment_ID = experiment_ID + '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%-S.%f')
+        self.recording_start_time = time.time()
+        # create a new folder
+        try:
+            os.mkdir(os.path.join(self.base_path,self.experiment_ID))
+        except:
+            pass
+        self.counter = 0
+
+    def close(self):
+        self.queue.join()
+        self.stop_signal_received = True
+        self.thread.join()
+
+
 class ImageArrayDisplayWindow(QMainWindow):
 
     def __init__(self, window_title=''):
@@ -173,3 +417,47 @@ class ImageArrayDisplayWindow(QMainWindow):
         if i < 9:
             self.sub_windows[i].img.setImage(image,autoLevels=False)
             self.sub_windows[i].view.autoRange(padding=0)
+
+    def display_volume(self,volume,volume_ID):
+        # 9 planes evenly spaced through the volume
+        for i,plane in enumerate(np.round(np.linspace(0,volume.shape[0]-1,9)).astype(int)):
+            self.sub_windows[i].img.setImage(volume[plane],autoLevels=False)
+        self.setWindowTitle('volume ' + str(volume_ID))
+
+
+class VolumePreviewWindow(QMainWindow):
+
+    # max intensity projection and orthogonal slices, updated as planes arrive
+
+    def __init__(self, window_title='Volume Preview'):
+        super().__init__()
+        self.setWindowTitle(window_title)
+        self.setWindowFlags(self.windowFlags() | Qt.CustomizeWindowHint)
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowCloseButtonHint)
+        self.widget = QWidget()
+
+        # interpret image data as row-major instead of col-major
+        pg.setConfigOptions(imageAxisOrder='row-major')
+
+        self.sub_windows = {}
+        for name in ['MIP','XZ','YZ']:
+            self.sub_windows[name] = pg.GraphicsLayoutWidget()
+            self.sub_windows[name].view = self.sub_windows[name].addViewBox(enableMouse=True)
+            self.sub_windows[name].img = pg.ImageItem(border='w')
+            self.sub_windows[name].view.setAspectLocked(False)
+            self.sub_windows[name].view.addItem(self.sub_windows[name].img)
+
+        ## Layout
+        layout = QGridLayout()
+        layout.addWidget(self.sub_windows['MIP'], 0, 0)
+        layout.addWidget(self.sub_windows['YZ'], 0, 1)
+        layout.addWidget(self.sub_windows['XZ'], 1, 0)
+        self.widget.setLayout(layout)
+        self.setCentralWidget(self.widget)
+
+    def display_mip(self,image):
+        self.sub_windows['MIP'].img.setImage(image,autoLevels=False)
+
+    def display_orthogonal_slices(self,slice_xz,slice_yz):
+        self.sub_windows['XZ'].img.setImage(slice_xz,autoLevels=False)
+        self.sub_windows['YZ'].img.setImage(np.swapaxes(slice_yz,0,1),autoLevels=False)
@@ -12,6 +12,8 @@ from qtpy.QtGui import *
 import control.widgets as widgets
 import control.camera as camera
 import control.core as core
+import control.core_microscope as core_microscope
+import control.microscope as microscope
 import control.microcontroller as microcontroller
 from control._def import *
 
@@ -56,8 +58,13 @@ class OctopiGUI(QMainWindow):
 		self.streamHandler = core.StreamHandler(display_resolution_scaling=DEFAULT_DISPLAY_CROP/100)
 		self.liveController = core.LiveController(self.camera,self.microcontroller,self.configurationManager)
 		self.navigationController = core.NavigationController(self.microcontroller)
+		if is_simulation:
+			# the simulated camera renders the sample at the current stage position
+			self.camera.set_position_source(lambda: (self.navigationController.x_pos_mm,self.navigationController.y_pos_mm,self.navigationController.z_pos_mm))
 		self.autofocusController = core.AutoFocusController(self.camera,self.navigationController,self.liveController)
-		self.multipointController = core.MultiPointController(self.camera,self.navigationController,self.liveController,self.autofocusController,self.configurationManager)
+		# multipoint acquisitions run on the Qt-free Microscope, MicroscopeController re-emits its events as signals
+		self.microscope = microscope.Microscope({'Widefield':self.camera},self.microcontroller,configurations=self.configurationManager.configurations)
+		self.multipointController = core_microscope.MicroscopeController(self.microscope,self.navigationController,{'Widefield':self.liveController},self.configurationManager)
 		if ENABLE_TRACKING:
 			self.trackingController = core.TrackingController(self.camera,self.microcontroller,self.navigationController,self.configurationManager,self.liveController,self.autofocusController,self.imageDisplayWindow)
 		self.imageSaver = core.ImageSaver()
@@ -160,6 +167,9 @@ class OctopiGUI(QMainWindow):
 	def closeEvent(self, event):
 		event.accept()
 		# self.softwareTriggerGenerator.stop() @@@ => 
+		self.multipointController.request_abort_aquisition()
+		self.microscope.close() # waits for the acquisition to end
+		self.multipointController.close()
 		self.navigationController.home()
 		self.liveController.stop_live()
 		self.camera.close()
@@ -12,6 +12,8 @@ from qtpy.QtGui import *
 import control.widgets as widgets
 import control.camera as camera
 import control.core as core
+import control.core_microscope as core_microscope
+import control.microscope as microscope
 import control.microcontroller as microcontroller
 from control._def import *
 
@@ -60,7 +62,9 @@ class OctopiGUI(QMainWindow):
 		self.navigationController = core.NavigationController(self.microcontroller)
 		self.slidePositionController = core.SlidePositionController(self.navigationController,self.liveController)
 		self.autofocusController = core.AutoFocusController(self.camera,self.navigationController,self.liveController)
-		self.multipointController = core.MultiPointController(self.camera,self.navigationController,self.liveController,self.autofocusController,self.configurationManager)
+		# multipoint acquisitions run on the Qt-free Microscope, MicroscopeController re-emits its events as signals
+		self.microscope = microscope.Microscope({'Widefield':self.camera},self.microcontroller,configurations=self.configurationManager.configurations)
+		self.multipointController = core_microscope.MicroscopeController(self.microscope,self.navigationController,{'Widefield':self.liveController},self.configurationManager)
 		if ENABLE_TRACKING:
 			self.trackingController = core.TrackingController(self.camera,self.microcontroller,self.navigationController,self.configurationManager,self.liveController,self.autofocusController,self.imageDisplayWindow)
 		self.imageSaver = core.ImageSaver()
@@ -189,6 +193,9 @@ class OctopiGUI(QMainWindow):
 	def closeEvent(self, event):
 		event.accept()
 		# self.softwareTriggerGenerator.stop() @@@ => 
+		self.multipointController.request_abort_aquisition()
+		self.microscope.close() # waits for the acquisition to end
+		self.multipointController.close()
 		self.navigationController.home()
 		self.liveController.stop_live()
 		self.camera.close()
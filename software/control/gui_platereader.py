@@ -99,5 +99,6 @@ class OctopiGUI(QMainWindow):
 		self.liveController.stop_live()
 		self.camera.close()
 		self.imageSaver.close()
+		self.plateReadingController.close()
 		self.imageDisplayWindow.close()
 		self.microcontroller.close()
\ No newline at end of file
@@ -13,6 +13,7 @@ import control.widgets as widgets
 import control.camera as camera
 import control.camera_TIS_fix as camera_tis
 import control.core as core
+import control.spectrum as spectrum
 import control.microcontroller as microcontroller
 import control.microcontroller2 as microcontroller2
 import pyqtgraph.dockarea as dock
@@ -51,6 +52,7 @@ class OctopiGUI(QMainWindow):
 		self.configurationManager_widefield = core.ConfigurationManager(str(Path.home()) + "/configurations_spectrometer_widefield.xml",channel='Widefield')
 		self.liveController_spectrum = core.LiveController(self.camera_spectrometer,self.microcontroller,self.microcontroller2,self.configurationManager_spectrum)
 		self.imageSaver = core.ImageSaver()
+		self.spectrumRecorder = core.SpectrumRecorder()
 		self.imageDisplay = core.ImageDisplay()
 
 		self.streamHandler_widefield = core.StreamHandler()
@@ -59,9 +61,19 @@ class OctopiGUI(QMainWindow):
 		self.imageDisplay_widefield = core.ImageDisplay()
 
 		self.spectrumExtractor = core.SpectrumExtractor()
+		self.spectrumExtractor.load_wavelength_calibration()
+		self.spectrumRecorder.set_spectrum_extractor(self.spectrumExtractor)
+		self.spectrumPeakTracker = core.SpectrumPeakTracker()
 		self.spectrumROIManager = core.SpectrumROIManager(self.camera_spectrometer,self.liveController_spectrum,self.spectrumExtractor)
+		self.calibrationCache = spectrum.CalibrationCache(SPECTRUM_CORRECTION.CACHE_DIRECTORY)
+		self.frameCorrector = spectrum.FrameCorrector(self.calibrationCache,output_dtype=SPECTRUM_CORRECTION.OUTPUT_DTYPE,flat_min_fraction=SPECTRUM_CORRECTION.FLAT_MIN_FRACTION)
+		self.streamHandler_spectrum.set_frame_corrector(self.frameCorrector)
 		
 		self.navigationController = core.NavigationController(self.microcontroller)
+		if is_simulation:
+			# the simulated cameras render the sample at the current stage position
+			self.camera_widefield.set_position_source(lambda: (self.navigationController.x_pos_mm,self.navigationController.y_pos_mm,self.navigationController.z_pos_mm))
+			self.camera_spectrometer.set_position_source(lambda: (self.navigationController.x_pos_mm,self.navigationController.y_pos_mm,self.navigationController.z_pos_mm))
 		self.autofocusController = core.AutoFocusController(self.camera_widefield,self.navigationController,self.liveController_widefield)
 		
 		self.cameras = {}
@@ -75,6 +87,8 @@ class OctopiGUI(QMainWindow):
 		self.liveControllers['Spectrum'] = self.liveController_spectrum
 
 		self.multipointController = core.MultiPointController(self.cameras,self.navigationController,self.liveControllers,self.autofocusController,self.configurationManagers)
+		self.multipointController.set_spectrum_extractor(self.spectrumExtractor)
+		self.multipointController.set_frame_corrector(self.frameCorrector)
 
 		# open the camera
 		# camera start streaming
@@ -91,24 +105,32 @@ class OctopiGUI(QMainWindow):
 		# load widgets
 		self.cameraSettingWidget_spectrum = widgets.CameraSettingsWidget(self.camera_spectrometer,include_gain_exposure_time=False)
 		self.liveControlWidget_spectrum = widgets.LiveControlWidget(self.streamHandler_spectrum,self.liveController_spectrum,self.configurationManager_spectrum,show_display_options=False)
-		self.recordingControlWidget_spectrum = widgets.RecordingWidget(self.streamHandler_spectrum,self.imageSaver)
+		self.recordingControlWidget_spectrum = widgets.RecordingWidget(self.streamHandler_spectrum,self.imageSaver,self.spectrumRecorder)
 
 		self.cameraSettingWidget_widefield = widgets.CameraSettingsWidget(self.camera_widefield,include_gain_exposure_time=False)
 		self.liveControlWidget_widefield = widgets.LiveControlWidget(self.streamHandler_widefield,self.liveController_widefield,self.configurationManager_widefield,show_display_options=False)
 		self.recordingControlWidget_widefield = widgets.RecordingWidget(self.streamHandler_widefield,self.imageSaver_widefield)
 
 		self.spectrumROIManagerWidget = widgets.SpectrumROIManagerWidget(self.spectrumExtractor,self.spectrumROIManager, self.camera_spectrometer)
+		self.spectrumCorrectionWidget = widgets.SpectrumCorrectionWidget(self.frameCorrector,self.camera_spectrometer,self.liveController_spectrum)
+		self.spectrumDisplayWindow = widgets.SpectrumDisplayWindow()
+		self.wavelengthCalibrationWidget = widgets.WavelengthCalibrationWidget(self.spectrumExtractor,self.camera_spectrometer,self.spectrumDisplayWindow.plotWidget)
 		self.brightfieldWidget = widgets.BrightfieldWidget(self.liveController_spectrum)
 
 		self.navigationWidget = widgets.NavigationWidget(self.navigationController)
 		self.autofocusWidget = widgets.AutoFocusWidget(self.autofocusController)
 		self.multiPointWidget = widgets.MultiPointWidget(self.multipointController,self.configurationManagers)
+		self.instrumentationWidget = widgets.InstrumentationWidget()
+		self.peakTrackingWidget = widgets.PeakTrackingWidget(self.spectrumPeakTracker)
+		self.datacubeWidget = widgets.DatacubeWidget(self.multipointController)
 
 		# layout widgets
 		layout_spectrum_control = QVBoxLayout()
 		layout_spectrum_control.addWidget(self.cameraSettingWidget_spectrum)
 		layout_spectrum_control.addWidget(self.liveControlWidget_spectrum)
 		layout_spectrum_control.addWidget(self.spectrumROIManagerWidget)
+		layout_spectrum_control.addWidget(self.spectrumCorrectionWidget)
+		layout_spectrum_control.addWidget(self.wavelengthCalibrationWidget)
 		layout_spectrum_control.addWidget(self.recordingControlWidget_spectrum)
 
 		layout_widefield_control = QVBoxLayout()
@@ -129,6 +151,9 @@ class OctopiGUI(QMainWindow):
 		acquisitionTabWidget.addTab(self.multiPointWidget, "Multipoint")
 		acquisitionTabWidget.addTab(self.recordingControlWidget_spectrum, "Recording - Spectrum")
 		acquisitionTabWidget.addTab(self.recordingControlWidget_widefield, "Recording - Widefield")
+		acquisitionTabWidget.addTab(self.peakTrackingWidget, "Peaks")
+		acquisitionTabWidget.addTab(self.datacubeWidget, "Datacube")
+		acquisitionTabWidget.addTab(self.instrumentationWidget, "Timing")
 
 		layout = QVBoxLayout()
 		layout.addWidget(self.controlTabWidget)
@@ -146,8 +171,7 @@ class OctopiGUI(QMainWindow):
 		# self.imageDisplayWindow_spectrum.show()
 		self.imageDisplayWindow_widefield = core.ImageDisplayWindow()
 		# self.imageDisplayWindow_widefield.show()
-		# load spectrum display window
-		self.spectrumDisplayWindow = widgets.SpectrumDisplayWindow()
+		# spectrum display window (created with the wavelength calibration widget)
 		# self.spectrumDisplayWindow.show()
 
 		# dock windows
@@ -200,7 +224,11 @@ class OctopiGUI(QMainWindow):
 
 		# route the new image (once it has arrived) to the spectrumExtractor
 		self.streamHandler_spectrum.image_to_spectrum_extraction.connect(self.spectrumExtractor.extract_and_display_the_spectrum)
-		self.spectrumExtractor.packet_spectrum.connect(self.spectrumDisplayWindow.plotWidget.plot)
+		# the recorder extracts in its own thread, its queue is filled from the camera thread
+		self.streamHandler_spectrum.packet_image_to_spectrum_recording.connect(self.spectrumRecorder.enqueue,Qt.DirectConnection)
+		self.spectrumExtractor.packet_spectra.connect(self.spectrumDisplayWindow.plotWidget.plot_spectra)
+		self.spectrumExtractor.packet_spectra.connect(self.spectrumPeakTracker.track)
+		self.streamHandler_spectrum.signal_calibration_frame_captured.connect(self.spectrumCorrectionWidget.calibration_frame_captured)
 
 		self.streamHandler_widefield.signal_new_frame_received.connect(self.liveController_widefield.on_new_frame)
 		self.streamHandler_widefield.image_to_display.connect(self.imageDisplay_widefield.enqueue)
@@ -251,6 +279,7 @@ class OctopiGUI(QMainWindow):
 		self.liveController_spectrum.stop_live()
 		self.camera_spectrometer.close()
 		self.imageSaver.close()
+		self.spectrumRecorder.close()
 		self.imageDisplay.close()
 		self.imageDisplayWindow_spectrum.close()
 		self.spectrumDisplayWindow.close()
@@ -263,6 +292,10 @@ class OctopiGUI(QMainWindow):
 		if SINGLE_WINDOW == False:
 			self.displayWindow.close()
 
+		self.spectrumPeakTracker.close()
+		self.configurationManager_spectrum.close()
+		self.configurationManager_widefield.close()
+
 		self.microcontroller2.analog_write_DAC8050x(0,0)
 		self.microcontroller2.analog_write_DAC8050x(1,0)
 		self.microcontroller2.close()
@@ -12,6 +12,8 @@ from qtpy.QtGui import *
 import control.widgets as widgets
 import control.camera_TIS as camera
 import control.core as core
+import control.core_microscope as core_microscope
+import control.microscope as microscope
 import control.microcontroller as microcontroller
 
 class OctopiGUI(QMainWindow):
@@ -31,7 +33,9 @@ class OctopiGUI(QMainWindow):
 		self.liveController = core.LiveController(self.camera,self.microcontroller,self.configurationManager)
 		self.navigationController = core.NavigationController(self.microcontroller)
 		self.autofocusController = core.AutoFocusController(self.camera,self.navigationController,self.liveController)
-		self.multipointController = core.MultiPointController(self.camera,self.navigationController,self.liveController,self.autofocusController,self.configurationManager)
+		# multipoint acquisitions run on the Qt-free Microscope, MicroscopeController re-emits its events as signals
+		self.microscope = microscope.Microscope({'Widefield':self.camera},self.microcontroller,configurations=self.configurationManager.configurations)
+		self.multipointController = core_microscope.MicroscopeController(self.microscope,self.navigationController,{'Widefield':self.liveController},self.configurationManager)
 		self.trackingController = core.TrackingController(self.microcontroller,self.navigationController)
 		self.imageSaver = core.ImageSaver()
 		self.imageDisplay = core.ImageDisplay()
@@ -96,6 +100,9 @@ class OctopiGUI(QMainWindow):
 	def closeEvent(self, event):
 		event.accept()
 		# self.softwareTriggerGenerator.stop() @@@ => 
+		self.multipointController.request_abort_aquisition()
+		self.microscope.close() # waits for the acquisition to end
+		self.multipointController.close()
 		self.navigationController.home()
 		self.liveController.stop_live()
 		self.camera.close()
@@ -12,6 +12,8 @@ from qtpy.QtGui import *
 import control.widgets as widgets
 import control.camera as camera
 import control.core as core
+import control.core_microscope as core_microscope
+import control.microscope as microscope
 import control.core_volumetric_imaging as core_volumetric_imaging
 import control.microcontroller as microcontroller
 
@@ -32,10 +34,13 @@ class OctopiGUI(QMainWindow):
 		self.liveController = core.LiveController(self.camera,self.microcontroller,self.configurationManager)
 		self.navigationController = core.NavigationController(self.microcontroller)
 		self.autofocusController = core.AutoFocusController(self.camera,self.navigationController,self.liveController)
-		self.multipointController = core.MultiPointController(self.camera,self.navigationController,self.liveController,self.autofocusController,self.configurationManager)
+		# multipoint acquisitions run on the Qt-free Microscope, MicroscopeController re-emits its events as signals
+		self.microscope = microscope.Microscope({'Widefield':self.camera},self.microcontroller,configurations=self.configurationManager.configurations)
+		self.multipointController = core_microscope.MicroscopeController(self.microscope,self.navigationController,{'Widefield':self.liveController},self.configurationManager)
 		self.trackingController = core.TrackingController(self.microcontroller,self.navigationController)
-		self.imageSaver = core.ImageSaver()
 		self.imageDisplay = core.ImageDisplay()
+		self.volumeAssembler = core_volumetric_imaging.VolumeAssembler()
+		self.volumeSaver = core_volumetric_imaging.VolumeSaver()
 
 		# open the camera
 		# camera start streaming
@@ -49,7 +54,7 @@ class OctopiGUI(QMainWindow):
 		self.liveControlWidget = widgets.LiveControlWidget(self.streamHandler,self.liveController,self.configurationManager)
 		self.navigationWidget = widgets.NavigationWidget(self.navigationController)
 		self.autofocusWidget = widgets.AutoFocusWidget(self.autofocusController)
-		self.recordingControlWidget = widgets.RecordingWidget(self.streamHandler,self.imageSaver)
+		self.recordingControlWidget = widgets.RecordingWidget(self.streamHandler,self.volumeSaver)
 		self.trackingControlWidget = widgets.TrackingControllerWidget(self.streamHandler,self.trackingController)
 		self.multiPointWidget = widgets.MultiPointWidget(self.multipointController,self.configurationManager)
 
@@ -74,15 +79,23 @@ class OctopiGUI(QMainWindow):
 		# load window
 		self.imageDisplayWindow = core.ImageDisplayWindow()
 		self.imageArrayDisplayWindow = core_volumetric_imaging.ImageArrayDisplayWindow() 
+		self.volumePreviewWindow = core_volumetric_imaging.VolumePreviewWindow()
 		self.imageDisplayWindow.show()
 		self.imageArrayDisplayWindow.show()
+		self.volumePreviewWindow.show()
 
 		# make connections
 		self.streamHandler.signal_new_frame_received.connect(self.liveController.on_new_frame)
 		self.streamHandler.image_to_display.connect(self.imageDisplay.enqueue)
-		self.streamHandler.packet_image_to_write.connect(self.imageSaver.enqueue)
 		self.streamHandler.packet_image_for_tracking.connect(self.trackingController.on_new_frame)
-		self.streamHandler.packet_image_for_array_display.connect(self.imageArrayDisplayWindow.display_image)
+		self.streamHandler.signal_frame_index_restarted.connect(self.volumeAssembler.restart)
+		self.streamHandler.packet_image_for_volume_assembly.connect(self.volumeAssembler.on_new_image)
+		self.streamHandler.signal_recording_state_changed.connect(self.volumeAssembler.set_save_flag)
+		self.volumeAssembler.packet_volume_to_display.connect(self.imageArrayDisplayWindow.display_volume)
+		self.volumeAssembler.packet_volume_to_write.connect(self.volumeSaver.enqueue)
+		self.volumeAssembler.mip_to_display.connect(self.volumePreviewWindow.display_mip)
+		self.volumeAssembler.orthogonal_slices_to_display.connect(self.volumePreviewWindow.display_orthogonal_slices)
+		self.volumeSaver.volume_saved.connect(self.volumeAssembler.release_volume)
 		self.imageDisplay.image_to_display.connect(self.imageDisplayWindow.display_image) # may connect streamHandler directly to imageDisplayWindow
 		self.navigationController.xPos.connect(self.navigationWidget.label_Xpos.setNum)
 		self.navigationController.yPos.connect(self.navigationWidget.label_Ypos.setNum)
@@ -98,10 +111,14 @@ class OctopiGUI(QMainWindow):
 	def closeEvent(self, event):
 		event.accept()
 		# self.softwareTriggerGenerator.stop() @@@ => 
+		self.multipointController.request_abort_aquisition()
+		self.microscope.close() # waits for the acquisition to end
+		self.multipointController.close()
 		self.navigationController.home()
 		self.liveController.stop_live()
 		self.camera.close()
-		self.imageSaver.close()
+		self.volumeSaver.close()
 		self.imageDisplay.close()
 		self.imageDisplayWindow.close()
-		self.imageArrayDisplayWindow.close()
\ No newline at end of file
+		self.imageArrayDisplayWindow.close()
+		self.volumePreviewWindow.close()
\ No newline at end of file
@@ -951,6 +951,7 @@ class Device:
         self.__offline_callback_handle = None
         self.__py_capture_callback = None
         self.__CaptureCallBack = None
+        self.__capture_copy = True
         self.__user_param = None
 
         # ---------------Device Information Section--------------------------
@@ -1204,12 +1205,15 @@ class Device:
         self.__py_offline_callback()
 
 
-    def register_capture_callback(self, user_param, cap_call):
+    def register_capture_callback(self, user_param, cap_call, copy=True):
         """
         :brief      Register the capture event callback function.
         :param      cap_call:  callback function
+        :param      copy:      False: the RawImage passed to cap_call wraps the driver buffer without copying,
+                               its data is only valid until cap_call returns
         :return:    none
         """
+        self.__capture_copy = copy
         self.__user_param = user_param
         self.__py_capture_callback = cap_call
         self.__CaptureCallBack = CAP_CALL(self.__on_capture_call_back)
@@ -1232,6 +1236,7 @@ class Device:
         :return:    none
         """
         frame_data = GxFrameData()
+        frame_data.status = capture_data.contents.status
         frame_data.image_buf = capture_data.contents.image_buf
         frame_data.width = capture_data.contents.width
         frame_data.height = capture_data.contents.height
@@ -1240,7 +1245,7 @@ class Device:
         frame_data.frame_id = capture_data.contents.frame_id
         frame_data.timestamp = capture_data.contents.timestamp
         frame_data.buf_id = capture_data.contents.frame_id
-        image = RawImage(frame_data)
+        image = RawImage(frame_data, self.__capture_copy)
         self.__py_capture_callback(self.__user_param, image)
 
 
@@ -1328,10 +1333,12 @@ class DataStream:
         status = gx_set_acquisition_buffer_number(self.__dev_handle, buf_num)
         StatusProcessor.process(status, 'DataStream', 'set_acquisition_buffer_number')
 
-    def get_image(self, timeout=1000):
+    def get_image(self, timeout=1000, buffer=None):
         """
         :brief          Get an image, get successfully create image class object
         :param          timeout:    Acquisition timeout, range:[0, 0xFFFFFFFF]
+        :param          buffer:     optional preallocated, C-contiguous numpy array of at least payload size bytes
+                                    the image is acquired directly into it
         :return:        image object
         """
         if not isinstance(timeout, INT_TYPE):
@@ -1350,8 +1357,16 @@ class DataStream:
 
         frame_data = GxFrameData()
         frame_data.image_size = self.payload_size
-        frame_data.image_buf = None
-        image = RawImage(frame_data)
+        if buffer is not None:
+            if buffer.nbytes < self.payload_size or not buffer.flags['C_CONTIGUOUS']:
+                print("DataStream.get_image: buffer is too small or not contiguous")
+                return None
+            frame_data.image_buf = buffer.ctypes.data
+            image = RawImage(frame_data, False)
+            image.buffer = buffer
+        else:
+            frame_data.image_buf = None
+            image = RawImage(frame_data)
 
         status = gx_get_image(self.__dev_handle, image.frame_data, timeout)
         if status == GxStatusList.SUCCESS:
@@ -1675,10 +1690,13 @@ class RGBImage:
 
 
 class RawImage:
-    def __init__(self, frame_data):
+    def __init__(self, frame_data, copy=True):
         self.frame_data = frame_data
 
-        if self.frame_data.image_buf is not None:
+        if self.frame_data.image_buf is not None and copy is False:
+            # wrap the buffer without copying
+            self.__image_array = (c_ubyte * self.frame_data.image_size).from_address(self.frame_data.image_buf)
+        elif self.frame_data.image_buf is not None:
             self.__image_array = string_at(self.frame_data.image_buf, self.frame_data.image_size)
         else:
             self.__image_array = (c_ubyte * self.frame_data.image_size)()
@@ -0,0 +1,182 @@
+# timing instrumentation for the workers and controllers
+# - span(name): context manager that records the duration of a block, e.g. with instrumentation.span('multipoint.move_x'): ...
+# - record(name,duration_s): records a duration measured elsewhere, e.g. the time between sending an mcu command and its completion
+# - count(name,n): counters, e.g. dropped frames
+# events go to a ring buffer owned by the recording thread, so recording takes no lock; when disabled, span() returns a shared no-op context
+# the buffer of a thread that has ended is shrunk to its events when the next thread registers, and dropped by reset()
+# get_summary() aggregates the events of all threads, export_chrome_trace() writes a file that chrome://tracing and ui.perfetto.dev open
+
+import os
+import json
+import time
+import weakref
+import threading
+import contextlib
+
+import numpy as np
+
+from control._def import *
+
+_enabled = INSTRUMENTATION.ENABLED
+_events_per_thread = INSTRUMENTATION.EVENTS_PER_THREAD
+_t0 = time.perf_counter() # time origin of the exported trace
+_local = threading.local()
+_buffers = []
+_buffers_lock = threading.Lock() # only taken when a thread records its first event and when reading
+_null_span = contextlib.nullcontext()
+
+class _ThreadBuffer(object):
+
+    def __init__(self,size):
+        thread = threading.current_thread()
+        self.thread = weakref.ref(thread) # the buffer must not keep the thread alive
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.events = [None]*size # (name, t_start, duration), t_start in s from perf_counter()
+        self.index = 0 # number of events recorded so far, the ring position is index % size
+        self.lost = 0 # events overwritten before the buffer was compacted
+        self.counters = {}
+
+    def is_alive(self):
+        thread = self.thread()
+        return thread is not None and thread.is_alive()
+
+    def compact(self):
+        # the thread has ended, nothing is added anymore: keep only the recorded events
+        if self.index != len(self.events):
+            self.lost = self.events_lost()
+            self.events = self.snapshot()
+            self.index = len(self.events)
+
+    def add(self,name,t_start,duration):
+        self.events[self.index % len(self.events)] = (name,t_start,duration)
+        self.index = self.index + 1
+
+    def snapshot(self):
+        # read without stopping the writer: the oldest events may be overwritten while copying, which only affects events about to be lost anyway
+        index = self.index
+        size = len(self.events)
+        if index <= size:
+            return self.events[:index]
+        i = index % size
+        return [event for event in self.events[i:] + self.events[:i] if event is not None]
+
+    def events_lost(self):
+        return self.lost + max(0,self.index - len(self.events))
+
+class _Span(object):
+    __slots__ = ('name','t_start')
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        _get_buffer().add(self.name,self.t_start,time.perf_counter() - self.t_start)
+        return False
+
+def _get_buffer():
+    try:
+        return _local.buffer
+    except AttributeError:
+        _local.buffer = _ThreadBuffer(_events_per_thread)
+        with _buffers_lock:
+            # ended threads keep their events for the summaries, but not the preallocated slots
+            for buffer in _buffers:
+                if not buffer.is_alive():
+                    buffer.compact()
+            _buffers.append(_local.buffer)
+        return _local.buffer
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def set_enabled(enabled):
+    global _enabled
+    _enabled = bool(enabled)
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    # clears the events and counters of all threads; the buffers of running threads are kept, those of ended threads dropped
+    global _t0
+    with _buffers_lock:
+        _buffers[:] = [buffer for buffer in _buffers if buffer.is_alive()]
+        for buffer in _buffers:
+            buffer.index = 0
+            buffer.lost = 0
+            buffer.events = [None]*len(buffer.events)
+            buffer.counters = {}
+        _t0 = time.perf_counter()
+
+def span(name):
+    if not _enabled:
+        return _null_span
+    return _Span(name)
+
+def record(name,duration_s,t_start=None):
+    if not _enabled:
+        return
+    if t_start is None:
+        t_start = time.perf_counter() - duration_s
+    _get_buffer().add(name,t_start,duration_s)
+
+def count(name,n=1):
+    if not _enabled:
+        return
+    counters = _get_buffer().counters
+    counters[name] = counters.get(name,0) + n
+
+def get_counters():
+    counters = {}
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        for name, value in list(buffer.counters.items()):
+            counters[name] = counters.get(name,0) + value
+    return counters
+
+def get_summary():
+    # {name: {count, total_ms, mean_ms, p50_ms, p90_ms, p99_ms, max_ms}}, over the events still in the ring buffers
+    durations = {}
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        for name, t_start, duration in buffer.snapshot():
+            durations.setdefault(name,[]).append(duration)
+    summary = {}
+    for name in sorted(durations):
+        d = np.array(durations[name])*1000
+        p50, p90, p99 = np.percentile(d,[50,90,99])
+        summary[name] = {'count':len(d),'total_ms':float(d.sum()),'mean_ms':float(d.mean()),'p50_ms':float(p50),'p90_ms':float(p90),'p99_ms':float(p99),'max_ms':float(d.max())}
+    return summary
+
+def get_events_lost():
+    with _buffers_lock:
+        return sum(buffer.events_lost() for buffer in _buffers)
+
+def export_chrome_trace(filename):
+    # chrome trace event format: complete events ('X') with timestamps in us, one track per thread
+    pid = os.getpid()
+    trace_events = []
+    with _buffers_lock:
+        buffers = list(_buffers)
+    for buffer in buffers:
+        trace_events.append({'name':'thread_name','ph':'M','pid':pid,'tid':buffer.thread_id,'args':{'name':buffer.thread_name}})
+        for name, t_start, duration in buffer.snapshot():
+            trace_events.append({'name':name,'cat':name.split('.')[0],'ph':'X','pid':pid,'tid':buffer.thread_id,'ts':(t_start - _t0)*1e6,'dur':duration*1e6})
+    t_now = (time.perf_counter() - _t0)*1e6
+    for name, value in get_counters().items():
+        trace_events.append({'name':name,'ph':'C','pid':pid,'ts':t_now,'args':{'value':value}})
+    with open(filename,'w') as f:
+        json.dump({'traceEvents':trace_events,'displayTimeUnit':'ms','otherData':{'events_lost':get_events_lost()}},f)
+    print('timing trace saved to ' + filename)
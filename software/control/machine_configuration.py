@@ -0,0 +1,239 @@
+# typed machine configuration: configuration*.toml / .json / .yaml instead of exec() of configuration*.txt
+# the file only lists what differs from the defaults in _def.py, with the same names, e.g.
+#
+#   SCREW_PITCH_Z_MM = 0.3048
+#   MICROSTEPPING_DEFAULT_Z = 8
+#   STAGE_MOVEMENT_SIGN_Y = -1
+#   FLIP_IMAGE = "None"
+#   [PLATE_READER]           # the classes of _def.py are tables
+#   OFFSET_COLUMN_1_MM = 20
+#
+# values are checked against the type of their default and the ranges in _SCHEMA, unknown names are errors;
+# the result is an immutable MachineConfiguration (a namedtuple, tables are namedtuples as well), cached by file mtime
+# this module does not import _def (_def uses it while being imported), the defaults are passed in
+
+import os
+import json
+import types
+import inspect
+from collections import namedtuple
+
+class MachineConfigurationError(ValueError):
+    def __init__(self,filename,errors):
+        self.filename = filename
+        self.errors = errors
+        ValueError.__init__(self,str(filename) + ':\n' + '\n'.join('  ' + error for error in errors))
+
+AXES = ('X','Y','Z','THETA')
+MICROSTEPPING_VALUES = (1,2,4,8,16,32,64,128,256)
+
+def _positive(value):
+    return value > 0
+
+def _sign(value):
+    return value in (-1,1)
+
+def _fraction(value):
+    return 0 <= value <= 1
+
+# name: (type, check, description of what is accepted); None as type keeps the type of the default
+# the stage geometry is here because a wrong pitch or microstepping silently scales every move of a scan
+_SCHEMA = {
+    'ROTATE_IMAGE_ANGLE': (None,lambda value: value in (None,0,90,180,270,-90),'None, 0, 90, 180, 270 or -90'),
+    'FLIP_IMAGE': (None,lambda value: value in (None,'Horizontal','Vertical','Both'),"None, 'Horizontal', 'Vertical' or 'Both'"),
+    'SLEEP_TIME_S': (float,_positive,'> 0'),
+    'DAC_SETTLING_TIME_S': (float,lambda value: value >= 0,'>= 0'),
+    'DEFAULT_DISPLAY_CROP': (float,lambda value: 1 <= value <= 100,'between 1 and 100'),
+}
+for _axis in AXES:
+    _SCHEMA['STAGE_MOVEMENT_SIGN_' + _axis] = (int,_sign,'1 or -1')
+    _SCHEMA['STAGE_POS_SIGN_' + _axis] = (int,_sign,'1 or -1')
+    _SCHEMA['TRACKING_MOVEMENT_SIGN_' + _axis] = (int,_sign,'1 or -1')
+    _SCHEMA['ENCODER_POS_SIGN_' + _axis] = (int,_sign,'1 or -1')
+    _SCHEMA['USE_ENCODER_' + _axis] = (bool,None,'')
+    _SCHEMA['FULLSTEPS_PER_REV_' + _axis] = (int,_positive,'> 0')
+    _SCHEMA['MICROSTEPPING_DEFAULT_' + _axis] = (int,lambda value: value in MICROSTEPPING_VALUES,'one of ' + str(MICROSTEPPING_VALUES))
+for _axis in AXES[:3]:
+    _SCHEMA['SCREW_PITCH_' + _axis + '_MM'] = (float,lambda value: 0 < value < 100,'between 0 and 100 (mm per revolution)')
+    _SCHEMA['ENCODER_STEP_SIZE_' + _axis + '_MM'] = (float,_positive,'> 0')
+    _SCHEMA[_axis + '_MOTOR_RMS_CURRENT_mA'] = (float,lambda value: 0 < value <= 3000,'between 0 and 3000')
+    _SCHEMA[_axis + '_MOTOR_I_HOLD'] = (float,_fraction,'between 0 and 1')
+    _SCHEMA['MAX_VELOCITY_' + _axis + '_mm'] = (float,_positive,'> 0')
+    _SCHEMA['MAX_ACCELERATION_' + _axis + '_mm'] = (float,_positive,'> 0')
+    _SCHEMA['SCAN_STABILIZATION_TIME_MS_' + _axis] = (float,lambda value: value >= 0,'>= 0')
+    _SCHEMA['HOMING_ENABLED_' + _axis] = (bool,None,'')
+for _color in ('R','G','B'):
+    _SCHEMA['LED_MATRIX_' + _color + '_FACTOR'] = (float,_fraction,'between 0 and 1')
+
+_cache = {} # filename: (mtime_ns, size, MachineConfiguration)
+
+def _is_section(value):
+    return inspect.isclass(value)
+
+def get_settings(namespace):
+    # the names of a module namespace (e.g. vars(_def)) that a machine configuration can set: constants and the classes holding constants
+    settings = {}
+    for name, value in namespace.items():
+        if name.startswith('_') or inspect.ismodule(value) or inspect.isfunction(value):
+            continue
+        if _is_section(value):
+            if value.__module__ != namespace.get('__name__'):
+                continue # e.g. Path
+        settings[name] = value
+    return settings
+
+def _section_settings(section):
+    return {name: value for name, value in vars(section).items() if not name.startswith('_')}
+
+def _check_type(name,value,default,errors):
+    expected = _SCHEMA[name][0] if name in _SCHEMA else None
+    if expected is None:
+        if default is None or value is None:
+            return value
+        expected = type(default)
+    if expected is bool or isinstance(value,bool):
+        if not isinstance(value,bool) or expected is not bool:
+            errors.append(name + ' = ' + repr(value) + ': expected ' + expected.__name__)
+        return value
+    if expected is float and isinstance(value,int):
+        return value # ints are fine where floats are expected, e.g. SCREW_PITCH_X_MM = 1
+    if expected is int and isinstance(value,float):
+        if name not in _SCHEMA:
+            return value # the defaults of _def.py are often written as ints, e.g. OFFSET_COLUMN_1_MM = 20
+        errors.append(name + ' = ' + repr(value) + ': expected int')
+        return value
+    if not isinstance(value,expected):
+        errors.append(name + ' = ' + repr(value) + ': expected ' + expected.__name__)
+    return value
+
+def _check_range(name,value,errors):
+    if name not in _SCHEMA:
+        return
+    expected, check, description = _SCHEMA[name]
+    if check is None:
+        return
+    try:
+        ok = check(value)
+    except TypeError:
+        ok = False
+    if not ok:
+        errors.append(name + ' = ' + repr(value) + ': expected ' + description)
+
+def validate(values):
+    # range checks of the settings in values (a namespace or a dict of settings); returns the errors, e.g. to check a configuration*.txt after exec()
+    errors = []
+    for name in _SCHEMA:
+        if name in values:
+            _check_range(name,values[name],errors)
+    return errors
+
+def _parse(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib # python < 3.11
+        with open(filename,'rb') as f:
+            return tomllib.load(f)
+    if extension == '.json':
+        with open(filename) as f:
+            return json.load(f)
+    if extension in ('.yaml','.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise MachineConfigurationError(filename,['reading yaml needs pyyaml (pip3 install pyyaml)'])
+        with open(filename) as f:
+            return yaml.safe_load(f) or {}
+    raise MachineConfigurationError(filename,['unknown format, use .toml, .json, .yaml or .yml'])
+
+def _freeze(value):
+    if isinstance(value,dict):
+        return types.MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value,list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _thaw(value):
+    if isinstance(value,types.MappingProxyType):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value,tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+def _to_namedtuple(typename,values):
+    return namedtuple(typename,sorted(values))(**{name: _freeze(value) for name, value in values.items()})
+
+def from_namespace(namespace):
+    # MachineConfiguration of the current settings of a namespace, e.g. after a configuration*.txt was exec()'d
+    values = {}
+    for name, value in get_settings(namespace).items():
+        values[name] = _to_namedtuple(name,_section_settings(value)) if _is_section(value) else value
+    return _to_namedtuple('MachineConfiguration',values)
+
+def load(filename,defaults):
+    # defaults: get_settings(vars(_def)); raises MachineConfigurationError listing every problem of the file
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    cached = _cache.get(filename)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns,stat.st_size):
+        return cached[2]
+
+    try:
+        file_values = _parse(filename)
+    except MachineConfigurationError:
+        raise
+    except Exception as e:
+        raise MachineConfigurationError(filename,['cannot be parsed: ' + str(e)])
+    if not isinstance(file_values,dict):
+        raise MachineConfigurationError(filename,['expected a table of settings at the top level'])
+
+    errors = []
+    values = {}
+    for name, default in defaults.items():
+        values[name] = dict(_section_settings(default)) if _is_section(default) else default
+    for name, value in file_values.items():
+        if name not in defaults:
+            errors.append(name + ': unknown setting')
+            continue
+        default = defaults[name]
+        if _is_section(default):
+            if not isinstance(value,dict):
+                errors.append(name + ': expected a table')
+                continue
+            for key, item in value.items():
+                if key not in values[name]:
+                    errors.append(name + '.' + key + ': unknown setting')
+                    continue
+                values[name][key] = _check_type(name + '.' + key,item,values[name][key],errors)
+        else:
+            if value == 'None' and (default is None or name in _SCHEMA):
+                value = None # toml has no null
+            values[name] = _check_type(name,value,default,errors)
+
+    # as in the .txt files, the position signs follow the movement signs unless given
+    for axis in AXES:
+        if 'STAGE_MOVEMENT_SIGN_' + axis in file_values and 'STAGE_POS_SIGN_' + axis not in file_values:
+            values['STAGE_POS_SIGN_' + axis] = values['STAGE_MOVEMENT_SIGN_' + axis]
+    # and tracking displays the full frame (if ENABLE_TRACKING: DEFAULT_DISPLAY_CROP = 100)
+    if values.get('ENABLE_TRACKING') and 'DEFAULT_DISPLAY_CROP' in values and 'DEFAULT_DISPLAY_CROP' not in file_values:
+        values['DEFAULT_DISPLAY_CROP'] = 100
+
+    errors.extend(validate(values))
+    if errors:
+        raise MachineConfigurationError(filename,errors)
+
+    configuration = _to_namedtuple('MachineConfiguration',{name: _to_namedtuple(name,value) if _is_section(defaults[name]) else value for name, value in values.items()})
+    _cache[filename] = (stat.st_mtime_ns,stat.st_size,configuration)
+    return configuration
+
+def apply(configuration,namespace):
+    # writes a MachineConfiguration into a module namespace (_def); classes are updated in place so that they stay the same objects
+    for name, value in configuration._asdict().items():
+        current = namespace.get(name)
+        if _is_section(current):
+            for key, item in value._asdict().items():
+                setattr(current,key,_thaw(item))
+        elif _thaw(value) != current:
+            namespace[name] = _thaw(value)
@@ -6,6 +6,7 @@ import numpy as np
 import threading
 
 from control._def import *
+import control.instrumentation as instrumentation
 
 from qtpy.QtCore import *
 from qtpy.QtWidgets import *
@@ -20,7 +21,7 @@ from qtpy.QtGui import *
 # to do (7/28/2021) - add functions for configuring the stepper motors
 
 class Microcontroller():    
-    def __init__(self,parent=None):
+    def __init__(self,parent=None,port=None):
         self.serial = None
         self.platform_name = platform.system()
         self.tx_buffer_length = MicrocontrollerDef.CMD_LENGTH
@@ -41,22 +42,26 @@ class Microcontroller():
         self.switch_state = 0
 
         self.last_command = None
+        self.timestamp_command_sent = time.perf_counter()
         self.timeout_counter = 0
 
-        # AUTO-DETECT the Arduino! Based on Deepak's code
-        arduino_ports = [
-                p.device
-                for p in serial.tools.list_ports.comports()
-                if 'Arduino Due' == p.description]
-        if not arduino_ports:
-            raise IOError("No Arduino found")
-        if len(arduino_ports) > 1:
-            print('Multiple Arduinos found - using the first')
-        else:
-            print('Using Arduino found at : {}'.format(arduino_ports[0]))
+        # port: serial port to use instead of auto-detection, e.g. the pty of a MicrocontrollerEmulator
+        if port is None:
+            # AUTO-DETECT the Arduino! Based on Deepak's code
+            arduino_ports = [
+                    p.device
+                    for p in serial.tools.list_ports.comports()
+                    if 'Arduino Due' == p.description]
+            if not arduino_ports:
+                raise IOError("No Arduino found")
+            if len(arduino_ports) > 1:
+                print('Multiple Arduinos found - using the first')
+            else:
+                print('Using Arduino found at : {}'.format(arduino_ports[0]))
+            port = arduino_ports[0]
 
         # establish serial communication
-        self.serial = serial.Serial(arduino_ports[0],2000000)
+        self.serial = serial.Serial(port,2000000)
         time.sleep(0.2)
         print('Serial Connection Open')
 
@@ -446,8 +451,8 @@ class Microcontroller():
         self.configure_motor_driver(AXIS.Z,MICROSTEPPING_DEFAULT_Z,Z_MOTOR_RMS_CURRENT_mA,Z_MOTOR_I_HOLD)
         # max velocity and acceleration
         self.set_max_velocity_acceleration(AXIS.X,MAX_VELOCITY_X_mm,MAX_ACCELERATION_X_mm)
-        self.set_max_velocity_acceleration(AXIS.Y,MAX_VELOCITY_X_mm,MAX_ACCELERATION_Y_mm)
-        self.set_max_velocity_acceleration(AXIS.Z,MAX_VELOCITY_X_mm,MAX_ACCELERATION_Z_mm)
+        self.set_max_velocity_acceleration(AXIS.Y,MAX_VELOCITY_Y_mm,MAX_ACCELERATION_Y_mm)
+        self.set_max_velocity_acceleration(AXIS.Z,MAX_VELOCITY_Z_mm,MAX_ACCELERATION_Z_mm)
         # home switch
         self.set_limit_switch_polarity(AXIS.X,X_HOME_SWITCH_POLARITY)
         self.set_limit_switch_polarity(AXIS.Y,Y_HOME_SWITCH_POLARITY)
@@ -474,6 +479,7 @@ class Microcontroller():
         self.mcu_cmd_execution_in_progress = True
         self.last_command = command
         self.timeout_counter = 0
+        self.timestamp_command_sent = time.perf_counter()
 
     def resend_last_command(self):
         self.serial.write(self.last_command)
@@ -482,10 +488,12 @@ class Microcontroller():
 
     def read_received_packet(self):
         while self.terminate_reading_received_packet_thread == False:
-            # wait to receive data
+            # wait to receive data; packets come every 10 ms, polling without a pause would take a whole core from the other threads
             if self.serial.in_waiting==0:
+                time.sleep(0.001)
                 continue
             if self.serial.in_waiting % self.rx_buffer_length != 0:
+                time.sleep(0.001)
                 continue
             
             # get rid of old data
@@ -517,11 +525,12 @@ class Microcontroller():
             if (self._cmd_id_mcu == self._cmd_id) and (self._cmd_execution_status == CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS):
                 if self.mcu_cmd_execution_in_progress == True:
                     self.mcu_cmd_execution_in_progress = False
-                    print('   mcu command ' + str(self._cmd_id) + ' complete')
+                    instrumentation.record('mcu.command',time.perf_counter() - self.timestamp_command_sent,self.timestamp_command_sent) # ack latency
                 elif self._cmd_id_mcu != self._cmd_id and self.last_command != None:
                     self.timeout_counter = self.timeout_counter + 1
                     if self.timeout_counter > 10:
                         self.resend_last_command()
+                        instrumentation.count('mcu.resend')
                         print('      *** resend the last command')
             # print('command id ' + str(self._cmd_id) + '; mcu command ' + str(self._cmd_id_mcu) + ' status: ' + str(msg[1]) )
 
@@ -595,6 +604,7 @@ class Microcontroller_Simulation():
 
          # for simulation
         self.timestamp_last_command = time.time() # for simulation only
+        self.timestamp_command_sent = time.perf_counter()
         self._mcu_cmd_execution_status = None
         self.timer_update_command_execution_status = QTimer()
         self.timer_update_command_execution_status.timeout.connect(self._simulation_update_cmd_execution_status)
@@ -760,8 +770,8 @@ class Microcontroller_Simulation():
         self.configure_motor_driver(AXIS.Z,MICROSTEPPING_DEFAULT_Z,Z_MOTOR_RMS_CURRENT_mA,Z_MOTOR_I_HOLD)
         # max velocity and acceleration
         self.set_max_velocity_acceleration(AXIS.X,MAX_VELOCITY_X_mm,MAX_ACCELERATION_X_mm)
-        self.set_max_velocity_acceleration(AXIS.Y,MAX_VELOCITY_X_mm,MAX_ACCELERATION_Y_mm)
-        self.set_max_velocity_acceleration(AXIS.Z,MAX_VELOCITY_X_mm,MAX_ACCELERATION_Z_mm)
+        self.set_max_velocity_acceleration(AXIS.Y,MAX_VELOCITY_Y_mm,MAX_ACCELERATION_Y_mm)
+        self.set_max_velocity_acceleration(AXIS.Z,MAX_VELOCITY_Z_mm,MAX_ACCELERATION_Z_mm)
         # home switch
         self.set_limit_switch_polarity(AXIS.X,X_HOME_SWITCH_POLARITY)
         self.set_limit_switch_polarity(AXIS.Y,Y_HOME_SWITCH_POLARITY)
@@ -781,7 +791,7 @@ class Microcontroller_Simulation():
             if time.time() - self.timestamp_last_command > 0.05: # in the simulation, assume all the operation takes 0.05s to complete
                 if self._mcu_cmd_execution_status !=  CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS:
                     self._mcu_cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
-                    print('   mcu command ' + str(self._cmd_id) + ' complete')
+                    instrumentation.record('mcu.command',time.perf_counter() - self.timestamp_command_sent,self.timestamp_command_sent) # ack latency
 
             # read and parse message
             msg=[]
@@ -853,6 +863,7 @@ class Microcontroller_Simulation():
         # print('start timer')
         # timer cannot be started from another thread
         self.timestamp_last_command = time.time()
+        self.timestamp_command_sent = time.perf_counter()
 
     def _simulation_update_cmd_execution_status(self):
         # print('simulation - MCU command execution finished')
@@ -6,6 +6,7 @@ import numpy as np
 import threading
 
 from control._def import *
+import control.instrumentation as instrumentation
 
 from qtpy.QtCore import *
 from qtpy.QtWidgets import *
@@ -24,6 +25,7 @@ class Microcontroller2():
         self._cmd_execution_status = None
         self.mcu_cmd_execution_in_progress = False
         self.last_command = None
+        self.timestamp_command_sent = time.perf_counter()
         self.timeout_counter = 0
 
         controller_ports = [ p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'Teensyduino']
@@ -59,13 +61,16 @@ class Microcontroller2():
         self.mcu_cmd_execution_in_progress = True
         self.last_command = command
         self.timeout_counter = 0
+        self.timestamp_command_sent = time.perf_counter()
 
     def read_received_packet(self):
         while self.terminate_reading_received_packet_thread == False:
-            # wait to receive data
+            # wait to receive data; packets come every 10 ms, polling without a pause would take a whole core from the other threads
             if self.serial.in_waiting==0:
+                time.sleep(0.001)
                 continue
             if self.serial.in_waiting % self.rx_buffer_length != 0:
+                time.sleep(0.001)
                 continue
             
             # get rid of old data
@@ -91,11 +96,12 @@ class Microcontroller2():
             if (self._cmd_id_mcu == self._cmd_id) and (self._cmd_execution_status == CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS):
                 if self.mcu_cmd_execution_in_progress == True:
                     self.mcu_cmd_execution_in_progress = False
-                    print('   mcu command ' + str(self._cmd_id) + ' complete')
+                    instrumentation.record('mcu2.command',time.perf_counter() - self.timestamp_command_sent,self.timestamp_command_sent) # ack latency
                 elif self._cmd_id_mcu != self._cmd_id and self.last_command != None:
                     self.timeout_counter = self.timeout_counter + 1
                     if self.timeout_counter > 10:
                         self.resend_last_command()
+                        instrumentation.count('mcu2.resend')
                         print('      *** resend the last command')
             # print('command id ' + str(self._cmd_id) + '; mcu command ' + str(self._cmd_id_mcu) + ' status: ' + str(msg[1]) )
 
@@ -137,6 +143,7 @@ class Microcontroller2_Simulation():
 
          # for simulation
         self.timestamp_last_command = time.time() # for simulation only
+        self.timestamp_command_sent = time.perf_counter()
         self._mcu_cmd_execution_status = None
         self.timer_update_command_execution_status = QTimer()
         self.timer_update_command_execution_status.timeout.connect(self._simulation_update_cmd_execution_status)
@@ -166,7 +173,7 @@ class Microcontroller2_Simulation():
             if time.time() - self.timestamp_last_command > 0.05: # in the simulation, assume all the operation takes 0.05s to complete
                 if self._mcu_cmd_execution_status !=  CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS:
                     self._mcu_cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
-                    print('   mcu command ' + str(self._cmd_id) + ' complete')
+                    instrumentation.record('mcu2.command',time.perf_counter() - self.timestamp_command_sent,self.timestamp_command_sent) # ack latency
 
             # read and parse message
             msg=[]
@@ -205,6 +212,7 @@ class Microcontroller2_Simulation():
         # print('start timer')
         # timer cannot be started from another thread
         self.timestamp_last_command = time.time()
+        self.timestamp_command_sent = time.perf_counter()
 
     def _simulation_update_cmd_execution_status(self):
         # print('simulation - MCU command execution finished')
@@ -0,0 +1,274 @@
+import os
+import tty
+import time
+import select
+import threading
+import numpy as np
+
+from control._def import *
+
+# emulates the octopi firmware at the serial protocol level: 8-byte commands in, 24-byte status packets out every 10 ms
+# usage:
+#   emulator = MicrocontrollerEmulator()
+#   emulator.start()
+#   mcu = microcontroller.Microcontroller(port=emulator.port)
+
+# from the firmware (def.h)
+HOMING_VELOCITY = 0.5 # fraction of the max velocity
+INTERVAL_SEND_POS_UPDATE_S = 0.01
+LOOP_PERIOD_S = 0.0005
+
+class _Axis(object):
+    # trapezoidal velocity profile: accelerate to the max velocity, cruise, decelerate to stop at the target
+
+    def __init__(self,steps_per_mm,max_velocity_mm,max_acceleration_mm,position_usteps=0,switch_position_usteps=0):
+        self.steps_per_mm = steps_per_mm
+        self.max_velocity = max_velocity_mm*steps_per_mm
+        self.max_acceleration = max_acceleration_mm*steps_per_mm
+        self.position = float(position_usteps) # unit: usteps, counted from the current origin
+        self.origin = 0.0 # mechanical position of the origin, so that the home switch stays at a fixed place
+        self.switch_position = switch_position_usteps # mechanical position of the home switch
+        self.velocity = 0.0
+        self.target = float(position_usteps)
+        self.moving = False
+        self.homing = False
+        self.homing_direction = HOME_OR_ZERO.HOME_NEGATIVE
+        self.neg_limit = -2**31
+        self.pos_limit = 2**31-1
+
+    def set_steps_per_mm(self,steps_per_mm):
+        # velocity and acceleration are kept in mm
+        self.max_velocity = self.max_velocity/self.steps_per_mm*steps_per_mm
+        self.max_acceleration = self.max_acceleration/self.steps_per_mm*steps_per_mm
+        self.steps_per_mm = steps_per_mm
+
+    def move(self,usteps):
+        target = self.target + usteps if self.moving else self.position + usteps
+        self.move_to(min(target,self.pos_limit) if usteps > 0 else max(target,self.neg_limit))
+
+    def move_to(self,usteps):
+        self.target = float(usteps)
+        self.moving = True
+
+    def home(self,direction):
+        # run at the homing velocity until the switch, then zero the position there
+        self.homing = True
+        self.homing_direction = direction
+        self.moving = True
+        switch = self.switch_position - self.origin
+        self.target = switch
+
+    def zero(self):
+        self.origin = self.origin + self.position
+        self.target = self.target - self.position
+        self.position = 0.0
+
+    def update(self,dt):
+        if not self.moving:
+            return
+        max_velocity = self.max_velocity*(HOMING_VELOCITY if self.homing else 1)
+        distance = self.target - self.position
+        # the fastest speed from which the axis can still stop at the target
+        v_desired = np.sign(distance)*min(max_velocity,np.sqrt(2*self.max_acceleration*abs(distance)))
+        dv = np.clip(v_desired - self.velocity,-self.max_acceleration*dt,self.max_acceleration*dt)
+        self.velocity = self.velocity + dv
+        self.position = self.position + self.velocity*dt
+        # arrival (or overshoot within one step)
+        if np.sign(self.target - self.position) != np.sign(distance) or (abs(self.target - self.position) < 0.5 and abs(self.velocity) <= self.max_acceleration*dt*2):
+            self.position = self.target
+            self.velocity = 0.0
+            self.moving = False
+            if self.homing:
+                self.homing = False
+                self.zero()
+
+class MicrocontrollerEmulator(object):
+
+    def __init__(self,initial_position_mm=(10,10,1),drop_byte_probability=0,drop_command_probability=0,ack_delay_s=0,packet_interval_jitter_s=0,seed=None):
+        # faults: drop_byte_probability - each byte (in either direction) is lost with this probability
+        #         drop_command_probability - a complete command is ignored
+        #         ack_delay_s - completion of a command is reported this much later than it happens
+        #         packet_interval_jitter_s - random extra delay of the status packets
+        self.drop_byte_probability = drop_byte_probability
+        self.drop_command_probability = drop_command_probability
+        self.ack_delay_s = ack_delay_s
+        self.packet_interval_jitter_s = packet_interval_jitter_s
+        self.rng = np.random.default_rng(seed)
+
+        steps_per_mm_x = FULLSTEPS_PER_REV_X*MICROSTEPPING_DEFAULT_X/SCREW_PITCH_X_MM
+        steps_per_mm_y = FULLSTEPS_PER_REV_Y*MICROSTEPPING_DEFAULT_Y/SCREW_PITCH_Y_MM
+        steps_per_mm_z = FULLSTEPS_PER_REV_Z*MICROSTEPPING_DEFAULT_Z/SCREW_PITCH_Z_MM
+        # the home switches are at the mechanical zero
+        self.axes = {
+            AXIS.X: _Axis(steps_per_mm_x,MAX_VELOCITY_X_mm,MAX_ACCELERATION_X_mm,initial_position_mm[0]*steps_per_mm_x),
+            AXIS.Y: _Axis(steps_per_mm_y,MAX_VELOCITY_Y_mm,MAX_ACCELERATION_Y_mm,initial_position_mm[1]*steps_per_mm_y),
+            AXIS.Z: _Axis(steps_per_mm_z,MAX_VELOCITY_Z_mm,MAX_ACCELERATION_Z_mm,initial_position_mm[2]*steps_per_mm_z)
+        }
+        self.fullsteps_per_rev = {AXIS.X:FULLSTEPS_PER_REV_X,AXIS.Y:FULLSTEPS_PER_REV_Y,AXIS.Z:FULLSTEPS_PER_REV_Z}
+        self.microstepping = {AXIS.X:MICROSTEPPING_DEFAULT_X,AXIS.Y:MICROSTEPPING_DEFAULT_Y,AXIS.Z:MICROSTEPPING_DEFAULT_Z}
+        self.screw_pitch_mm = {AXIS.X:SCREW_PITCH_X_MM,AXIS.Y:SCREW_PITCH_Y_MM,AXIS.Z:SCREW_PITCH_Z_MM}
+
+        self.cmd_id = 0
+        self.mcu_cmd_execution_in_progress = False
+        self.t_cmd_completed = None
+        self.illumination_on = False
+        self.illumination_source = None
+        self.illumination_intensity = 0
+        self.led_matrix_rgb = (0,0,0)
+        self.dac_values = {}
+        self.joystick_button_pressed = False
+
+        self.statistics = {'commands_received':0,'commands_dropped':0,'bytes_dropped':0,'packets_sent':0,'invalid_commands':0}
+
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self.thread = None
+        self.terminate = False
+
+    def start(self):
+        # the host opens self.port like the serial port of the Arduino
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        tty.setraw(self.master_fd)
+        # a host that stops reading must not block the emulator
+        os.set_blocking(self.master_fd,False)
+        self.port = os.ttyname(self.slave_fd)
+        self.terminate = False
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+        print('microcontroller emulator listening on ' + self.port)
+
+    def close(self):
+        self.terminate = True
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def press_joystick_button(self):
+        self.joystick_button_pressed = True
+
+    def get_pos_mm(self):
+        return tuple(self.axes[axis].position/self.axes[axis].steps_per_mm for axis in (AXIS.X,AXIS.Y,AXIS.Z))
+
+    def run(self):
+        buffer_rx = bytearray()
+        t_last = time.time()
+        t_next_packet = t_last + INTERVAL_SEND_POS_UPDATE_S
+        while not self.terminate:
+            readable, _, _ = select.select([self.master_fd],[],[],LOOP_PERIOD_S)
+            if readable:
+                for byte in os.read(self.master_fd,1024):
+                    if self.drop_byte_probability and self.rng.random() < self.drop_byte_probability:
+                        self.statistics['bytes_dropped'] = self.statistics['bytes_dropped'] + 1
+                        continue
+                    buffer_rx.append(byte)
+                    if len(buffer_rx) == MicrocontrollerDef.CMD_LENGTH:
+                        self.execute(buffer_rx)
+                        buffer_rx = bytearray()
+            t = time.time()
+            for axis in self.axes.values():
+                axis.update(t - t_last)
+            t_last = t
+            if self.mcu_cmd_execution_in_progress and not any(axis.moving for axis in self.axes.values()):
+                if self.t_cmd_completed is None:
+                    self.t_cmd_completed = t
+                if t - self.t_cmd_completed >= self.ack_delay_s:
+                    self.mcu_cmd_execution_in_progress = False
+                    self.t_cmd_completed = None
+            if t >= t_next_packet:
+                self.send_packet()
+                t_next_packet = t_next_packet + INTERVAL_SEND_POS_UPDATE_S
+                if self.packet_interval_jitter_s:
+                    t_next_packet = t_next_packet + self.rng.uniform(0,self.packet_interval_jitter_s)
+                t_next_packet = max(t_next_packet,t)
+
+    def execute(self,cmd):
+        self.statistics['commands_received'] = self.statistics['commands_received'] + 1
+        if self.drop_command_probability and self.rng.random() < self.drop_command_probability:
+            self.statistics['commands_dropped'] = self.statistics['commands_dropped'] + 1
+            return
+        self.cmd_id = cmd[0]
+        command = cmd[1]
+        payload = int.from_bytes(bytes(cmd[2:6]),'big',signed=True)
+        if command in (CMD_SET.MOVE_X,CMD_SET.MOVE_Y,CMD_SET.MOVE_Z):
+            self.axes[command - CMD_SET.MOVE_X].move(payload)
+            self._start_execution()
+        elif command in (CMD_SET.MOVETO_X,CMD_SET.MOVETO_Y,CMD_SET.MOVETO_Z):
+            self.axes[command - CMD_SET.MOVETO_X].move_to(payload)
+            self._start_execution()
+        elif command == CMD_SET.MOVE_THETA:
+            pass
+        elif command == CMD_SET.HOME_OR_ZERO:
+            axes = [AXIS.X,AXIS.Y] if cmd[2] == AXIS.XY else [cmd[2]]
+            for i, axis in enumerate(axes):
+                if axis not in self.axes:
+                    continue
+                # for XY the direction of y is in byte 4
+                direction = cmd[3+i]
+                if cmd[3] == HOME_OR_ZERO.ZERO:
+                    self.axes[axis].zero()
+                else:
+                    self.axes[axis].home(direction)
+                    self._start_execution()
+        elif command == CMD_SET.SET_LIM:
+            axis = self.axes[cmd[2]//2]
+            value = int.from_bytes(bytes(cmd[3:7]),'big',signed=True)
+            if cmd[2] % 2 == 0:
+                axis.pos_limit = value
+            else:
+                axis.neg_limit = value
+        elif command == CMD_SET.CONFIGURE_STEPPER_DRIVER:
+            self.microstepping[cmd[2]] = 1 if cmd[3] == 0 else cmd[3]
+            self._update_steps_per_mm(cmd[2])
+        elif command == CMD_SET.SET_LEAD_SCREW_PITCH:
+            self.screw_pitch_mm[cmd[2]] = (cmd[3]*256 + cmd[4])/1000
+            self._update_steps_per_mm(cmd[2])
+        elif command == CMD_SET.SET_MAX_VELOCITY_ACCELERATION:
+            axis = self.axes[cmd[2]]
+            axis.max_velocity = (cmd[3]*256 + cmd[4])/100*axis.steps_per_mm
+            axis.max_acceleration = (cmd[5]*256 + cmd[6])/10*axis.steps_per_mm
+        elif command == CMD_SET.TURN_ON_ILLUMINATION:
+            self.illumination_on = True
+        elif command == CMD_SET.TURN_OFF_ILLUMINATION:
+            self.illumination_on = False
+        elif command == CMD_SET.SET_ILLUMINATION:
+            self.illumination_source = cmd[2]
+            self.illumination_intensity = (cmd[3]*256 + cmd[4])/65535*100
+        elif command == CMD_SET.SET_ILLUMINATION_LED_MATRIX:
+            self.illumination_source = cmd[2]
+            self.led_matrix_rgb = (cmd[3],cmd[4],cmd[5])
+        elif command == CMD_SET.ACK_JOYSTICK_BUTTON_PRESSED:
+            self.joystick_button_pressed = False
+        elif command == CMD_SET.ANALOG_WRITE_ONBOARD_DAC:
+            self.dac_values[cmd[2]] = cmd[3]*256 + cmd[4]
+        elif command == CMD_SET.SET_LIM_SWITCH_POLARITY:
+            pass
+        else:
+            self.statistics['invalid_commands'] = self.statistics['invalid_commands'] + 1
+
+    def _start_execution(self):
+        self.mcu_cmd_execution_in_progress = True
+        self.t_cmd_completed = None
+
+    def _update_steps_per_mm(self,axis):
+        if axis in self.axes:
+            self.axes[axis].set_steps_per_mm(self.fullsteps_per_rev[axis]*self.microstepping[axis]/self.screw_pitch_mm[axis])
+
+    def send_packet(self):
+        msg = bytearray(MicrocontrollerDef.MSG_LENGTH)
+        msg[0] = self.cmd_id
+        msg[1] = CMD_EXECUTION_STATUS.IN_PROGRESS if self.mcu_cmd_execution_in_progress else CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
+        for i, axis in enumerate((AXIS.X,AXIS.Y,AXIS.Z)):
+            msg[2+4*i:6+4*i] = int(round(self.axes[axis].position)).to_bytes(4,'big',signed=True)
+        msg[18] = int(self.joystick_button_pressed) << BIT_POS_JOYSTICK_BUTTON
+        if self.drop_byte_probability:
+            keep = self.rng.random(len(msg)) >= self.drop_byte_probability
+            self.statistics['bytes_dropped'] = self.statistics['bytes_dropped'] + int(np.sum(~keep))
+            msg = bytearray(b for b, k in zip(msg,keep) if k)
+        try:
+            os.write(self.master_fd,bytes(msg))
+        except BlockingIOError:
+            return
+        self.statistics['packets_sent'] = self.statistics['packets_sent'] + 1
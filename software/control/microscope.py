@@ -0,0 +1,539 @@
+# acquisition core without Qt: no QApplication, signals or event loop are needed, so acquisitions can run from scripts and job queues
+# the hardware objects are the same as in the GUI (camera*.py, microcontroller*.py); in the GUI, control/core_microscope.py wraps it in a QObject
+#
+# microscope = Microscope({'Widefield':camera},microcontroller,microcontroller2,configurations=load_configurations('configurations.xml'))
+# result = microscope.acquire(AcquisitionPlan(NX=3,NY=3,configurations=['BF LED matrix full'],base_path='/data'))
+# future = microscope.submit(plan) # runs in the background, plans submitted later wait for the earlier ones
+
+import os
+import csv
+import json
+import time
+import weakref
+import threading
+from queue import Queue
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+from lxml import etree as ET
+
+import control.utils as utils
+import control.instrumentation as instrumentation
+from control.spectrum import SpectrumAccumulator, save_accumulated_spectrum
+from control._def import *
+
+class Configuration:
+    def __init__(self,mode_id=None,name=None,camera_sn=None,exposure_time=None,analog_gain=None,illumination_source=None,illumination_intensity=None,channel=None,dac_led=None,dac_laser=None):
+        self.id = mode_id
+        self.name = name
+        self.exposure_time = exposure_time
+        self.analog_gain = analog_gain
+        self.illumination_source = illumination_source
+        self.illumination_intensity = illumination_intensity
+        self.camera_sn = camera_sn
+        self.channel = channel
+        self.dac_led = dac_led
+        self.dac_laser = dac_laser
+
+def load_configurations(filename,channel=None):
+    # reads the xml files written by ConfigurationManager; the channel is used for modes that do not have one
+    configurations = []
+    for mode in ET.parse(filename).getroot().iter('mode'):
+        configurations.append(
+            Configuration(
+                mode_id = mode.get('ID'),
+                name = mode.get('Name'),
+                exposure_time = float(mode.get('ExposureTime')),
+                analog_gain = float(mode.get('AnalogGain')),
+                illumination_source = int(mode.get('IlluminationSource')),
+                illumination_intensity = float(mode.get('IlluminationIntensity')),
+                camera_sn = mode.get('CameraSN'),
+                channel = mode.get('Channel',channel),
+                dac_led = float(mode.get('DAC_LED')) if mode.get('DAC_LED') is not None else None,
+                dac_laser = float(mode.get('DAC_Laser')) if mode.get('DAC_Laser') is not None else None
+            )
+        )
+    return configurations
+
+class DeviceState(object):
+    # last values written to one device, so that switching configuration only sends the parameters that changed
+    # there is one per device (get_device_state), shared by everything that talks to it: the live controllers of the spectrometer share the microcontrollers
+    def __init__(self):
+        self.values = {}
+        self.timestamp_last_settling_change = 0 # time of the last write that needs settling (illumination, DAC)
+
+    def is_current(self,key,value):
+        return key in self.values and self.values[key] == value
+
+    def write(self,key,value,function,settle=False):
+        if self.is_current(key,value):
+            instrumentation.count('device_state.writes_skipped')
+            return False
+        function(value)
+        self.values[key] = value
+        if settle:
+            self.timestamp_last_settling_change = time.time()
+        instrumentation.count('device_state.writes')
+        return True
+
+    def invalidate(self,key=None):
+        # for values changed without write(), e.g. from a settings widget, or when the device was reset
+        if key is None:
+            self.values.clear()
+        else:
+            self.values.pop(key,None)
+
+    def get_settling_time_remaining(self,settling_time_s):
+        return max(0,settling_time_s - (time.time() - self.timestamp_last_settling_change))
+
+_device_states = weakref.WeakKeyDictionary()
+_device_states_lock = threading.Lock()
+
+def get_device_state(device):
+    with _device_states_lock:
+        state = _device_states.get(device)
+        if state is None:
+            state = DeviceState()
+            _device_states[device] = state
+        return state
+
+def set_illumination(microcontroller,illumination_source,intensity):
+    if illumination_source < 10: # LED matrix
+        microcontroller.set_illumination_led_matrix(illumination_source,r=(intensity/100)*LED_MATRIX_R_FACTOR,g=(intensity/100)*LED_MATRIX_G_FACTOR,b=(intensity/100)*LED_MATRIX_B_FACTOR)
+    else:
+        microcontroller.set_illumination(illumination_source,intensity)
+
+def get_configuration_changes(configuration,camera,microcontroller,microcontroller2=None,control_illumination=True):
+    # the writes needed to go from the current device state to the configuration: [(state, key, value, function, settle)]
+    writes = []
+    camera_state = get_device_state(camera)
+    writes.append((camera_state,'exposure_time',configuration.exposure_time,camera.set_exposure_time,False))
+    writes.append((camera_state,'analog_gain',configuration.analog_gain,camera.set_analog_gain,False))
+    if control_illumination:
+        writes.append((get_device_state(microcontroller),'illumination',(configuration.illumination_source,configuration.illumination_intensity),lambda value: set_illumination(microcontroller,*value),True))
+        if microcontroller2 is not None and configuration.dac_led is not None:
+            microcontroller2_state = get_device_state(microcontroller2)
+            for DAC, value in ((0,configuration.dac_led),(1,configuration.dac_laser)):
+                writes.append((microcontroller2_state,('DAC',DAC),int(value*65535/100),lambda value, DAC=DAC: microcontroller2.analog_write_DAC8050x(DAC,value),True))
+    return [write for write in writes if not write[0].is_current(write[1],write[2])]
+
+def apply_configuration_changes(changes):
+    for state, key, value, function, settle in changes:
+        state.write(key,value,function,settle)
+
+class AcquisitionPlan(object):
+    # what MultiPointWidget sets on MultiPointController, as one object
+    # positions_mm: list of (x,y) or (x,y,z) to visit instead of the NX x NY grid around the current position, e.g. the wells of a plate
+    def __init__(self,NX=1,NY=1,NZ=1,Nt=1,deltaX_mm=Acquisition.DX,deltaY_mm=Acquisition.DY,deltaZ_um=Acquisition.DZ,deltat_s=0,
+                 configurations=None,N_spectrum=1,positions_mm=None,do_autofocus=False,autofocus_configuration=None,
+                 autofocus_N=10,autofocus_deltaZ_um=1.524,fovs_per_autofocus=Acquisition.NUMBER_OF_FOVS_PER_AF,
+                 base_path=None,experiment_ID='acquisition',save_images=True,image_format=Acquisition.IMAGE_FORMAT,
+                 spectrum_accumulation=SPECTRUM_ACCUMULATION.MODE,keep_raw_spectrum_frames=SPECTRUM_ACCUMULATION.KEEP_RAW_FRAMES,spectrum_mask=None):
+        self.NX = NX
+        self.NY = NY
+        self.NZ = NZ
+        self.Nt = Nt
+        self.deltaX_mm = deltaX_mm
+        self.deltaY_mm = deltaY_mm
+        self.deltaZ_um = deltaZ_um
+        self.deltat_s = deltat_s
+        self.configurations = configurations if configurations is not None else [] # names or Configuration objects
+        self.N_spectrum = N_spectrum
+        self.positions_mm = positions_mm
+        self.do_autofocus = do_autofocus
+        self.autofocus_configuration = autofocus_configuration
+        self.autofocus_N = autofocus_N
+        self.autofocus_deltaZ_um = autofocus_deltaZ_um
+        self.fovs_per_autofocus = fovs_per_autofocus
+        self.base_path = base_path
+        self.experiment_ID = experiment_ID
+        self.save_images = save_images
+        self.image_format = image_format
+        self.spectrum_accumulation = spectrum_accumulation # see SPECTRUM_ACCUMULATION
+        self.keep_raw_spectrum_frames = keep_raw_spectrum_frames
+        self.spectrum_mask = spectrum_mask # extraction mask for spectrum_accumulation 'spectrum' and 'band', None: every pixel
+
+    def to_dict(self):
+        plan = dict(self.__dict__)
+        plan['configurations'] = [c if isinstance(c,str) else c.name for c in self.configurations]
+        plan['spectrum_mask'] = self.spectrum_mask is not None
+        return plan
+
+class AcquisitionAborted(Exception):
+    pass
+
+class Stage(object):
+    # mm <-> microstep conversion and blocking moves; the position is read from the microcontroller when needed,
+    # the callback of the microcontroller is left to NavigationController
+    def __init__(self,microcontroller,timeout_s=60):
+        self.microcontroller = microcontroller
+        self.timeout_s = timeout_s
+        self.x_microstepping = MICROSTEPPING_DEFAULT_X
+        self.y_microstepping = MICROSTEPPING_DEFAULT_Y
+        self.z_microstepping = MICROSTEPPING_DEFAULT_Z
+
+    def mm_per_ustep(self,axis):
+        if axis == 'x':
+            return SCREW_PITCH_X_MM/(self.x_microstepping*FULLSTEPS_PER_REV_X)
+        if axis == 'y':
+            return SCREW_PITCH_Y_MM/(self.y_microstepping*FULLSTEPS_PER_REV_Y)
+        return SCREW_PITCH_Z_MM/(self.z_microstepping*FULLSTEPS_PER_REV_Z)
+
+    def wait_till_operation_is_completed(self):
+        t_start = time.time()
+        while self.microcontroller.is_busy():
+            if time.time() - t_start > self.timeout_s:
+                raise TimeoutError('microcontroller did not complete the command within ' + str(self.timeout_s) + ' s')
+            time.sleep(SLEEP_TIME_S)
+
+    def move_usteps(self,axis,usteps):
+        if usteps == 0:
+            return
+        with instrumentation.span('microscope.move_' + axis):
+            getattr(self.microcontroller,'move_' + axis + '_usteps')(usteps)
+            self.wait_till_operation_is_completed()
+
+    def move(self,axis,delta_mm):
+        self.move_usteps(axis,round(delta_mm/self.mm_per_ustep(axis)))
+
+    def move_to(self,axis,position_mm):
+        with instrumentation.span('microscope.move_' + axis):
+            getattr(self.microcontroller,'move_' + axis + '_to_usteps')(round(position_mm/self.mm_per_ustep(axis)))
+            self.wait_till_operation_is_completed()
+
+    def get_pos_mm(self):
+        # same conversion as NavigationController.update_pos
+        x_pos, y_pos, z_pos, theta_pos = self.microcontroller.get_pos()
+        x_mm = x_pos*ENCODER_POS_SIGN_X*ENCODER_STEP_SIZE_X_MM if USE_ENCODER_X else x_pos*STAGE_POS_SIGN_X*self.mm_per_ustep('x')
+        y_mm = y_pos*ENCODER_POS_SIGN_Y*ENCODER_STEP_SIZE_Y_MM if USE_ENCODER_Y else y_pos*STAGE_POS_SIGN_Y*self.mm_per_ustep('y')
+        z_mm = z_pos*ENCODER_POS_SIGN_Z*ENCODER_STEP_SIZE_Z_MM if USE_ENCODER_Z else z_pos*STAGE_POS_SIGN_Z*self.mm_per_ustep('z')
+        return x_mm, y_mm, z_mm
+
+    def settle(self,axis):
+        with instrumentation.span('microscope.settle'):
+            time.sleep({'x':SCAN_STABILIZATION_TIME_MS_X,'y':SCAN_STABILIZATION_TIME_MS_Y,'z':SCAN_STABILIZATION_TIME_MS_Z}[axis]/1000)
+
+class _ImageWriter(object):
+    # encodes and writes images in a background thread, so that saving overlaps with the next move
+    def __init__(self,max_queue_size=32):
+        self.queue = Queue(max_queue_size)
+        self.counter = 0
+        self.errors = []
+        self.thread = threading.Thread(target=self.process_queue,daemon=True)
+        self.thread.start()
+
+    def process_queue(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            image, saving_path = item
+            try:
+                with instrumentation.span('image_saver.encode'):
+                    cv2.imwrite(saving_path,image)
+                self.counter = self.counter + 1
+            except Exception as e:
+                self.errors.append(saving_path + ': ' + str(e))
+            self.queue.task_done()
+
+    def enqueue(self,image,saving_path):
+        # blocks when the queue is full - no image is discarded during an acquisition
+        self.queue.put((image,saving_path))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class Microscope(object):
+
+    def __init__(self,cameras,microcontroller,microcontroller2=None,configurations=None,frame_timeout_s=5):
+        # cameras: {channel: camera}, configurations: list of Configuration (or {channel: list of Configuration})
+        self.cameras = cameras
+        self.microcontroller = microcontroller
+        self.microcontroller2 = microcontroller2
+        self.stage = Stage(microcontroller)
+        self.configurations = []
+        if isinstance(configurations,dict):
+            for channel in configurations:
+                for configuration in configurations[channel]:
+                    if configuration.channel is None:
+                        configuration.channel = channel
+                    self.configurations.append(configuration)
+        elif configurations is not None:
+            self.configurations = list(configurations)
+        self.frame_timeout_s = frame_timeout_s
+        self.current_configuration = {} # per channel
+        self.listeners = []
+        self.abort_requested = threading.Event()
+        self.lock = threading.Lock() # one acquisition at a time
+        self.executor = None
+
+    # events: 'configuration' (Configuration), 'image' (image, Configuration, (t,i,j,k)), 'fov' ((t,i,j,k), (x_mm,y_mm,z_mm)),
+    # 'time_point' (t), 'finished' (result dict); listeners are called from the acquisition thread
+    def add_listener(self,function):
+        self.listeners.append(function)
+
+    def remove_listener(self,function):
+        self.listeners.remove(function)
+
+    def _emit(self,event,*data):
+        for listener in list(self.listeners):
+            try:
+                listener(event,*data)
+            except Exception as e:
+                print('microscope listener error (' + event + '): ' + str(e))
+
+    def get_configuration(self,name,channel=None):
+        for configuration in self.configurations:
+            if configuration.name == name and (channel is None or configuration.channel == channel):
+                return configuration
+        raise KeyError('no configuration named ' + name)
+
+    def _get_channel(self,configuration):
+        if configuration.channel in self.cameras:
+            return configuration.channel
+        if len(self.cameras) == 1:
+            return next(iter(self.cameras))
+        raise KeyError('no camera for channel ' + str(configuration.channel))
+
+    def set_configuration(self,configuration):
+        # what LiveController.set_microscope_mode and LiveControlWidget do when a mode is selected, without the gui round trip
+        if isinstance(configuration,str):
+            configuration = self.get_configuration(configuration)
+        channel = self._get_channel(configuration)
+        changes = get_configuration_changes(configuration,self.cameras[channel],self.microcontroller,self.microcontroller2)
+        if len(changes) > 0:
+            with instrumentation.span('microscope.set_configuration'):
+                apply_configuration_changes(changes)
+                self.stage.wait_till_operation_is_completed()
+        # only settle when illumination or DAC changed, and only for what is left of the settling time
+        with instrumentation.span('microscope.settle'):
+            time.sleep(self.get_settling_time_remaining())
+        if self.current_configuration.get(channel) is not configuration:
+            self.current_configuration[channel] = configuration
+            self._emit('configuration',configuration)
+        return configuration
+
+    def get_settling_time_remaining(self):
+        settling_time_s = get_device_state(self.microcontroller).get_settling_time_remaining(DAC_SETTLING_TIME_S)
+        if self.microcontroller2 is not None:
+            settling_time_s = max(settling_time_s,get_device_state(self.microcontroller2).get_settling_time_remaining(DAC_SETTLING_TIME_S))
+        return settling_time_s
+
+    def snap(self,configuration=None,channel=None):
+        # one frame of the given configuration (or of the current one of the channel)
+        if configuration is not None:
+            configuration = self.set_configuration(configuration)
+            channel = self._get_channel(configuration)
+        elif channel is None:
+            channel = next(iter(self.cameras))
+        camera = self.cameras[channel]
+        with instrumentation.span('microscope.capture'):
+            camera.image_received = False
+            camera.send_trigger()
+            if getattr(camera,'callback_is_enabled',False):
+                # frames of callback-driven cameras arrive in current_frame, which may be a ring slot of the driver:
+                # the copy is what goes to the listeners and the writer queue
+                t_end = time.time() + self.frame_timeout_s
+                while camera.image_received == False:
+                    if time.time() > t_end:
+                        raise TimeoutError('no frame from the ' + channel + ' camera')
+                    time.sleep(0.001)
+                image = np.copy(camera.current_frame)
+            else:
+                # read_frame() returns an array of the caller
+                image = camera.read_frame()
+                if image is None:
+                    raise TimeoutError('no frame from the ' + channel + ' camera')
+        return utils.rotate_and_flip_image(image,rotate_image_angle=getattr(camera,'rotate_image_angle',None),flip_image=getattr(camera,'flip_image',None))
+
+    def autofocus(self,N=10,deltaZ_um=1.524,configuration=None,crop_width=AF.CROP_WIDTH,crop_height=AF.CROP_HEIGHT):
+        # same search as AutofocusWorker.run_autofocus; returns the in-focus z in mm
+        with instrumentation.span('microscope.autofocus'):
+            if configuration is not None:
+                configuration = self.set_configuration(configuration)
+            channel = self._get_channel(configuration) if configuration is not None else next(iter(self.cameras))
+            deltaZ_usteps = round((deltaZ_um/1000)/self.stage.mm_per_ustep('z'))
+            self.stage.move_usteps('z',-deltaZ_usteps*round(N/2))
+            # maneuver for achiving uniform step size and repeatability when using open-loop control
+            self.stage.move_usteps('z',-160)
+            self.stage.move_usteps('z',160)
+            focus_measure_vs_z = [0]*N
+            focus_measure_max = 0
+            steps_moved = 0
+            for i in range(N):
+                self.stage.move_usteps('z',deltaZ_usteps)
+                steps_moved = steps_moved + 1
+                self.microcontroller.turn_on_illumination()
+                self.stage.wait_till_operation_is_completed()
+                image = self.snap(channel=channel)
+                self.microcontroller.turn_off_illumination()
+                with instrumentation.span('autofocus.focus_measure'):
+                    focus_measure = utils.calculate_focus_measure(utils.crop_image(image,crop_width,crop_height))
+                focus_measure_vs_z[i] = focus_measure
+                focus_measure_max = max(focus_measure,focus_measure_max)
+                if focus_measure < focus_measure_max*AF.STOP_THRESHOLD:
+                    break
+            self.stage.move_usteps('z',-steps_moved*deltaZ_usteps)
+            self.stage.move_usteps('z',-160)
+            self.stage.move_usteps('z',160)
+            idx_in_focus = focus_measure_vs_z.index(max(focus_measure_vs_z))
+            self.stage.move_usteps('z',idx_in_focus*deltaZ_usteps)
+        return self.stage.get_pos_mm()[2]
+
+    def abort(self):
+        self.abort_requested.set()
+
+    def submit(self,plan):
+        # queues the plan and returns a concurrent.futures.Future of the result
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.acquire,plan)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def acquire(self,plan):
+        # blocking; returns {'experiment_path','images_saved','fov','aborted','elapsed_s'} (and 'error' when it raised)
+        with self.lock:
+            self.abort_requested.clear()
+            configurations = [self.get_configuration(c) if isinstance(c,str) else c for c in plan.configurations]
+            experiment_path = None
+            writer = None
+            if plan.save_images:
+                if plan.base_path is None:
+                    raise ValueError('the plan has no base_path')
+                experiment_path = self._start_new_experiment(plan)
+                writer = _ImageWriter()
+            t_start = time.time()
+            result = {'experiment_path':experiment_path,'images_saved':0,'fov':0,'aborted':False,'elapsed_s':0}
+            try:
+                t = 0
+                while t < plan.Nt:
+                    self._emit('time_point',t)
+                    result['fov'] = result['fov'] + self._run_single_time_point(plan,t,configurations,experiment_path,writer)
+                    t = t + 1
+                    if plan.deltat_s > 0:
+                        # skip the time points that have already passed, then wait for the next one
+                        while t < plan.Nt and time.time() > t_start + t*plan.deltat_s:
+                            print('skip time point ' + str(t+1))
+                            t = t + 1
+                        while t < plan.Nt and time.time() < t_start + t*plan.deltat_s:
+                            if self.abort_requested.wait(0.05):
+                                raise AcquisitionAborted()
+            except AcquisitionAborted:
+                result['aborted'] = True
+            except Exception as e:
+                # listeners are still told that the acquisition has ended
+                result['error'] = repr(e)
+                raise
+            finally:
+                if writer is not None:
+                    writer.close()
+                    result['images_saved'] = writer.counter
+                    for error in writer.errors:
+                        print('error saving ' + error)
+                result['elapsed_s'] = time.time() - t_start
+                self._emit('finished',result)
+            return result
+
+    def _start_new_experiment(self,plan):
+        experiment_ID = plan.experiment_ID.replace(' ','_') + '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%-S.%f')
+        experiment_path = os.path.join(plan.base_path,experiment_ID)
+        os.mkdir(experiment_path)
+        with open(os.path.join(experiment_path,'acquisition parameters.json'),'w') as f:
+            f.write(json.dumps(plan.to_dict()))
+        return experiment_path
+
+    def _check_abort(self):
+        if self.abort_requested.is_set():
+            raise AcquisitionAborted()
+
+    def _run_single_time_point(self,plan,t,configurations,experiment_path,writer):
+        current_path = None
+        if experiment_path is not None:
+            current_path = os.path.join(experiment_path,str(t))
+            os.mkdir(current_path)
+        coordinates = []
+        fov_counter = 0
+        x_start_mm, y_start_mm, z_start_mm = self.stage.get_pos_mm()
+        try:
+            if plan.positions_mm is not None:
+                # listed positions, one row
+                scan = [(0,j,position) for j, position in enumerate(plan.positions_mm)]
+            else:
+                # serpentine grid starting at the current position
+                scan = []
+                for i in range(plan.NY):
+                    for j in (range(plan.NX) if i%2 == 0 else reversed(range(plan.NX))):
+                        scan.append((i,j,(x_start_mm + j*plan.deltaX_mm,y_start_mm + i*plan.deltaY_mm)))
+            previous_position = (x_start_mm,y_start_mm,z_start_mm)
+            for i, j, position in scan:
+                t_fov_start = time.perf_counter()
+                self._move_to_fov(position,previous_position)
+                previous_position = position
+                if plan.NZ > 1:
+                    # maneuver for achiving uniform step size and repeatability when using open-loop control
+                    self.stage.move_usteps('z',-160)
+                    self.stage.move_usteps('z',160)
+                    self.stage.settle('z')
+                elif plan.do_autofocus and fov_counter%plan.fovs_per_autofocus == 0:
+                    self.autofocus(plan.autofocus_N,plan.autofocus_deltaZ_um,plan.autofocus_configuration)
+                deltaZ_usteps = round((plan.deltaZ_um/1000)/self.stage.mm_per_ustep('z'))
+                for k in range(plan.NZ):
+                    self._check_abort()
+                    file_ID = str(i) + '_' + str(j) + '_' + str(k) + '_'
+                    for configuration in configurations:
+                        accumulator = None
+                        if configuration.channel == 'Spectrum' and plan.spectrum_accumulation != 'frames':
+                            accumulator = SpectrumAccumulator(plan.spectrum_accumulation,plan.spectrum_mask)
+                        for l in range(plan.N_spectrum if configuration.channel == 'Spectrum' else 1):
+                            image = self.snap(configuration)
+                            self._emit('image',image,configuration,(t,i,j,k))
+                            if accumulator is not None:
+                                accumulator.add(image)
+                            if writer is not None and (accumulator is None or plan.keep_raw_spectrum_frames):
+                                postfix = '_' + str(l) if configuration.channel == 'Spectrum' else ''
+                                if getattr(self.cameras[self._get_channel(configuration)],'is_color',False):
+                                    image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+                                writer.enqueue(image,os.path.join(current_path,file_ID + str(configuration.name) + postfix + '.' + plan.image_format))
+                        if accumulator is not None and writer is not None:
+                            camera = self.cameras[self._get_channel(configuration)]
+                            save_accumulated_spectrum(os.path.join(current_path,file_ID + str(configuration.name) + '_' + plan.spectrum_accumulation + '.npz'),
+                                accumulator.get_result(),sensor_ROI_offset_y=getattr(camera,'ROI_offset_y',0))
+                    x_mm, y_mm, z_mm = self.stage.get_pos_mm()
+                    coordinates.append([i,j,k,x_mm,y_mm,z_mm*1000])
+                    self._emit('fov',(t,i,j,k),(x_mm,y_mm,z_mm))
+                    if plan.NZ > 1 and k < plan.NZ - 1:
+                        self.stage.move_usteps('z',deltaZ_usteps)
+                        self.stage.settle('z')
+                if plan.NZ > 1:
+                    self.stage.move_usteps('z',-deltaZ_usteps*(plan.NZ-1))
+                fov_counter = fov_counter + 1
+                instrumentation.record('microscope.fov',time.perf_counter() - t_fov_start,t_fov_start)
+        finally:
+            # back to where the time point started, also when aborted
+            self.stage.move_to('x',x_start_mm)
+            self.stage.move_to('y',y_start_mm)
+            if current_path is not None:
+                with open(os.path.join(current_path,'coordinates.csv'),'w',newline='') as f:
+                    csv_writer = csv.writer(f)
+                    csv_writer.writerow(['i','j','k','x (mm)','y (mm)','z (um)'])
+                    csv_writer.writerows(coordinates)
+        return len(scan)
+
+    def _move_to_fov(self,position,previous_position):
+        # only the axes that change are moved, y before x as in the row by row scan
+        if position[1] != previous_position[1]:
+            self.stage.move_to('y',position[1])
+            self.stage.settle('y')
+        if position[0] != previous_position[0]:
+            self.stage.move_to('x',position[0])
+            self.stage.settle('x')
+        if len(position) > 2 and len(previous_position) > 2 and position[2] != previous_position[2]:
+            self.stage.move_to('z',position[2])
+            self.stage.settle('z')
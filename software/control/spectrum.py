@@ -0,0 +1,1040 @@
+# spectrum processing without Qt, shared by the gui controllers (core.py) and the headless acquisition (microscope.py)
+
+import os
+import glob
+import json
+from threading import Lock, local
+
+import numpy as np
+import scipy.sparse
+import scipy.signal
+import scipy.optimize
+import scipy.stats
+import cv2
+
+class SpectrumAccumulator(object):
+    # sums N consecutive frames as they arrive instead of keeping them, and gives the per-FOV mean, standard deviation and
+    # number of saturated pixels
+    # mode 'spectrum': the spectrum extracted with the mask (sum over the rows of the band) is accumulated, in float64; with
+    # add_spectrum() the spectra are extracted by the caller instead, e.g. by SpectrumExtractor (tracks, wavelength axis)
+    # mode 'band': the rows of the band are accumulated as an image, in uint32 (up to 65536 16-bit frames)
+    # the mask is the extraction mask of SpectrumExtractor (None: every pixel); only the rows it covers are read
+
+    def __init__(self,mode='spectrum',mask=None,keep_raw_frames=False,saturation_level=None):
+        self.mode = mode
+        self.saturation_level = saturation_level # None: the maximum of the frame dtype
+        self.keep_raw_frames = keep_raw_frames
+        self.set_mask(mask)
+        self.reset()
+
+    def set_mask(self,mask):
+        self.mask = mask
+        if mask is None:
+            self.rows = None
+            self.mask_band = None
+            return
+        rows = np.flatnonzero(np.any(mask,axis=1))
+        if len(rows) == 0:
+            rows = np.arange(mask.shape[0])
+        self.rows = slice(rows[0],rows[-1]+1)
+        self.mask_band = mask[self.rows]
+
+    def reset(self):
+        self.N = 0
+        self.sum = None
+        self.sum_of_squares = None
+        self.saturated_pixels = 0
+        self.raw_frames = []
+
+    def _get_band(self,frame):
+        band = frame if self.rows is None else frame[self.rows]
+        if self.mask is not None and band.shape != self.mask_band.shape:
+            raise ValueError('frame of shape ' + str(frame.shape) + ' does not match the mask of shape ' + str(self.mask.shape))
+        return band
+
+    def _count_saturated(self,raw_band):
+        saturation_level = self.saturation_level
+        if saturation_level is None and np.issubdtype(raw_band.dtype,np.integer):
+            saturation_level = np.iinfo(raw_band.dtype).max
+        if saturation_level is not None:
+            saturated = raw_band >= saturation_level
+            if self.mask_band is not None:
+                saturated = saturated & (self.mask_band > 0)
+            self.saturated_pixels = self.saturated_pixels + int(np.count_nonzero(saturated))
+
+    def _add_values(self,values):
+        if self.sum is None:
+            self.sum = np.zeros(values.shape,np.float64)
+            self.sum_of_squares = np.zeros(values.shape,np.float64)
+        self.sum += values
+        self.sum_of_squares += values*values
+
+    def add(self,frame,raw_frame=None):
+        # raw_frame: the frame before dark/flat correction (FrameCorrector), for counting the saturated pixels
+        frame = np.squeeze(frame)
+        band = self._get_band(frame)
+        self._count_saturated(band if raw_frame is None else self._get_band(np.squeeze(raw_frame)))
+        if self.mode == 'spectrum':
+            if self.mask_band is None:
+                values = band.sum(axis=0,dtype=np.float64)
+            else:
+                values = np.einsum('ij,ij->j',band,self.mask_band,dtype=np.float64)
+            self._add_values(values)
+        else:
+            if self.sum is None:
+                self.sum = np.zeros(band.shape,np.uint32 if np.issubdtype(band.dtype,np.integer) else np.float64)
+                self.sum_of_squares = np.zeros(band.shape,np.float64)
+            self.sum += band
+            values = band.astype(np.float64)
+            self.sum_of_squares += values*values
+        if self.keep_raw_frames:
+            self.raw_frames.append(np.copy(frame)) # frames from the camera are reused by the driver
+        self.N = self.N + 1
+
+    def add_spectrum(self,spectrum,raw_frame=None):
+        # mode 'spectrum': accumulates spectra extracted by the caller, of any shape (e.g. one row per track);
+        # raw_frame: the frame the spectra are from, before dark/flat correction, for counting the saturated pixels
+        if raw_frame is not None:
+            raw_frame = np.squeeze(raw_frame)
+            self._count_saturated(self._get_band(raw_frame))
+            if self.keep_raw_frames:
+                self.raw_frames.append(np.copy(raw_frame))
+        self._add_values(np.asarray(spectrum,np.float64))
+        self.N = self.N + 1
+
+    def get_result(self):
+        # {'N', 'mean', 'std', 'saturated_pixels', 'raw_frames'}
+        if self.N == 0:
+            return {'N':0,'mean':None,'std':None,'saturated_pixels':0,'raw_frames':[]}
+        mean = self.sum/self.N
+        variance = np.maximum(self.sum_of_squares/self.N - mean*mean,0)
+        return {'N':self.N,'mean':mean,'std':np.sqrt(variance),'saturated_pixels':self.saturated_pixels,'raw_frames':self.raw_frames}
+
+def save_accumulated_spectrum(filename,result,**metadata):
+    # one .npz per FOV instead of N images; metadata, e.g. the sensor ROI offset, is stored next to the arrays
+    np.savez(filename,N=result['N'],mean=result['mean'],std=result['std'],saturated_pixels=result['saturated_pixels'],**metadata)
+
+def get_calibration_key(camera):
+    # dark and flat frames only apply to frames taken with the same camera, exposure time, gain, pixel format and sensor ROI
+    ROI = tuple(getattr(camera,'ROI_' + name,None) for name in ('offset_x','offset_y','width','height'))
+    return (str(camera.sn),round(float(camera.exposure_time),6),round(float(camera.analog_gain),6),str(getattr(camera,'pixel_format',None)),
+            tuple(None if value is None else int(value) for value in ROI))
+
+class FrameAverager(object):
+    # mean of N frames, summed in place into one preallocated buffer (uint32 for integer frames)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.N = 0
+        self.sum = None
+
+    def add(self,frame):
+        frame = np.squeeze(frame)
+        if self.sum is None:
+            self.sum = np.zeros(frame.shape,np.uint32 if np.issubdtype(frame.dtype,np.integer) else np.float64)
+        np.add(self.sum,frame,out=self.sum)
+        self.N = self.N + 1
+
+    def get_mean(self):
+        return np.divide(self.sum,self.N,dtype=np.float32)
+
+def average_frames(frames):
+    averager = FrameAverager()
+    for frame in frames:
+        averager.add(frame)
+    return averager.get_mean()
+
+class CalibrationCache(object):
+    # master dark and flat frames by (kind, get_calibration_key()), in memory and, with a directory, as <directory>/<kind>_<key>.npz
+    # frames for a sensor ROI without a master of its own are cropped from a master of a larger ROI with the same settings,
+    # e.g. in fast spectrum mode from the full frame masters
+
+    KINDS = ('dark','flat')
+
+    def __init__(self,directory=None):
+        self.directory = directory
+        self.masters = {}
+        self.files = {}
+        self.crops = {}
+        self.lock = Lock()
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+            for filename in glob.glob(os.path.join(directory,'*.npz')):
+                try:
+                    with np.load(filename) as data:
+                        kind, key = _key_from_json(str(data['key']))
+                    self.files[(kind,key)] = filename
+                except Exception as e:
+                    print('cannot read calibration frame ' + filename + ': ' + str(e))
+
+    def set_master(self,kind,key,frame):
+        with self.lock:
+            self.crops = {cached: crop for cached, crop in self.crops.items() if cached[0] != kind or cached[1][:4] != key[:4]}
+            self.masters[(kind,key)] = frame
+        if self.directory is None:
+            return
+        filename = os.path.join(self.directory,kind + '_' + _key_to_filename(key) + '.npz')
+        filename_tmp = filename[:-len('.npz')] + '.tmp.npz'
+        np.savez(filename_tmp,frame=frame,key=_key_to_json(kind,key))
+        os.replace(filename_tmp,filename)
+        with self.lock:
+            self.files[(kind,key)] = filename
+
+    def get_master(self,kind,key):
+        # None if there is no master for these settings
+        with self.lock:
+            frame = self.masters.get((kind,key),self.crops.get((kind,key)))
+            filename = self.files.get((kind,key))
+            candidates = set(self.masters) | set(self.files)
+        if frame is not None:
+            return frame
+        if filename is not None:
+            with np.load(filename) as data:
+                frame = data['frame']
+            with self.lock:
+                self.masters[(kind,key)] = frame
+            return frame
+        if None in key[4]:
+            return None
+        offset_x, offset_y, width, height = key[4]
+        for other_kind, other_key in candidates:
+            if other_kind != kind or other_key[:4] != key[:4] or other_key == key or None in other_key[4]:
+                continue
+            x0, y0, w0, h0 = other_key[4]
+            if x0 <= offset_x and y0 <= offset_y and offset_x + width <= x0 + w0 and offset_y + height <= y0 + h0:
+                frame = self.get_master(kind,other_key)
+                frame = np.ascontiguousarray(frame[offset_y-y0:offset_y-y0+height,offset_x-x0:offset_x-x0+width])
+                with self.lock:
+                    self.crops[(kind,key)] = frame
+                return frame
+        return None
+
+def _key_to_json(kind,key):
+    return json.dumps([kind,list(key[:4]),list(key[4])])
+
+def _key_from_json(string):
+    kind, settings, ROI = json.loads(string)
+    return kind, tuple(settings) + (tuple(ROI),)
+
+def _key_to_filename(key):
+    sn, exposure_time, analog_gain, pixel_format, ROI = key
+    return sn + '_' + str(exposure_time) + 'ms_gain' + str(analog_gain) + '_' + pixel_format + '_' + '_'.join(str(value) for value in ROI)
+
+class FrameCorrector(object):
+    # dark and flat correction stage of the frame pipeline: (frame - dark)/flat, clipped to the range of the raw frames and
+    # written into a ring of preallocated buffers; a returned frame stays valid until num_buffers further frames are corrected
+    # by the same thread (each thread, e.g. the stream handler and the multipoint worker, has its own ring), copy it before queuing it
+    # the flat (minus dark) is normalized to a mean of 1 over its lit pixels (> flat_min_fraction of its maximum) and inverted
+    # once per change of the camera settings, so that a frame takes one multiply by the inverse flat and one subtract of dark*inverse flat
+    # masters are captured from the stream: start_capture(), then add_capture_frame() for every frame
+
+    def __init__(self,cache,output_dtype='float32',flat_min_fraction=0.05,num_buffers=4):
+        self.cache = cache
+        self.output_dtype = np.dtype(output_dtype)
+        self.flat_min_fraction = flat_min_fraction
+        self.num_buffers = num_buffers
+        self.enabled = False
+        self.use_dark = True
+        self.use_flat = True
+        self.capture_kind = None
+        self.capture_N = 0
+        self._averager = FrameAverager()
+        self._key = None
+        self._stage = None # (inverse flat or None, dark*inverse flat, clip maximum), read-only once prepared
+        self._thread_buffers = local() # ring and work buffer of the calling thread
+        self._lock = Lock()
+
+    def set_enabled(self,enabled):
+        self.enabled = enabled
+
+    def set_use_dark(self,flag):
+        self.use_dark = flag
+        self._key = None
+
+    def set_use_flat(self,flag):
+        self.use_flat = flag
+        self._key = None
+
+    def start_capture(self,kind,N):
+        # the next N frames are averaged into the master dark (illumination off) or flat (uniform illumination)
+        if kind not in CalibrationCache.KINDS:
+            raise ValueError('unknown calibration frame ' + str(kind))
+        with self._lock:
+            self._averager.reset()
+            self.capture_N = N
+            self.capture_kind = kind
+
+    def add_capture_frame(self,frame,camera):
+        # returns the kind of the master when this frame completed it
+        with self._lock:
+            kind = self.capture_kind
+            if kind is None:
+                return None
+            self._averager.add(frame)
+            if self._averager.N < self.capture_N:
+                return None
+            master = self._averager.get_mean()
+            self._averager.reset()
+            self.capture_kind = None
+        key = get_calibration_key(camera)
+        self.cache.set_master(kind,key,master)
+        with self._lock:
+            self._key = None
+        print('captured the ' + kind + ' frame for ' + str(key))
+        return kind
+
+    def correct_frame(self,frame,camera):
+        # the corrected frame, or frame itself while disabled, capturing or without masters for the current camera settings
+        if not self.enabled or self.capture_kind is not None:
+            return frame
+        return self.correct(frame,get_calibration_key(camera))
+
+    def correct(self,frame,key):
+        # frame itself if it is not corrected
+        image = np.squeeze(frame)
+        with self._lock:
+            if key != self._key:
+                self._prepare(key,image)
+            stage = self._stage
+        if stage is None:
+            return frame
+        inverse_flat, offset, clip_max = stage
+        if image.shape != offset.shape:
+            return frame # e.g. a frame from before a change of the sensor ROI
+        output, work = self._get_buffers(image.shape)
+        if work is None:
+            work = output
+        if inverse_flat is None:
+            np.subtract(image,offset,out=work)
+        else:
+            np.multiply(image,inverse_flat,out=work)
+            np.subtract(work,offset,out=work)
+        np.clip(work,0,clip_max,out=work)
+        if work is not output:
+            np.rint(work,out=work)
+            np.copyto(output,work,casting='unsafe')
+        return output
+
+    def _prepare(self,key,frame):
+        self._key = key
+        self._stage = None
+        dark = self.cache.get_master('dark',key) if self.use_dark else None
+        flat = self.cache.get_master('flat',key) if self.use_flat else None
+        for master in (dark,flat):
+            if master is not None and master.shape != frame.shape:
+                print('calibration frames of shape ' + str(master.shape) + ' do not match the frames of shape ' + str(frame.shape))
+                return
+        if dark is None and flat is None:
+            return
+        dark = np.zeros(frame.shape,np.float32) if dark is None else dark.astype(np.float32)
+        inverse_flat = None
+        if flat is not None:
+            lit = flat.astype(np.float32) - dark
+            is_lit = lit > self.flat_min_fraction*lit.max()
+            inverse_flat = np.ones(frame.shape,np.float32)
+            if np.any(is_lit):
+                inverse_flat[is_lit] = lit[is_lit].mean()/lit[is_lit]
+        offset = dark if inverse_flat is None else dark*inverse_flat
+        clip_max = np.iinfo(frame.dtype).max if np.issubdtype(frame.dtype,np.integer) else np.inf
+        if np.issubdtype(self.output_dtype,np.integer):
+            clip_max = min(clip_max,np.iinfo(self.output_dtype).max)
+        self._stage = (inverse_flat,offset,clip_max)
+
+    def _get_buffers(self,shape):
+        # (output, work buffer or None), from the ring of the calling thread
+        buffers = self._thread_buffers
+        if getattr(buffers,'ring',None) is None or buffers.ring[0].shape != shape:
+            buffers.ring = [np.empty(shape,self.output_dtype) for i in range(self.num_buffers)]
+            buffers.work = None if self.output_dtype == np.float32 else np.empty(shape,np.float32)
+            buffers.index = 0
+        output = buffers.ring[buffers.index]
+        buffers.index = (buffers.index + 1) % self.num_buffers
+        return output, buffers.work
+
+def get_band_weights(shape,x1,y1,x2,y2,w):
+    # a band of width w along the line through (x1,y1) and (x2,y2), across the whole frame, as SpectrumROIManager.create_mask
+    height, width = shape
+    m = (y2 - y1)/(x2 - x1) if x2 != x1 else 0
+    b = y1 - m*x1
+    weights = np.zeros(shape,np.uint8)
+    cv2.line(weights,(0,int(round(b))),(width - 1,int(round(m*(width - 1) + b))),1,max(1,int(w)))
+    return weights
+
+def get_polygon_weights(shape,points):
+    weights = np.zeros(shape,np.uint8)
+    cv2.fillPoly(weights,[np.round(np.asarray(points,dtype=np.float64)).astype(np.int32)],1)
+    return weights
+
+def get_curved_band_weights(shape,centre,width,x_range=None):
+    # a band following the curvature of the spectrum: center row and width are polynomials (np.polyval coefficients) of the column;
+    # pixels are weighted by the fraction of their height inside the band, so that summing the weights along the rows integrates
+    # the straightened band with sub-pixel edges
+    height, frame_width = shape
+    x0, x1 = (0,frame_width) if x_range is None else (max(0,int(x_range[0])),min(frame_width,int(x_range[1])))
+    x = np.arange(x0,x1)
+    c = np.polyval(centre,x)
+    half_width = np.maximum(np.polyval(width,x),1)/2
+    low = c - half_width
+    high = c + half_width
+    weights = np.zeros(shape,np.float32)
+    first_row = np.floor(low + 0.5).astype(np.int64)
+    for k in range(int(np.ceil(half_width.max()*2)) + 2):
+        row = first_row + k
+        coverage = np.clip(np.minimum(row + 0.5,high) - np.maximum(row - 0.5,low),0,1)
+        inside = (row >= 0) & (row < height) & (coverage > 0)
+        weights[row[inside],x[inside]] = coverage[inside]
+    return weights
+
+def get_fwhm(profile,peak):
+    # (FWHM, first row, last row at or above half maximum) of the peak of a background subtracted profile; the half maximum
+    # crossings are interpolated
+    half = profile[peak]/2
+    above = profile >= half
+    low = peak
+    while low > 0 and above[low - 1]:
+        low = low - 1
+    high = peak
+    while high < len(profile) - 1 and above[high + 1]:
+        high = high + 1
+    low_edge = low - 0.5 if low == 0 else low - (profile[low] - half)/(profile[low] - profile[low - 1])
+    high_edge = high + 0.5 if high == len(profile) - 1 else high + (profile[high] - half)/(profile[high] - profile[high + 1])
+    return high_edge - low_edge, low, high
+
+def fit_curved_band(image,degree=2,width_degree=1,column_step=8,fwhm_factor=2.0,min_signal=20,row_offset=0):
+    # a curved band track ({'centre','width','x_range'}) from a reference frame with one bright band (e.g. a broadband lamp):
+    # per column, the center row is the centroid of the band and its width is fwhm_factor times its FWHM; polynomials are fitted
+    # to these, refitted once without the columns more than 3 median absolute deviations off. row_offset: first sensor row of image
+    image = np.squeeze(image).astype(np.float32)
+    if image.ndim != 2:
+        raise ValueError('expected a monochrome frame')
+    columns = np.arange(0,image.shape[1],column_step)
+    profiles = image[:,columns]
+    profiles = profiles - np.median(profiles,axis=0)
+    peaks = np.argmax(profiles,axis=0)
+    peak_values = profiles[peaks,np.arange(len(columns))]
+    rows = np.arange(image.shape[0],dtype=np.float64)
+    x, centres, widths = [], [], []
+    for i in np.flatnonzero(peak_values >= min_signal):
+        profile = profiles[:,i]
+        fwhm, low, high = get_fwhm(profile,peaks[i])
+        window = slice(max(0,int(low - fwhm)),min(len(profile),int(high + fwhm) + 1))
+        weights = np.maximum(profile[window],0)
+        x.append(columns[i])
+        centres.append(np.sum(weights*rows[window])/np.sum(weights))
+        widths.append(fwhm*fwhm_factor)
+    if len(x) <= max(degree,width_degree) + 1:
+        raise ValueError('the band was found in ' + str(len(x)) + ' columns, too few to fit its curvature')
+    x = np.array(x,dtype=np.float64)
+    centres = np.array(centres) + row_offset
+    widths = np.array(widths)
+    keep = np.ones(len(x),bool)
+    for fit in range(2):
+        centre = np.polyfit(x[keep],centres[keep],degree)
+        width = np.polyfit(x[keep],widths[keep],width_degree)
+        residuals = np.abs(centres - np.polyval(centre,x))
+        keep = residuals <= max(3*1.4826*np.median(residuals[keep]),0.5)
+    return {'name':'curved band','centre':centre.tolist(),'width':width.tolist(),'x_range':[int(x[0]),int(x[-1]) + column_step],
+            'residual_rms':float(np.sqrt(np.mean((centres[keep] - np.polyval(centre,x[keep]))**2)))}
+
+def detect_band(image,column_bin=16,min_signal=20,fwhm_factor=2.0,row_offset=0):
+    # the straight band of a spectrum in a frame, robust to hot pixels and noise: the frame is binned into column_bin wide columns,
+    # the centroid of the band in each bin (with a signal of at least min_signal above the median of the bin) gives a point of the
+    # centerline, which is fitted by Theil-Sen regression; the width is fwhm_factor times the FWHM of the mean cross section along
+    # the fitted line. Returns {'x1','y1','x2','y2','w'} (the ends of the band and its width, in sensor coordinates) or None
+    image = np.squeeze(image)
+    if image.ndim != 2:
+        raise ValueError('expected a monochrome frame')
+    height, width = image.shape
+    bins = width//column_bin
+    if bins < 3:
+        return None
+    accumulator = np.uint32 if np.issubdtype(image.dtype,np.integer) else np.float64
+    profiles = image[:,:bins*column_bin].reshape(height,bins,column_bin).sum(axis=2,dtype=accumulator).astype(np.float32)/column_bin
+    profiles -= np.median(profiles,axis=0)
+    peaks = np.argmax(profiles,axis=0)
+    columns = np.arange(bins)
+    valid = profiles[peaks,columns] >= min_signal
+    if np.count_nonzero(valid) < 3:
+        return None
+    # centroid of the positive part of the profile within 4 rows of the peak
+    offsets = np.arange(-4,5)
+    rows = np.clip(peaks[None,:] + offsets[:,None],0,height - 1)
+    weights = np.maximum(profiles[rows,columns[None,:]],0)
+    centres = np.sum(weights*rows,axis=0)/np.maximum(np.sum(weights,axis=0),1e-6)
+    x = (columns + 0.5)*column_bin - 0.5
+    slope, intercept, low_slope, high_slope = scipy.stats.theilslopes(centres[valid],x[valid])
+    residuals = np.abs(centres - (slope*x + intercept))
+    inliers = valid & (residuals <= max(3*1.4826*np.median(residuals[valid]),1))
+    if np.count_nonzero(inliers) < 3:
+        return None
+    # mean cross section along the line, over the inlier bins
+    radius = min(height//2,64)
+    offsets = np.arange(-radius,radius + 1)
+    centre_rows = np.round(slope*x[inliers] + intercept).astype(np.int64)
+    rows = centre_rows[None,:] + offsets[:,None]
+    inside = (rows >= 0) & (rows < height)
+    section = np.where(inside,profiles[np.clip(rows,0,height - 1),columns[inliers][None,:]],0).sum(axis=1)/np.maximum(inside.sum(axis=1),1)
+    fwhm, low, high = get_fwhm(section,int(np.argmax(section)))
+    x1 = float(x[inliers][0] - (column_bin - 1)/2)
+    x2 = float(x[inliers][-1] + (column_bin - 1)/2)
+    return {'x1':x1,'y1':float(slope*x1 + intercept + row_offset),'x2':x2,'y2':float(slope*x2 + intercept + row_offset),'w':float(max(1.0,fwhm*fwhm_factor))}
+
+def get_track_weights(shape,track):
+    # (weights, background weights or None) of a track given as a dict with one of
+    #   'x1','y1','x2','y2','w': a tilted band, as the spectrum ROI; 'background_width' (and 'background_gap') add a band on either side
+    #   'centre','width': a curved band, see get_curved_band_weights() and fit_curved_band(); 'background_width' as for tilted bands
+    #   'polygon': [[x,y],...]; 'background_polygon' for the background
+    #   'weights': an array of the frame shape, e.g. per-column weights; 'background_weights' for the background
+    if 'weights' in track:
+        weights = np.asarray(track['weights'],dtype=np.float32)
+    elif 'polygon' in track:
+        weights = get_polygon_weights(shape,track['polygon'])
+    elif 'centre' in track:
+        weights = get_curved_band_weights(shape,track['centre'],track['width'],track.get('x_range'))
+    else:
+        weights = get_band_weights(shape,track['x1'],track['y1'],track['x2'],track['y2'],track['w'])
+    if weights.shape != tuple(shape):
+        raise ValueError('weights of shape ' + str(weights.shape) + ' for frames of shape ' + str(tuple(shape)))
+    background = None
+    if track.get('background_weights') is not None:
+        background = np.asarray(track['background_weights'],dtype=np.float32)
+    elif track.get('background_polygon') is not None:
+        background = get_polygon_weights(shape,track['background_polygon'])
+    elif track.get('background_width',0) > 0 and 'centre' in track:
+        background = np.zeros(shape,np.float32)
+        distance = np.polyadd(np.asarray(track['width'],dtype=np.float64)/2,[track.get('background_gap',0) + track['background_width']/2])
+        for sign in (-1,1):
+            background = np.maximum(background,get_curved_band_weights(shape,np.polyadd(track['centre'],sign*distance),[track['background_width']],track.get('x_range')))
+        background[weights > 0] = 0
+    elif track.get('background_width',0) > 0 and 'w' in track:
+        background = np.zeros(shape,np.uint8)
+        distance = track['w']/2 + track.get('background_gap',0) + track['background_width']/2
+        for sign in (-1,1):
+            background |= get_band_weights(shape,track['x1'],track['y1'] + sign*distance,track['x2'],track['y2'] + sign*distance,track['background_width'])
+        background[weights > 0] = 0
+    return weights, background
+
+def load_tracks(filename):
+    # a json list of track dicts, see get_track_weights(); a 'name' is optional
+    with open(filename) as f:
+        tracks = json.load(f)
+    if not isinstance(tracks,list):
+        raise ValueError(filename + ': expected a list of tracks')
+    return tracks
+
+class SpectrumProjection(object):
+    # the spectra of K tracks of a frame in one sparse matrix-vector product: spectrum k at column x is the sum over the rows of
+    # weights_k*frame minus the mean of the background of track k in that column, scaled by the summed weights of the column.
+    # The background is folded into the matrix, and the matrix only has columns for the pixels the tracks use, so a frame
+    # costs a gather and a product proportional to the number of ROI pixels.
+    # Tracks are in full frame coordinates; frames of a sensor ROI (fast spectrum mode) give their first row as row_offset.
+    # Tracks covering most of the frame (e.g. the default mask of every pixel) are faster as a dense product
+
+    def __init__(self,shape,tracks=()):
+        self.shape = tuple(shape)
+        self.names = []
+        self.weights = []
+        self.backgrounds = []
+        self.resampling = None # e.g. onto a wavelength grid, see WavelengthCalibration.get_resampling_matrix()
+        self._compiled = {}
+        for k, track in enumerate(tracks):
+            weights, background = get_track_weights(self.shape,track)
+            self.add_track(weights,background,track.get('name','track ' + str(k + 1)))
+
+    def add_track(self,weights,background=None,name=None):
+        self.names.append(name if name is not None else 'track ' + str(len(self.names) + 1))
+        self.weights.append(weights)
+        self.backgrounds.append(background)
+        self._compiled = {}
+
+    def set_resampling(self,matrix):
+        # a sparse (points x width) matrix applied to every spectrum; it is folded into the projection
+        self.resampling = matrix
+        self._compiled = {}
+
+    def get_number_of_tracks(self):
+        return len(self.weights)
+
+    def get_footprint(self):
+        # the pixels used by any track or background
+        footprint = np.zeros(self.shape,np.uint8)
+        for weights, background in zip(self.weights,self.backgrounds):
+            footprint[weights != 0] = 1
+            if background is not None:
+                footprint[background != 0] = 1
+        return footprint
+
+    def compile(self,row_offset=0,height=None,resample=True):
+        # (matrix, pixel indices, dense weights or None) for frames holding the rows row_offset to row_offset+height
+        if height is None:
+            height = self.shape[0] - row_offset
+        key = (row_offset,height,resample and self.resampling is not None)
+        if key in self._compiled:
+            return self._compiled[key]
+        width = self.shape[1]
+        rows, pixels, values, projections = [], [], [], []
+        for k, (weights, background) in enumerate(zip(self.weights,self.backgrounds)):
+            projection = np.asarray(weights,dtype=np.float32)
+            if background is not None:
+                background = np.asarray(background,dtype=np.float32)
+                weights_per_column = projection.sum(axis=0)
+                background_per_column = background.sum(axis=0)
+                scale = np.divide(weights_per_column,background_per_column,out=np.zeros(width,np.float32),where=background_per_column > 0)
+                projection = projection - background*scale
+            projection = projection[row_offset:row_offset + height]
+            projections.append(projection)
+            y, x = np.nonzero(projection)
+            rows.append(k*width + x)
+            pixels.append(y*width + x)
+            values.append(projection[y,x])
+        rows = np.concatenate(rows) if rows else np.zeros(0,np.int64)
+        pixels = np.concatenate(pixels) if pixels else np.zeros(0,np.int64)
+        values = np.concatenate(values) if values else np.zeros(0,np.float32)
+        if len(values) > height*width//2:
+            self._compiled[key] = (None,None,np.stack(projections))
+            return self._compiled[key]
+        pixel_indices, columns = np.unique(pixels,return_inverse=True)
+        matrix = scipy.sparse.csr_matrix((values,(rows,columns.ravel())),shape=(len(self.weights)*width,len(pixel_indices)),dtype=np.float32)
+        if key[2]:
+            matrix = scipy.sparse.csr_matrix(scipy.sparse.kron(scipy.sparse.identity(len(self.weights),format='csr'),self.resampling) @ matrix,dtype=np.float32)
+        self._compiled[key] = (matrix,pixel_indices,None)
+        return self._compiled[key]
+
+    def extract(self,frame,row_offset=0,resample=True):
+        # K x width spectra, or K x points with resampling
+        frame = np.squeeze(frame)
+        matrix, pixel_indices, dense = self.compile(row_offset,frame.shape[0],resample)
+        if dense is not None:
+            spectra = np.einsum('khw,hw->kw',dense,frame)
+            if resample and self.resampling is not None:
+                spectra = (self.resampling @ spectra.T).T
+            return spectra
+        values = np.take(frame.reshape(-1),pixel_indices).astype(np.float32)
+        return (matrix @ values).reshape(len(self.weights),-1)
+
+def refine_peak_positions(spectrum,indices):
+    # sub-pixel positions of local maxima, from the parabola through each maximum and its neighbors
+    spectrum = np.asarray(spectrum,dtype=np.float64)
+    indices = np.clip(np.asarray(indices,dtype=np.int64),1,len(spectrum) - 2)
+    y0, y1, y2 = spectrum[indices - 1], spectrum[indices], spectrum[indices + 1]
+    denominator = y0 - 2*y1 + y2
+    delta = np.divide(0.5*(y0 - y2),denominator,out=np.zeros(len(indices)),where=denominator != 0)
+    return indices + np.clip(delta,-0.5,0.5)
+
+def find_spectrum_peaks(spectrum,min_prominence,max_peaks=None):
+    # sub-pixel positions of the peaks of a spectrum, most prominent first
+    indices, properties = scipy.signal.find_peaks(spectrum,prominence=min_prominence)
+    order = np.argsort(properties['prominences'])[::-1][:max_peaks]
+    return refine_peak_positions(spectrum,indices[order])
+
+class WavelengthCalibration(object):
+    # wavelength (nm) of each column of the spectra: a dispersion polynomial (np.polyval coefficients) of the column,
+    # fitted to the peaks of a reference lamp spectrum; saved as json with the spectrometer configurations and each experiment
+
+    def __init__(self,coefficients,width,pixels=(),wavelengths_nm=()):
+        self.coefficients = [float(c) for c in coefficients]
+        self.width = int(width)
+        self.pixels = [float(p) for p in pixels]
+        self.wavelengths_nm = [float(w) for w in wavelengths_nm]
+        if len(self.pixels) > 0:
+            self.residual_rms_nm = float(np.sqrt(np.mean((np.polyval(self.coefficients,self.pixels) - np.array(self.wavelengths_nm))**2)))
+        else:
+            self.residual_rms_nm = None
+
+    @classmethod
+    def fit(cls,pixels,wavelengths_nm,width,degree=2):
+        if len(pixels) < degree + 2:
+            raise ValueError(str(len(pixels)) + ' lines are too few to fit a dispersion polynomial of degree ' + str(degree))
+        calibration = cls(np.polyfit(pixels,wavelengths_nm,degree),width,pixels,wavelengths_nm)
+        if not calibration.is_monotonic():
+            raise ValueError('the fitted dispersion is not monotonic, check the lines and their peaks')
+        return calibration
+
+    @classmethod
+    def from_spectrum(cls,spectrum,lines_nm,degree=2,min_prominence=20,initial=None,tolerance_nm=3):
+        # the lines are matched to the peaks of the spectrum: with an initial calibration (e.g. the previous one), each line to the
+        # nearest peak within tolerance_nm; without, the most prominent peaks in order of column to the lines in order of wavelength,
+        # for either direction of the dispersion, keeping the better fit
+        lines_nm = np.sort(np.asarray(lines_nm,dtype=np.float64))
+        width = len(spectrum)
+        if initial is not None:
+            peaks = find_spectrum_peaks(spectrum,min_prominence)
+            peaks_nm = np.polyval(initial.coefficients,peaks)
+            pixels, wavelengths = [], []
+            for line in lines_nm:
+                if len(peaks) == 0:
+                    break
+                i = np.argmin(np.abs(peaks_nm - line))
+                if abs(peaks_nm[i] - line) <= tolerance_nm:
+                    pixels.append(peaks[i])
+                    wavelengths.append(line)
+            return cls.fit(pixels,wavelengths,width,degree)
+        peaks = np.sort(find_spectrum_peaks(spectrum,min_prominence,len(lines_nm)))
+        if len(peaks) < len(lines_nm):
+            raise ValueError(str(len(peaks)) + ' peaks found for ' + str(len(lines_nm)) + ' lines, lower the prominence or remove lines')
+        best = None
+        for wavelengths in (lines_nm,lines_nm[::-1]):
+            try:
+                calibration = cls.fit(peaks,wavelengths,width,degree)
+            except ValueError:
+                continue
+            if best is None or calibration.residual_rms_nm < best.residual_rms_nm:
+                best = calibration
+        if best is None:
+            raise ValueError('the peaks cannot be matched to the lines')
+        return best
+
+    def get_wavelengths(self):
+        return np.polyval(self.coefficients,np.arange(self.width))
+
+    def is_monotonic(self):
+        steps = np.diff(self.get_wavelengths())
+        return bool(np.all(steps > 0) or np.all(steps < 0))
+
+    def get_grid(self,axis='nm',points=None):
+        # a uniform grid over the calibrated range, in nm or in wavenumbers (cm^-1), ascending
+        values = self.get_wavelengths()
+        if axis == 'wavenumber':
+            values = 1e7/values
+        return np.linspace(values.min(),values.max(),self.width if points is None else int(points))
+
+    def get_resampling_matrix(self,grid,axis='nm'):
+        # sparse (points x width) linear interpolation of a spectrum onto the grid; points outside the calibrated range are 0
+        values = self.get_wavelengths()
+        if axis == 'wavenumber':
+            values = 1e7/values
+        order = np.argsort(values)
+        positions = np.interp(grid,values[order],order.astype(np.float64))
+        inside = (grid >= values.min()) & (grid <= values.max())
+        i0 = np.clip(np.floor(positions).astype(np.int64),0,self.width - 2)
+        f = positions - i0
+        rows = np.flatnonzero(inside)
+        return scipy.sparse.csr_matrix((np.concatenate([1 - f[rows],f[rows]]),(np.concatenate([rows,rows]),np.concatenate([i0[rows],i0[rows] + 1]))),
+                                       shape=(len(grid),self.width),dtype=np.float32)
+
+    def to_dict(self):
+        return {'coefficients':self.coefficients,'width':self.width,'pixels':self.pixels,'wavelengths_nm':self.wavelengths_nm,'residual_rms_nm':self.residual_rms_nm}
+
+    @classmethod
+    def from_dict(cls,values):
+        return cls(values['coefficients'],values['width'],values.get('pixels',()),values.get('wavelengths_nm',()))
+
+    def save(self,filename):
+        with open(filename,'w') as f:
+            json.dump(self.to_dict(),f,indent=4)
+
+    @classmethod
+    def load(cls,filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+class PeakTracker(object):
+    # streaming analysis of a few peaks of a spectrum: Savitzky-Golay smoothing with a precomputed kernel, peak detection,
+    # parabolic sub-pixel refinement and frame to frame association (minimum total shift, up to max_shift). The time, position and
+    # height of the tracked peaks are kept in a ring of records over about the last history frames, so that long runs can follow
+    # the peaks without saving spectra. Positions and max_shift are in the units of the x axis of the spectra (e.g. nm)
+
+    RECORD = np.dtype([('time',np.float64),('id',np.int64),('position',np.float64),('height',np.float64)])
+
+    def __init__(self,window=11,polyorder=2,min_prominence=20,max_peaks=5,max_shift=5,max_missed=10,history=10000):
+        self.set_smoothing(window,polyorder)
+        self.min_prominence = min_prominence
+        self.max_peaks = max_peaks
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.history = history
+        self.reset()
+
+    def set_smoothing(self,window,polyorder=2):
+        # window 1 (or not above polyorder): no smoothing
+        window = int(window) | 1
+        self.kernel = scipy.signal.savgol_coeffs(window,polyorder) if window > polyorder else None
+
+    def reset(self):
+        self.next_id = 0
+        self.ids = np.zeros(0,np.int64)
+        self.positions = np.zeros(0)
+        self.missed = np.zeros(0,np.int64)
+        self.records = np.zeros(self.history*max(1,self.max_peaks),self.RECORD)
+        self.number_of_records = 0
+
+    def smooth(self,spectrum):
+        spectrum = np.asarray(spectrum,dtype=np.float64)
+        if self.kernel is None or len(spectrum) < len(self.kernel):
+            return spectrum
+        return np.convolve(spectrum,self.kernel,mode='same')
+
+    def detect(self,x,spectrum):
+        # (positions, heights) of the most prominent peaks of the smoothed spectrum, most prominent first
+        smoothed = self.smooth(spectrum)
+        indices, properties = scipy.signal.find_peaks(smoothed,prominence=self.min_prominence)
+        indices = indices[np.argsort(properties['prominences'])[::-1][:self.max_peaks]]
+        if len(indices) == 0 or len(smoothed) < 3:
+            return np.zeros(0), np.zeros(0)
+        positions = refine_peak_positions(smoothed,indices)
+        i = np.clip(indices,1,len(smoothed) - 2)
+        heights = smoothed[i] - 0.25*(smoothed[i - 1] - smoothed[i + 1])*(positions - i)
+        return np.interp(positions,np.arange(len(x)),x), heights
+
+    def update(self,x,spectrum,timestamp):
+        # (ids, positions, heights) of the peaks found in this spectrum
+        positions, heights = self.detect(x,spectrum)
+        ids = np.full(len(positions),-1,np.int64)
+        matched = np.zeros(len(self.ids),bool)
+        if len(self.ids) > 0 and len(positions) > 0:
+            cost = np.abs(self.positions[:,None] - positions[None,:])
+            rows, columns = scipy.optimize.linear_sum_assignment(cost)
+            valid = cost[rows,columns] <= self.max_shift
+            rows, columns = rows[valid], columns[valid]
+            ids[columns] = self.ids[rows]
+            self.positions[rows] = positions[columns]
+            matched[rows] = True
+        self.missed[matched] = 0
+        self.missed[~matched] += 1
+        keep = self.missed <= self.max_missed
+        self.ids, self.positions, self.missed = self.ids[keep], self.positions[keep], self.missed[keep]
+        # new peaks, most prominent first, while fewer than max_peaks are tracked
+        new = np.flatnonzero(ids < 0)[:max(0,self.max_peaks - len(self.ids))]
+        ids[new] = self.next_id + np.arange(len(new))
+        self.next_id = self.next_id + len(new)
+        self.ids = np.concatenate([self.ids,ids[new]])
+        self.positions = np.concatenate([self.positions,positions[new]])
+        self.missed = np.concatenate([self.missed,np.zeros(len(new),np.int64)])
+        found = ids >= 0
+        self._record(timestamp,ids[found],positions[found],heights[found])
+        return ids[found], positions[found], heights[found]
+
+    def _record(self,timestamp,ids,positions,heights):
+        n = len(ids)
+        if n == 0:
+            return
+        index = (self.number_of_records + np.arange(n)) % len(self.records)
+        self.records['time'][index] = timestamp
+        self.records['id'][index] = ids
+        self.records['position'][index] = positions
+        self.records['height'][index] = heights
+        self.number_of_records = self.number_of_records + n
+
+    def get_records(self):
+        # the kept records, oldest first
+        if self.number_of_records <= len(self.records):
+            return self.records[:self.number_of_records]
+        start = self.number_of_records % len(self.records)
+        return np.concatenate([self.records[start:],self.records[:start]])
+
+    def get_time_series(self):
+        # {id: (times, positions, heights)} of the kept records
+        records = self.get_records()
+        series = {}
+        for peak_id in np.unique(records['id']):
+            selected = records[records['id'] == peak_id]
+            series[int(peak_id)] = (selected['time'],selected['position'],selected['height'])
+        return series
+
+class SpectrumDatacube(object):
+    # the (NY, NX, NZ, number of points) float32 datacube of the spectra of a multipoint scan, in a memory mapped .npy file that is
+    # filled FOV by FOV; the spectrum axis and the stage position of every FOV are saved next to it (<name>_axes.npz, see
+    # load_datacube()). Band images (the mean of the spectra over up to 3 ranges of the axis, shown as red, green and blue) and
+    # summary maps (total, peak position, centroid) are updated with every spectrum so they can be displayed during the scan
+
+    MAPS = ['total','peak','centroid']
+
+    def __init__(self,filename,NY,NX,NZ,x,bands=None):
+        self.filename = filename
+        self.x = np.asarray(x,np.float64)
+        self.shape = (NY,NX,NZ,len(self.x))
+        self.cube = np.lib.format.open_memmap(filename,mode='w+',dtype=np.float32,shape=self.shape)
+        self.cube[:] = np.nan
+        self.filled = np.zeros((NY,NX,NZ),bool)
+        self.positions = np.full((NY,NX,NZ,3),np.nan) # x (mm), y (mm), z (um)
+        self.maps = {name:np.full((NY,NX,NZ),np.nan,np.float32) for name in self.MAPS}
+        self.lock = Lock()
+        self.set_bands(bands)
+
+    def set_bands(self,bands=None):
+        # (start, end) ranges in units of the axis, for red, green and blue; None: the thirds of the axis, the last one in red
+        if bands is None:
+            edges = np.linspace(0,len(self.x),4).astype(int)
+            bands = [(self.x[edges[i]],self.x[edges[i+1]-1]) for i in (2,1,0)]
+        weights = np.zeros((len(bands),len(self.x)),np.float32)
+        for b, (start, end) in enumerate(bands):
+            selected = (self.x >= min(start,end)) & (self.x <= max(start,end))
+            if np.any(selected):
+                weights[b,selected] = 1/np.count_nonzero(selected)
+        with self.lock:
+            self.bands = list(bands)
+            self.band_weights = weights
+            self.band_maps = np.full(self.filled.shape + (len(bands),),np.nan,np.float32)
+            if np.any(self.filled):
+                self.band_maps[self.filled] = self.cube[self.filled] @ weights.T
+
+    def add(self,i,j,k,spectrum,position=None):
+        # the spectrum of FOV (i, j, k) (row, column, plane) and its stage position (x (mm), y (mm), z (um))
+        spectrum = np.asarray(spectrum,np.float32)
+        if spectrum.shape != (self.shape[3],):
+            raise ValueError('spectrum of ' + str(spectrum.shape) + ' points for a datacube of ' + str(self.shape[3]))
+        with self.lock:
+            self.cube[i,j,k] = spectrum
+            self.filled[i,j,k] = True
+            if position is not None:
+                self.positions[i,j,k] = position
+            positive = np.maximum(spectrum,0)
+            total = float(positive.sum())
+            self.maps['total'][i,j,k] = float(spectrum.sum())
+            self.maps['peak'][i,j,k] = self.x[int(np.argmax(spectrum))]
+            self.maps['centroid'][i,j,k] = float(positive @ self.x)/total if total > 0 else np.nan
+            self.band_maps[i,j,k] = self.band_weights @ spectrum
+
+    def get_map(self,name,k=0):
+        # (NY, NX) image of a summary map, NaN where there is no spectrum yet
+        with self.lock:
+            return np.copy(self.maps[name][:,:,k])
+
+    def get_band_image(self,band,k=0):
+        with self.lock:
+            return np.copy(self.band_maps[:,:,k,band])
+
+    def get_false_colour_image(self,k=0,percentiles=(1,99)):
+        # (NY, NX, 3) uint8 image of the bands, each stretched between the percentiles of its filled pixels
+        with self.lock:
+            images = np.copy(self.band_maps[:,:,k])
+        rgb = np.zeros(images.shape[:2] + (3,),np.uint8)
+        for b in range(min(images.shape[2],3)):
+            rgb[:,:,b] = _scale_to_uint8(images[:,:,b],percentiles)
+        return rgb
+
+    def get_scaled_map(self,name,k=0,percentiles=(1,99)):
+        # uint8 image of a summary map for display
+        return _scale_to_uint8(self.get_map(name,k),percentiles)
+
+    def get_axes_filename(self):
+        return os.path.splitext(self.filename)[0] + '_axes.npz'
+
+    def flush(self):
+        # writes the datacube and the axes, so the file can be read while the scan goes on
+        with self.lock:
+            self.cube.flush()
+            np.savez(self.get_axes_filename(),x=self.x,positions=self.positions,filled=self.filled,bands=np.array(self.bands,np.float64),**self.maps)
+
+    def close(self):
+        # the maps stay available, the datacube is reopened read only
+        self.flush()
+        with self.lock:
+            self.cube = np.load(self.filename,mmap_mode='r')
+
+def _scale_to_uint8(image,percentiles):
+    # stretched between the percentiles of the finite pixels, 0 elsewhere
+    valid = np.isfinite(image)
+    if not np.any(valid):
+        return np.zeros(image.shape,np.uint8)
+    low, high = np.percentile(image[valid],percentiles)
+    scaled = (image - low)/(high - low) if high > low else np.ones_like(image)
+    return np.where(valid,np.clip(scaled,0,1)*255,0).astype(np.uint8)
+
+def load_datacube(filename):
+    # (the datacube, memory mapped read only, {'x', 'positions', 'filled', 'bands', and the summary maps})
+    cube = np.load(filename,mmap_mode='r')
+    with np.load(os.path.splitext(filename)[0] + '_axes.npz') as f:
+        axes = {name:f[name] for name in f.files}
+    return cube, axes
+
+class SpectrumRecording(object):
+    # timestamped spectra appended to a preallocated, memory mapped (capacity, number of points) float32 .npy file; the times
+    # (s since the start of the recording) go to <name>_index.npy, the camera frame IDs to <name>_frame_ID.npy and the number of
+    # spectra, the x axis, the start time and the frames dropped before extraction to <name>.json, rewritten every flush_interval
+    # spectra. See SpectrumRecordingReader for reading time slices
+
+    def __init__(self,filename,x,capacity,flush_interval=1000,start_time=None):
+        stem = os.path.splitext(filename)[0]
+        self.filename = filename
+        self.index_filename = stem + '_index.npy'
+        self.frame_ID_filename = stem + '_frame_ID.npy'
+        self.metadata_filename = stem + '.json'
+        self.x = np.asarray(x,np.float64)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.start_time = start_time
+        self.spectra = np.lib.format.open_memmap(filename,mode='w+',dtype=np.float32,shape=(capacity,len(self.x)))
+        self.times = np.lib.format.open_memmap(self.index_filename,mode='w+',dtype=np.float64,shape=(capacity,))
+        self.frame_IDs = np.lib.format.open_memmap(self.frame_ID_filename,mode='w+',dtype=np.int64,shape=(capacity,))
+        self.count = 0
+        self.frames_dropped = 0 # set by the recorder
+        self.write_metadata()
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def append(self,timestamp,spectrum,frame_ID=-1):
+        # timestamp: time.time() of the frame of the spectrum; False if the recording is full or the spectrum does not match the x axis
+        if self.count >= self.capacity or len(spectrum) != len(self.x):
+            return False
+        if self.start_time is None:
+            self.start_time = timestamp
+        self.spectra[self.count] = spectrum
+        self.times[self.count] = timestamp - self.start_time
+        self.frame_IDs[self.count] = frame_ID
+        self.count = self.count + 1
+        if self.count % self.flush_interval == 0:
+            self.write_metadata()
+        return True
+
+    def write_metadata(self):
+        # the spectra before count are complete when the metadata is read; written to a temporary file and renamed,
+        # so that a reader polling the file never sees it half written
+        filename_temporary = self.metadata_filename + '.tmp'
+        with open(filename_temporary,'w') as f:
+            json.dump({'count':self.count,'capacity':self.capacity,'start_time':self.start_time,'frames_dropped':self.frames_dropped,'x':self.x.tolist()},f)
+        os.replace(filename_temporary,self.metadata_filename)
+
+    def close(self):
+        self.spectra.flush()
+        self.times.flush()
+        self.frame_IDs.flush()
+        self.write_metadata()
+
+class SpectrumRecordingReader(object):
+    # reads slices of a SpectrumRecording without loading the file, also while it is being recorded (see refresh())
+
+    def __init__(self,filename):
+        stem = os.path.splitext(filename)[0]
+        self.metadata_filename = stem + '.json'
+        self.spectra = np.load(filename,mmap_mode='r')
+        self.times = np.load(stem + '_index.npy',mmap_mode='r')
+        self.frame_IDs = np.load(stem + '_frame_ID.npy',mmap_mode='r') if os.path.exists(stem + '_frame_ID.npy') else None
+        self.refresh()
+
+    def refresh(self):
+        with open(self.metadata_filename) as f:
+            metadata = json.load(f)
+        self.count = metadata['count']
+        self.start_time = metadata['start_time']
+        self.frames_dropped = metadata.get('frames_dropped',0)
+        self.x = np.array(metadata['x'])
+
+    def __len__(self):
+        return self.count
+
+    def get_times(self):
+        # s since the start of the recording
+        return np.array(self.times[:self.count])
+
+    def get_frame_IDs(self,t0=None,t1=None):
+        # camera frame IDs of the spectra between t0 and t1, gaps are frames that were not recorded
+        if self.frame_IDs is None:
+            return None
+        i0, i1 = self.get_index_range(t0,t1)
+        return np.array(self.frame_IDs[i0:i1])
+
+    def get_index_range(self,t0=None,t1=None):
+        # the spectra with t0 <= time < t1
+        times = self.times[:self.count]
+        i0 = 0 if t0 is None else int(np.searchsorted(times,t0,side='left'))
+        i1 = self.count if t1 is None else int(np.searchsorted(times,t1,side='left'))
+        return i0, max(i0,i1)
+
+    def get_spectra(self,t0=None,t1=None,step=1):
+        # (times, spectra) between t0 and t1 (s since the start), every step-th spectrum
+        i0, i1 = self.get_index_range(t0,t1)
+        return np.array(self.times[i0:i1:step]), np.array(self.spectra[i0:i1:step])
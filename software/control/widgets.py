@@ -10,6 +10,8 @@ from qtpy.QtWidgets import *
 from qtpy.QtGui import *
 
 from control._def import *
+import control.instrumentation as instrumentation
+import control.microscope as microscope
 
 class CameraSettingsWidget(QFrame):
 
@@ -29,14 +31,14 @@ class CameraSettingsWidget(QFrame):
         self.entry_exposureTime.setMaximum(self.camera.EXPOSURE_TIME_MS_MAX) 
         self.entry_exposureTime.setSingleStep(1)
         self.entry_exposureTime.setValue(20)
-        self.camera.set_exposure_time(20)
+        self.write_exposure_time(20)
 
         self.entry_analogGain = QDoubleSpinBox()
         self.entry_analogGain.setMinimum(self.camera.GAIN_MIN) 
         self.entry_analogGain.setMaximum(self.camera.GAIN_MAX) 
         self.entry_analogGain.setSingleStep(self.camera.GAIN_STEP)
         self.entry_analogGain.setValue(0)
-        self.camera.set_analog_gain(0)
+        self.write_analog_gain(0)
 
         self.dropdown_pixelFormat = QComboBox()
         self.dropdown_pixelFormat.addItems(['MONO8','MONO12','MONO14','MONO16','BAYER_RG8','BAYER_RG12'])
@@ -66,8 +68,8 @@ class CameraSettingsWidget(QFrame):
         self.entry_ROI_height.setKeyboardTracking(False)
 
         # connection
-        self.entry_exposureTime.valueChanged.connect(self.camera.set_exposure_time)
-        self.entry_analogGain.valueChanged.connect(self.camera.set_analog_gain)
+        self.entry_exposureTime.valueChanged.connect(self.write_exposure_time)
+        self.entry_analogGain.valueChanged.connect(self.write_analog_gain)
         self.dropdown_pixelFormat.currentTextChanged.connect(self.camera.set_pixel_format)
         self.entry_ROI_offset_x.valueChanged.connect(self.set_ROI)
         self.entry_ROI_offset_y.valueChanged.connect(self.set_ROI)
@@ -108,6 +110,13 @@ class CameraSettingsWidget(QFrame):
     def set_analog_gain(self,analog_gain):
         self.entry_analogGain.setValue(analog_gain)
 
+    # through the device state shared with the live controllers, so that their next mode switch knows the current values
+    def write_exposure_time(self,exposure_time):
+        microscope.get_device_state(self.camera).write('exposure_time',exposure_time,self.camera.set_exposure_time)
+
+    def write_analog_gain(self,analog_gain):
+        microscope.get_device_state(self.camera).write('analog_gain',analog_gain,self.camera.set_analog_gain)
+
     def set_ROI(self):
     	self.camera.set_ROI(self.entry_ROI_offset_x.value(),self.entry_ROI_offset_y.value(),self.entry_ROI_width.value(),self.entry_ROI_height.value())
 
@@ -309,7 +318,7 @@ class LiveControlWidget(QFrame):
         print('load the setttings for the current microscope mode: ' + current_microscope_mode_name )
         self.is_switching_mode = True
         # identify the mode selected (note that this references the object in self.configurationManager.configurations)
-        self.currentConfiguration = next((config for config in self.configurationManager.configurations if config.name == current_microscope_mode_name), None)
+        self.currentConfiguration = self.configurationManager.get_configuration_by_name(current_microscope_mode_name)
         # update the microscope to the current configuration
         self.liveController.set_microscope_mode(self.currentConfiguration)
         # update the exposure time and analog gain settings according to the selected configuration
@@ -328,12 +337,14 @@ class LiveControlWidget(QFrame):
             self.currentConfiguration.exposure_time = new_value
             self.configurationManager.update_configuration(self.currentConfiguration.id,'ExposureTime',new_value)
             self.signal_newExposureTime.emit(new_value)
+            self.liveController.invalidate_device_state('exposure_time')
 
     def update_config_analog_gain(self,new_value):
         if self.is_switching_mode == False:
             self.currentConfiguration.analog_gain = new_value
             self.configurationManager.update_configuration(self.currentConfiguration.id,'AnalogGain',new_value)
             self.signal_newAnalogGain.emit(new_value)
+            self.liveController.invalidate_device_state('analog_gain')
 
     def update_config_illumination_intensity(self,new_value):
         if self.is_switching_mode == False:
@@ -343,21 +354,25 @@ class LiveControlWidget(QFrame):
 
     def set_microscope_mode(self,config):
         # self.liveController.set_microscope_mode(config)
-        self.dropdown_modeSelection.setCurrentText(config.name)
+        if self.dropdown_modeSelection.currentText() == config.name:
+            # no currentTextChanged, but another channel may have changed the shared illumination and DACs since (only what differs is written)
+            self.update_microscope_mode_by_name(config.name)
+        else:
+            self.dropdown_modeSelection.setCurrentText(config.name)
 
     def set_DAC0(self,value):
-        self.liveController.microcontroller2.analog_write_DAC8050x(0,int(value*65535/100))
+        self.liveController.set_DAC(0,value)
         self.currentConfiguration.dac_led = value
         self.configurationManager.update_configuration(self.currentConfiguration.id,'DAC_LED',value)
 
     def set_DAC1(self,value):
-        self.liveController.microcontroller2.analog_write_DAC8050x(1,int(value*65535/100))
+        self.liveController.set_DAC(1,value)
         self.currentConfiguration.dac_laser = value
         self.configurationManager.update_configuration(self.currentConfiguration.id,'DAC_Laser',value)
 
     def update_DACs(self):
-        self.liveController.microcontroller2.analog_write_DAC8050x(0,int(self.entry_DAC0.value()*65535/100))
-        self.liveController.microcontroller2.analog_write_DAC8050x(1,int(self.entry_DAC1.value()*65535/100))
+        self.liveController.set_DAC(0,self.entry_DAC0.value())
+        self.liveController.set_DAC(1,self.entry_DAC1.value())
 
 class BrightfieldWidget(QFrame):
     def __init__(self, liveController, main=None, *args, **kwargs):
@@ -397,12 +412,22 @@ class SpectrumPlotWidget(pg.GraphicsLayoutWidget):
     
     def plot(self,x,y):
         self.plotWidget.plot(x,y,clear=True)
+
+    def set_axis(self,axis):
+        labels = {'pixel':'column','nm':'wavelength (nm)','nm resampled':'wavelength (nm)','wavenumber resampled':'wavenumber (cm-1)'}
+        self.plotWidget.setLabel('bottom',labels.get(axis,axis))
+
+    def plot_spectra(self,x,spectra):
+        self.plotWidget.clear()
+        for k in range(spectra.shape[0]):
+            self.plotWidget.plot(x,spectra[k],pen=pg.intColor(k,hues=max(spectra.shape[0],9)))
         
 class RecordingWidget(QFrame):
-    def __init__(self, streamHandler, imageSaver, main=None, *args, **kwargs):
+    def __init__(self, streamHandler, imageSaver, spectrumRecorder=None, main=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.imageSaver = imageSaver # for saving path control
         self.streamHandler = streamHandler
+        self.spectrumRecorder = spectrumRecorder # records the extracted spectra instead of the frames when Spectra only is checked
         self.base_path_is_set = False
         self.add_components()
         self.setFrameStyle(QFrame.Panel | QFrame.Raised)
@@ -436,6 +461,10 @@ class RecordingWidget(QFrame):
         self.btn_record.setChecked(False)
         self.btn_record.setDefault(False)
 
+        self.checkbox_spectraOnly = QCheckBox('Spectra only')
+        self.checkbox_spectraOnly.setToolTip('record the spectrum of every frame to one file instead of the frames (the saving FPS does not apply)')
+        self.checkbox_spectraOnly.setVisible(self.spectrumRecorder is not None)
+
         grid_line1 = QGridLayout()
         grid_line1.addWidget(QLabel('Saving Path'))
         grid_line1.addWidget(self.lineEdit_savingDir, 0,1)
@@ -450,7 +479,8 @@ class RecordingWidget(QFrame):
         grid_line3.addWidget(self.entry_saveFPS, 0,1)
         grid_line3.addWidget(QLabel('Time Limit (s)'), 0,2)
         grid_line3.addWidget(self.entry_timeLimit, 0,3)
-        grid_line3.addWidget(self.btn_record, 0,4)
+        grid_line3.addWidget(self.checkbox_spectraOnly, 0,4)
+        grid_line3.addWidget(self.btn_record, 0,5)
 
         self.grid = QGridLayout()
         self.grid.addLayout(grid_line1,0,0)
@@ -467,11 +497,16 @@ class RecordingWidget(QFrame):
         self.entry_saveFPS.valueChanged.connect(self.streamHandler.set_save_fps)
         self.entry_timeLimit.valueChanged.connect(self.imageSaver.set_recording_time_limit)
         self.imageSaver.stop_recording.connect(self.stop_recording)
+        if self.spectrumRecorder is not None:
+            self.entry_timeLimit.valueChanged.connect(self.spectrumRecorder.set_recording_time_limit)
+            self.spectrumRecorder.stop_recording.connect(self.stop_recording)
 
     def set_saving_dir(self):
         dialog = QFileDialog()
         save_dir_base = dialog.getExistingDirectory(None, "Select Folder")
         self.imageSaver.set_base_path(save_dir_base)
+        if self.spectrumRecorder is not None:
+            self.spectrumRecorder.set_base_path(save_dir_base)
         self.lineEdit_savingDir.setText(save_dir_base)
         self.base_path_is_set = True
 
@@ -485,19 +520,26 @@ class RecordingWidget(QFrame):
         if pressed:
             self.lineEdit_experimentID.setEnabled(False)
             self.btn_setSavingDir.setEnabled(False)
-            self.imageSaver.start_new_experiment(self.lineEdit_experimentID.text())
-            self.streamHandler.start_recording()
+            self.checkbox_spectraOnly.setEnabled(False)
+            if self.checkbox_spectraOnly.isChecked():
+                self.spectrumRecorder.start_new_experiment(self.lineEdit_experimentID.text())
+                self.streamHandler.start_spectrum_recording()
+            else:
+                self.imageSaver.start_new_experiment(self.lineEdit_experimentID.text())
+                self.streamHandler.start_recording()
         else:
-            self.streamHandler.stop_recording()
-            self.lineEdit_experimentID.setEnabled(True)
-            self.btn_setSavingDir.setEnabled(True)
+            self.stop_recording()
 
-    # stop_recording can be called by imageSaver
+    # stop_recording can be called by imageSaver and spectrumRecorder
     def stop_recording(self):
         self.lineEdit_experimentID.setEnabled(True)
         self.btn_record.setChecked(False)
         self.streamHandler.stop_recording()
+        if self.spectrumRecorder is not None:
+            self.streamHandler.stop_spectrum_recording()
+            self.spectrumRecorder.stop()
         self.btn_setSavingDir.setEnabled(True)
+        self.checkbox_spectraOnly.setEnabled(True)
 
 class NavigationWidget(QFrame):
     def __init__(self, navigationController, slidePositionController=None, main=None, widget_configuration = 'full', *args, **kwargs):
@@ -793,11 +835,12 @@ class DACControWidget(QFrame):
         self.grid.addLayout(grid_line1,1,0)
         self.setLayout(self.grid)
 
+    # same keys as LiveController.set_DAC, the configurations see the value written here
     def set_DAC0(self,value):
-        self.microcontroller2.analog_write_DAC8050x(0,int(value*65535/100))
+        microscope.get_device_state(self.microcontroller2).write(('DAC',0),int(value*65535/100),lambda value: self.microcontroller2.analog_write_DAC8050x(0,value),settle=True)
 
     def set_DAC1(self,value):
-        self.microcontroller2.analog_write_DAC8050x(1,int(value*65535/100))
+        microscope.get_device_state(self.microcontroller2).write(('DAC',1),int(value*65535/100),lambda value: self.microcontroller2.analog_write_DAC8050x(1,value),settle=True)
 
 class AutoFocusWidget(QFrame):
     def __init__(self, autofocusController, main=None, *args, **kwargs):
@@ -944,6 +987,13 @@ class MultiPointWidget(QFrame):
         self.entry_N_spectrum.setSingleStep(1)
         self.entry_N_spectrum.setValue(1)
 
+        self.dropdown_spectrumAccumulation = QComboBox()
+        self.dropdown_spectrumAccumulation.addItems(['frames','spectrum','band'])
+        self.dropdown_spectrumAccumulation.setCurrentText(SPECTRUM_ACCUMULATION.MODE)
+        self.dropdown_spectrumAccumulation.setToolTip('frames: save the Ns images; spectrum/band: save the mean and std of the Ns spectra/bands')
+        self.checkbox_keepRawSpectrumFrames = QCheckBox('Keep raw frames')
+        self.checkbox_keepRawSpectrumFrames.setChecked(SPECTRUM_ACCUMULATION.KEEP_RAW_FRAMES)
+
         self.list_configurations = QListWidget()
         for channel in self.configurationManagers.keys():
             for microscope_configuration in self.configurationManagers[channel].configurations:
@@ -988,6 +1038,9 @@ class MultiPointWidget(QFrame):
 
         grid_line2.addWidget(QLabel('Ns'), 2,0)
         grid_line2.addWidget(self.entry_N_spectrum, 2,1)
+        grid_line2.addWidget(QLabel('Ns mode'), 2,2)
+        grid_line2.addWidget(self.dropdown_spectrumAccumulation, 2,3)
+        grid_line2.addWidget(self.checkbox_keepRawSpectrumFrames, 2,4,1,2)
 
         grid_line3 = QHBoxLayout()
         grid_line3.addWidget(self.list_configurations)
@@ -1014,6 +1067,8 @@ class MultiPointWidget(QFrame):
         self.entry_NZ.valueChanged.connect(self.multipointController.set_NZ)
         self.entry_Nt.valueChanged.connect(self.multipointController.set_Nt)
         self.entry_N_spectrum.valueChanged.connect(self.multipointController.set_N_spectrum)
+        self.dropdown_spectrumAccumulation.currentTextChanged.connect(self.multipointController.set_spectrum_accumulation_mode)
+        self.checkbox_keepRawSpectrumFrames.toggled.connect(self.multipointController.set_keep_raw_spectrum_frames)
         self.checkbox_withAutofocus.stateChanged.connect(self.multipointController.set_af_flag)
         self.btn_setSavingDir.clicked.connect(self.set_saving_dir)
         self.btn_startAcquisition.clicked.connect(self.toggle_acquisition)
@@ -1122,6 +1177,20 @@ class SpectrumROIManagerWidget(QFrame):
         self.btn_autoROI.setDefault(False)
         self.btn_autoROI.setChecked(False)
 
+        self.checkbox_followBand = QCheckBox('Follow')
+        self.checkbox_followBand.setToolTip('re-detect the band continuously and move the ROI when it drifts')
+
+        self.checkbox_fastSpectrum = QCheckBox('Fast spectrum')
+        self.checkbox_fastSpectrum.setToolTip('read out only the rows of the spectrum ROI from the sensor')
+
+        self.btn_fitCurvature = QPushButton('Fit Curvature')
+        self.btn_fitCurvature.setDefault(False)
+        self.btn_fitCurvature.setToolTip('fit the curvature and width of the band in the current frame (e.g. of a broadband lamp) and extract along it')
+
+        self.btn_loadTracks = QPushButton('Load Tracks')
+        self.btn_loadTracks.setDefault(False)
+        self.btn_loadTracks.setToolTip('extract several spectra per frame, with background bands, from a json list of tracks (see control/spectrum.py)')
+
         # layout
         grid_line0 = QGridLayout()
         grid_line0.addWidget(QLabel('Y1'), 0,0)
@@ -1131,6 +1200,10 @@ class SpectrumROIManagerWidget(QFrame):
         grid_line0.addWidget(QLabel('Width'), 0,4)
         grid_line0.addWidget(self.entry_w, 0,5)
         grid_line0.addWidget(self.btn_autoROI, 0,6)
+        grid_line0.addWidget(self.checkbox_followBand, 0,7)
+        grid_line0.addWidget(self.checkbox_fastSpectrum, 0,8)
+        grid_line0.addWidget(self.btn_fitCurvature, 0,9)
+        grid_line0.addWidget(self.btn_loadTracks, 0,10)
 
         self.grid = QGridLayout()
         self.grid.addLayout(grid_line0,0,0)
@@ -1141,24 +1214,378 @@ class SpectrumROIManagerWidget(QFrame):
         self.entry_y0.valueChanged.connect(self.updateROI)
         self.entry_y1.valueChanged.connect(self.updateROI)
         self.entry_w.valueChanged.connect(self.updateROI)
+        self.checkbox_followBand.stateChanged.connect(self.set_continuous_auto_ROI)
+        self.checkbox_fastSpectrum.stateChanged.connect(self.set_fast_spectrum_mode)
+        self.spectrumROIManager.calculated_y_values.connect(self.update_y_entries)
+        self.spectrumROIManager.calculated_width.connect(self.update_width_entry)
+        self.btn_fitCurvature.clicked.connect(self.fit_curvature)
+        self.btn_loadTracks.clicked.connect(self.load_tracks)
 
     def update_y_entries(self, y0, y1):
-        print('updating y entries')
-        self.entry_y0.setValue(y0) 
-        self.entry_y1.setValue(y1)
+        # the ROI is already set, the entries only follow it
+        for entry, value in ((self.entry_y0,y0),(self.entry_y1,y1)):
+            entry.blockSignals(True)
+            entry.setValue(value)
+            entry.blockSignals(False)
+
+    def update_width_entry(self, w):
+        self.entry_w.blockSignals(True)
+        self.entry_w.setValue(w)
+        self.entry_w.blockSignals(False)
 
     def autoROI(self):
         print('automatically determine the ROI')
-        self.spectrumROIManager.auto_ROI()
-        self.spectrumROIManager.calculated_y_values.connect(self.update_y_entries)
-        QApplication.processEvents()
-        self.update()
+        try:
+            self.spectrumROIManager.auto_ROI()
+        except ValueError as e:
+            QMessageBox.warning(self,'Auto ROI',str(e))
+
+    def set_continuous_auto_ROI(self,state):
+        self.spectrumROIManager.set_continuous_auto_ROI(state == Qt.Checked)
 
     def updateROI(self):
         print('update the ROI definition in the spectrum Extractor')
         #mask = self.spectrumROIManager.create_mask(updated_x_coordinates[0],
         self.spectrumROIManager.manual_updatedROI(self.entry_y0.value(),self.entry_y1.value(),self.entry_w.value())
 
+    def fit_curvature(self):
+        try:
+            self.spectrumROIManager.fit_curvature()
+        except ValueError as e:
+            QMessageBox.warning(self,'Fit Curvature',str(e))
+
+    def load_tracks(self):
+        filename, _ = QFileDialog.getOpenFileName(self,'Load spectrum tracks','','JSON (*.json)')
+        if filename == '':
+            return
+        try:
+            self.spectrumROIManager.load_tracks(filename)
+        except (OSError,ValueError,KeyError) as e:
+            QMessageBox.warning(self,'Load Tracks',str(e))
+
+    def set_fast_spectrum_mode(self,state):
+        enabled = self.spectrumROIManager.set_fast_spectrum_mode(state == Qt.Checked)
+        if enabled != (state == Qt.Checked):
+            self.checkbox_fastSpectrum.blockSignals(True)
+            self.checkbox_fastSpectrum.setChecked(enabled)
+            self.checkbox_fastSpectrum.blockSignals(False)
+
+
+class SpectrumCorrectionWidget(QFrame):
+    def __init__(self, frameCorrector, camera, liveController, main=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frameCorrector = frameCorrector
+        self.camera = camera
+        self.liveController = liveController
+        self.add_components()
+        self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+
+    def add_components(self):
+        self.entry_N = QSpinBox()
+        self.entry_N.setMinimum(1)
+        self.entry_N.setMaximum(1000)
+        self.entry_N.setSingleStep(1)
+        self.entry_N.setValue(SPECTRUM_CORRECTION.N_CALIBRATION_FRAMES)
+
+        self.btn_captureDark = QPushButton('Capture Dark')
+        self.btn_captureDark.setDefault(False)
+        self.btn_captureDark.setToolTip('average the next N frames into the dark frame for the current camera settings, with the illumination off')
+        self.btn_captureFlat = QPushButton('Capture Flat')
+        self.btn_captureFlat.setDefault(False)
+        self.btn_captureFlat.setToolTip('average the next N frames into the flat frame for the current camera settings, with uniform illumination')
+
+        self.checkbox_dark = QCheckBox('Dark')
+        self.checkbox_dark.setChecked(self.frameCorrector.use_dark)
+        self.checkbox_flat = QCheckBox('Flat')
+        self.checkbox_flat.setChecked(self.frameCorrector.use_flat)
+        self.checkbox_correct = QCheckBox('Correct spectra')
+        self.checkbox_correct.setChecked(self.frameCorrector.enabled)
+
+        self.label_status = QLabel()
+        self.label_status.setFrameStyle(QFrame.Panel | QFrame.Sunken)
+
+        grid_line0 = QGridLayout()
+        grid_line0.addWidget(QLabel('N'), 0,0)
+        grid_line0.addWidget(self.entry_N, 0,1)
+        grid_line0.addWidget(self.btn_captureDark, 0,2)
+        grid_line0.addWidget(self.btn_captureFlat, 0,3)
+        grid_line0.addWidget(self.checkbox_dark, 0,4)
+        grid_line0.addWidget(self.checkbox_flat, 0,5)
+        grid_line0.addWidget(self.checkbox_correct, 0,6)
+
+        self.grid = QGridLayout()
+        self.grid.addLayout(grid_line0,0,0)
+        self.grid.addWidget(self.label_status,1,0)
+        self.setLayout(self.grid)
+
+        self.btn_captureDark.clicked.connect(lambda: self.start_capture('dark'))
+        self.btn_captureFlat.clicked.connect(lambda: self.start_capture('flat'))
+        self.checkbox_dark.toggled.connect(self.frameCorrector.set_use_dark)
+        self.checkbox_flat.toggled.connect(self.frameCorrector.set_use_flat)
+        self.checkbox_correct.toggled.connect(self.frameCorrector.set_enabled)
+
+    def start_capture(self,kind):
+        if not self.liveController.is_live:
+            self.label_status.setText('start live to capture the ' + kind + ' frame')
+            return
+        self.frameCorrector.start_capture(kind,self.entry_N.value())
+        self.label_status.setText('capturing the ' + kind + ' frame from ' + str(self.entry_N.value()) + ' frames')
+
+    def calibration_frame_captured(self,kind):
+        self.label_status.setText(kind + ' frame captured at ' + str(self.camera.exposure_time) + ' ms, gain ' + str(self.camera.analog_gain))
+
+
+class WavelengthCalibrationWidget(QFrame):
+    AXES = ['pixel','nm','nm resampled','wavenumber resampled']
+
+    def __init__(self, spectrumExtractor, camera, spectrumPlotWidget=None, main=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spectrumExtractor = spectrumExtractor
+        self.camera = camera
+        self.spectrumPlotWidget = spectrumPlotWidget
+        self.add_components()
+        self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+
+    def add_components(self):
+        self.lineEdit_lines = QLineEdit()
+        self.lineEdit_lines.setText(', '.join(str(line) for line in SPECTRUM_WAVELENGTH.REFERENCE_LINES_NM))
+        self.lineEdit_lines.setToolTip('wavelengths (nm) of the lines of the reference lamp')
+
+        self.btn_calibrate = QPushButton('Calibrate Wavelength')
+        self.btn_calibrate.setDefault(False)
+        self.btn_calibrate.setToolTip('fit the dispersion to the peaks of the current spectrum of the reference lamp')
+        self.checkbox_usePrevious = QCheckBox('From previous')
+        self.checkbox_usePrevious.setToolTip('match the peaks to the lines through the previous calibration')
+        self.checkbox_usePrevious.setChecked(True)
+
+        self.dropdown_axis = QComboBox()
+        self.dropdown_axis.addItems(self.AXES)
+        self.dropdown_axis.setCurrentText(self.spectrumExtractor.axis)
+
+        self.label_status = QLabel()
+        self.label_status.setFrameStyle(QFrame.Panel | QFrame.Sunken)
+        self.update_status()
+
+        grid_line0 = QGridLayout()
+        grid_line0.addWidget(QLabel('Lines (nm)'), 0,0)
+        grid_line0.addWidget(self.lineEdit_lines, 0,1)
+        grid_line0.addWidget(self.checkbox_usePrevious, 0,2)
+        grid_line0.addWidget(self.btn_calibrate, 0,3)
+        grid_line0.addWidget(QLabel('Axis'), 0,4)
+        grid_line0.addWidget(self.dropdown_axis, 0,5)
+
+        self.grid = QGridLayout()
+        self.grid.addLayout(grid_line0,0,0)
+        self.grid.addWidget(self.label_status,1,0)
+        self.setLayout(self.grid)
+
+        self.btn_calibrate.clicked.connect(self.calibrate)
+        self.dropdown_axis.currentTextChanged.connect(self.set_axis)
+        if self.spectrumPlotWidget is not None:
+            self.spectrumPlotWidget.set_axis(self.spectrumExtractor.axis)
+
+    def calibrate(self):
+        if self.camera.current_frame is None:
+            return
+        try:
+            lines_nm = [float(line) for line in self.lineEdit_lines.text().replace(',',' ').split()]
+            self.spectrumExtractor.calibrate_wavelength(self.camera.current_frame,lines_nm,self.checkbox_usePrevious.isChecked())
+        except ValueError as e:
+            QMessageBox.warning(self,'Calibrate Wavelength',str(e))
+        self.update_status()
+
+    def set_axis(self,axis):
+        self.spectrumExtractor.set_axis(axis,SPECTRUM_WAVELENGTH.GRID_POINTS)
+        if self.spectrumPlotWidget is not None:
+            self.spectrumPlotWidget.set_axis(axis)
+
+    def update_status(self):
+        calibration = self.spectrumExtractor.wavelength_calibration
+        if calibration is None:
+            self.label_status.setText('not calibrated')
+            return
+        wavelengths = calibration.get_wavelengths()
+        text = str(round(float(wavelengths.min()),1)) + ' - ' + str(round(float(wavelengths.max()),1)) + ' nm'
+        if calibration.residual_rms_nm is not None:
+            text = text + ', ' + str(len(calibration.pixels)) + ' lines, rms residual ' + str(round(calibration.residual_rms_nm,3)) + ' nm'
+        self.label_status.setText(text)
+
+
+class PeakTrackingWidget(QFrame):
+    # controls of the SpectrumPeakTracker and the position and height of the tracked peaks over time
+
+    def __init__(self, spectrumPeakTracker, refresh_interval_ms=500, main=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spectrumPeakTracker = spectrumPeakTracker
+        self.add_components()
+        self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+        self.timer_refresh = QTimer()
+        self.timer_refresh.setInterval(refresh_interval_ms)
+        self.timer_refresh.timeout.connect(self.refresh)
+        self.timer_refresh.start()
+
+    def add_components(self):
+        self.checkbox_enable = QCheckBox('Track peaks')
+        self.checkbox_enable.setChecked(self.spectrumPeakTracker.enabled)
+
+        self.entry_window = QSpinBox()
+        self.entry_window.setMinimum(1)
+        self.entry_window.setMaximum(101)
+        self.entry_window.setSingleStep(2)
+        self.entry_window.setValue(SPECTRUM_PEAKS.SMOOTHING_WINDOW)
+
+        self.entry_prominence = QDoubleSpinBox()
+        self.entry_prominence.setMinimum(0)
+        self.entry_prominence.setMaximum(1e9)
+        self.entry_prominence.setDecimals(1)
+        self.entry_prominence.setValue(SPECTRUM_PEAKS.MIN_PROMINENCE)
+
+        self.entry_maxPeaks = QSpinBox()
+        self.entry_maxPeaks.setMinimum(1)
+        self.entry_maxPeaks.setMaximum(50)
+        self.entry_maxPeaks.setValue(SPECTRUM_PEAKS.MAX_PEAKS)
+
+        self.entry_maxShift = QDoubleSpinBox()
+        self.entry_maxShift.setMinimum(0)
+        self.entry_maxShift.setMaximum(1e4)
+        self.entry_maxShift.setDecimals(2)
+        self.entry_maxShift.setValue(SPECTRUM_PEAKS.MAX_SHIFT)
+
+        self.btn_reset = QPushButton('Reset')
+        self.btn_log = QPushButton('Log')
+        self.btn_log.setCheckable(True)
+        self.btn_log.setToolTip('write the peaks of every spectrum to a csv file')
+
+        self.graphics = pg.GraphicsLayoutWidget()
+        self.plot_position = self.graphics.addPlot(title='position')
+        self.graphics.nextRow()
+        self.plot_height = self.graphics.addPlot(title='height')
+        self.plot_height.setXLink(self.plot_position)
+        self.plot_height.setLabel('bottom','time (s)')
+
+        grid_line0 = QGridLayout()
+        grid_line0.addWidget(self.checkbox_enable, 0,0)
+        grid_line0.addWidget(QLabel('Smoothing'), 0,1)
+        grid_line0.addWidget(self.entry_window, 0,2)
+        grid_line0.addWidget(QLabel('Prominence'), 0,3)
+        grid_line0.addWidget(self.entry_prominence, 0,4)
+        grid_line0.addWidget(QLabel('Peaks'), 0,5)
+        grid_line0.addWidget(self.entry_maxPeaks, 0,6)
+        grid_line0.addWidget(QLabel('Max shift'), 0,7)
+        grid_line0.addWidget(self.entry_maxShift, 0,8)
+        grid_line0.addWidget(self.btn_reset, 0,9)
+        grid_line0.addWidget(self.btn_log, 0,10)
+
+        self.grid = QGridLayout()
+        self.grid.addLayout(grid_line0,0,0)
+        self.grid.addWidget(self.graphics,1,0)
+        self.setLayout(self.grid)
+
+        self.checkbox_enable.toggled.connect(self.spectrumPeakTracker.set_enabled)
+        self.entry_window.valueChanged.connect(self.spectrumPeakTracker.set_smoothing_window)
+        self.entry_prominence.valueChanged.connect(self.spectrumPeakTracker.set_min_prominence)
+        self.entry_maxPeaks.valueChanged.connect(self.spectrumPeakTracker.set_max_peaks)
+        self.entry_maxShift.valueChanged.connect(self.spectrumPeakTracker.set_max_shift)
+        self.btn_reset.clicked.connect(self.spectrumPeakTracker.reset)
+        self.btn_log.clicked.connect(self.toggle_logging)
+
+    def toggle_logging(self,pressed):
+        if pressed:
+            filename, _ = QFileDialog.getSaveFileName(self,'Log peaks','','CSV (*.csv)')
+            if filename == '':
+                self.btn_log.setChecked(False)
+                return
+            self.spectrumPeakTracker.start_logging(filename)
+        else:
+            self.spectrumPeakTracker.stop_logging()
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        series = self.spectrumPeakTracker.get_time_series()
+        self.plot_position.clear()
+        self.plot_height.clear()
+        for peak_id, (t, position, height) in series.items():
+            pen = pg.intColor(peak_id,hues=9)
+            self.plot_position.plot(t,position,pen=pen)
+            self.plot_height.plot(t,height,pen=pen)
+
+
+class DatacubeWidget(QFrame):
+    # band images (false colour) and summary maps of the datacubes of the multipoint scan, updated as the FOVs are captured
+
+    def __init__(self, multipointController, main=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.multipointController = multipointController
+        self.configuration = None # of the datacube shown
+        self.add_components()
+        self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+
+    def add_components(self):
+        self.checkbox_enable = QCheckBox('Assemble datacube')
+        self.checkbox_enable.setChecked(self.multipointController.datacube_enabled)
+        self.checkbox_enable.setToolTip('extract the spectrum of every FOV of multipoint scans into a datacube (datacube_<configuration>.npy)')
+
+        self.dropdown_map = QComboBox()
+        self.dropdown_map.addItems(['false colour','total','peak','centroid'])
+
+        self.entry_plane = QSpinBox()
+        self.entry_plane.setMinimum(0)
+        self.entry_plane.setMaximum(0)
+
+        self.label_status = QLabel()
+
+        # interpret image data as row-major instead of col-major
+        pg.setConfigOptions(imageAxisOrder='row-major')
+        self.graphics = pg.GraphicsLayoutWidget()
+        self.view = self.graphics.addViewBox(invertY=True)
+        self.view.setAspectLocked(True)
+        self.img = pg.ImageItem()
+        self.view.addItem(self.img)
+
+        grid_line0 = QGridLayout()
+        grid_line0.addWidget(self.checkbox_enable, 0,0)
+        grid_line0.addWidget(QLabel('Map'), 0,1)
+        grid_line0.addWidget(self.dropdown_map, 0,2)
+        grid_line0.addWidget(QLabel('Z'), 0,3)
+        grid_line0.addWidget(self.entry_plane, 0,4)
+        grid_line0.addWidget(self.label_status, 0,5)
+
+        self.grid = QGridLayout()
+        self.grid.addLayout(grid_line0,0,0)
+        self.grid.addWidget(self.graphics,1,0)
+        self.setLayout(self.grid)
+
+        self.checkbox_enable.toggled.connect(self.multipointController.set_datacube_enabled)
+        self.dropdown_map.currentTextChanged.connect(self.refresh)
+        self.entry_plane.valueChanged.connect(self.refresh)
+        self.multipointController.datacube_updated.connect(self.update_datacube)
+
+    def update_datacube(self, configuration, i, j, k):
+        self.configuration = configuration
+        datacube = self.multipointController.datacubes.get(configuration)
+        if datacube is None:
+            return
+        self.entry_plane.setMaximum(datacube.shape[2] - 1)
+        self.label_status.setText(str(configuration) + ': FOV (' + str(i) + ', ' + str(j) + ', ' + str(k) + ')')
+        if k == self.entry_plane.value():
+            self.refresh()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+
+    def refresh(self):
+        datacube = self.multipointController.datacubes.get(self.configuration)
+        if datacube is None or not self.isVisible():
+            return
+        name = self.dropdown_map.currentText()
+        k = min(self.entry_plane.value(),datacube.shape[2] - 1)
+        if name == 'false colour':
+            self.img.setImage(datacube.get_false_colour_image(k),autoLevels=False,levels=(0,255))
+        else:
+            self.img.setImage(datacube.get_scaled_map(name,k),autoLevels=False,levels=(0,255))
+
 
 class TrackingControllerWidget(QFrame):
     def __init__(self, trackingController, configurationManager, show_configurations = True, main=None, *args, **kwargs):
@@ -1414,12 +1841,28 @@ class PlateReaderAcquisitionWidget(QFrame):
             self.list_columns.addItems([str(i+1)])
         self.list_columns.setSelectionMode(QAbstractItemView.MultiSelection) # ref: https://doc.qt.io/qt-5/qabstractitemview.html#SelectionMode-enum
 
+        self.dropdown_plateFormat = QComboBox()
+        self.dropdown_plateFormat.addItems(list(WELLPLATE_FORMATS.keys()))
+        self.lineEdit_wells = QLineEdit()
+        self.lineEdit_wells.setPlaceholderText('e.g. A1-H6, B7 (overrides the selected columns)')
+        self.btn_estimateTime = QPushButton('Estimate Time')
+        self.label_estimatedTime = QLabel()
+
         self.list_configurations = QListWidget()
         for microscope_configuration in self.configurationManager.configurations:
             self.list_configurations.addItems([microscope_configuration.name])
         self.list_configurations.setSelectionMode(QAbstractItemView.MultiSelection) # ref: https://doc.qt.io/qt-5/qabstractitemview.html#SelectionMode-enum
 
         self.checkbox_withAutofocus = QCheckBox('With AF')
+        self.checkbox_pipelined = QCheckBox('Pipelined')
+        self.checkbox_pipelined.setToolTip('overlap stage moves with saving, skip homing when the position is known')
+        self.checkbox_wellStatistics = QCheckBox('Well Statistics')
+        self.checkbox_wellStatistics.setToolTip('save per-well mean/median/background-subtracted totals to well_statistics.csv')
+        self.checkbox_saveImages = QCheckBox('Save Images')
+        self.checkbox_saveImages.setChecked(True)
+        self.btn_spectrumMask = QPushButton('Spectrum Mask')
+        self.btn_spectrumMask.setCheckable(True)
+        self.btn_spectrumMask.setToolTip('also extract a spectrum per well with the weights of a .npy mask (of the shape of the cropped images) into spectra.npy')
         self.btn_startAcquisition = QPushButton('Start Acquisition')
         self.btn_startAcquisition.setCheckable(True)
         self.btn_startAcquisition.setChecked(False)
@@ -1446,6 +1889,13 @@ class PlateReaderAcquisitionWidget(QFrame):
         grid_line2.addWidget(tmp)
         grid_line2.addWidget(self.list_columns, 0,1)
 
+        grid_line2_wells = QGridLayout()
+        tmp = QLabel('Wells')
+        tmp.setFixedWidth(90)
+        grid_line2_wells.addWidget(tmp)
+        grid_line2_wells.addWidget(self.dropdown_plateFormat,0,1)
+        grid_line2_wells.addWidget(self.lineEdit_wells,0,2)
+
         grid_line3 = QHBoxLayout()
         tmp = QLabel('Configurations')
         tmp.setFixedWidth(90)
@@ -1453,15 +1903,25 @@ class PlateReaderAcquisitionWidget(QFrame):
         grid_line3.addWidget(self.list_configurations)
         # grid_line3.addWidget(self.checkbox_withAutofocus)
 
+        grid_line4 = QHBoxLayout()
+        grid_line4.addWidget(self.checkbox_pipelined)
+        grid_line4.addWidget(self.checkbox_wellStatistics)
+        grid_line4.addWidget(self.checkbox_saveImages)
+        grid_line4.addWidget(self.btn_spectrumMask)
+        grid_line4.addWidget(self.btn_estimateTime)
+        grid_line4.addWidget(self.label_estimatedTime)
+
         self.grid = QGridLayout()
         self.grid.addLayout(grid_line0,0,0)
         self.grid.addLayout(grid_line1,1,0)
         self.grid.addLayout(grid_line2,2,0)
+        self.grid.addLayout(grid_line2_wells,3,0)
         if show_configurations:
-            self.grid.addLayout(grid_line3,3,0)
+            self.grid.addLayout(grid_line3,4,0)
         else:
             self.list_configurations.setCurrentRow(0) # select the first configuration
-        self.grid.addWidget(self.btn_startAcquisition,4,0)
+        self.grid.addLayout(grid_line4,5,0)
+        self.grid.addWidget(self.btn_startAcquisition,6,0)
         self.setLayout(self.grid)
 
         # add and display a timer - to be implemented
@@ -1469,7 +1929,13 @@ class PlateReaderAcquisitionWidget(QFrame):
 
         # connections
         self.checkbox_withAutofocus.stateChanged.connect(self.plateReadingController.set_af_flag)
+        self.checkbox_pipelined.stateChanged.connect(self.plateReadingController.set_pipelined_acquisition)
+        self.checkbox_wellStatistics.stateChanged.connect(self.plateReadingController.set_well_statistics_flag)
+        self.checkbox_saveImages.stateChanged.connect(self.plateReadingController.set_save_raw_images_flag)
+        self.btn_spectrumMask.clicked.connect(self.set_spectrum_mask)
         self.btn_setSavingDir.clicked.connect(self.set_saving_dir)
+        self.dropdown_plateFormat.currentTextChanged.connect(self.plateReadingController.set_plate_format)
+        self.btn_estimateTime.clicked.connect(self.estimate_time)
         self.btn_startAcquisition.clicked.connect(self.toggle_acquisition)
         self.plateReadingController.acquisitionFinished.connect(self.acquisition_is_finished)
 
@@ -1490,15 +1956,50 @@ class PlateReaderAcquisitionWidget(QFrame):
         if pressed:
             # @@@ to do: add a widgetManger to enable and disable widget 
             # @@@ to do: emit signal to widgetManager to disable other widgets
+            # the wells are checked before the experiment folder is created
+            if self.set_selected_wells() == False:
+                self.btn_startAcquisition.setChecked(False)
+                return
             self.setEnabled_all(False)
             self.plateReadingController.start_new_experiment(self.lineEdit_experimentID.text())
-            self.plateReadingController.set_selected_configurations((item.text() for item in self.list_configurations.selectedItems()))
-            self.plateReadingController.set_selected_columns(list(map(int,[item.text() for item in self.list_columns.selectedItems()])))
             self.plateReadingController.run_acquisition()
         else:
             self.plateReadingController.stop_acquisition() # to implement
             pass
 
+    def set_selected_wells(self):
+        self.plateReadingController.set_selected_configurations((item.text() for item in self.list_configurations.selectedItems()))
+        if self.lineEdit_wells.text().strip() != '':
+            try:
+                self.plateReadingController.set_selected_wells(self.lineEdit_wells.text())
+            except ValueError as e:
+                msg = QMessageBox()
+                msg.setText(str(e))
+                msg.exec_()
+                return False
+        else:
+            self.plateReadingController.set_selected_columns(list(map(int,[item.text() for item in self.list_columns.selectedItems()])))
+        return True
+
+    def set_spectrum_mask(self,pressed):
+        if not pressed:
+            self.plateReadingController.load_spectrum_mask(None)
+            return
+        filename, _ = QFileDialog.getOpenFileName(self,'Load spectrum mask','','NumPy (*.npy)')
+        if filename == '':
+            self.btn_spectrumMask.setChecked(False)
+            return
+        try:
+            self.plateReadingController.load_spectrum_mask(filename)
+        except (OSError,ValueError) as e:
+            self.btn_spectrumMask.setChecked(False)
+            QMessageBox.warning(self,'Spectrum Mask',str(e))
+
+    def estimate_time(self):
+        if self.set_selected_wells():
+            t = self.plateReadingController.get_estimated_acquisition_time()
+            self.label_estimatedTime.setText(str(int(t//60)) + ' min ' + str(round(t%60)) + ' s per time point')
+
     def acquisition_is_finished(self):
         self.btn_startAcquisition.setChecked(False)
         self.setEnabled_all(True)
@@ -1508,8 +2009,14 @@ class PlateReaderAcquisitionWidget(QFrame):
         self.lineEdit_savingDir.setEnabled(enabled)
         self.lineEdit_experimentID.setEnabled(enabled)
         self.list_columns.setEnabled(enabled)
+        self.dropdown_plateFormat.setEnabled(enabled)
+        self.lineEdit_wells.setEnabled(enabled)
+        self.btn_estimateTime.setEnabled(enabled)
         self.list_configurations.setEnabled(enabled)
         self.checkbox_withAutofocus.setEnabled(enabled)
+        self.checkbox_pipelined.setEnabled(enabled)
+        self.checkbox_wellStatistics.setEnabled(enabled)
+        self.checkbox_saveImages.setEnabled(enabled)
         if exclude_btn_startAcquisition is not True:
             self.btn_startAcquisition.setEnabled(enabled)
 
@@ -1599,4 +2106,72 @@ class SpectrumDisplayWindow(QMainWindow):
         layout = QGridLayout()
         layout.addWidget(self.plotWidget, 0, 0) 
         self.centralWidget.setLayout(layout)
-        self.setCentralWidget(self.centralWidget)
\ No newline at end of file
+        self.setCentralWidget(self.centralWidget)
+
+class InstrumentationWidget(QFrame):
+    # live summary of the timing spans and counters recorded through control/instrumentation.py
+
+    COLUMNS = ['name','count','mean (ms)','p50 (ms)','p99 (ms)','max (ms)','total (s)']
+
+    def __init__(self, refresh_interval_ms=1000, main=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_components()
+        self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+        self.timer_refresh = QTimer()
+        self.timer_refresh.setInterval(refresh_interval_ms)
+        self.timer_refresh.timeout.connect(self.refresh)
+        self.timer_refresh.start()
+
+    def add_components(self):
+        self.checkbox_enable = QCheckBox('Record timing')
+        self.checkbox_enable.setChecked(instrumentation.is_enabled())
+        self.btn_reset = QPushButton('Reset')
+        self.btn_save_trace = QPushButton('Save Trace')
+        self.label_counters = QLabel()
+        self.label_counters.setWordWrap(True)
+        self.table = QTableWidget(0,len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0,QHeaderView.Stretch)
+
+        grid_line0 = QHBoxLayout()
+        grid_line0.addWidget(self.checkbox_enable)
+        grid_line0.addWidget(self.btn_reset)
+        grid_line0.addWidget(self.btn_save_trace)
+
+        self.grid = QVBoxLayout()
+        self.grid.addLayout(grid_line0)
+        self.grid.addWidget(self.table)
+        self.grid.addWidget(self.label_counters)
+        self.setLayout(self.grid)
+
+        # connections
+        self.checkbox_enable.stateChanged.connect(lambda state: instrumentation.set_enabled(state == Qt.Checked))
+        self.btn_reset.clicked.connect(self.reset)
+        self.btn_save_trace.clicked.connect(self.save_trace)
+
+    def refresh(self):
+        # nothing new is recorded while disabled
+        if not self.isVisible() or not instrumentation.is_enabled():
+            return
+        summary = instrumentation.get_summary()
+        self.table.setRowCount(len(summary))
+        for row, (name, stats) in enumerate(summary.items()):
+            values = [name,str(stats['count']),'{:.2f}'.format(stats['mean_ms']),'{:.2f}'.format(stats['p50_ms']),
+                      '{:.2f}'.format(stats['p99_ms']),'{:.2f}'.format(stats['max_ms']),'{:.2f}'.format(stats['total_ms']/1000)]
+            for column, value in enumerate(values):
+                self.table.setItem(row,column,QTableWidgetItem(value))
+        counters = instrumentation.get_counters()
+        self.label_counters.setText(', '.join(name + ': ' + str(value) for name, value in sorted(counters.items())))
+
+    def reset(self):
+        instrumentation.reset()
+        self.table.setRowCount(0)
+        self.label_counters.setText('')
+
+    def save_trace(self):
+        dialog = QFileDialog()
+        filename, _ = dialog.getSaveFileName(None,'Save Timing Trace','timing_trace.json','Chrome trace (*.json)')
+        if filename:
+            instrumentation.export_chrome_trace(filename)
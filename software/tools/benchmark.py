@@ -0,0 +1,613 @@
+# headless end-to-end benchmark of the acquisition hot paths, run against the simulated cameras and microcontroller
+# benchmarks: live (StreamHandler), recording (StreamHandler + ImageSaver), spectrum (SpectrumExtractor), multipoint (MultiPointController),
+#             autofocus (AutoFocusController), tracking (Tracker_Image), platereader (PlateReadingController)
+# every benchmark reports throughput, latency percentiles, cpu and memory, plus the instrumentation spans recorded meanwhile; the results are written as json so that runs can be compared
+# usage: python3 tools/benchmark.py [--benchmarks live,multipoint] [--duration 5] [--nx 3 --ny 3 --nz 1] [--emulator] [--output benchmark.json]
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import traceback
+import subprocess
+import contextlib
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on windows
+
+# the benchmark runs without a display unless a platform is given explicitly
+os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+os.environ['QT_API'] = 'pyqt5'
+
+SOFTWARE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,SOFTWARE_DIR)
+
+import numpy as np
+import cv2
+import qtpy
+from qtpy.QtCore import *
+from qtpy.QtWidgets import *
+
+import control.core as core
+import control.instrumentation as instrumentation
+import control.core_platereader as core_platereader
+import control.camera as camera
+import control.camera_TIS as camera_tis
+import control.microcontroller as microcontroller
+import control.microcontroller2 as microcontroller2
+from control._def import *
+
+BENCHMARKS = ['live','recording','spectrum','multipoint','autofocus','tracking','platereader']
+
+# written to the temporary folder so that the benchmark does not depend on (or modify) the configurations in the home folder
+CONFIGURATIONS = {
+    'Widefield':[
+        {'ID':'1','Name':'View Sample','ExposureTime':'10','AnalogGain':'0','IlluminationSource':'0','IlluminationIntensity':'50','DAC_LED':'0','DAC_Laser':'0'},
+        {'ID':'2','Name':'View Sample + Laser Spot','ExposureTime':'10','AnalogGain':'0','IlluminationSource':'0','IlluminationIntensity':'50','DAC_LED':'0','DAC_Laser':'0'}
+    ],
+    'Spectrum':[
+        {'ID':'1','Name':'Spectrum','ExposureTime':'20','AnalogGain':'0','IlluminationSource':'0','IlluminationIntensity':'50','DAC_LED':'0','DAC_Laser':'0'}
+    ]
+}
+
+def latency_summary(samples_s):
+    # samples in seconds, summary in ms
+    if len(samples_s) == 0:
+        return {'n':0}
+    samples_ms = np.asarray(samples_s,dtype=np.float64)*1000
+    p50, p90, p99 = np.percentile(samples_ms,[50,90,99])
+    return {'n':len(samples_ms),'mean_ms':float(samples_ms.mean()),'p50_ms':float(p50),'p90_ms':float(p90),'p99_ms':float(p99),'max_ms':float(samples_ms.max())}
+
+def get_rss_mb():
+    # current resident set size, from /proc where available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1e6
+    except (OSError,ValueError,AttributeError):
+        return None
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on macos
+    return peak/1e6 if sys.platform == 'darwin' else peak/1e3
+
+class ResourceMonitor(object):
+    # wall time, process cpu time (all threads) and memory over a block of code; rss is sampled in the background
+    def __init__(self,sampling_interval_s=0.05):
+        self.sampling_interval_s = sampling_interval_s
+        self.rss_samples = []
+        self.terminate = False
+
+    def __enter__(self):
+        self.rss_start_mb = get_rss_mb()
+        self.t_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.thread = threading.Thread(target=self._sample,daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.wall_s = time.perf_counter() - self.t_start
+        self.cpu_s = time.process_time() - self.cpu_start
+        self.terminate = True
+        self.thread.join()
+        return False
+
+    def _sample(self):
+        while not self.terminate:
+            rss = get_rss_mb()
+            if rss is not None:
+                self.rss_samples.append(rss)
+            time.sleep(self.sampling_interval_s)
+
+    def summary(self):
+        return {
+            'wall_s':self.wall_s,
+            'cpu_s':self.cpu_s,
+            'cpu_percent':100*self.cpu_s/self.wall_s if self.wall_s > 0 else 0,
+            'rss_start_mb':self.rss_start_mb,
+            'rss_max_mb':max(self.rss_samples) if self.rss_samples else None,
+            'rss_growth_mb':(self.rss_samples[-1] - self.rss_start_mb) if self.rss_samples and self.rss_start_mb is not None else None,
+            'peak_rss_mb':get_peak_rss_mb()
+        }
+
+def process_events_for(duration_s):
+    t_end = time.time() + duration_s
+    while time.time() < t_end:
+        QApplication.processEvents()
+        time.sleep(0.001)
+
+def wait_until(condition,timeout_s):
+    # keeps the main thread event loop running, the controllers' QTimers and queued signals depend on it
+    t_end = time.time() + timeout_s
+    while not condition():
+        if time.time() > t_end:
+            return False
+        QApplication.processEvents()
+        time.sleep(0.001)
+    return True
+
+def timed(function,samples):
+    # wraps a callable so that the duration of every call is appended to samples
+    def wrapper(*args,**kwargs):
+        t0 = time.perf_counter()
+        result = function(*args,**kwargs)
+        samples.append(time.perf_counter() - t0)
+        return result
+    return wrapper
+
+def write_configurations(path):
+    filenames = {}
+    for channel, modes in CONFIGURATIONS.items():
+        lines = ['<?xml version=\'1.0\' encoding=\'utf-8\'?>','<modes>']
+        for mode in modes:
+            attributes = dict(mode,CameraSN='',Channel=channel)
+            lines.append('  <mode ' + ' '.join(key + '="' + value + '"' for key, value in attributes.items()) + '/>')
+        lines.append('</modes>')
+        filenames[channel] = os.path.join(path,'configurations_' + channel + '.xml')
+        with open(filenames[channel],'w') as f:
+            f.write('\n'.join(lines))
+    return filenames
+
+class Rig(object):
+    # the objects gui_spectrometer.py creates, without the widgets
+    def __init__(self,args,path):
+        self.emulator = None
+        if args.emulator:
+            import control.microcontroller_emulator as microcontroller_emulator
+            self.emulator = microcontroller_emulator.MicrocontrollerEmulator()
+            self.emulator.start()
+            self.microcontroller = microcontroller.Microcontroller(port=self.emulator.port)
+        else:
+            self.microcontroller = microcontroller.Microcontroller_Simulation()
+        self.microcontroller2 = microcontroller2.Microcontroller2_Simulation()
+        self.microcontroller.configure_actuators()
+
+        self.camera_spectrometer = camera_tis.Camera_Simulation(sn='benchmark')
+        self.camera_widefield = camera.Camera_Simulation(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+
+        filenames = write_configurations(path)
+        self.configurationManagers = {channel:core.ConfigurationManager(filenames[channel],channel=channel) for channel in filenames}
+        self.liveControllers = {
+            'Widefield':core.LiveController(self.camera_widefield,self.microcontroller,self.microcontroller2,self.configurationManagers['Widefield']),
+            'Spectrum':core.LiveController(self.camera_spectrometer,self.microcontroller,self.microcontroller2,self.configurationManagers['Spectrum'])
+        }
+        self.cameras = {'Widefield':self.camera_widefield,'Spectrum':self.camera_spectrometer}
+        self.streamHandlers = {'Widefield':core.StreamHandler(),'Spectrum':core.StreamHandler()}
+
+        self.navigationController = core.NavigationController(self.microcontroller)
+        position_source = lambda: (self.navigationController.x_pos_mm,self.navigationController.y_pos_mm,self.navigationController.z_pos_mm)
+        self.camera_widefield.set_position_source(position_source)
+        self.camera_spectrometer.set_position_source(position_source)
+        self.autofocusController = core.AutoFocusController(self.camera_widefield,self.navigationController,self.liveControllers['Widefield'])
+        self.multipointController = core.MultiPointController(self.cameras,self.navigationController,self.liveControllers,self.autofocusController,self.configurationManagers)
+        # stands in for LiveControlWidget.set_microscope_mode
+        self.multipointController.signal_current_configuration_widefield.connect(self.liveControllers['Widefield'].set_microscope_mode)
+        self.multipointController.signal_current_configuration_spectrum.connect(self.liveControllers['Spectrum'].set_microscope_mode)
+
+        for channel in self.cameras:
+            self.cameras[channel].open()
+            self.cameras[channel].set_software_triggered_acquisition()
+            self.cameras[channel].set_callback(self.streamHandlers[channel].on_new_frame)
+            self.cameras[channel].enable_callback()
+            self.liveControllers[channel].set_microscope_mode(self.configurationManagers[channel].configurations[0])
+
+    def close(self):
+        for channel in self.cameras:
+            self.liveControllers[channel].stop_live()
+            self.cameras[channel].close()
+        self.microcontroller.close()
+        if self.emulator is not None:
+            self.emulator.close()
+
+def benchmark_live(args,path):
+    # continuous acquisition of the widefield camera through StreamHandler.on_new_frame
+    cam = camera.Camera_Simulation(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+    streamHandler = core.StreamHandler()
+    streamHandler.set_display_fps(args.display_fps)
+    handler_latency = []
+    frame_age = []
+    displayed = [0]
+    def on_new_frame(c):
+        frame_age.append(time.time() - c.timestamp)
+        t0 = time.perf_counter()
+        streamHandler.on_new_frame(c)
+        handler_latency.append(time.perf_counter() - t0)
+    streamHandler.image_to_display.connect(lambda image: displayed.__setitem__(0,displayed[0]+1))
+    cam.open()
+    cam.set_callback(on_new_frame)
+    cam.enable_callback()
+    cam.set_exposure_time(args.exposure_ms)
+    cam.set_continuous_acquisition()
+    with ResourceMonitor() as monitor:
+        cam.start_streaming()
+        process_events_for(args.duration)
+        cam.stop_streaming()
+    statistics = cam.get_statistics()
+    cam.close()
+    return {
+        'frames_generated':statistics['frames_generated'],
+        'frames_handled':len(handler_latency),
+        'frames_dropped':statistics['frames_dropped'],
+        'frames_displayed':displayed[0],
+        'fps':len(handler_latency)/monitor.wall_s,
+        'camera_fps':statistics['fps'],
+        'handler_latency':latency_summary(handler_latency),
+        'frame_age_at_handler':latency_summary(frame_age),
+        'resources':monitor.summary()
+    }
+
+def benchmark_recording(args,path):
+    # live streaming with every frame recorded through ImageSaver
+    cam = camera.Camera_Simulation(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+    streamHandler = core.StreamHandler()
+    streamHandler.set_display_fps(args.display_fps)
+    streamHandler.set_save_fps(args.save_fps)
+    imageSaver = core.ImageSaver()
+    imageSaver.set_base_path(path)
+    imageSaver.start_new_experiment('recording')
+    enqueue_latency = []
+    queue_depth = []
+    emitted = [0]
+    def enqueue(image,frame_ID,timestamp):
+        emitted[0] = emitted[0] + 1
+        queue_depth.append(imageSaver.queue.qsize())
+        t0 = time.perf_counter()
+        imageSaver.enqueue(image,frame_ID,timestamp)
+        enqueue_latency.append(time.perf_counter() - t0)
+    streamHandler.packet_image_to_write.connect(enqueue)
+    cam.open()
+    cam.set_callback(streamHandler.on_new_frame)
+    cam.enable_callback()
+    cam.set_exposure_time(args.exposure_ms)
+    cam.set_continuous_acquisition()
+    with ResourceMonitor() as monitor:
+        streamHandler.start_recording()
+        cam.start_streaming()
+        process_events_for(args.duration)
+        cam.stop_streaming()
+        streamHandler.stop_recording()
+        # includes draining the queue
+        QApplication.processEvents()
+        imageSaver.close()
+    cam.close()
+    experiment_path = os.path.join(path,imageSaver.experiment_ID)
+    bytes_written = sum(os.path.getsize(os.path.join(root,f)) for root, dirs, files in os.walk(experiment_path) for f in files)
+    return {
+        'frames_emitted':emitted[0],
+        'frames_written':imageSaver.counter,
+        'frames_discarded':emitted[0] - imageSaver.counter,
+        'fps_written':imageSaver.counter/monitor.wall_s,
+        'write_MB_per_s':bytes_written/1e6/monitor.wall_s,
+        'image_format':imageSaver.image_format,
+        'enqueue_latency':latency_summary(enqueue_latency),
+        'queue_depth_max':max(queue_depth) if queue_depth else 0,
+        'resources':monitor.summary()
+    }
+
+def benchmark_spectrum(args,path):
+    # SpectrumExtractor on frames of the simulated spectrometer camera
+    cam = camera_tis.Camera_Simulation(sn='benchmark')
+    cam.open()
+    cam.set_software_triggered_acquisition()
+    frames = []
+    for i in range(8):
+        cam.send_trigger()
+        frame = cam.read_frame()
+        if frame is None:
+            raise RuntimeError('no frame from the simulated spectrometer camera')
+        frames.append(np.squeeze(frame))
+    cam.close()
+    spectrumExtractor = core.SpectrumExtractor()
+    if spectrumExtractor.mask.shape != frames[0].shape:
+        spectrumExtractor.update_ROI(np.ones(frames[0].shape,np.uint8))
+    spectra = [0]
+    spectrumExtractor.packet_spectrum.connect(lambda x, spectrum: spectra.__setitem__(0,spectra[0]+1))
+    latency = []
+    with ResourceMonitor() as monitor:
+        for i in range(args.n_frames):
+            t0 = time.perf_counter()
+            spectrumExtractor.extract_and_display_the_spectrum(frames[i%len(frames)])
+            latency.append(time.perf_counter() - t0)
+    return {
+        'frame_shape':list(frames[0].shape),
+        'spectra':spectra[0],
+        'spectra_per_s':len(latency)/monitor.wall_s,
+        'latency':latency_summary(latency),
+        'resources':monitor.summary()
+    }
+
+def benchmark_multipoint(args,path):
+    rig = Rig(args,path)
+    try:
+        mpc = rig.multipointController
+        mpc.set_NX(args.nx)
+        mpc.set_NY(args.ny)
+        mpc.set_NZ(args.nz)
+        mpc.set_deltaX(args.dx_mm)
+        mpc.set_deltaY(args.dy_mm)
+        mpc.set_deltaZ(args.dz_um)
+        mpc.set_N_spectrum(args.n_spectrum)
+        mpc.set_af_flag(args.multipoint_af)
+        mpc.set_base_path(path)
+        mpc.start_new_experiment('multipoint')
+        mpc.set_selected_configurations(args.configurations.split(','))
+        # trigger-to-frame latency of each capture, and the interval between consecutive fields of view
+        triggers = {channel:[] for channel in rig.cameras}
+        reads = {channel:[] for channel in rig.cameras}
+        for channel, cam in rig.cameras.items():
+            cam.send_trigger = timed(cam.send_trigger,triggers[channel])
+            cam.read_frame = timed(cam.read_frame,reads[channel])
+        fov_timestamps = []
+        first_configuration = mpc.selected_configurations[0]
+        mpc.signal_current_configuration_widefield.connect(lambda c: fov_timestamps.append(time.perf_counter()) if c is first_configuration else None)
+        mpc.signal_current_configuration_spectrum.connect(lambda c: fov_timestamps.append(time.perf_counter()) if c is first_configuration else None)
+        finished = [False]
+        mpc.acquisitionFinished.connect(lambda: finished.__setitem__(0,True))
+        with ResourceMonitor() as monitor:
+            mpc.run_acquisition()
+            completed = wait_until(lambda: finished[0],args.timeout)
+        if not completed:
+            mpc.request_abort_aquisition()
+            wait_until(lambda: finished[0],10)
+        n_fov = args.nx*args.ny*args.nz
+        images = sum(len(files) for root, dirs, files in os.walk(os.path.join(path,mpc.experiment_ID,'0')))
+        return {
+            'completed':completed,
+            'grid':[args.nx,args.ny,args.nz],
+            'configurations':[c.name for c in mpc.selected_configurations],
+            'images_written':images,
+            'time_per_fov_s':monitor.wall_s/n_fov,
+            'fov_per_s':n_fov/monitor.wall_s,
+            'fov_interval':latency_summary(np.diff(fov_timestamps)),
+            'send_trigger':{channel:latency_summary(samples) for channel, samples in triggers.items() if samples},
+            'read_frame':{channel:latency_summary(samples) for channel, samples in reads.items() if samples},
+            'resources':monitor.summary()
+        }
+    finally:
+        rig.close()
+
+def benchmark_autofocus(args,path):
+    rig = Rig(args,path)
+    try:
+        afc = rig.autofocusController
+        afc.set_N(args.af_n)
+        afc.set_deltaZ(args.af_dz_um)
+        latency = []
+        z_mm = []
+        with ResourceMonitor() as monitor:
+            for i in range(args.af_repeats):
+                t0 = time.perf_counter()
+                afc.autofocus()
+                if not wait_until(lambda: not afc.autofocus_in_progress,args.timeout):
+                    break
+                latency.append(time.perf_counter() - t0)
+                process_events_for(0.05) # position update
+                z_mm.append(rig.navigationController.z_pos_mm)
+        return {
+            'completed':len(latency) == args.af_repeats,
+            'N':args.af_n,
+            'deltaZ_um':args.af_dz_um,
+            'latency':latency_summary(latency),
+            'time_per_image_s':float(np.mean(latency))/args.af_n if latency else None,
+            'z_mm':z_mm,
+            'resources':monitor.summary()
+        }
+    finally:
+        rig.close()
+
+def benchmark_tracking(args,path):
+    # Tracker_Image on a bright disk that moves along a circle
+    import control.tracking as tracking
+    tracker = tracking.Tracker_Image()
+    tracker.update_init_method('roi')
+    width, height, radius = 640, 480, 20
+    tracker.set_roi_bbox([width//2 + 100 - 2*radius,height//2 - 2*radius,4*radius,4*radius])
+    rng = np.random.default_rng(0)
+    background = rng.normal(40,5,(height,width)).clip(0,255).astype(np.uint8)
+    latency = []
+    errors = []
+    with ResourceMonitor() as monitor:
+        for i in range(args.n_frames):
+            angle = 2*np.pi*i/200
+            center = (int(width//2 + 100*np.cos(angle)),int(height//2 + 100*np.sin(angle)))
+            image = background.copy()
+            cv2.circle(image,center,radius,220,-1)
+            thresh_image = (image > 128).astype(np.uint8)*255
+            t0 = time.perf_counter()
+            found, centroid, rect_pts = tracker.track(image,thresh_image,is_first_frame=(i==0))
+            latency.append(time.perf_counter() - t0)
+            if found and centroid is not None:
+                errors.append(float(np.hypot(centroid[0]-center[0],centroid[1]-center[1])))
+    return {
+        'tracker':tracker.tracker_type,
+        'frames':len(latency),
+        'frames_tracked':len(errors),
+        'fps':len(latency)/monitor.wall_s,
+        'latency':latency_summary(latency),
+        'position_error_px_mean':float(np.mean(errors)) if errors else None,
+        'position_error_px_max':float(np.max(errors)) if errors else None,
+        'resources':monitor.summary()
+    }
+
+def benchmark_platereader(args,path):
+    # objects as created in gui_platereader.py
+    if args.emulator:
+        import control.microcontroller_emulator as microcontroller_emulator
+        emulator = microcontroller_emulator.MicrocontrollerEmulator()
+        emulator.start()
+        mcu = microcontroller.Microcontroller(port=emulator.port)
+    else:
+        emulator = None
+        mcu = microcontroller.Microcontroller_Simulation()
+    cam = camera.Camera_Simulation(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+    try:
+        mcu.configure_actuators()
+        configurationManager = core.ConfigurationManager(write_configurations(path)['Widefield'],channel='Widefield')
+        streamHandler = core.StreamHandler()
+        liveController = core.LiveController(cam,mcu,microcontroller2.Microcontroller2_Simulation(),configurationManager)
+        navigationController = core.NavigationController(mcu)
+        plateReaderNavigationController = core.PlateReaderNavigationController(mcu)
+        autofocusController = core.AutoFocusController(cam,navigationController,liveController)
+        plateReadingController = core_platereader.PlateReadingController(cam,plateReaderNavigationController,liveController,autofocusController,configurationManager)
+        plateReadingController.signal_current_configuration.connect(liveController.set_microscope_mode)
+        cam.set_position_source(lambda: (plateReaderNavigationController.x_pos_mm,plateReaderNavigationController.y_pos_mm,plateReaderNavigationController.z_pos_mm))
+        cam.open()
+        cam.set_software_triggered_acquisition()
+        cam.set_callback(streamHandler.on_new_frame)
+        cam.enable_callback()
+        liveController.set_microscope_mode(configurationManager.configurations[0])
+
+        plateReadingController.set_selected_wells(args.wells)
+        plateReadingController.set_selected_configurations([configurationManager.configurations[0].name])
+        plateReadingController.set_pipelined_acquisition(args.pipelined)
+        plateReadingController.set_base_path(path)
+        plateReadingController.start_new_experiment('platereader')
+        n_wells = len(plateReadingController.plateScheduler.wells)
+        estimated_s = plateReadingController.get_estimated_acquisition_time()
+        well_timestamps = []
+        plateReaderNavigationController.signal_current_well.connect(lambda well: well_timestamps.append((well,time.perf_counter())))
+        finished = [False]
+        plateReadingController.acquisitionFinished.connect(lambda: finished.__setitem__(0,True))
+        with ResourceMonitor() as monitor:
+            plateReadingController.run_acquisition()
+            completed = wait_until(lambda: finished[0],args.timeout)
+        if not completed:
+            plateReadingController.stop_acquisition()
+            wait_until(lambda: finished[0],10)
+        plateReadingController.imageSaver.close()
+        plateReadingController.wellStatisticsCalculator.close()
+        # time between arriving at consecutive wells
+        arrivals = [t for i, (well,t) in enumerate(well_timestamps) if i == 0 or well != well_timestamps[i-1][0]]
+        return {
+            'completed':completed,
+            'wells':n_wells,
+            'pipelined':args.pipelined,
+            'time_per_well_s':monitor.wall_s/max(n_wells,1),
+            'estimated_time_s':estimated_s,
+            'well_interval':latency_summary(np.diff(arrivals)),
+            'resources':monitor.summary()
+        }
+    finally:
+        cam.close()
+        mcu.close()
+        if emulator is not None:
+            emulator.close()
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=SOFTWARE_DIR,stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def print_summary(name,result):
+    if 'error' in result:
+        print(name + ': failed - ' + result['error'])
+        return
+    items = []
+    for key, value in result.items():
+        if key == 'resources':
+            items.append('cpu ' + str(round(value['cpu_percent'])) + '%')
+            if value['rss_max_mb'] is not None:
+                items.append('rss ' + str(round(value['rss_max_mb'])) + ' MB')
+        elif isinstance(value,dict) and 'p50_ms' in value:
+            items.append(key + ' p50/p99 ' + str(round(value['p50_ms'],2)) + '/' + str(round(value['p99_ms'],2)) + ' ms')
+        elif isinstance(value,float):
+            items.append(key + ' ' + str(round(value,3)))
+        elif isinstance(value,(int,bool)):
+            items.append(key + ' ' + str(value))
+    print(name + ': ' + ', '.join(items))
+
+def main():
+    parser = argparse.ArgumentParser(description='headless benchmark of the acquisition hot paths against the simulated hardware')
+    parser.add_argument('--benchmarks',default=','.join(BENCHMARKS),help='comma separated subset of ' + ','.join(BENCHMARKS))
+    parser.add_argument('--duration',type=float,default=5,help='duration of the streaming benchmarks in s')
+    parser.add_argument('--exposure_ms',type=float,default=10)
+    parser.add_argument('--display_fps',type=float,default=30)
+    parser.add_argument('--save_fps',type=float,default=1000)
+    parser.add_argument('--n_frames',type=int,default=500,help='frames for the spectrum extraction and tracking benchmarks')
+    parser.add_argument('--nx',type=int,default=3)
+    parser.add_argument('--ny',type=int,default=3)
+    parser.add_argument('--nz',type=int,default=1)
+    parser.add_argument('--dx_mm',type=float,default=0.9)
+    parser.add_argument('--dy_mm',type=float,default=0.9)
+    parser.add_argument('--dz_um',type=float,default=1.5)
+    parser.add_argument('--n_spectrum',type=int,default=1)
+    parser.add_argument('--configurations',default='View Sample,Spectrum',help='comma separated configuration names for the multipoint benchmark')
+    parser.add_argument('--multipoint_af',action='store_true',help='autofocus during the multipoint acquisition')
+    parser.add_argument('--af_n',type=int,default=10)
+    parser.add_argument('--af_dz_um',type=float,default=1.5)
+    parser.add_argument('--af_repeats',type=int,default=3)
+    parser.add_argument('--wells',default='A1-A6')
+    parser.add_argument('--pipelined',action='store_true',help='use the pipelined plate reading')
+    parser.add_argument('--emulator',action='store_true',help='drive the serial Microcontroller class through the microcontroller emulator instead of Microcontroller_Simulation (posix only; the emulator and the serial reader thread share the cpu with the simulated cameras, so timings include their load)')
+    parser.add_argument('--timeout',type=float,default=300,help='timeout for a single acquisition in s')
+    parser.add_argument('--output',default='benchmark_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.json')
+    parser.add_argument('--keep_files',action='store_true',help='keep the images written by the benchmarks')
+    parser.add_argument('--verbose',action='store_true',help='show the output of the controllers')
+    parser.add_argument('--no_timing',action='store_true',help='disable the instrumentation spans, to measure their overhead')
+    parser.add_argument('--trace',action='store_true',help='also save a chrome trace of each benchmark next to the output')
+    args = parser.parse_args()
+
+    benchmarks = [name.strip() for name in args.benchmarks.split(',') if name.strip()]
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark ' + name)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    path = tempfile.mkdtemp(prefix='octopi_benchmark_')
+    report = {
+        'timestamp':datetime.now().isoformat(),
+        'git_commit':get_git_commit(),
+        'platform':{'system':platform.platform(),'machine':platform.machine(),'processor':platform.processor(),'python':platform.python_version(),
+                    'cpu_count':os.cpu_count(),'numpy':np.__version__,'opencv':cv2.__version__,'qt_api':qtpy.API_NAME},
+        'args':vars(args),
+        'results':{}
+    }
+    try:
+        for name in benchmarks:
+            benchmark_path = os.path.join(path,name)
+            os.mkdir(benchmark_path)
+            output = io.StringIO()
+            instrumentation.set_enabled(not args.no_timing)
+            instrumentation.reset()
+            try:
+                # the controllers print on every frame; printing still costs time, it just does not reach the terminal
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+                    result = globals()['benchmark_' + name](args,benchmark_path)
+            except Exception as e:
+                result = {'error':repr(e),'traceback':traceback.format_exc()}
+            result['stdout_lines'] = output.getvalue().count('\n')
+            if not args.no_timing:
+                # where the time went, from the spans in the controllers
+                result['timing'] = instrumentation.get_summary()
+                result['counters'] = instrumentation.get_counters()
+                if args.trace:
+                    instrumentation.export_chrome_trace(os.path.splitext(args.output)[0] + '_' + name + '_trace.json')
+            report['results'][name] = result
+            print_summary(name,result)
+    finally:
+        if args.keep_files:
+            print('images kept in ' + path)
+        else:
+            shutil.rmtree(path,ignore_errors=True)
+
+    with open(args.output,'w') as f:
+        json.dump(report,f,indent=2,default=lambda o: o.tolist() if isinstance(o,np.ndarray) else float(o))
+    print('results saved to ' + args.output)
+    failed = [name for name, result in report['results'].items() if 'error' in result or result.get('completed') is False]
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
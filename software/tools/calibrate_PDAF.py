@@ -0,0 +1,187 @@
+# offline calibration of the two-camera PDAF shift-to-defocus relation
+# input: folders written by TwoCamerasPDAFCalibrationController (camera1_<k><config>.bmp and camera2_<k><config>.bmp for each z step k)
+#        or pairs of .npy stacks (camera1.npy, camera2.npy, shape (NZ,H,W)) that are memory-mapped instead of decoded
+# output: a json file that PDAFController.load_calibration() reads
+# usage: python3 calibrate_PDAF.py <folder> [<folder> ...] --dz 1.5 --output pdaf_calibration.json
+
+import os
+import re
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+from scipy import stats
+
+IMAGE_EXTENSIONS = ('.bmp','.png','.tif','.tiff','.jpg')
+
+def find_image_pairs(path,config_name=None):
+    # returns {k: (camera1 file, camera2 file)}; a folder with several configurations needs config_name
+    pattern = re.compile(r'^camera([12])_(\d+)(.*)$')
+    files = {1:{},2:{}}
+    configs = set()
+    for filename in os.listdir(path):
+        name, ext = os.path.splitext(filename)
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        match = pattern.match(name)
+        if match is None:
+            continue
+        camera, k, config = int(match.group(1)), int(match.group(2)), match.group(3)
+        if config_name is not None and config != config_name:
+            continue
+        configs.add(config)
+        files[camera][k] = os.path.join(path,filename)
+    if len(configs) > 1:
+        raise ValueError(path + ' holds images of several configurations (' + ', '.join(sorted(configs)) + '), choose one with --config')
+    ks = sorted(set(files[1]).intersection(files[2]))
+    return {k:(files[1][k],files[2][k]) for k in ks}
+
+def load_stacks(path,config_name=None):
+    # .npy stacks are memory-mapped, images are decoded once into a preallocated stack
+    if os.path.exists(os.path.join(path,'camera1.npy')) and os.path.exists(os.path.join(path,'camera2.npy')):
+        stack1 = np.load(os.path.join(path,'camera1.npy'),mmap_mode='r')
+        stack2 = np.load(os.path.join(path,'camera2.npy'),mmap_mode='r')
+        return np.arange(stack1.shape[0]), stack1, stack2
+    pairs = find_image_pairs(path,config_name)
+    if len(pairs) == 0:
+        raise ValueError('no camera1/camera2 image pairs found in ' + path)
+    ks = np.array(sorted(pairs))
+    stack1 = None
+    for i,k in enumerate(ks):
+        for stack_index,filename in enumerate(pairs[k]):
+            image = cv2.imread(filename,cv2.IMREAD_UNCHANGED)
+            if image.ndim == 3:
+                image = cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
+            if stack1 is None:
+                stack1 = np.empty((len(ks),)+image.shape,dtype=image.dtype)
+                stack2 = np.empty((len(ks),)+image.shape,dtype=image.dtype)
+            (stack1 if stack_index == 0 else stack2)[i] = image
+    return ks, stack1, stack2
+
+def crop_stack(stack,crop_width,crop_height):
+    height, width = stack.shape[1:3]
+    crop_width = min(crop_width,width) if crop_width else width
+    crop_height = min(crop_height,height) if crop_height else height
+    top = (height - crop_height)//2
+    left = (width - crop_width)//2
+    return stack[:,top:top+crop_height,left:left+crop_width]
+
+def batched_phase_correlation(stack1,stack2):
+    # all pairwise shifts in one batched FFT; same sign convention as skimage.registration.phase_cross_correlation(image1,image2)
+    n, height, width = stack1.shape
+    window = np.outer(np.hanning(height),np.hanning(width)).astype(np.float32)
+    a = stack1.astype(np.float32)
+    b = stack2.astype(np.float32)
+    a -= a.mean(axis=(1,2),keepdims=True)
+    b -= b.mean(axis=(1,2),keepdims=True)
+    a *= window
+    b *= window
+    cross_power = np.fft.rfft2(a)
+    cross_power *= np.conj(np.fft.rfft2(b))
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power,s=(height,width))
+    # integer peak
+    peak = np.argmax(correlation.reshape(n,-1),axis=1)
+    row, col = np.unravel_index(peak,(height,width))
+    index = np.arange(n)
+    # sub-pixel refinement with a parabola through the peak and its (wrapped) neighbours
+    def refine(c_minus,c_0,c_plus):
+        denominator = c_minus - 2*c_0 + c_plus
+        with np.errstate(divide='ignore',invalid='ignore'):
+            offset = np.where(denominator != 0,0.5*(c_minus - c_plus)/denominator,0)
+        return np.clip(offset,-0.5,0.5)
+    c0 = correlation[index,row,col]
+    row_offset = refine(correlation[index,(row-1)%height,col],c0,correlation[index,(row+1)%height,col])
+    col_offset = refine(correlation[index,row,(col-1)%width],c0,correlation[index,row,(col+1)%width])
+    shifts = np.stack((row + row_offset,col + col_offset),axis=1)
+    # wrap to [-N/2, N/2)
+    shifts[:,0] = np.where(shifts[:,0] > height/2,shifts[:,0] - height,shifts[:,0])
+    shifts[:,1] = np.where(shifts[:,1] > width/2,shifts[:,1] - width,shifts[:,1])
+    return shifts
+
+def focus_measures(stack):
+    return np.array([np.mean(np.square(cv2.Laplacian(image,cv2.CV_32F))) for image in stack])
+
+def process_stack(path,config_name=None,crop_width=None,crop_height=None,flip='Horizontal',batch_size=16):
+    ks, stack1, stack2 = load_stacks(path,config_name)
+    stack1 = crop_stack(stack1,crop_width,crop_height)
+    stack2 = crop_stack(stack2,crop_width,crop_height)
+    # same orientation fix as PDAFController.register_image_from_camera_2
+    if flip == 'Horizontal':
+        stack2 = stack2[:,:,::-1]
+    elif flip == 'Vertical':
+        stack2 = stack2[:,::-1,:]
+    # batches bound the memory used by the float32/complex intermediates
+    shifts = np.concatenate([batched_phase_correlation(stack1[i:i+batch_size],stack2[i:i+batch_size]) for i in range(0,len(ks),batch_size)])
+    return {'path':path,'k':ks.tolist(),'shifts':shifts.tolist(),'focus_measure':focus_measures(stack1).tolist()}
+
+def fit_defocus_vs_shift(shift,z,confidence=0.95):
+    # z = intercept + coefficient*shift, with t-based confidence intervals
+    n = len(shift)
+    if n < 3:
+        raise ValueError('at least 3 z positions are needed for the fit')
+    result = stats.linregress(shift,z)
+    t = stats.t.ppf(0.5 + confidence/2,n-2)
+    intercept_stderr = result.stderr*np.sqrt(np.mean(np.square(shift)))
+    residuals = z - (result.intercept + result.slope*shift)
+    return {
+        'coefficient':result.slope,
+        'coefficient_ci':[result.slope - t*result.stderr,result.slope + t*result.stderr],
+        'intercept':result.intercept,
+        'intercept_ci':[result.intercept - t*intercept_stderr,result.intercept + t*intercept_stderr],
+        'r_squared':result.rvalue**2,
+        'residual_rms_um':float(np.sqrt(np.mean(np.square(residuals)))),
+        'n_points':n,
+        'confidence':confidence
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='fit the PDAF shift-to-defocus coefficient from two-camera z-stacks')
+    parser.add_argument('paths',nargs='+',help='folders containing the camera1_/camera2_ z-stack images')
+    parser.add_argument('--dz',type=float,required=True,help='z step between images in um')
+    parser.add_argument('--config',default=None,help='only use images of this configuration name (required when a folder holds several)')
+    parser.add_argument('--crop_width',type=int,default=None)
+    parser.add_argument('--crop_height',type=int,default=None)
+    parser.add_argument('--axis',type=int,default=0,help='shift axis used by PDAFController (0: rows, 1: columns)')
+    parser.add_argument('--flip',default='Horizontal',choices=['Horizontal','Vertical','None'])
+    parser.add_argument('--workers',type=int,default=None)
+    parser.add_argument('--output',default='pdaf_calibration.json')
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(process_stack,path,args.config,args.crop_width,args.crop_height,args.flip) for path in args.paths]
+        results = [future.result() for future in futures]
+
+    # z relative to the sharpest camera1 image of each stack, so stacks taken at different start positions can be pooled
+    shift_all = []
+    z_all = []
+    for result in results:
+        k = np.array(result['k'])
+        shift = np.array(result['shifts'])[:,args.axis]
+        z = (k - k[np.argmax(result['focus_measure'])])*args.dz
+        result['z_um'] = z.tolist()
+        shift_all.append(shift)
+        z_all.append(z)
+        print(result['path'] + ': shift range ' + str(round(shift.min(),2)) + ' to ' + str(round(shift.max(),2)) + ' pixels')
+    fit = fit_defocus_vs_shift(np.concatenate(shift_all),np.concatenate(z_all))
+
+    # defocus = coefficient*(shift - shift_offset), shift_offset being the shift at best focus
+    calibration = {
+        'coefficient_shift2defocus':fit['coefficient'],
+        'coefficient_shift2defocus_ci':fit['coefficient_ci'],
+        'shift_offset':-fit['intercept']/fit['coefficient'],
+        'shift_axis':args.axis,
+        'flip':args.flip,
+        'unit':'um',
+        'fit':fit,
+        'stacks':results
+    }
+    with open(args.output,'w') as f:
+        json.dump(calibration,f,indent=2)
+    print('coefficient_shift2defocus: ' + str(round(fit['coefficient'],4)) + ' um/pixel (' + str(int(fit['confidence']*100)) + '% CI ' + str([round(float(c),4) for c in fit['coefficient_ci']]) + '), r^2 = ' + str(round(fit['r_squared'],4)))
+    print('calibration saved to ' + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# runs acquisition plans without the gui, one after the other
+# a plan is a json file with the arguments of control.microscope.AcquisitionPlan, e.g.
+#   {"NX":3,"NY":3,"deltaX_mm":0.9,"deltaY_mm":0.9,"configurations":["BF LED matrix full"],"base_path":"/data","experiment_ID":"slide 1"}
+# usage: python3 tools/run_acquisition.py plan1.json [plan2.json ...] --configurations ~/configurations_default.xml [--simulation]
+
+import os
+import sys
+import json
+import argparse
+
+SOFTWARE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,SOFTWARE_DIR)
+
+from control._def import *
+from control.microscope import Microscope, AcquisitionPlan, load_configurations
+import control.microcontroller as microcontroller
+
+def main():
+    parser = argparse.ArgumentParser(description='run acquisition plans headless')
+    parser.add_argument('plans',nargs='+',help='json files with the AcquisitionPlan arguments')
+    parser.add_argument('--configurations',required=True,help='configuration xml file, as written by ConfigurationManager')
+    parser.add_argument('--channel',default='Widefield',help='channel of the camera')
+    parser.add_argument('--simulation',action='store_true',help='use the simulated camera and microcontroller')
+    parser.add_argument('--port',default=None,help='serial port of the microcontroller (default: auto-detect)')
+    args = parser.parse_args()
+
+    import control.camera as camera
+    if args.simulation:
+        cam = camera.Camera_Simulation(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+        mcu = microcontroller.Microcontroller_Simulation()
+    else:
+        cam = camera.Camera(rotate_image_angle=ROTATE_IMAGE_ANGLE,flip_image=FLIP_IMAGE)
+        mcu = microcontroller.Microcontroller(port=args.port)
+    mcu.configure_actuators()
+    cam.open()
+    cam.set_software_triggered_acquisition()
+    cam.start_streaming()
+
+    microscope = Microscope({args.channel:cam},mcu,configurations=load_configurations(args.configurations,args.channel))
+    if args.simulation:
+        cam.set_position_source(microscope.stage.get_pos_mm)
+    try:
+        futures = []
+        for filename in args.plans:
+            with open(filename) as f:
+                futures.append((filename,microscope.submit(AcquisitionPlan(**json.load(f)))))
+        for filename, future in futures:
+            result = future.result()
+            print(filename + ': ' + str(result['images_saved']) + ' images, ' + str(result['fov']) + ' fov in ' + str(round(result['elapsed_s'],1)) + ' s' + (' (aborted)' if result['aborted'] else '') + ' -> ' + str(result['experiment_path']))
+    except KeyboardInterrupt:
+        microscope.abort()
+    finally:
+        microscope.close()
+        cam.stop_streaming()
+        cam.close()
+        mcu.close()
+
+if __name__ == '__main__':
+    main()